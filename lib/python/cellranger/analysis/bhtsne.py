@@ -60,7 +60,7 @@ def run_tsne(transformed_pca_matrix, name='TSNE', key='TSNE', tsne_dims=None, in
 
     return TSNE(transformed_tsne_matrix, name=name, key=key)
 
-def save_tsne_csv(tsne, matrix, base_dir):
+def save_tsne_csv(tsne, barcodes, base_dir):
     """Save a TSNE object to CSV"""
     # Preserve backward compatibility with pre-3.0 CSV files
     #   where the CSV directory was named "2_components" and the HDF5 dataset was named "_2"
@@ -72,7 +72,7 @@ def save_tsne_csv(tsne, matrix, base_dir):
     matrix_fn = os.path.join(tsne_dir, 'projection.csv')
     n_tsne_components = tsne.transformed_tsne_matrix.shape[1]
     matrix_header = ['Barcode'] + ['TSNE-%d' % (i+1) for i in xrange(n_tsne_components)]
-    analysis_io.save_matrix_csv(matrix_fn, tsne.transformed_tsne_matrix, matrix_header, matrix.bcs)
+    analysis_io.save_matrix_csv(matrix_fn, tsne.transformed_tsne_matrix, matrix_header, barcodes)
 
 def save_tsne_h5(tsne, f):
     """Save a TSNE object to HDF5"""
@@ -47,12 +47,6 @@ def compute_sseq_params(x, zeta_quantile=SSEQ_ZETA_QUANTILE):
     Returns:
       A dictionary containing the sSeq parameters and some diagnostic info.
     """
-    # Number of cells
-    N = x.shape[1]
-
-    # Number of features
-    G = x.shape[0]
-
     # Estimate size factors and normalize the matrix for quick mean/var calcs
     size_factors = estimate_size_factors(x)
     # Cast to float to prevent truncation of 1 -> 0 for size factors < 1
@@ -62,8 +56,27 @@ def compute_sseq_params(x, zeta_quantile=SSEQ_ZETA_QUANTILE):
     # Estimate featurewise mean, variance, and dispersion by the method of moments
     # assuming that each feature follows a negative-binomial distribution.
     mean_g = np.squeeze(np.asarray(x_norm.mean(axis=1, dtype=np.float64)))
-    # V[X] = E[X^2] - E[X]^2
     mean_sq_g = np.squeeze(np.asarray(x_norm.multiply(x_norm).mean(axis=1, dtype=np.float64)))
+
+    return compute_sseq_params_from_moments(size_factors, mean_g, mean_sq_g, zeta_quantile)
+
+def compute_sseq_params_from_moments(size_factors, mean_g, mean_sq_g, zeta_quantile=SSEQ_ZETA_QUANTILE):
+    """ Compute the sSeq parameters from featurewise moments of the normalized counts.
+    Args:
+      size_factors (np.array(float)) - Size factor of each cell
+      mean_g (np.array(float)) - Featurewise mean of the size-factor normalized counts
+      mean_sq_g (np.array(float)) - Featurewise mean of the squared normalized counts
+      zeta_quantile (float) - See compute_sseq_params
+    Returns:
+      A dictionary containing the sSeq parameters and some diagnostic info.
+    """
+    # Number of cells
+    N = len(size_factors)
+
+    # Number of features
+    G = len(mean_g)
+
+    # V[X] = E[X^2] - E[X]^2
     var_g = mean_sq_g - np.square(mean_g)
 
     # Method of moments estimate of feature-wise dispersion (phi)
@@ -229,19 +242,36 @@ def sseq_differential_expression(x, cond_a, cond_b, sseq_params, big_count=900):
     x_a = x[:, cond_a]
     x_b = x[:, cond_b]
 
-    # Number of features
-    G = x.shape[0]
-
     # Size factors
     size_factor_a = np.sum(sseq_params['size_factors'][cond_a])
     size_factor_b = np.sum(sseq_params['size_factors'][cond_b])
 
-    # Compute p-value for each feature
-    p_values = np.ones(G)
-
     feature_sums_a = np.squeeze(np.asarray(x_a.sum(axis=1)))
     feature_sums_b = np.squeeze(np.asarray(x_b.sum(axis=1)))
 
+    return sseq_differential_expression_from_sums(feature_sums_a, feature_sums_b,
+                                                  size_factor_a, size_factor_b,
+                                                  sseq_params, big_count)
+
+def sseq_differential_expression_from_sums(feature_sums_a, feature_sums_b,
+                                           size_factor_a, size_factor_b,
+                                           sseq_params, big_count=900):
+    """ Run sSeq pairwise differential expression test on per-group totals.
+      Args:
+        feature_sums_a (np.array(int)): Total count of each feature in group A
+        feature_sums_b (np.array(int)): Total count of each feature in group B
+        size_factor_a (float): Sum of size factors for group A
+        size_factor_b (float): Sum of size factors for group B
+        sseq_params (dict): Precomputed global parameters
+        big_count (int): Use asymptotic approximation if both counts > this
+      Returns:
+        A pd.DataFrame with DE results for group A relative to group B """
+    # Number of features
+    G = len(feature_sums_a)
+
+    # Compute p-value for each feature
+    p_values = np.ones(G)
+
     big = tk_stats.numpy_logical_and_list([sseq_params['use_g'], feature_sums_a > big_count, feature_sums_b > big_count])
     small = np.logical_and(sseq_params['use_g'], np.logical_not(big))
 
@@ -3,11 +3,13 @@
 # Copyright (c) 2016 10X Genomics, Inc. All rights reserved.
 #
 import csv
+import h5py
 import numpy as np
 import os
 import six
 import tables
 import cellranger.h5_constants as h5_constants
+import cellranger.io as cr_io
 
 # Version for HDF5 format
 VERSION_KEY = 'version'
@@ -43,15 +45,70 @@ def save_h5(f, group, key, namedtuple):
         else:
             ds = f.create_array(subgroup, field, arr)
 
-def save_matrix_csv(filename, arr, header, prefixes):
-    with open(filename, 'wb') as f:
+# Number of rows to format at a time when writing a matrix CSV
+CSV_BLOCK_ROWS = 10000
+
+class _CsvLineBuffer(object):
+    """ File-like object that collects the lines written by a csv.writer """
+    def __init__(self):
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(line)
+
+def _get_csv_row(x):
+    return list(x) if hasattr(x, '__iter__') else [x]
+
+def _format_csv_rows(block, prefixes):
+    """ Format rows of a matrix CSV, one per element of block, each preceded by its prefix(es).
+        Numeric numpy blocks are converted to strings in one call; numpy's float64 to string
+        conversion gives the same shortest repr that csv.writer uses. """
+    buf = _CsvLineBuffer()
+    writer = csv.writer(buf, lineterminator='\n')
+
+    prefix_rows = [_get_csv_row(p) for p in prefixes]
+    vectorize = type(block) is np.ndarray and \
+                block.dtype.kind in 'biuf' and block.dtype.itemsize <= 8 and \
+                (block.ndim == 1 or (block.ndim == 2 and block.shape[1] > 0)) and \
+                all(len(row) > 0 for row in prefix_rows)
+
+    if not vectorize:
+        for prefix_row, v in zip(prefix_rows, block):
+            writer.writerow(prefix_row + _get_csv_row(v))
+        return buf.lines
+
+    # Let csv quote the prefixes; the trailing empty field gives the separating comma
+    writer.writerows(row + [''] for row in prefix_rows)
+
+    values = block.astype(str)
+    if values.ndim == 1:
+        values = values.tolist()
+    else:
+        values = [','.join(row) for row in values.tolist()]
+
+    return [prefix[:-1] + value + '\n' for prefix, value in zip(buf.lines, values)]
+
+def save_matrix_csv(filename, arr, header, prefixes, block_rows=CSV_BLOCK_ROWS):
+    """ Save a matrix to CSV. Each element of arr (a row, by default) is written after its prefix(es).
+        Output is gzipped if filename ends with .gz.
+        Args: arr - np.ndarray, or any array-like that can be sliced by rows (e.g. an HDF5 dataset)
+              header (list) - Header row
+              prefixes (list) - Value or tuple of values to write before each row """
+    blocks = (arr[start:(start + block_rows)] for start in xrange(0, len(arr), block_rows))
+    save_matrix_csv_blocks(filename, blocks, header, prefixes)
+
+def save_matrix_csv_blocks(filename, blocks, header, prefixes):
+    """ Save a matrix to CSV from an iterable of row blocks, e.g. for arrays that don't fit in memory.
+        Output is identical to save_matrix_csv on the concatenated blocks. """
+    with cr_io.open_maybe_gzip(filename, 'w') as f:
         writer = csv.writer(f, lineterminator='\n')
         writer.writerow(header)
-        # Iterate over the given arr, default iteration is by-row
-        for i, v in enumerate(arr):
-            row = list(prefixes[i]) if hasattr(prefixes[i], '__iter__') else [prefixes[i]]
-            row += list(v) if hasattr(v, '__iter__') else [v]
-            writer.writerow(row)
+
+        start = 0
+        for block in blocks:
+            end = start + len(block)
+            f.write(''.join(_format_csv_rows(block, prefixes[start:end])))
+            start = end
 
 def load_h5_namedtuple(group, namedtuple):
     """ Load a single namedtuple from an h5 group """
@@ -71,30 +128,41 @@ def load_h5_namedtuple(group, namedtuple):
 
 def load_h5_iter(group, namedtuple):
     for subgroup in group:
+        # Follow links written by combine_h5_files(link=True)
+        if isinstance(subgroup, tables.link.ExternalLink):
+            subgroup = subgroup()
         yield subgroup._v_name[1:], load_h5_namedtuple(subgroup, namedtuple)
 
 def h5_path(base_path):
     return os.path.join(base_path, "analysis.h5")
 
-def _combine_h5_group(fins, fout, group):
-    group_out = fout.create_group(fout.root, group)
-    for fin in fins:
-        # Skip non-existent input groups
-        if group not in fin.root:
-            continue
-
-        group_in = fin.root._v_groups[group]
-
-        # NOTE - this throws an exception if a child group already exists
-        fin.copy_children(group_in, group_out, recursive=True)
-
-def combine_h5_files(in_files, out_file, groups):
-    fins = [tables.open_file(filename, 'r') for filename in in_files]
+def combine_h5_files(in_files, out_file, groups, link=False):
+    """ Combine top-level groups of analysis h5 files into one file.
+        Children of each group are copied with HDF5 object copy, so compressed
+        datasets are copied as-is instead of being decoded and re-encoded.
+        Args: link (bool) - Write external links to the input files instead of copying.
+                            The input files must then be kept alongside the output. """
+    # Create the output groups with PyTables so they carry its metadata
     with tables.open_file(out_file, 'w') as fout:
         for group in groups:
-            _combine_h5_group(fins, fout, group)
-    for fin in fins:
-        fin.close()
+            fout.create_group(fout.root, group)
+
+    with h5py.File(out_file, 'a') as fout:
+        for filename in in_files:
+            with h5py.File(filename, 'r') as fin:
+                for group in groups:
+                    # Skip non-existent input groups
+                    if group not in fin:
+                        continue
+
+                    group_out = fout[group]
+                    for name in fin[group]:
+                        # NOTE - this throws an exception if a child already exists
+                        if link:
+                            group_out[name] = h5py.ExternalLink(os.path.abspath(filename),
+                                                                '/%s/%s' % (group, name))
+                        else:
+                            fin.copy(fin[group][name], group_out, name=name)
 
 def open_h5_for_writing(filename):
     filters = tables.Filters(complevel = h5_constants.H5_COMPRESSION_LEVEL)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2018 10X Genomics, Inc. All rights reserved.
+#
+# Merge similar clusters by differential expression of sibling clusters
+
+import numpy as np
+import scipy.sparse as sp_sparse
+from scipy.cluster.hierarchy import linkage
+import sys
+from multiprocessing import Pool
+from sklearn.utils import sparsefuncs
+import cellranger.analysis.diffexp as cr_diffexp
+
+# Adjusted p-value threshold for calling genes DE
+MERGE_CLUSTERS_DE_ADJ_P_THRESHOLD = 0.05
+
+class ClusterStats(object):
+    """ Sufficient statistics of a cluster for the sSeq test of a pair of clusters """
+    def __init__(self, cluster_id, cells, medoid, feature_sums, norm_sums, norm_sq_sums):
+        # Unique id; a merged cluster gets a new id
+        self.cluster_id = cluster_id
+        # Sorted indices of the member cells
+        self.cells = cells
+        # Median of the members in PCA-space
+        self.medoid = medoid
+        # Per-feature sums of the counts (x), of x/c and of (x/c)^2 where c is the cell's total count
+        self.feature_sums = feature_sums
+        self.norm_sums = norm_sums
+        self.norm_sq_sums = norm_sq_sums
+
+def count_de_genes(feature_sums_a, feature_sums_b, norm_sums, norm_sq_sums, counts_per_cell, num_cells_a):
+    """ Count the DE genes between two groups of cells.
+        Equivalent to running compute_sseq_params on the cells of both groups
+        followed by sseq_differential_expression of group A vs group B.
+    Args:
+      feature_sums_a, feature_sums_b (np.array(int)): Per-feature count totals of each group
+      norm_sums, norm_sq_sums (np.array(float)): Per-feature sums of x/c and (x/c)^2 over both groups
+      counts_per_cell (np.array(int)): Total count of each cell, group A followed by group B
+      num_cells_a (int): Number of cells in group A
+    Returns:
+      Number of features with an adjusted p-value below the threshold """
+    median_count = np.median(counts_per_cell)
+    size_factors = counts_per_cell.astype(np.float64) / median_count
+
+    # x/s = x*m/c where s = c/m is the size factor and m the median count
+    num_cells = float(len(counts_per_cell))
+    mean_g = norm_sums * (median_count / num_cells)
+    mean_sq_g = norm_sq_sums * (median_count * median_count / num_cells)
+    params = cr_diffexp.compute_sseq_params_from_moments(size_factors, mean_g, mean_sq_g)
+
+    de_result = cr_diffexp.sseq_differential_expression_from_sums(feature_sums_a, feature_sums_b,
+                                                                  np.sum(size_factors[:num_cells_a]),
+                                                                  np.sum(size_factors[num_cells_a:]),
+                                                                  params)
+    return np.sum(de_result.adjusted_p_value < MERGE_CLUSTERS_DE_ADJ_P_THRESHOLD)
+
+def _count_de_genes_star(args):
+    return count_de_genes(*args)
+
+class ClusterMerger(object):
+    """ Repeatedly merge sibling clusters in a hierarchical clustering of the
+        cluster medoids that have no DE genes between them.
+
+        Per-cluster sums are combined on merge instead of re-slicing the matrix,
+        and candidate pairs are tested in parallel. Merge decisions are the same
+        as testing the pairs one at a time in linkage order. """
+    def __init__(self, matrix, pca, labels):
+        """ Args:
+              matrix - Sparse matrix (csc) of counts (feature x cell)
+              pca (np.ndarray) - PCA coordinates (cell x component)
+              labels (np.array(int)) - 0-based cluster labels """
+        self.pca = pca
+        self.counts_per_cell = np.squeeze(np.asarray(matrix.sum(axis=0)))
+
+        # Scale each cell by its total count
+        norm_matrix = sp_sparse.csc_matrix(matrix, dtype=np.float64, copy=True)
+        with np.errstate(divide='ignore'):
+            sparsefuncs.inplace_column_scale(norm_matrix, 1.0 / self.counts_per_cell)
+        norm_sq_matrix = norm_matrix.multiply(norm_matrix).tocsc()
+
+        self.clusters = []
+        for label in xrange(1 + np.max(labels)):
+            cells = np.flatnonzero(labels == label)
+            self.clusters.append(ClusterStats(cluster_id=label,
+                                              cells=cells,
+                                              medoid=np.median(pca[cells, :], axis=0),
+                                              feature_sums=self._sum_columns(matrix, cells),
+                                              norm_sums=self._sum_columns(norm_matrix, cells),
+                                              norm_sq_sums=self._sum_columns(norm_sq_matrix, cells)))
+        self.next_cluster_id = len(self.clusters)
+
+        # Number of DE genes for each tested pair of cluster ids
+        self.num_de_genes = {}
+
+    @staticmethod
+    def _sum_columns(matrix, cols):
+        return np.squeeze(np.asarray(matrix[:, cols].sum(axis=1)))
+
+    def get_labels(self, num_cells):
+        """ Returns the 0-based cluster label of each cell """
+        labels = np.zeros(num_cells, dtype=int)
+        for label, cluster in enumerate(self.clusters):
+            labels[cluster.cells] = label
+        return labels
+
+    def _get_test_args(self, leaf0, leaf1):
+        c0, c1 = self.clusters[leaf0], self.clusters[leaf1]
+        return (c0.feature_sums, c1.feature_sums,
+                c0.norm_sums + c1.norm_sums, c0.norm_sq_sums + c1.norm_sq_sums,
+                self.counts_per_cell[np.concatenate((c0.cells, c1.cells))],
+                len(c0.cells))
+
+    def _get_candidates(self):
+        """ Returns the pairs of sibling leaves in the linkage of the cluster medoids """
+        medoids = np.vstack([cluster.medoid for cluster in self.clusters])
+        hc = linkage(medoids, 'complete')
+        max_label = len(self.clusters) - 1
+
+        candidates = []
+        for step in xrange(hc.shape[0]):
+            if hc[step,0] <= max_label and hc[step,1] <= max_label:
+                candidates.append((int(hc[step,0]), int(hc[step,1])))
+        return candidates
+
+    def _merge(self, leaf0, leaf1):
+        """ Merge leaf1 into leaf0 and shift the labels above leaf1 down """
+        c0, c1 = self.clusters[leaf0], self.clusters[leaf1]
+        cells = np.sort(np.concatenate((c0.cells, c1.cells)))
+        self.clusters[leaf0] = ClusterStats(cluster_id=self.next_cluster_id,
+                                            cells=cells,
+                                            medoid=np.median(self.pca[cells, :], axis=0),
+                                            feature_sums=c0.feature_sums + c1.feature_sums,
+                                            norm_sums=c0.norm_sums + c1.norm_sums,
+                                            norm_sq_sums=c0.norm_sq_sums + c1.norm_sq_sums)
+        self.next_cluster_id += 1
+        del self.clusters[leaf1]
+
+    def _find_merge(self, candidates, pool, batch_size):
+        """ Returns the first candidate pair with no DE genes, or None.
+            Untested pairs are tested batch_size at a time, in linkage order. """
+        for start in xrange(0, len(candidates), batch_size):
+            batch = candidates[start:(start + batch_size)]
+
+            untested = []
+            for leaf0, leaf1 in batch:
+                key = frozenset((self.clusters[leaf0].cluster_id, self.clusters[leaf1].cluster_id))
+                if key not in self.num_de_genes:
+                    print 'Comparing clusters (%d,%d)' % (1+leaf0,1+leaf1)
+                    untested.append((key, self._get_test_args(leaf0, leaf1)))
+
+            test_args = [args for _, args in untested]
+            if pool is None:
+                results = map(_count_de_genes_star, test_args)
+            else:
+                results = pool.map(_count_de_genes_star, test_args, chunksize=1)
+            for (key, _), n_de_genes in zip(untested, results):
+                self.num_de_genes[key] = n_de_genes
+
+            for leaf0, leaf1 in batch:
+                key = frozenset((self.clusters[leaf0].cluster_id, self.clusters[leaf1].cluster_id))
+                if self.num_de_genes[key] == 0:
+                    return leaf0, leaf1
+        return None
+
+    def run(self, threads=1):
+        """ Merge clusters until no sibling pair is left without DE genes """
+        pool = Pool(threads) if threads > 1 else None
+        try:
+            while len(self.clusters) > 1:
+                print np.array([len(cluster.cells) for cluster in self.clusters])
+                sys.stdout.flush()
+
+                to_merge = self._find_merge(self._get_candidates(), pool, max(1, threads))
+                if to_merge is None:
+                    break
+
+                leaf0, leaf1 = to_merge
+                print 'Found 0 DE genes. Merging clusters (%d,%d)' % (1+leaf0,1+leaf1)
+                self._merge(leaf0, leaf1)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
@@ -220,3 +220,10 @@ def load_pca_from_h5(filename):
         # Just take the first PCA object, assuming we never have multiple
         for _, pca in analysis_io.load_h5_iter(group, PCA):
             return pca
+
+def load_pca_shape_from_h5(filename):
+    """ Load just the shape of the transformed PCA matrix (barcodes x components) from an analysis h5 """
+    with tables.open_file(filename, 'r') as f:
+        group = f.root._v_groups[analysis_constants.ANALYSIS_H5_PCA_GROUP]
+        for subgroup in group:
+            return subgroup.transformed_pca_matrix.shape
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2018 10X Genomics, Inc. All rights reserved.
+#
+# K-mer indexes of a reference, used by DETECT_CHEMISTRY to map reads.
+#
+# An index is stored either in the reference folder itself (built by mkref/mkvdjref)
+# or in a shared cache directory, along with the reference hashes it was built from.
+# It is reused as long as those match the hashes in the reference's reference.json.
+
+import json
+import os
+import shutil
+import tempfile
+import tenkit.log_subprocess as tk_subproc
+import cellranger.constants as cr_constants
+import cellranger.vdj.reference as vdj_ref
+
+KMER_INDEX_DIR = 'chemistry'
+KMER_INDEX_FILE = 'kmers.idx'
+KMER_INDEX_METADATA_FILE = 'kmers.json'
+
+# Bump this if the index parameters or the detect_chemistry index format change
+KMER_INDEX_VERSION = 1
+KMER_INDEX_VERSION_KEY = 'kmer_index_version'
+
+# Environment variable naming a directory shared between runs to cache indexes in
+KMER_INDEX_CACHE_ENV = 'CELLRANGER_CHEMISTRY_INDEX_CACHE'
+
+# Target size of the transcriptome FASTA per k-mer step; see build_transcriptome_kmer_index
+BASES_PER_KMER_STEP = 400000000
+
+def run(args):
+    """ Run tk_subproc.check_call and print command """
+    print ' '.join(args)
+    tk_subproc.check_call(args)
+
+def get_index_metadata(reference_path):
+    """ Returns the dict identifying an index of this reference,
+        or None if the reference.json has no FASTA hash (e.g. older references) """
+    metadata_path = os.path.join(reference_path, cr_constants.REFERENCE_METADATA_FILE)
+    if not os.path.exists(metadata_path):
+        return None
+
+    with open(metadata_path) as f:
+        ref_metadata = json.load(f)
+
+    if not ref_metadata.get(cr_constants.REFERENCE_FASTA_HASH_KEY):
+        return None
+
+    return {
+        KMER_INDEX_VERSION_KEY: KMER_INDEX_VERSION,
+        cr_constants.REFERENCE_FASTA_HASH_KEY: ref_metadata.get(cr_constants.REFERENCE_FASTA_HASH_KEY),
+        cr_constants.REFERENCE_GTF_HASH_KEY: ref_metadata.get(cr_constants.REFERENCE_GTF_HASH_KEY),
+    }
+
+def get_cache_dir(index_metadata):
+    """ Returns the directory for this index in the shared cache, or None if no cache is configured """
+    cache_path = os.environ.get(KMER_INDEX_CACHE_ENV)
+    if not cache_path or index_metadata is None:
+        return None
+
+    key = '_'.join([str(index_metadata[cr_constants.REFERENCE_FASTA_HASH_KEY]),
+                    str(index_metadata[cr_constants.REFERENCE_GTF_HASH_KEY]),
+                    'v%d' % KMER_INDEX_VERSION])
+    return os.path.join(cache_path, key)
+
+def is_valid_index_dir(index_dir, index_metadata):
+    """ True if index_dir holds an index built from a reference with these hashes """
+    if index_metadata is None:
+        return False
+
+    idx_path = os.path.join(index_dir, KMER_INDEX_FILE)
+    metadata_path = os.path.join(index_dir, KMER_INDEX_METADATA_FILE)
+    if not (os.path.exists(idx_path) and os.path.exists(metadata_path)):
+        return False
+
+    try:
+        with open(metadata_path) as f:
+            return json.load(f) == index_metadata
+    except ValueError:
+        return False
+
+def find_kmer_index(reference_path):
+    """ Returns the path of a valid index for this reference (in the reference or the cache), or None """
+    index_metadata = get_index_metadata(reference_path)
+    for index_dir in [os.path.join(reference_path, KMER_INDEX_DIR), get_cache_dir(index_metadata)]:
+        if index_dir is not None and is_valid_index_dir(index_dir, index_metadata):
+            return os.path.join(index_dir, KMER_INDEX_FILE)
+    return None
+
+def build_transcriptome_kmer_index(reference_path, out_idx_path, work_dir):
+    """ Build a k-mer index of the first transcript of each gene in a GEX reference """
+    fa_path = os.path.join(reference_path, cr_constants.REFERENCE_FASTA_PATH)
+    gtf_path = os.path.join(reference_path, cr_constants.REFERENCE_GENES_GTF_PATH)
+
+    if not os.path.exists(fa_path + '.fai'):
+        # Index a symlink to the genome FASTA; the reference may not be writeable
+        # Note: this will fail if user's fs doesn't support symlinks
+        new_fa_path = os.path.join(work_dir, 'ref.fa')
+        os.symlink(fa_path, new_fa_path)
+        run(['samtools', 'faidx', new_fa_path])
+        fa_path = new_fa_path
+
+    # Only index the 1st encountered transcript per gene
+    tx_fa_path = os.path.join(work_dir, 'transcriptome.fa')
+    run(['detect_chemistry', 'get-transcripts', fa_path, gtf_path, tx_fa_path])
+
+    ## Use a larger step size as the reference grows.
+    ## This ensure the index size stays sane.
+    ## Should get to a step of <10 for the whole genome, which
+    ## is still 3x overlap w/ 32-mers
+    step = os.path.getsize(tx_fa_path) / BASES_PER_KMER_STEP
+    skip = step - 1
+
+    index_args = ['detect_chemistry', 'index-transcripts']
+    if skip > 0:
+        index_args.append('--skip=%d' % skip)
+    index_args.extend([tx_fa_path, out_idx_path])
+    run(index_args)
+
+def build_vdj_kmer_index(reference_path, out_idx_path, work_dir):
+    """ Build a k-mer index of the segments in a V(D)J reference """
+    vdj_fa_path = vdj_ref.get_vdj_reference_fasta(reference_path)
+    run(['detect_chemistry', 'index-transcripts', vdj_fa_path, out_idx_path])
+
+def write_kmer_index(reference_path, index_dir, build_func):
+    """ Build an index of the reference into index_dir and record the reference hashes.
+        Files are moved into place only once complete, so concurrent readers never see a partial index.
+        Returns the index path. """
+    if not os.path.exists(index_dir):
+        try:
+            os.makedirs(index_dir)
+        except OSError:
+            # Another process may have created it
+            if not os.path.isdir(index_dir):
+                raise
+
+    tmp_dir = tempfile.mkdtemp(prefix='.tmp', dir=index_dir)
+    try:
+        tmp_idx_path = os.path.join(tmp_dir, KMER_INDEX_FILE)
+        build_func(reference_path, tmp_idx_path, tmp_dir)
+
+        idx_path = os.path.join(index_dir, KMER_INDEX_FILE)
+        os.rename(tmp_idx_path, idx_path)
+
+        # Write the metadata last; it marks the index as valid
+        index_metadata = get_index_metadata(reference_path)
+        if index_metadata is not None:
+            tmp_metadata_path = os.path.join(tmp_dir, KMER_INDEX_METADATA_FILE)
+            with open(tmp_metadata_path, 'w') as f:
+                json.dump(index_metadata, f, sort_keys=True, indent=4)
+            os.rename(tmp_metadata_path, os.path.join(index_dir, KMER_INDEX_METADATA_FILE))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return idx_path
+
+def get_kmer_index(reference_path, work_dir, build_func):
+    """ Returns the path of an index for this reference, building it only if no valid index exists.
+        A new index is stored in the shared cache if one is configured and writeable, otherwise in work_dir,
+        which must be an existing directory private to this index. """
+    idx_path = find_kmer_index(reference_path)
+    if idx_path is not None:
+        print 'Using existing k-mer index %s' % idx_path
+        return idx_path
+
+    cache_dir = get_cache_dir(get_index_metadata(reference_path))
+    if cache_dir is not None:
+        try:
+            return write_kmer_index(reference_path, cache_dir, build_func)
+        except (OSError, IOError) as e:
+            print 'Could not write k-mer index to cache %s: %s' % (cache_dir, e)
+
+    idx_path = os.path.join(work_dir, KMER_INDEX_FILE)
+    build_func(reference_path, idx_path, work_dir)
+    return idx_path
+
+def get_transcriptome_kmer_index(reference_path, work_dir):
+    return get_kmer_index(reference_path, work_dir, build_transcriptome_kmer_index)
+
+def get_vdj_kmer_index(vdj_reference_path, work_dir):
+    return get_kmer_index(vdj_reference_path, work_dir, build_vdj_kmer_index)
@@ -417,6 +417,24 @@ class AugmentedFastqHeader:
 
         return self.WORD_SEP.join([augmented_word] + hdr_words[1:])
 
+    @staticmethod
+    def set_header_tag(fastq_header, key, value):
+        """ Same as AugmentedFastqHeader(fastq_header).set_tag(key, value).to_string(),
+            but only parses the tag list if the key might already be present """
+        word, sep, rest = fastq_header.partition(AugmentedFastqHeader.WORD_SEP)
+        tag_sep = AugmentedFastqHeader.TAG_SEP
+        if (tag_sep + key + tag_sep) in word:
+            hdr = AugmentedFastqHeader(fastq_header)
+            hdr.set_tag(key, value)
+            return hdr.to_string()
+        return word + tag_sep + key + tag_sep + value + sep + rest
+
+    @staticmethod
+    def strip_header_tags(fastq_header):
+        """ Same as AugmentedFastqHeader(fastq_header).fastq_header """
+        word, sep, rest = fastq_header.partition(AugmentedFastqHeader.WORD_SEP)
+        return word.partition(AugmentedFastqHeader.TAG_SEP)[0] + sep + rest
+
 # Copied from tenkit because tenkit/preflight.py is utterly broken (imports martian)
 def check_sample_indices(sample_item, sample_index_key = "sample_indices"):
     sample_indices = sample_item[sample_index_key]
@@ -28,6 +28,9 @@ HDF5_COMPRESSION = 'gzip'
 # Number of elements per chunk. Here, 1 MiB / (12 bytes)
 HDF5_CHUNK_SIZE = 80000
 
+# Number of nonzero entries to read at a time when loading a subset of features
+HDF5_LOAD_BLOCK_SIZE = 10 * HDF5_CHUNK_SIZE
+
 DEFAULT_DATA_DTYPE = 'int32'
 
 
@@ -548,6 +551,58 @@ class CountMatrix(object):
 
         return cls(feature_ref=feature_ref, bcs=bcs, matrix=matrix)
 
+    @classmethod
+    def load_features_from_h5_group(cls, group, feature_indices, block_size=HDF5_LOAD_BLOCK_SIZE):
+        '''Load only a subset of features (rows) from an HDF5 group.
+        The nonzero entries are read block_size at a time, so memory scales with
+        the size of the selected submatrix rather than the whole matrix.'''
+        feature_ref = CountMatrix.load_feature_ref_from_h5_group(group)
+        feature_indices = np.asarray(feature_indices, dtype=int)
+
+        bcs = cls.load_bcs_from_h5_group(group)
+
+        num_features, num_bcs = group[h5_constants.H5_MATRIX_SHAPE_ATTR][:]
+        indptr = group[h5_constants.H5_MATRIX_INDPTR_ATTR][:]
+        assert np.all(np.diff(indptr)>=0)
+
+        # Map old row index to new row index, -1 for rows that aren't selected
+        new_rows = np.full(num_features, -1, dtype=np.int64)
+        new_rows[feature_indices] = np.arange(len(feature_indices))
+
+        data_ds = group[h5_constants.H5_MATRIX_DATA_ATTR]
+        indices_ds = group[h5_constants.H5_MATRIX_INDICES_ATTR]
+        sub_data, sub_rows, sub_cols = [], [], []
+        for start in xrange(0, len(data_ds), block_size):
+            end = min(start + block_size, len(data_ds))
+            rows = new_rows[indices_ds[start:end]]
+            keep = np.flatnonzero(rows >= 0)
+            sub_rows.append(rows[keep])
+            sub_data.append(data_ds[start:end][keep])
+            sub_cols.append(np.searchsorted(indptr, start + keep, side='right') - 1)
+
+        sub_data = np.concatenate(sub_data) if sub_data else np.zeros(0, dtype=data_ds.dtype)
+        sub_rows = np.concatenate(sub_rows) if sub_rows else np.zeros(0, dtype=np.int64)
+        sub_cols = np.concatenate(sub_cols) if sub_cols else np.zeros(0, dtype=np.int64)
+
+        matrix = sp_sparse.csc_matrix((sub_data, (sub_rows, sub_cols)),
+                                      shape=(len(feature_indices), num_bcs))
+
+        return cls(feature_ref=CountMatrix._select_feature_ref(feature_ref, feature_indices),
+                   bcs=bcs, matrix=matrix)
+
+    @staticmethod
+    def load_features_by_type_from_h5(filename, feature_type):
+        '''Load only the features of a particular type (e.g. "Antibody Capture") from an HDF5 file.'''
+        h5_version = CountMatrix.get_format_version_from_h5(filename)
+        if h5_version == 1:
+            return CountMatrix.load_h5_file(filename).select_features_by_type(feature_type)
+        else:
+            with h5.File(filename, 'r') as f:
+                group = f['matrix']
+                feature_ref = CountMatrix.load_feature_ref_from_h5_group(group)
+                indices = [fd.index for fd in feature_ref.feature_defs if fd.feature_type == feature_type]
+                return CountMatrix.load_features_from_h5_group(group, indices)
+
     @staticmethod
     def load_bcs_from_h5_group(group):
         '''Load just the barcode sequences from an h5 group.'''
@@ -567,11 +622,13 @@ class CountMatrix(object):
     def _load_bcs_from_legacy_v1_h5(filename):
         '''Load just the barcode sequences from a legacy h5py.File (format version 1)'''
         with h5.File(filename, 'r') as f:
+            # Same order as the columns of from_legacy_v1_h5
             genomes = f.keys()
-            barcodes = set()
+            barcodes = OrderedDict()
             for genome in genomes:
                 group = f[genome]
-                barcodes.update(group['barcodes'])
+                for bc in group['barcodes'][:]:
+                    barcodes.setdefault(bc, None)
             return list(barcodes)
 
     @staticmethod
@@ -648,7 +705,14 @@ class CountMatrix(object):
         '''Select a subset of features and return the resulting matrix.
         We also update FeatureDefs to keep their indices consistent with their new position'''
 
-        old_feature_defs = [self.feature_ref.feature_defs[i] for i in indices]
+        return CountMatrix(feature_ref=CountMatrix._select_feature_ref(self.feature_ref, indices),
+                           bcs=self.bcs,
+                           matrix=self.m[indices, :])
+
+    @staticmethod
+    def _select_feature_ref(feature_ref, indices):
+        '''Subset a FeatureReference, renumbering the FeatureDefs to their new positions'''
+        old_feature_defs = [feature_ref.feature_defs[i] for i in indices]
 
         updated_feature_defs = [FeatureDef( index = i,
                                             id = fd.id,
@@ -658,12 +722,8 @@ class CountMatrix(object):
                                           )
                                           for (i, fd) in enumerate(old_feature_defs)]
 
-        feature_ref = FeatureReference(feature_defs = updated_feature_defs,
-                                       all_tag_keys = self.feature_ref.all_tag_keys)
-
-        return CountMatrix(feature_ref=feature_ref,
-                           bcs=self.bcs,
-                           matrix=self.m[indices, :])
+        return FeatureReference(feature_defs = updated_feature_defs,
+                                all_tag_keys = feature_ref.all_tag_keys)
 
     def select_features_by_ids(self, feature_ids):
         return self.select_features(self.feature_ids_to_ints(feature_ids))
@@ -8,11 +8,15 @@ import csv
 import itertools
 import json
 import math
+import multiprocessing
 import numpy as np
 import os
+import Queue
 import subprocess
 import sys
 import re
+import threading
+import time
 import tenkit.log_subprocess as tk_subproc
 import tenkit.safe_json as tk_safe_json
 import tenkit.seq as tk_seq
@@ -21,9 +25,134 @@ import cellranger.constants as cr_constants
 import cellranger.h5_constants as h5_constants
 import cellranger.io as cr_io
 
+# Size of the byte blocks of a GTF file processed by each worker
+GTF_BLOCK_SIZE = 1 << 24
+
+# Output line terminator of the csv.writer used for GTFs
+GTF_LINE_TERMINATOR = '\r\n'
+
+GTF_PROPERTIES_PATTERN = re.compile(r'(\S+?)\s*"(.*?)"')
+WHITESPACE_PATTERN = re.compile(r'\s')
+
+GtfBlock = collections.namedtuple('GtfBlock', ['num_lines', 'lines', 'transcripts', 'error', 'needs_csv'])
+
+def get_gtf_blocks(filename, block_size=GTF_BLOCK_SIZE):
+    """ Split a file into (start, end) byte ranges of about block_size that end at line boundaries """
+    size = os.path.getsize(filename)
+    blocks = []
+    with open(filename, 'rb') as f:
+        start = 0
+        while start < size:
+            f.seek(start + block_size)
+            f.readline()
+            end = min(f.tell(), size)
+            blocks.append((start, end))
+            start = end
+    return blocks
+
+def process_gtf_block(args):
+    """ Validate and filter or rewrite the lines in a byte range of a GTF, with the same results as
+        GtfBuilder.build_gtf (attributes) or ReferenceBuilder.write_genome_gtf (rewrite) would give.
+        Stops at the first invalid line, or at the first line that needs the csv reader
+        (quoted fields, carriage returns or NUL bytes within a line, overlong fields).
+        Returns a GtfBlock; transcripts holds the (transcript_id, chrom) of each rewritten line, or None. """
+    filename, start, end, attributes, rewrite, genome_prefix = args
+    parser = GtfParser()
+
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    lines = data.split('\n')
+    if data.endswith('\n'):
+        lines.pop()
+
+    out_lines = []
+    transcripts = [] if rewrite else None
+    max_line_len = csv.field_size_limit()
+
+    for i, line in enumerate(lines):
+        if line.endswith('\r'):
+            line = line[:-1]
+        if line.startswith('"') or '\t"' in line or '\r' in line or '\0' in line or len(line) > max_line_len:
+            return GtfBlock(i, out_lines, transcripts, None, True)
+        if len(line) == 0:
+            continue
+
+        row = line.split('\t')
+        if row[0].startswith('#'):
+            out_lines.append(line + GTF_LINE_TERMINATOR)
+            if rewrite:
+                transcripts.append(None)
+            continue
+
+        # Attributes are only parsed where needed: exons are validated, filters look for their keys
+        parse_properties = len(row) == 9 and (rewrite or any(key in row[8] for key in attributes))
+        error, properties = parser.check_gtf_row(row, parse_properties, ordered=False)
+        if error is not None:
+            return GtfBlock(i, out_lines, transcripts, (i, error, row), False)
+
+        if rewrite:
+            line, transcript = GtfParser.rewrite_gtf_row(row, properties, genome_prefix,
+                                                         keys=GtfParser.get_properties_keys(row[8]))
+            out_lines.append(line + GTF_LINE_TERMINATOR)
+            transcripts.append(transcript)
+        elif not GtfParser.is_filtered_gtf_row(properties, attributes):
+            out_lines.append(line + GTF_LINE_TERMINATOR)
+
+    return GtfBlock(len(lines), out_lines, transcripts, None, False)
+
 class GtfParser:
     GTF_ERROR_TXT = 'Please fix your GTF and start again.'
 
+    GTF_ERRORS = {
+        'num_columns': "Invalid number of columns in GTF line %d: %s",
+        'strand': 'Invalid strand in GTF line %d: %s',
+        'no_transcript_id': "Property 'transcript_id' not found in GTF line %d: %s",
+        'transcript_id_semicolon': "Property 'transcript_id' has invalid character ';' in GTF line %d: %s",
+        'transcript_id_whitespace': "Property 'transcript_id' has invalid whitespace character in GTF line %d: %s",
+        'no_gene_id': "Property 'gene_id' not found in GTF line %d: %s",
+        'gene_id_semicolon': "Property 'gene_id' has invalid character ';' in GTF line %d: %s",
+    }
+
+    def format_gtf_error(self, error, line_idx, row):
+        """ Message for an invalid row at 0-based line index line_idx """
+        return (self.GTF_ERRORS[error] % (line_idx+1, '\t'.join(row))) + '\n\n' + self.GTF_ERROR_TXT
+
+    def check_gtf_row(self, row, parse_properties=True, ordered=True):
+        """ Validate a non-comment GTF row. Exon attributes are always parsed.
+            Returns (error, properties) where error is a key of GTF_ERRORS or None,
+            and properties is None if the attributes weren't parsed.
+            Unless ordered, properties is a plain dict, which is faster to build. """
+        if len(row) != 9:
+            return 'num_columns', None
+
+        strand = row[6]
+        if strand not in cr_constants.STRANDS:
+            return 'strand', None
+
+        annotation = row[2]
+        if not parse_properties and annotation != 'exon':
+            return None, None
+
+        if ordered:
+            properties = self.get_properties_dict(row[8])
+        else:
+            properties = dict(GTF_PROPERTIES_PATTERN.findall(row[8]))
+        if annotation == 'exon':
+            if 'transcript_id' not in properties:
+                return 'no_transcript_id', properties
+            if ';' in properties['transcript_id']:
+                return 'transcript_id_semicolon', properties
+            if WHITESPACE_PATTERN.search(properties['transcript_id']) is not None:
+                return 'transcript_id_whitespace', properties
+            if 'gene_id' not in properties:
+                return 'no_gene_id', properties
+            if ';' in properties['gene_id']:
+                return 'gene_id_semicolon', properties
+
+        return None, properties
+
     def gtf_reader_iter(self, filename):
         with open(filename, 'r') as f:
             reader = csv.reader(f, delimiter='\t')
@@ -34,29 +163,92 @@ class GtfParser:
                     yield row, True, None
                     continue
 
-                if len(row) != 9:
-                    sys.exit("Invalid number of columns in GTF line %d: %s\n\n%s" % (i+1, '\t'.join(row), self.GTF_ERROR_TXT))
-
-                strand = row[6]
-                if strand not in cr_constants.STRANDS:
-                    sys.exit('Invalid strand in GTF line %d: %s\n\n%s' % (i+1, '\t'.join(row), self.GTF_ERROR_TXT))
-
-                annotation = row[2]
-                properties = self.get_properties_dict(row[8])
-                if annotation == 'exon':
-                    if 'transcript_id' not in properties:
-                        sys.exit("Property 'transcript_id' not found in GTF line %d: %s\n\n%s" % (i+1, '\t'.join(row), self.GTF_ERROR_TXT))
-                    if ';' in properties['transcript_id']:
-                        sys.exit("Property 'transcript_id' has invalid character ';' in GTF line %d: %s\n\n%s" % (i+1, '\t'.join(row), self.GTF_ERROR_TXT))
-                    if re.search(r'\s', properties['transcript_id']) is not None:
-                        sys.exit("Property 'transcript_id' has invalid whitespace character in GTF line %d: %s\n\n%s" % (i+1, '\t'.join(row), self.GTF_ERROR_TXT))
-                    if 'gene_id' not in properties:
-                        sys.exit("Property 'gene_id' not found in GTF line %d: %s\n\n%s" % (i+1, '\t'.join(row), self.GTF_ERROR_TXT))
-                    if ';' in properties['gene_id']:
-                        sys.exit("Property 'gene_id' has invalid character ';' in GTF line %d: %s\n\n%s" % (i+1, '\t'.join(row), self.GTF_ERROR_TXT))
+                error, properties = self.check_gtf_row(row)
+                if error is not None:
+                    sys.exit(self.format_gtf_error(error, i, row))
 
                 yield row, False, properties
 
+    def iter_gtf_blocks(self, filename, num_threads=1, attributes={}, rewrite=False, genome_prefix=None):
+        """ Process a GTF in blocks (see process_gtf_block) on a pool of num_threads workers.
+            Yields each GtfBlock in file order. """
+        block_args = [(filename, start, end, attributes, rewrite, genome_prefix) \
+                      for start, end in get_gtf_blocks(filename)]
+
+        if num_threads <= 1 or len(block_args) <= 1:
+            for args in block_args:
+                yield process_gtf_block(args)
+            return
+
+        pool = multiprocessing.Pool(num_threads)
+        try:
+            for block in pool.imap(process_gtf_block, block_args):
+                yield block
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    @staticmethod
+    def is_filtered_gtf_row(properties, attributes):
+        """ True if a row has a value of a filtered attribute that isn't in the allowed set """
+        if properties is None:
+            return False
+        for key, values in attributes.iteritems():
+            if key in properties and properties[key] not in values:
+                return True
+        return False
+
+    @staticmethod
+    def rewrite_gtf_row(row, properties, genome_prefix=None, keys=None):
+        """ Prefix the chromosome and the ids/names of a row with a genome prefix (if any),
+            and reformat the attributes in the order of keys (default: the order of properties). Modifies row.
+            Returns (line, (transcript_id, chrom)), with None instead of the pair if there is no transcript_id """
+        if genome_prefix is not None:
+            prefix_func = lambda s: '%s_%s' % (genome_prefix, s)
+        else:
+            prefix_func = lambda s: s
+
+        chrom = prefix_func(row[0])
+        row[0] = chrom
+
+        transcript = None
+        if 'transcript_id' in properties:
+            properties['transcript_id'] = prefix_func(properties['transcript_id'])
+            transcript = (properties['transcript_id'], chrom)
+        if 'gene_id' in properties:
+            properties['gene_id'] = prefix_func(properties['gene_id'])
+        if 'gene_name' in properties:
+            properties['gene_name'] = prefix_func(properties['gene_name'])
+
+        if keys is None:
+            keys = properties.keys()
+        row[8] = '; '.join('%s "%s"' % (key, properties[key]) for key in keys)
+        return '\t'.join(row), transcript
+
+    def write_gtf_blocks(self, f, in_gtf_fn, num_threads=1, attributes={}, rewrite=False, genome_prefix=None,
+                         keep_transcript=None):
+        """ Write the processed lines of a GTF to a file, in order. Exits on the first invalid line,
+            after writing the lines before it, as reading with gtf_reader_iter would.
+            keep_transcript(transcript_id, chrom) decides whether to keep a rewritten line.
+            Returns False if the GTF needs the csv reader, in which case the output should be discarded. """
+        line_offset = 0
+        for block in self.iter_gtf_blocks(in_gtf_fn, num_threads, attributes, rewrite, genome_prefix):
+            if block.needs_csv:
+                return False
+
+            if keep_transcript is None:
+                f.writelines(block.lines)
+            else:
+                f.writelines(line for line, transcript in itertools.izip(block.lines, block.transcripts) \
+                             if transcript is None or keep_transcript(*transcript))
+
+            if block.error is not None:
+                line_idx, error, row = block.error
+                sys.exit(self.format_gtf_error(error, line_offset + line_idx, row))
+            line_offset += block.num_lines
+        return True
+
     def load_gtf(self, in_gtf_fn, fasta_parser=None):
         transcripts = {}
         gene_to_transcripts = collections.OrderedDict()
@@ -93,8 +285,8 @@ class GtfParser:
         transcript_gc_contents = {}
         for transcript_id, transcript in transcripts.iteritems():
             transcript_lengths[transcript_id] = sum([interval.length for interval in transcript.intervals])
-            if fasta_parser is not None:
-                transcript_gc_contents[transcript_id] = fasta_parser.get_transcript_gc_content(transcript)
+        if fasta_parser is not None:
+            transcript_gc_contents = fasta_parser.get_transcript_gc_contents(transcripts)
 
         # Gene length, GC content and start + end positions
         genes = []
@@ -132,13 +324,19 @@ class GtfParser:
             return properties_str
 
         properties = collections.OrderedDict()
-        pattern = re.compile('(\S+?)\s*"(.*?)"')
-        for m in re.finditer(pattern, properties_str):
-            key = m.group(1)
-            value = m.group(2)
+        for key, value in GTF_PROPERTIES_PATTERN.findall(properties_str):
             properties[key] = value
         return properties
 
+    @staticmethod
+    def get_properties_keys(properties_str):
+        """ The keys of get_properties_dict, in the same order """
+        keys = [key for key, _ in GTF_PROPERTIES_PATTERN.findall(properties_str)]
+        if len(set(keys)) < len(keys):
+            seen = set()
+            keys = [key for key in keys if not (key in seen or seen.add(key))]
+        return keys
+
     def format_properties_dict(self, properties):
         properties_str = []
         for key, value in properties.iteritems():
@@ -146,29 +344,129 @@ class GtfParser:
         return '; '.join(properties_str)
 
 class GtfBuilder(GtfParser):
-    def __init__(self, in_gtf_fn, out_gtf_fn, attributes={}):
+    def __init__(self, in_gtf_fn, out_gtf_fn, attributes={}, num_threads=1):
         self.in_gtf_fn = in_gtf_fn
         self.out_gtf_fn = out_gtf_fn
         self.attributes = attributes
+        self.num_threads = num_threads
 
     def build_gtf(self):
-        print "Writing new genes GTF file (may take 10 minutes for a 1GB input GTF file)..."
+        print "Writing new genes GTF file..."
         with open(self.out_gtf_fn, 'wb') as f:
-            writer = csv.writer(f, delimiter='\t', quoting=csv.QUOTE_NONE, quotechar='')
-            for row, is_comment, properties in self.gtf_reader_iter(self.in_gtf_fn):
-                if is_comment:
-                    writer.writerow(row)
-                    continue
+            if not self.write_gtf_blocks(f, self.in_gtf_fn, self.num_threads, attributes=self.attributes):
+                f.seek(0)
+                f.truncate()
+                self.write_gtf_rows(f)
 
-                remove = False
-                for key, value in properties.iteritems():
-                    if key in self.attributes and value not in self.attributes[key]:
-                        remove = True
+        print "...done\n"
 
-                if not remove:
-                    writer.writerow(row)
+    def write_gtf_rows(self, f):
+        """ Filter the GTF one csv row at a time """
+        writer = csv.writer(f, delimiter='\t', quoting=csv.QUOTE_NONE, quotechar='')
+        for row, is_comment, properties in self.gtf_reader_iter(self.in_gtf_fn):
+            if is_comment:
+                writer.writerow(row)
+                continue
 
-        print "...done\n"
+            if not GtfParser.is_filtered_gtf_row(properties, self.attributes):
+                writer.writerow(row)
+
+# Per-step timings of ReferenceBuilder.build_reference, written into the reference folder
+REFERENCE_BUILD_TIMINGS_FILE = 'build_timings.json'
+
+# Memory left by the STAR index for the steps that run alongside it
+REFERENCE_HELPER_MEM_GB = 2
+
+class BuildStep(object):
+    """ A step of building a reference, run once the steps it depends on are done.
+        A step with threads=0 or mem_gb=None isn't counted against the thread or memory budget. """
+    def __init__(self, name, func, deps=[], threads=1, mem_gb=0, message=None):
+        self.name = name
+        self.func = func
+        self.deps = deps
+        self.threads = threads
+        self.mem_gb = mem_gb
+        self.message = message if message is not None else name
+
+def run_build_steps(steps, num_threads, mem_gb=None):
+    """ Run steps concurrently as their dependencies finish, keeping the threads and memory
+        of the running steps within num_threads and mem_gb (None for no limit).
+        Among ready steps, those earlier in the list start first.
+        Once a step fails, no new steps are started; the error is raised after the running steps finish.
+        Returns a dict of step name to timing information. """
+    names = set(step.name for step in steps)
+    for step in steps:
+        for dep in step.deps:
+            assert dep in names
+
+    done_queue = Queue.Queue()
+
+    def run_step(step):
+        try:
+            step.func()
+            done_queue.put((step, None))
+        except BaseException:
+            done_queue.put((step, sys.exc_info()))
+
+    build_start = time.time()
+    timings = {}
+    pending = list(steps)
+    running = []
+    done = set()
+    error = None
+
+    while pending or running:
+        if error is None:
+            for step in list(pending):
+                if not all(dep in done for dep in step.deps):
+                    continue
+                used_threads = sum(s.threads for s in running)
+                used_mem_gb = sum(s.mem_gb or 0 for s in running)
+                fits = used_threads + step.threads <= num_threads and \
+                       (mem_gb is None or step.mem_gb is None or used_mem_gb + step.mem_gb <= mem_gb)
+                # A step that exceeds the budget on its own runs alone
+                if not fits and running:
+                    continue
+
+                print "%s..." % step.message
+                sys.stdout.flush()
+                pending.remove(step)
+                running.append(step)
+                timings[step.name] = {'start': time.time() - build_start, 'threads': step.threads}
+                thread = threading.Thread(target=run_step, args=(step,))
+                thread.daemon = True
+                thread.start()
+        elif not running:
+            break
+
+        if not running:
+            raise Exception('Unable to run reference build steps with unmet dependencies: %s' % \
+                            ', '.join(step.name for step in pending))
+
+        # Poll so the main thread stays responsive to interrupts
+        while True:
+            try:
+                step, exc_info = done_queue.get(timeout=1)
+                break
+            except Queue.Empty:
+                pass
+        running.remove(step)
+        timings[step.name]['end'] = time.time() - build_start
+        timings[step.name]['elapsed'] = timings[step.name]['end'] - timings[step.name]['start']
+
+        if exc_info is None:
+            done.add(step.name)
+            print "...done: %s (%.1f seconds)\n" % (step.message, timings[step.name]['elapsed'])
+            sys.stdout.flush()
+        elif error is None:
+            error = exc_info
+
+    if error is not None:
+        raise error[0], error[1], error[2]
+
+    timings['total'] = {'start': 0.0, 'end': time.time() - build_start, 'threads': num_threads}
+    timings['total']['elapsed'] = timings['total']['end']
+    return timings
 
 class ReferenceBuilder(GtfParser):
     def __init__(self, genomes, in_fasta_fns, in_gtf_fns, out_dir, ref_version, mkref_version, num_threads=1, mem_gb=None):
@@ -188,60 +486,79 @@ class ReferenceBuilder(GtfParser):
         os.mkdir(self.out_dir)
         print "...done\n"
 
-        print "Writing genome FASTA file into reference folder..."
         new_genome_fasta = os.path.join(self.out_dir, cr_constants.REFERENCE_FASTA_PATH)
-        os.mkdir(os.path.dirname(new_genome_fasta))
-        self.write_genome_fasta(new_genome_fasta)
-        print "...done\n"
-
-        print "Computing hash of genome FASTA file..."
-        fasta_hash = cr_io.compute_hash_of_file(new_genome_fasta)
-        print "...done\n"
-
-        print "Indexing genome FASTA file..."
-        subprocess.check_call(["samtools", "faidx", new_genome_fasta])
-        print "...done\n"
-
-        print "Writing genes GTF file into reference folder..."
         new_gene_gtf = os.path.join(self.out_dir, cr_constants.REFERENCE_GENES_GTF_PATH)
-        os.mkdir(os.path.dirname(new_gene_gtf))
-        self.write_genome_gtf(new_gene_gtf)
-        print "...done\n"
-
-        print "Computing hash of genes GTF file..."
-        gtf_hash = cr_io.compute_hash_of_file(new_gene_gtf)
-        print "...done\n"
-
-        print "Writing genes index file into reference folder (may take over 10 minutes for a 3Gb genome)..."
         new_gene_index = os.path.join(self.out_dir, cr_constants.REFERENCE_GENES_INDEX_PATH)
-        os.mkdir(os.path.dirname(new_gene_index))
-        self.write_genome_gene_index(new_gene_index, new_gene_gtf, new_genome_fasta)
-        print "...done\n"
-
-        print "Writing genome metadata JSON file into reference folder..."
-        metadata = {
-            cr_constants.REFERENCE_GENOMES_KEY: self.genomes,
-            cr_constants.REFERENCE_NUM_THREADS_KEY: int(math.ceil(float(self.mem_gb) / 8.0)),
-            cr_constants.REFERENCE_MEM_GB_KEY: self.mem_gb,
-            cr_constants.REFERENCE_FASTA_HASH_KEY: fasta_hash,
-            cr_constants.REFERENCE_GTF_HASH_KEY: gtf_hash,
-            cr_constants.REFERENCE_INPUT_FASTA_KEY: [os.path.basename(x) for x in self.in_fasta_fns],
-            cr_constants.REFERENCE_INPUT_GTF_KEY: [os.path.basename(x) for x in self.in_gtf_fns],
-            cr_constants.REFERENCE_VERSION_KEY: self.ref_version,
-            cr_constants.REFERENCE_MKREF_VERSION_KEY: self.mkref_version,
-        }
         new_metadata_json = os.path.join(self.out_dir, cr_constants.REFERENCE_METADATA_FILE)
-        with open(new_metadata_json, 'w') as f:
-            json.dump(tk_safe_json.json_sanitize(metadata), f, sort_keys=True, indent=4)
-        print "...done\n"
-
-        print "Generating STAR genome index (may take over 8 core hours for a 3Gb genome)..."
         new_star_path = os.path.join(self.out_dir, cr_constants.REFERENCE_STAR_PATH)
-        star = STAR(new_star_path)
-        star.index_reference_with_mem_gb(new_genome_fasta, new_gene_gtf,
-                                         num_threads=self.num_threads,
-                                         mem_gb=self.mem_gb)
-        print "...done.\n"
+        for path in [new_genome_fasta, new_gene_gtf, new_gene_index]:
+            os.mkdir(os.path.dirname(path))
+
+        hashes = {}
+
+        def hash_fasta():
+            hashes[cr_constants.REFERENCE_FASTA_HASH_KEY] = cr_io.compute_hash_of_file(new_genome_fasta)
+
+        def hash_gtf():
+            hashes[cr_constants.REFERENCE_GTF_HASH_KEY] = cr_io.compute_hash_of_file(new_gene_gtf)
+
+        def write_metadata():
+            metadata = {
+                cr_constants.REFERENCE_GENOMES_KEY: self.genomes,
+                cr_constants.REFERENCE_NUM_THREADS_KEY: int(math.ceil(float(self.mem_gb) / 8.0)),
+                cr_constants.REFERENCE_MEM_GB_KEY: self.mem_gb,
+                cr_constants.REFERENCE_FASTA_HASH_KEY: hashes[cr_constants.REFERENCE_FASTA_HASH_KEY],
+                cr_constants.REFERENCE_GTF_HASH_KEY: hashes[cr_constants.REFERENCE_GTF_HASH_KEY],
+                cr_constants.REFERENCE_INPUT_FASTA_KEY: [os.path.basename(x) for x in self.in_fasta_fns],
+                cr_constants.REFERENCE_INPUT_GTF_KEY: [os.path.basename(x) for x in self.in_gtf_fns],
+                cr_constants.REFERENCE_VERSION_KEY: self.ref_version,
+                cr_constants.REFERENCE_MKREF_VERSION_KEY: self.mkref_version,
+            }
+            with open(new_metadata_json, 'w') as f:
+                json.dump(tk_safe_json.json_sanitize(metadata), f, sort_keys=True, indent=4)
+
+        def generate_star_index():
+            star = STAR(new_star_path)
+            star.index_reference_with_mem_gb(new_genome_fasta, new_gene_gtf,
+                                             num_threads=star_threads,
+                                             mem_gb=self.mem_gb)
+
+        # STAR gets all the threads. The steps that can run alongside it (indexing, hashing)
+        # are short and mostly I/O-bound, so they reserve no thread and overlap with it.
+        # STAR keeps a memory buffer of REFERENCE_HELPER_MEM_GB for them (see index_reference_with_mem_gb).
+        star_threads = self.num_threads
+        star_mem_gb = None if self.mem_gb is None else max(0, self.mem_gb - REFERENCE_HELPER_MEM_GB)
+        # The GTF is written while the FASTA is being copied
+        gtf_threads = max(1, self.num_threads - 1)
+
+        # Listed in order of priority among steps that are ready to run
+        steps = [
+            BuildStep('star_index', generate_star_index, ['genome_fasta', 'genes_gtf'],
+                      threads=star_threads, mem_gb=star_mem_gb,
+                      message="Generating STAR genome index (may take over 8 core hours for a 3Gb genome)"),
+            BuildStep('genome_fasta', lambda: self.write_genome_fasta(new_genome_fasta),
+                      message="Writing genome FASTA file into reference folder"),
+            BuildStep('genes_gtf', lambda: self.write_genome_gtf(new_gene_gtf, num_threads=gtf_threads),
+                      threads=gtf_threads,
+                      message="Writing genes GTF file into reference folder"),
+            BuildStep('genome_fasta_index', lambda: subprocess.check_call(["samtools", "faidx", new_genome_fasta]),
+                      ['genome_fasta'], threads=0,
+                      message="Indexing genome FASTA file"),
+            BuildStep('genes_index', lambda: self.write_genome_gene_index(new_gene_index, new_gene_gtf, new_genome_fasta),
+                      ['genes_gtf', 'genome_fasta_index'], threads=0, mem_gb=None,
+                      message="Writing genes index file into reference folder"),
+            BuildStep('genome_fasta_hash', hash_fasta, ['genome_fasta'], threads=0,
+                      message="Computing hash of genome FASTA file"),
+            BuildStep('genes_gtf_hash', hash_gtf, ['genes_gtf'], threads=0,
+                      message="Computing hash of genes GTF file"),
+            BuildStep('metadata', write_metadata, ['genome_fasta_hash', 'genes_gtf_hash'], threads=0,
+                      message="Writing genome metadata JSON file into reference folder"),
+        ]
+
+        timings = run_build_steps(steps, self.num_threads, self.mem_gb)
+
+        with open(os.path.join(self.out_dir, REFERENCE_BUILD_TIMINGS_FILE), 'w') as f:
+            json.dump(tk_safe_json.json_sanitize(timings), f, sort_keys=True, indent=4)
 
         print ">>> Reference successfully created! <<<\n"
         print "You can now specify this reference on the command line:"
@@ -273,41 +590,39 @@ class ReferenceBuilder(GtfParser):
         else:
             cr_io.copy(self.in_fasta_fns[0], out_fasta_fn)
 
-    def write_genome_gtf(self, out_gtf_fn):
+    def write_genome_gtf(self, out_gtf_fn, num_threads=1):
         with open(out_gtf_fn, 'wb') as f:
-            writer = csv.writer(f, delimiter='\t', quoting=csv.QUOTE_NONE, quotechar='')
             for genome_prefix, in_gtf_fn in itertools.izip(self.genome_prefixes, self.in_gtf_fns):
-                if len(self.genomes) > 1:
-                    prefix_func = lambda s: '%s_%s' % (genome_prefix, s)
-                else:
-                    prefix_func = lambda s: s
+                if len(self.genomes) <= 1:
+                    genome_prefix = None
 
                 transcript_to_chrom = {}
                 cross_chrom_transcripts = set()
-                for row, is_comment, properties in self.gtf_reader_iter(in_gtf_fn):
-                    if is_comment:
-                        writer.writerow(row)
-                        continue
-
-                    chrom = prefix_func(row[0])
-                    row[0] = chrom
-
-                    if 'transcript_id' in properties:
-                        properties['transcript_id'] = prefix_func(properties['transcript_id'])
-                        curr_tx = properties['transcript_id']
-                        if curr_tx in transcript_to_chrom and transcript_to_chrom[curr_tx] != chrom:
-                            # ignore recurrences of a transcript on different chromosomes - it will break the STAR index
-                            cross_chrom_transcripts.add(curr_tx)
-                            continue
-                        transcript_to_chrom[curr_tx] = chrom
-                    if 'gene_id' in properties:
-                        properties['gene_id'] = prefix_func(properties['gene_id'])
-                    if 'gene_name' in properties:
-                        properties['gene_name'] = prefix_func(properties['gene_name'])
 
-                    row[8] = self.format_properties_dict(properties)
+                def keep_transcript(curr_tx, chrom):
+                    if curr_tx in transcript_to_chrom and transcript_to_chrom[curr_tx] != chrom:
+                        # ignore recurrences of a transcript on different chromosomes - it will break the STAR index
+                        cross_chrom_transcripts.add(curr_tx)
+                        return False
+                    transcript_to_chrom[curr_tx] = chrom
+                    return True
+
+                start = f.tell()
+                if not self.write_gtf_blocks(f, in_gtf_fn, num_threads, rewrite=True, genome_prefix=genome_prefix,
+                                             keep_transcript=keep_transcript):
+                    f.seek(start)
+                    f.truncate()
+                    transcript_to_chrom.clear()
+                    cross_chrom_transcripts.clear()
+                    writer = csv.writer(f, delimiter='\t', quoting=csv.QUOTE_NONE, quotechar='')
+                    for row, is_comment, properties in self.gtf_reader_iter(in_gtf_fn):
+                        if is_comment:
+                            writer.writerow(row)
+                            continue
 
-                    writer.writerow(row)
+                        _, transcript = GtfParser.rewrite_gtf_row(row, properties, genome_prefix)
+                        if transcript is None or keep_transcript(*transcript):
+                            writer.writerow(row)
 
                 if len(cross_chrom_transcripts) > 0:
                     print "WARNING: The following transcripts appear on multiple chromosomes in the GTF:"
@@ -378,6 +693,126 @@ class FastaParser:
         else:
             return 0
 
+    def get_transcript_gc_contents(self, transcripts):
+        """ Get the GC content of each transcript in a dict of transcript_id to Transcript """
+        return {transcript_id: self.get_transcript_gc_content(transcript) \
+                for transcript_id, transcript in transcripts.iteritems()}
+
+# Indicator of G/C bases, indexed by the byte value of a base
+GC_BASE_TABLE = np.zeros(256, dtype=np.uint8)
+GC_BASE_TABLE[[ord(b) for b in 'cCgG']] = 1
+
+FaiEntry = collections.namedtuple('FaiEntry', ['length', 'offset', 'line_bases', 'line_width'])
+
+class IndexedFastaParser(FastaParser):
+    """ Read sequence through the samtools faidx index (.fai) of a FASTA file,
+        instead of loading the whole genome into memory. """
+    # Number of bases to read at a time when scanning a chromosome
+    BLOCK_SIZE = 1 << 22
+
+    def __init__(self, in_fasta_fn):
+        self.in_fasta_fn = in_fasta_fn
+        self.fai = IndexedFastaParser.load_fai(in_fasta_fn + '.fai')
+
+    @staticmethod
+    def load_fai(in_fai_fn):
+        fai = {}
+        with open(in_fai_fn, 'r') as f:
+            for line in f:
+                row = line.rstrip('\n').split('\t')
+                fai[row[0]] = FaiEntry(*map(int, row[1:5]))
+        return fai
+
+    def read_bases(self, chrom, start, end):
+        """ Read the bases of the half-open interval [start,end), which must be within the bounds of chrom """
+        if end <= start:
+            return ''
+        entry = self.fai[chrom]
+        first_line = start / entry.line_bases
+        last_line = (end - 1) / entry.line_bases
+        with open(self.in_fasta_fn, 'rb') as f:
+            f.seek(entry.offset + first_line * entry.line_width)
+            raw = f.read((last_line - first_line) * entry.line_width + entry.line_bases)
+        seq = raw.replace('\n', '').replace('\r', '')
+        skip = start - first_line * entry.line_bases
+        return seq[skip:(skip + end - start)]
+
+    def is_valid_interval(self, chrom, start, end):
+        """ Determine whether the half-open interval [start,end) is within the bounds of chrom """
+        return chrom in self.fai and start >= 0 and end <= self.fai[chrom].length
+
+    def get_sequence(self, chrom, start, end, strand=cr_constants.FORWARD_STRAND):
+        """ Get genomic sequence for the half-open interval [start,end) """
+        # Same bounds as slicing the chromosome string
+        start, end, _ = slice(start, end).indices(self.fai[chrom].length)
+        seq = self.read_bases(chrom, start, end)
+        if strand == cr_constants.FORWARD_STRAND:
+            return seq
+        elif strand == cr_constants.REVERSE_STRAND:
+            return tk_seq.get_rev_comp(seq)
+        else:
+            raise Exception("Invalid strand: %s" % strand)
+
+    def get_gc_prefix_sums(self, chrom, positions):
+        """ Count the G/C bases in [0,pos) for each of positions (within [0,length]).
+            Scans the chromosome BLOCK_SIZE bases at a time, up to the largest position. """
+        order = np.argsort(positions, kind='mergesort')
+        sorted_positions = positions[order]
+        sorted_sums = np.zeros(len(positions), dtype=np.int64)
+
+        max_position = sorted_positions[-1] if len(positions) > 0 else 0
+        total = 0
+        for block_start in xrange(0, max_position, self.BLOCK_SIZE):
+            block_end = min(block_start + self.BLOCK_SIZE, max_position)
+            seq = self.read_bases(chrom, block_start, block_end)
+            block_sums = np.cumsum(GC_BASE_TABLE[np.frombuffer(seq, dtype=np.uint8)], dtype=np.int32)
+
+            # Positions in (block_start, block_end]; those at block_start were set by the previous block
+            lo = np.searchsorted(sorted_positions, block_start, side='right')
+            hi = np.searchsorted(sorted_positions, block_end, side='right')
+            sorted_sums[lo:hi] = total + block_sums[sorted_positions[lo:hi] - block_start - 1]
+            total += int(block_sums[-1])
+
+        sums = np.empty_like(sorted_sums)
+        sums[order] = sorted_sums
+        return sums
+
+    def get_transcript_gc_contents(self, transcripts):
+        """ Get the GC content of each transcript in a dict of transcript_id to Transcript.
+            Intervals are grouped by chromosome, and each costs O(1) given the GC prefix sums. """
+        gc_counts = collections.defaultdict(int)
+        lengths = collections.defaultdict(int)
+        chrom_intervals = collections.defaultdict(list)
+        for transcript_id, transcript in transcripts.iteritems():
+            for interval in transcript.intervals:
+                if interval.chrom not in self.fai:
+                    continue
+                chrom_intervals[interval.chrom].append((transcript_id, interval.start, interval.end))
+                lengths[transcript_id] += interval.length
+
+        for chrom, intervals in chrom_intervals.iteritems():
+            transcript_ids, starts, ends = zip(*intervals)
+            chrom_length = self.fai[chrom].length
+
+            # Same bounds as slicing the chromosome string
+            starts, ends = np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+            starts = np.where(starts < 0, np.maximum(starts + chrom_length, 0), np.minimum(starts, chrom_length))
+            ends = np.where(ends < 0, np.maximum(ends + chrom_length, 0), np.minimum(ends, chrom_length))
+
+            prefix_sums = self.get_gc_prefix_sums(chrom, np.concatenate((starts, ends)))
+            interval_gc = np.where(ends > starts, prefix_sums[len(starts):] - prefix_sums[:len(starts)], 0)
+            for transcript_id, gc in itertools.izip(transcript_ids, interval_gc):
+                gc_counts[transcript_id] += int(gc)
+
+        gc_contents = {}
+        for transcript_id in transcripts:
+            length = lengths[transcript_id]
+            if length > 0:
+                gc_contents[transcript_id] = float(gc_counts[transcript_id]) / float(length)
+            else:
+                gc_contents[transcript_id] = 0
+        return gc_contents
+
 # NOTE: these stub classes are necessary to maintain backwards compatibility with old refdata (1.2 or older)
 class IntervalTree: pass
 class Region: pass
@@ -390,7 +825,10 @@ class GeneIndex(GtfParser):
         self.in_gtf_fn = in_gtf_fn
         self.in_fasta_fn = in_fasta_fn
 
-        fasta_parser = FastaParser(self.in_fasta_fn)
+        if os.path.exists(self.in_fasta_fn + '.fai'):
+            fasta_parser = IndexedFastaParser(self.in_fasta_fn)
+        else:
+            fasta_parser = FastaParser(self.in_fasta_fn)
 
         self.transcripts, self.genes = self.load_gtf(self.in_gtf_fn, fasta_parser=fasta_parser)
         self.gene_ids_map = {gene.id: i for i, gene in enumerate(self.genes)}
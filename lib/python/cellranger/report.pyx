@@ -4,11 +4,14 @@
 #
 cimport cython
 import collections
+import copy
 import cPickle
 import h5py as h5
+import hashlib
 import itertools
 import json
 import math
+from multiprocessing import Pool
 import numpy as np
 import operator
 import random
@@ -17,6 +20,7 @@ import tenkit.safe_json as tk_safe_json
 import tenkit.seq as tk_seq
 import tenkit.stats as tk_stats
 import cellranger.constants as cr_constants
+import cellranger.h5_constants as h5_constants
 import cellranger.library_constants as lib_constants
 import cellranger.reference as cr_reference
 import cellranger.rna.library as rna_library
@@ -39,6 +43,19 @@ class Metric:
     def report(self):
         raise NotImplementedError
 
+    # Columnar storage (see Reporter.save_columnar)
+    def to_array(self, reporter):
+        """ Return the metric data as a numpy array, or None if it isn't stored as one """
+        return None
+
+    def clear_array(self):
+        """ Drop the data returned by to_array """
+        raise NotImplementedError
+
+    def add_array(self, reporter, array):
+        """ Add data in the form returned by to_array """
+        raise NotImplementedError
+
 # Dictionary metrics i.e. histograms, element counts
 class DictionaryMetric(Metric):
     def __init__(self, **kwargs):
@@ -56,6 +73,23 @@ class DictionaryMetric(Metric):
     def report(self):
         return self.d
 
+    def to_array(self, reporter):
+        """ Barcode counts are stored as an array indexed by whitelist position and gem group """
+        if self.__class__ is not DictionaryMetric or self.report_type != 'barcodes':
+            return None
+        barcode_index = reporter.get_barcode_index()
+        if barcode_index is None:
+            return None
+        return barcode_index.get_counts(self.d)
+
+    def clear_array(self):
+        self.d = collections.Counter()
+
+    def add_array(self, reporter, array):
+        barcode_index = reporter.get_barcode_index()
+        nz = np.flatnonzero(array)
+        self.d.update(dict(itertools.izip(barcode_index.get_barcodes(nz), array[nz].tolist())))
+
 class PercentDictionaryMetric(DictionaryMetric):
     def report(self):
         total = sum(self.d.values())
@@ -91,6 +125,15 @@ class CountDistinctIntegerMetric(Metric):
         else:
             return np.count_nonzero(self.counts)
 
+    def to_array(self, reporter):
+        return self.counts
+
+    def clear_array(self):
+        self.counts = None
+
+    def add_array(self, reporter, array):
+        self.add_many(array)
+
 
 class HistogramMetric(DictionaryMetric):
     def __init__(self, cutoffs, **kwargs):
@@ -131,6 +174,15 @@ class NumpyHistogramMetric(Metric):
         assert self.max_value == metric.max_value
         self.counts += metric.counts
 
+    def to_array(self, reporter):
+        return self.counts
+
+    def clear_array(self):
+        self.counts = np.zeros_like(self.counts)
+
+    def add_array(self, reporter, array):
+        self.counts += array
+
     def report(self):
         d = {str(k):int(v) for k, v in itertools.izip(xrange(0, 1 + self.max_value), self.counts)}
         d[">%d" % self.max_value] = int(self.counts[-1])
@@ -151,6 +203,15 @@ class SequenceDistributionMetric(Metric):
     def merge(self, metric):
         self.counts += metric.counts
 
+    def to_array(self, reporter):
+        return self.counts
+
+    def clear_array(self):
+        self.counts = np.zeros_like(self.counts)
+
+    def add_array(self, reporter, array):
+        self.counts += array
+
     def report(self):
         d = collections.defaultdict(lambda: collections.defaultdict(int))
         for col, pos in enumerate(xrange(-self.k/2, self.k/2)):
@@ -527,6 +588,89 @@ cdef class _RawFastqMetricsCache:
         metrics.n_bases += seq.count('N')
 
 
+class BarcodeIndex(object):
+    """ Maps barcode strings to their position in
+        cr_utils.format_barcode_seqs(barcode_whitelist, gem_groups) """
+    def __init__(self, barcode_whitelist, gem_groups):
+        self.whitelist = np.array(barcode_whitelist, dtype='S')
+        self.order = np.argsort(self.whitelist, kind='mergesort')
+        self.sorted_whitelist = self.whitelist[self.order]
+
+        if gem_groups is None:
+            self.gem_groups = None
+            self.size = len(self.whitelist)
+        else:
+            self.gem_groups = sorted(list(set(gem_groups)))
+            self.size = len(self.whitelist) * len(self.gem_groups)
+
+    def lookup(self, barcodes):
+        """ Returns an array of positions, with -1 for barcodes that aren't indexed """
+        barcodes = np.array(barcodes, dtype='S')
+        indices = np.full(len(barcodes), -1, dtype=np.int64)
+        if len(barcodes) == 0 or len(self.whitelist) == 0:
+            return indices
+
+        if self.gem_groups is None:
+            seqs = barcodes
+            gem_group_pos = np.zeros(len(barcodes), dtype=np.int64)
+        else:
+            parts = np.char.partition(barcodes, '-')
+            seqs = parts[:, 0]
+            gem_group_strs = {str(gg): i for i, gg in enumerate(self.gem_groups)}
+            uniq_gem_groups, inverse = np.unique(parts[:, 2], return_inverse=True)
+            gem_group_pos = np.array([gem_group_strs.get(gg, -1) for gg in uniq_gem_groups], dtype=np.int64)[inverse]
+            gem_group_pos[parts[:, 1] != '-'] = -1
+
+        pos = np.minimum(np.searchsorted(self.sorted_whitelist, seqs), len(self.whitelist) - 1)
+        found = (self.sorted_whitelist[pos] == seqs) & (gem_group_pos >= 0)
+
+        indices[found] = gem_group_pos[found] * len(self.whitelist) + self.order[pos[found]]
+        return indices
+
+    def get_indices(self, barcodes):
+        """ Returns an array of positions, or None if any barcode is not on the whitelist """
+        indices = self.lookup(barcodes)
+        if np.any(indices < 0):
+            return None
+        return indices
+
+    def get_all_barcodes(self):
+        """ Returns all barcode strings, in index order, as a numpy string array """
+        if self.gem_groups is None:
+            return self.whitelist
+        suffixes = np.array(['-' + str(gg) for gg in self.gem_groups])
+        return np.char.add(np.tile(self.whitelist, len(self.gem_groups)),
+                           np.repeat(suffixes, len(self.whitelist)))
+
+    def get_barcodes(self, indices):
+        """ Returns the list of barcode strings at the given positions """
+        seqs = self.whitelist[indices % len(self.whitelist)]
+        if self.gem_groups is None:
+            return seqs.tolist()
+        suffixes = np.array(['-' + str(gg) for gg in self.gem_groups])
+        return np.char.add(seqs, suffixes[indices // len(self.whitelist)]).tolist()
+
+    def get_counts(self, counter):
+        """ Convert a dict of barcode:count to an array of counts,
+            or None if a barcode or count can't be represented """
+        counts = np.zeros(self.size, dtype=np.int64)
+        if len(counter) == 0:
+            return counts
+
+        indices = self.get_indices(counter.keys())
+        values = np.array(counter.values())
+        if indices is None or values.dtype.kind not in 'iu':
+            return None
+
+        counts[indices] = values
+        return counts
+
+# Columnar reporter file layout
+REPORTER_H5_PICKLE = 'reporter'
+REPORTER_H5_WHITELIST = 'barcode_whitelist'
+REPORTER_H5_WHITELIST_DIGEST = 'md5'
+REPORTER_H5_METRICS = 'metrics'
+
 class Reporter:
     def __init__(self, umi_length=None, primers=None,
                  reference_path=None, high_conf_mapq=None, chroms=None,
@@ -1053,40 +1197,182 @@ class Reporter:
         data = self.report('barcodes')
 
         if self.barcode_whitelist:
-            bc_sequences = cr_utils.format_barcode_seqs(self.barcode_whitelist, self.gem_groups)
+            barcode_index = self.get_barcode_index()
         elif self.barcode_summary is not None:
-            bc_sequences = self.barcode_summary
+            barcode_index = BarcodeIndex(self.barcode_summary, None)
         else:
             # Get all observed bc sequences
             bc_sequences = sorted(list(reduce(lambda x, y: x.union(y.keys()), data.values(), set())))
+            barcode_index = BarcodeIndex(bc_sequences, None)
 
         # Build the columns for the table
-        bc_table_cols = {cr_constants.H5_BC_SEQUENCE_COL: bc_sequences}
+        bc_table_cols = {cr_constants.H5_BC_SEQUENCE_COL: barcode_index.get_all_barcodes()}
 
         for metric_name, metric_data in data.iteritems():
-            counts = np.array([metric_data.get(bc, 0) for bc in bc_sequences], dtype=np.uint32)
+            counts = np.zeros(barcode_index.size, dtype=np.uint32)
+            if len(metric_data) > 0:
+                indices = barcode_index.lookup(metric_data.keys())
+                values = np.array(metric_data.values(), dtype=np.uint32)
+                found = indices >= 0
+                counts[indices[found]] = values[found]
             bc_table_cols[metric_name] = counts
 
         cr_io.write_h5(filename, bc_table_cols)
 
+    def get_barcode_index(self):
+        """ Returns a BarcodeIndex for the whitelist, or None if there is no whitelist """
+        if not self.barcode_whitelist:
+            return None
+        if getattr(self, '_barcode_index', None) is None:
+            self._barcode_index = BarcodeIndex(self.barcode_whitelist, self.gem_groups)
+        return self._barcode_index
+
+    def __getstate__(self):
+        # The barcode index is rebuilt on demand
+        state = dict(self.__dict__)
+        state.pop('_barcode_index', None)
+        return state
+
     def save(self, filename):
         with open(filename, 'wb') as f:
             cPickle.dump(self, f, protocol=cPickle.HIGHEST_PROTOCOL)
 
+    def save_columnar(self, filename):
+        """ Save to an h5 file. Metrics that support it (e.g., barcode counts, histograms)
+            are stored as numpy arrays and the rest of the reporter is pickled.
+            Load with Reporter.load or merge_reporters. """
+        skeleton = copy.copy(self)
+        skeleton.metrics_data = dict(self.metrics_data)
+        skeleton.barcode_whitelist = None
+        skeleton.whitelist_set = None
+
+        keys = []
+        arrays = []
+        for key, metric in self.metrics_data.iteritems():
+            array = metric.to_array(self)
+            if array is None:
+                continue
+            stub = copy.copy(metric)
+            stub.clear_array()
+            skeleton.metrics_data[key] = stub
+            keys.append(key)
+            arrays.append(array)
+
+        with h5.File(filename, 'w') as f:
+            pickled = cPickle.dumps((skeleton, keys), protocol=cPickle.HIGHEST_PROTOCOL)
+            f.create_dataset(REPORTER_H5_PICKLE, data=np.frombuffer(pickled, dtype=np.uint8))
+
+            if self.barcode_whitelist:
+                whitelist = np.array(self.barcode_whitelist, dtype='S')
+                ds = f.create_dataset(REPORTER_H5_WHITELIST, data=whitelist,
+                                      compression='gzip', compression_opts=h5_constants.H5_COMPRESSION_LEVEL)
+                ds.attrs[REPORTER_H5_WHITELIST_DIGEST] = hashlib.md5(whitelist.tobytes()).hexdigest()
+
+            group = f.create_group(REPORTER_H5_METRICS)
+            for i, array in enumerate(arrays):
+                group.create_dataset(str(i), data=array, shuffle=True,
+                                     compression='gzip', compression_opts=h5_constants.H5_COMPRESSION_LEVEL)
+
+    @staticmethod
+    def _load_columnar_skeleton(f):
+        """ Returns (reporter without its array data, metric keys, whitelist digest) """
+        reporter, keys = cPickle.loads(f[REPORTER_H5_PICKLE][:].tobytes())
+        digest = None
+        if REPORTER_H5_WHITELIST in f:
+            digest = f[REPORTER_H5_WHITELIST].attrs[REPORTER_H5_WHITELIST_DIGEST]
+        return reporter, keys, digest
+
+    def _load_columnar_whitelist(self, f):
+        if REPORTER_H5_WHITELIST in f:
+            self.barcode_whitelist = f[REPORTER_H5_WHITELIST][:].tolist()
+            self.whitelist_set = set(self.barcode_whitelist)
+            self._barcode_index = None
+
     @staticmethod
     def load(filename):
+        if h5.is_hdf5(filename):
+            with h5.File(filename, 'r') as f:
+                reporter, keys, _ = Reporter._load_columnar_skeleton(f)
+                reporter._load_columnar_whitelist(f)
+                for i, key in enumerate(keys):
+                    reporter.metrics_data[key].add_array(reporter, f[REPORTER_H5_METRICS][str(i)][:])
+            return reporter
+
         with open(filename, 'rb') as f:
             return cPickle.load(f)
 
-def merge_reporters(filenames):
+def _sum_columnar_metrics(files):
+    """ Sum the array metrics of columnar reporter files.
+        Args: files - list of (filename, metric keys)
+        Returns: dict of metric key: summed array """
+    sums = {}
+    for filename, keys in files:
+        with h5.File(filename, 'r') as f:
+            for i, key in enumerate(keys):
+                array = f[REPORTER_H5_METRICS][str(i)][:]
+                if key in sums:
+                    sums[key] += array
+                else:
+                    sums[key] = array
+    return sums
+
+def _add_metric_sums(sums, other):
+    for key, array in other.iteritems():
+        if key in sums:
+            sums[key] += array
+        else:
+            sums[key] = array
+    return sums
+
+def merge_reporters(filenames, threads=1):
+    """ Merge reporters saved with Reporter.save or Reporter.save_columnar.
+        The array metrics of columnar files are summed in 'threads' processes
+        and added to the merged reporter at the end. """
     reporter = None
+    columnar_files = []
+    whitelist_digests = set()
+
     for filename in filenames:
-        tmp_reporter = Reporter.load(filename)
+        if h5.is_hdf5(filename):
+            with h5.File(filename, 'r') as f:
+                tmp_reporter, keys, digest = Reporter._load_columnar_skeleton(f)
+            columnar_files.append((filename, keys))
+            whitelist_digests.add(digest)
+        else:
+            tmp_reporter = Reporter.load(filename)
+
         if reporter is None:
             reporter = tmp_reporter
         else:
             reporter.merge(tmp_reporter)
 
+    if len(columnar_files) == 0:
+        return reporter
+
+    assert len(whitelist_digests) == 1, 'Columnar reporters have different barcode whitelists'
+    if not reporter.barcode_whitelist:
+        with h5.File(columnar_files[0][0], 'r') as f:
+            reporter._load_columnar_whitelist(f)
+
+    # Sum each group of files in its own process, then combine the partial sums
+    num_groups = max(1, min(threads, len(columnar_files)))
+    groups = [columnar_files[i::num_groups] for i in xrange(num_groups)]
+    if num_groups == 1:
+        partial_sums = [_sum_columnar_metrics(columnar_files)]
+    else:
+        pool = Pool(num_groups)
+        try:
+            partial_sums = pool.map(_sum_columnar_metrics, groups, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    sums = reduce(_add_metric_sums, partial_sums)
+
+    for key, array in sums.iteritems():
+        # Metrics that were never active in any chunk have no data to add
+        if key in reporter.metrics_data:
+            reporter.metrics_data[key].add_array(reporter, array)
+
     return reporter
 
 def merge_jsons(in_filenames, out_filename, dicts=[]):
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2018 10X Genomics, Inc. All rights reserved.
+#
+# Unit tests for the columnar serialization of cellranger.report.Reporter
+#
+
+import json
+import numpy as np
+import os
+import shutil
+import tempfile
+import tenkit.safe_json as tk_safe_json
+import tenkit.test as tk_test
+import cellranger.constants as cr_constants
+import cellranger.library_constants as lib_constants
+import cellranger.report as cr_report
+
+GENOMES = ['hg19', 'mm10']
+GEM_GROUPS = [1, 1, 2]
+
+class TestReporterColumnar(tk_test.UnitTestBase):
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+        self.whitelist = sorted(set(str(''.join(self.rng.choice(list('ACGT'), 16))) for _ in xrange(500)))
+        self.out_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def out_path(self, filename):
+        return os.path.join(self.out_dir, filename)
+
+    def make_reporter(self, chunk):
+        reporter = cr_report.Reporter(barcode_whitelist=self.whitelist,
+                                      gem_groups=GEM_GROUPS,
+                                      genomes=GENOMES,
+                                      library_types=[lib_constants.GENE_EXPRESSION_LIBRARY_TYPE])
+        get_metric = reporter._get_metric_attr
+
+        for genome in GENOMES + [lib_constants.MULTI_REFS_PREFIX]:
+            # Barcode counts, including a barcode off the whitelist in one chunk
+            barcoded_reads = get_metric('transcriptome_conf_mapped_barcoded_reads', '', genome)
+            for _ in xrange(200):
+                bc = '%s-%d' % (self.rng.choice(self.whitelist), self.rng.choice(GEM_GROUPS))
+                barcoded_reads.add(bc, value=self.rng.randint(1, 10))
+            if chunk == 1:
+                barcoded_reads.add('N' * 16 + '-1')
+
+            # Only active in some chunks
+            if chunk != 0:
+                deduped_reads = get_metric('transcriptome_conf_mapped_deduped_barcoded_reads', '', genome)
+                for _ in xrange(50):
+                    deduped_reads.add('%s-2' % self.rng.choice(self.whitelist))
+
+            for dupe_type in cr_constants.DUPE_TYPES:
+                histogram = get_metric('reads_per_molecule_histogram', genome, dupe_type)
+                for value in self.rng.randint(1, 2 * cr_constants.PER_DUPE_GROUP_MAX, 100):
+                    histogram.add(value)
+                get_metric('dupe_reads_frac', genome, dupe_type).add(1, filter=self.rng.rand() < 0.5)
+
+        for _ in xrange(100):
+            get_metric('top_raw_barcodes').add(self.rng.choice(self.whitelist))
+        get_metric('total_reads').add(self.rng.randint(1000))
+        return reporter
+
+    def get_reports(self, reporter):
+        return [json.dumps(tk_safe_json.json_sanitize(reporter.report(report_type)), sort_keys=True)
+                for report_type in [cr_constants.DEFAULT_REPORT_TYPE, 'barcodes']]
+
+    def test_load_columnar(self):
+        reporter = self.make_reporter(1)
+        filename = self.out_path('reporter_columnar.h5')
+        reporter.save_columnar(filename)
+        self.assertEqual(self.get_reports(reporter), self.get_reports(cr_report.Reporter.load(filename)))
+
+    def test_merge_columnar(self):
+        num_chunks = 5
+        pickled_filenames = []
+        columnar_filenames = []
+        for chunk in xrange(num_chunks):
+            reporter = self.make_reporter(chunk)
+            pickled_filenames.append(self.out_path('reporter_%d.pickle' % chunk))
+            reporter.save(pickled_filenames[-1])
+            columnar_filenames.append(self.out_path('reporter_%d.h5' % chunk))
+            reporter.save_columnar(columnar_filenames[-1])
+
+        expected = self.get_reports(cr_report.merge_reporters(pickled_filenames))
+        self.assertNotEqual(json.loads(expected[1]), {})
+
+        for threads in [1, 3]:
+            merged = cr_report.merge_reporters(columnar_filenames, threads=threads)
+            self.assertEqual(expected, self.get_reports(merged))
+
+        # Pickled and columnar files can be mixed
+        mixed = pickled_filenames[:2] + columnar_filenames[2:]
+        self.assertEqual(expected, self.get_reports(cr_report.merge_reporters(mixed, threads=2)))
+
+if __name__ == '__main__':
+    tk_test.run_tests()
@@ -6,6 +6,7 @@ import itertools
 import numpy as np
 import tenkit.stats as tk_stats
 import cellranger.stats as cr_stats
+import cellranger.vdj.umi_info as vdj_umi_info
 
 def call_vdj_cells(umi_barcode_idx,
                    umi_read_pairs,
@@ -115,11 +116,9 @@ def call_vdj_cells(umi_barcode_idx,
         print "Frac reads in top RPU component: %0.4f" % frac_top
 
 
-    # Filter UMIs by the computed threshold
-    filt_umi_info = umi_info[umi_info[:,1] >= rpu_threshold, :]
-
-    # Count the number of filtered UMIs for each BC
-    bc_filt_umis = np.bincount(filt_umi_info[:,0], minlength=len(barcodes))
+    # Count the number of UMIs passing the computed threshold for each BC
+    bc_filt_umis = vdj_umi_info.get_umis_per_barcode(umi_info[:,0], umi_info[:,1], len(barcodes),
+                                                     min_read_pairs=rpu_threshold)
     bc_filt_umis_nz = bc_filt_umis[np.flatnonzero(bc_filt_umis)]
 
 
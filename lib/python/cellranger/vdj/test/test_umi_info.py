@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2017 10X Genomics, Inc. All rights reserved.
+#
+# Unit tests for cellranger.vdj.umi_info.py
+#
+
+import itertools
+import numpy as np
+import tenkit.test as tk_test
+import cellranger.vdj.umi_info as vdj_umi_info
+
+class TestUmiInfo(tk_test.UnitTestBase):
+    def setUp(self):
+        np.random.seed(0)
+
+    def test_get_barcode_gem_groups(self):
+        barcodes = np.array(['AAAC-1', 'CCGT-2', 'GGTA-12'])
+        self.assertEqual(vdj_umi_info.get_barcode_gem_groups(barcodes).tolist(), [1, 2, 12])
+        self.assertEqual(len(vdj_umi_info.get_barcode_gem_groups(np.array([], dtype=str))), 0)
+
+    def test_get_umi_read_pairs(self):
+        num_rows = 5000
+        # The last block of rows repeats barcodes seen earlier, as in an unsorted chunk
+        barcode_idx = np.concatenate((np.sort(np.random.randint(0, 100, num_rows - 100)),
+                                      np.random.randint(0, 100, 100))).astype(np.uint32)
+        umi_idx = np.random.randint(0, 50, num_rows).astype(np.uint32)
+        reads = np.random.randint(1, 20, num_rows).astype(np.uint32)
+
+        expected = []
+        for bc_idx, data_iter in itertools.groupby(itertools.izip(barcode_idx, umi_idx, reads),
+                                                  key=lambda x: x[0]):
+            bc_umi_read_pairs = {}
+            for _, umi, r in data_iter:
+                bc_umi_read_pairs[umi] = bc_umi_read_pairs.get(umi, 0) + r
+            expected.extend((bc_idx, r) for r in bc_umi_read_pairs.itervalues())
+
+        umi_barcode_idx, umi_read_pairs = vdj_umi_info.get_umi_read_pairs(barcode_idx, umi_idx, reads)
+        self.assertEqual(sorted(expected), sorted(zip(umi_barcode_idx.tolist(), umi_read_pairs.tolist())))
+
+        umis_per_bc = vdj_umi_info.get_umis_per_barcode(umi_barcode_idx, umi_read_pairs, 100, min_read_pairs=10)
+        self.assertEqual(umis_per_bc.tolist(),
+                         np.bincount([bc for bc, r in expected if r >= 10], minlength=100).tolist())
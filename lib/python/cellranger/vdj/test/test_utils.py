@@ -6,9 +6,20 @@
 #
 
 import json
+import os
+import random
+import resource
 import StringIO
+import time
+import tenkit.fasta as tk_fasta
 import tenkit.test as tk_test
+import cellranger.constants as cr_constants
+import cellranger.fastq as cr_fastq
 import cellranger.vdj.utils as vdj_utils
+from cellranger.vdj.test import out_path
+
+def random_seq(n):
+    return ''.join(random.choice('ACGT') for _ in xrange(n))
 
 class TestVdjUtils(tk_test.UnitTestBase):
     def setUp(self):
@@ -24,3 +35,60 @@ class TestVdjUtils(tk_test.UnitTestBase):
                ]'''
 
         self.assertEqual(json.loads(s), list(vdj_utils.get_json_obj_iter(StringIO.StringIO(s))))
+
+    def test_set_header_tag(self):
+        for hdr in ['read1 1:N:0:0', 'read1', 'read1|||UR|||ACGT 1:N', 'read1|||CB|||AAAA-1|||UR|||ACGT 1:N']:
+            expected = cr_fastq.AugmentedFastqHeader(hdr)
+            expected_stripped = expected.fastq_header
+            expected.set_tag(cr_constants.PROCESSED_BARCODE_TAG, 'CCCC-1')
+
+            self.assertEqual(expected.to_string(),
+                             cr_fastq.AugmentedFastqHeader.set_header_tag(hdr, cr_constants.PROCESSED_BARCODE_TAG, 'CCCC-1'))
+            self.assertEqual(expected_stripped, cr_fastq.AugmentedFastqHeader.strip_header_tags(hdr))
+
+    def test_fastq_bucket_writer(self):
+        """ Check the spilling bucket writer against an in-memory sort and
+            report reads/sec and peak RSS """
+        random.seed(0)
+        barcodes = [random_seq(16) + '-1' for _ in xrange(500)]
+        reads = []
+        for i in xrange(50000):
+            bc = random.choice(barcodes)
+            # Repeat some qnames so that ties are broken by input order
+            name = 'read%d|||UR|||%s 1:N:0:0' % (i % 40000, random_seq(10))
+            reads.append((bc, name, random_seq(100), 'I' * 100))
+
+        num_buckets = 4
+        bucket = lambda bc: str(hash(bc) % num_buckets)
+
+        expected = {str(b): [] for b in xrange(num_buckets)}
+        for bc, name, seq, qual in reads:
+            hdr = cr_fastq.AugmentedFastqHeader(name)
+            hdr.set_tag(cr_constants.PROCESSED_BARCODE_TAG, bc)
+            expected[bucket(bc)].append((hdr.to_string(), seq, qual))
+        for bucket_reads in expected.itervalues():
+            bucket_reads.sort(key=vdj_utils.fastq_barcode_sort_key)
+
+        for max_buffer_bytes, compress_spills in [(1e9, False), (1e6, False), (1e6, True)]:
+            filenames = {str(b): out_path('bucket_%d.fastq' % b) for b in xrange(num_buckets)}
+            writer = vdj_utils.FastqBucketWriter(filenames, max_buffer_bytes, compress_spills)
+
+            start = time.time()
+            for bc, name, seq, qual in reads:
+                new_name = cr_fastq.AugmentedFastqHeader.set_header_tag(name, cr_constants.PROCESSED_BARCODE_TAG, bc)
+                writer.write(bucket(bc), bc, cr_fastq.AugmentedFastqHeader.strip_header_tags(name),
+                             new_name, seq, qual)
+            written = writer.close()
+            elapsed = time.time() - start
+
+            print 'max_buffer_bytes=%d, spills=%d: %.0f reads/sec, peak RSS %.1f MB' % \
+                (max_buffer_bytes, writer.num_spills, len(reads) / elapsed,
+                 resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3)
+
+            self.assertEqual(written, filenames)
+            for bucket_name, filename in written.iteritems():
+                with open(filename) as f:
+                    self.assertEqual(expected[bucket_name], list(tk_fasta.read_generator_fastq(f)))
+                os.remove(filename)
+                self.assertFalse(any(fn.startswith(os.path.basename(filename) + '.spill')
+                                     for fn in os.listdir(os.path.dirname(filename))))
@@ -64,3 +64,46 @@ def get_column(filename, col):
     """ Load a column into memory """
     with tables.open_file(filename, 'r') as h5:
         return getattr(h5.root, col)[:]
+
+def get_barcode_gem_groups(barcodes):
+    """ Get the integer gem group of each barcode string (e.g. 'ACGT-2' -> 2) """
+    barcodes = np.asarray(barcodes)
+    if len(barcodes) == 0:
+        return np.zeros(0, dtype=int)
+    return np.char.partition(barcodes, '-')[:, 2].astype(int)
+
+def get_umi_read_pairs(barcode_idx, umi_idx, reads):
+    """ Sum the read pairs of each UMI within each barcode.
+        Rows are grouped by runs of equal barcode_idx, as the umi info is sorted by barcode.
+        Args: barcode_idx, umi_idx, reads (np.array) - umi info columns (or a range of rows)
+        Returns: (umi_barcode_idx, umi_read_pairs) - one entry per (barcode, UMI),
+                 ordered by barcode run and then UMI """
+    assert len(barcode_idx) == len(umi_idx) == len(reads)
+
+    if len(barcode_idx) == 0:
+        return np.zeros(0, dtype=get_dtype('barcode_idx')), np.zeros(0, dtype=np.int64)
+
+    # Number each run of barcode_idx so that the grouping matches iterating over the rows
+    bc_run = np.zeros(len(barcode_idx), dtype=np.int64)
+    np.cumsum(barcode_idx[1:] != barcode_idx[:-1], out=bc_run[1:])
+
+    order = np.lexsort((umi_idx, bc_run))
+    sorted_run = bc_run[order]
+    sorted_umi = umi_idx[order]
+
+    new_group = np.ones(len(order), dtype=bool)
+    new_group[1:] = (sorted_run[1:] != sorted_run[:-1]) | (sorted_umi[1:] != sorted_umi[:-1])
+    starts = np.flatnonzero(new_group)
+
+    umi_barcode_idx = barcode_idx[order[starts]]
+    umi_read_pairs = np.add.reduceat(reads[order].astype(np.int64), starts)
+
+    return umi_barcode_idx, umi_read_pairs
+
+def get_umis_per_barcode(umi_barcode_idx, umi_read_pairs, num_barcodes, min_read_pairs=1):
+    """ Count the UMIs with at least min_read_pairs read pairs in each barcode.
+        Args: umi_barcode_idx, umi_read_pairs (np.array) - output of get_umi_read_pairs
+              num_barcodes (int) - length of the barcodes column
+        Returns: np.array(int) of UMI counts indexed by barcode_idx """
+    use_umis = umi_read_pairs >= min_read_pairs
+    return np.bincount(umi_barcode_idx[use_umis], minlength=num_barcodes)
@@ -3,6 +3,7 @@
 # Copyright (c) 2017 10X Genomics, Inc. All rights reserved.
 #
 
+import heapq
 import itertools
 import json
 import numpy as np
@@ -14,6 +15,8 @@ import tenkit.bam as tk_bam
 import tenkit.cache as tk_cache
 import cellranger.constants as cr_constants
 import cellranger.fastq as cr_fastq
+import cellranger.h5_constants as h5_constants
+import cellranger.io as cr_io
 import cellranger.vdj.constants as vdj_constants
 
 
@@ -257,3 +260,99 @@ class CachedJsonDictListWriters(object):
         """ d (dict) - data to write
             file_idx (int) - index of filename/writer in original given list """
         self.writers[file_idx].write(d, self.cache.get(self.filenames[file_idx]))
+
+class FastqBucketWriter(object):
+    """ Distribute FASTQ reads into bucket files, each sorted as if by
+        fastq_barcode_sort_key (barcode, then qname; ties in input order).
+        Reads are buffered in memory; once the buffered reads exceed max_buffer_bytes
+        every bucket is sorted and spilled to a run file, and the runs are merged when the
+        writer is closed. Bucket files are plain FASTQ; spill runs are optionally lz4'd. """
+
+    # Rough python overhead of a buffered read, in addition to its text
+    READ_OVERHEAD_BYTES = 250
+
+    def __init__(self, filenames, max_buffer_bytes, compress_spills=False):
+        """ filenames (dict of str:str) - bucket name to output FASTQ filename
+            max_buffer_bytes (int) - approximate memory budget for buffered reads
+            compress_spills (bool) - lz4-compress spilled runs """
+        self.filenames = filenames
+        self.max_buffer_bytes = max_buffer_bytes
+        self.spill_suffix = h5_constants.LZ4_SUFFIX if compress_spills else ''
+
+        self.buffers = {name: [] for name in filenames}
+        self.spills = {name: [] for name in filenames}
+        self.buffer_bytes = 0
+        self.num_spills = 0
+
+    def write(self, bucket_name, barcode, stripped_name, name, seq, qual):
+        """ barcode (str) - processed barcode, the primary sort key
+            stripped_name (str) - qname without tags, the secondary sort key
+            name, seq, qual (str) - the FASTQ record """
+        record = '@' + name + '\n' + seq + '\n+\n' + qual + '\n'
+        self.buffers[bucket_name].append(((barcode, stripped_name), record))
+        self.buffer_bytes += len(record) + len(stripped_name) + self.READ_OVERHEAD_BYTES
+
+        if self.buffer_bytes > self.max_buffer_bytes:
+            self.spill()
+
+    def spill(self):
+        """ Write each non-empty buffer out as a sorted run """
+        for bucket_name, buf in self.buffers.iteritems():
+            if len(buf) == 0:
+                continue
+            buf.sort(key=lambda x: x[0])
+
+            filename = '%s.spill%d%s' % (self.filenames[bucket_name], len(self.spills[bucket_name]),
+                                         self.spill_suffix)
+            with cr_io.open_maybe_gzip(filename, 'w') as f:
+                for (barcode, stripped_name), record in buf:
+                    f.write(barcode + '\n' + stripped_name + '\n' + record)
+
+            self.spills[bucket_name].append(filename)
+            self.buffers[bucket_name] = []
+
+        self.buffer_bytes = 0
+        self.num_spills += 1
+
+    @staticmethod
+    def _read_spill(filename, run_idx):
+        """ Yield ((barcode, stripped_name), run_idx, record) from a spilled run """
+        with cr_io.open_maybe_gzip(filename, 'r') as f:
+            while True:
+                lines = list(itertools.islice(f, 6))
+                if len(lines) == 0:
+                    break
+                yield (lines[0][:-1], lines[1][:-1]), run_idx, ''.join(lines[2:])
+
+    def close(self):
+        """ Write all bucket files and remove spilled runs.
+            Returns dict of bucket name to filename for the non-empty buckets. """
+        written = {}
+
+        for bucket_name, buf in self.buffers.iteritems():
+            spills = self.spills[bucket_name]
+            if len(buf) == 0 and len(spills) == 0:
+                continue
+
+            filename = self.filenames[bucket_name]
+            with open(filename, 'w') as f:
+                if len(spills) == 0:
+                    buf.sort(key=lambda x: x[0])
+                    for _, record in buf:
+                        f.write(record)
+                else:
+                    # Merge the in-memory reads as the most recent run
+                    buf.sort(key=lambda x: x[0])
+                    runs = [self._read_spill(fn, i) for i, fn in enumerate(spills)]
+                    runs.append((key, len(spills), record) for key, record in buf)
+                    for _, _, record in heapq.merge(*runs):
+                        f.write(record)
+
+            for spill_filename in spills:
+                os.remove(spill_filename)
+
+            written[bucket_name] = filename
+            self.buffers[bucket_name] = []
+            self.spills[bucket_name] = []
+
+        return written
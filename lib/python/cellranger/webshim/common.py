@@ -531,8 +531,9 @@ def plot_preprocess(analyses, sample_properties):
 def load_sample_data(sample_properties, sample_data_paths):
     return SampleData(sample_properties, sample_data_paths, plot_preprocess)
 
-def plot_tsne(chart, sample_properties, sample_data):
-    """ Plot cells in t-SNE space, colored by clustering label """
+def plot_tsne(chart, sample_properties, sample_data, **kwargs):
+    """ Plot cells in t-SNE space, colored by clustering label.
+        kwargs['max_points'], if given, limits the number of cells plotted """
     analysis = sample_data.get_analysis(SingleGenomeAnalysis)
     if analysis is None:
         return None
@@ -540,12 +541,34 @@ def plot_tsne(chart, sample_properties, sample_data):
     args = [analysis.get_tsne().transformed_tsne_matrix,
             ws_gex_constants.TSNE_CLUSTER_DESCRIPTION,
             1, 2]
-    return clustering_plot_func(chart, sample_properties, sample_data, plot_dimensions, args)
+    return clustering_plot_func(chart, sample_properties, sample_data, plot_dimensions, args,
+                                {'max_points': kwargs.get('max_points')})
+
+def format_data_values(values):
+    """ Format each value of an array with DATA_VALUE_FORMAT. Returns a list of strings """
+    return np.char.mod(shared_constants.DATA_VALUE_FORMAT, values).tolist()
+
+def group_by_value(values):
+    """ Returns a list of (value, indices) for each distinct value, where indices are
+        the increasing positions of that value in the array """
+    order = np.argsort(values, kind='mergesort')
+    unique_values, starts = np.unique(values[order], return_index=True)
+    return zip(unique_values, np.split(order, starts[1:]))
+
+def subsample_points(num_points, max_points):
+    """ Returns the sorted indices of a random subset of max_points points,
+        or None if there are no more than max_points """
+    if max_points is None or num_points <= max_points:
+        return None
+    rng = np.random.RandomState(0)
+    return np.sort(rng.choice(num_points, max_points, replace=False))
 
 def plot_dimensions(chart, transformed_matrix, description, pc1, pc2,
                     clip=None, clustering=None, diff_expr=None, values=None,
-                    original_cluster_sizes=None):
-    """ Plot cells in a 2-d space, colored by clustering label """
+                    original_cluster_sizes=None, max_points=None):
+    """ Plot cells in a 2-d space, colored by clustering label.
+        If max_points is given, only a random subset of that many cells is plotted;
+        cluster sizes in the legend still count all cells. """
     assert (values is not None and clustering is None) or \
         (clustering is not None and values is None and original_cluster_sizes is not None)
 
@@ -580,14 +603,15 @@ def plot_dimensions(chart, transformed_matrix, description, pc1, pc2,
             },
         }
 
-    for i in xrange(n):
-        r1 = shared_constants.DATA_VALUE_FORMAT % transformed_matrix[i, pc1-1]
-        r2 = shared_constants.DATA_VALUE_FORMAT % transformed_matrix[i, pc2-1]
-        value = values[i]
+    plotted = subsample_points(n, max_points)
+    if plotted is None:
+        plotted = np.arange(n)
 
+    for value, indices in group_by_value(values[plotted]):
+        cells = plotted[indices]
         series = chart['data'][value - 1]
-        series['x'].append(r1)
-        series['y'].append(r2)
+        series['x'].extend(format_data_values(transformed_matrix[cells, pc1-1]))
+        series['y'].extend(format_data_values(transformed_matrix[cells, pc2-1]))
 
     if clip is not None:
         xmin, xmax = np.percentile(transformed_matrix[:, pc1-1], clip)
@@ -602,7 +626,10 @@ def plot_dimensions(chart, transformed_matrix, description, pc1, pc2,
     chart['config'] = shared_constants.CHARTS_PLOTLY_MOVABLE_CONFIG
     return chart
 
-def plot_dimensions_color(chart, transformed_matrix, values, description, vmin, vmax, pc1, pc2):
+def plot_dimensions_color(chart, transformed_matrix, values, description, vmin, vmax, pc1, pc2,
+                          max_points=None):
+    """ Plot cells in a 2-d space, in random order, colored by value.
+        If max_points is given, only a random subset of that many cells is plotted. """
     _, m = transformed_matrix.shape
     if m < max(pc1, pc2):
         return None
@@ -611,26 +638,20 @@ def plot_dimensions_color(chart, transformed_matrix, values, description, vmin,
 
     index_order = range(transformed_matrix.shape[0])
     random.shuffle(index_order)
-    for i in index_order:
-        r1 = shared_constants.DATA_VALUE_FORMAT % transformed_matrix[i, pc1-1]
-        r2 = shared_constants.DATA_VALUE_FORMAT % transformed_matrix[i, pc2-1]
-        value = int(values[i])
-        text = '%s: %s' % (description, format_value(value, 'integer'))
-
-        if value < vmin:
-            value = vmin
-        if value > vmax:
-            value = vmax
-
-        series['x'].append(r1)
-        series['y'].append(r2)
-        series['marker']['color'].append(value)
-        series['text'].append(text)
+    index_order = np.array(index_order[:max_points], dtype=int)
+
+    int_values = np.asarray(values)[index_order].astype(int).tolist()
+
+    series['x'].extend(format_data_values(transformed_matrix[index_order, pc1-1]))
+    series['y'].extend(format_data_values(transformed_matrix[index_order, pc2-1]))
+    series['marker']['color'].extend([min(max(value, vmin), vmax) for value in int_values])
+    series['text'].extend(['%s: %s' % (description, format_value(value, 'integer')) for value in int_values])
 
     return chart
 
-def plot_tsne_totalcounts(chart, sample_properties, sample_data):
-    """ Plot cells colored by total counts """
+def plot_tsne_totalcounts(chart, sample_properties, sample_data, **kwargs):
+    """ Plot cells colored by total counts.
+        kwargs['max_points'], if given, limits the number of cells plotted """
     analysis = sample_data.get_analysis(SingleGenomeAnalysis)
     if not analysis:
         return None
@@ -642,7 +663,8 @@ def plot_tsne_totalcounts(chart, sample_properties, sample_data):
                                  reads_per_bc,
                                  ws_gex_constants.TSNE_TOTALCOUNTS_DESCRIPTION,
                                  vmin, vmax,
-                                 1, 2)
+                                 1, 2,
+                                 max_points=kwargs.get('max_points'))
 
 def _plot_differential_expression(chart, analysis, clustering=None, diff_expr=None, original_cluster_sizes=None):
     n_clusters = clustering.clusters.max()
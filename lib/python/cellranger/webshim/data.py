@@ -14,16 +14,18 @@ import cellranger.webshim.constants.gex as gex_constants
 import cellranger.utils as cr_utils
 
 import collections
+import itertools
 import numpy as np
 
 BarcodeRankPlotSegment = collections.namedtuple('BarcodeRankPlotSegment', ['start', 'end', 'cell_density', 'legend'])
 
-def get_plot_segment(start_index, end_index, sorted_bc, cell_barcodes, legend=False):
+def get_plot_segment(start_index, end_index, cum_num_cells, legend=False):
     """
     Helper function to build a plot segment.
+    cum_num_cells[i] is the number of cells among the first i sorted barcodes.
     """
     assert end_index > start_index
-    num_cells = sum([1 for i in xrange(start_index, end_index) if sorted_bc[i] in cell_barcodes])
+    num_cells = cum_num_cells[end_index] - cum_num_cells[start_index]
     density = float(num_cells)/float(end_index-start_index)
     return BarcodeRankPlotSegment(start=start_index, end=end_index, cell_density=density, legend=legend)
 
@@ -89,24 +91,23 @@ class SampleData:
             - plot_segments: List of BarcodeRankPlotSegment
         """
         counts_per_bc = self.barcode_summary[key][:]
-        srt_order = sorted(range(len(counts_per_bc)), key=lambda x: counts_per_bc[x], reverse=True)
+        # Descending by count; ties keep their original order
+        srt_order = np.argsort(counts_per_bc[::-1], kind='mergesort')[::-1]
+        srt_order = len(counts_per_bc) - 1 - srt_order
         sorted_bc = self.barcode_summary['bc_sequence'][:][srt_order]
         sorted_counts = counts_per_bc[srt_order]
         del srt_order
- 
+
+        is_cell = np.in1d(sorted_bc, list(self.cell_barcodes))
+        cum_num_cells = np.concatenate(([0], np.cumsum(is_cell)))
+
         # find the first barcode which is not a cell
-        first_non_cell = len(sorted_bc)
-        for i, bc in enumerate(sorted_bc):
-            if bc not in self.cell_barcodes:
-                first_non_cell = i
-                break
+        non_cells = np.flatnonzero(~is_cell)
+        first_non_cell = non_cells[0] if len(non_cells) > 0 else len(sorted_bc)
 
         # find the last barcode which is a cell
-        last_cell = 0 
-        for i in reversed(xrange(len(sorted_bc))):
-            if sorted_bc[i] in self.cell_barcodes:
-                last_cell = i
-                break
+        cells = np.flatnonzero(is_cell)
+        last_cell = cells[-1] if len(cells) > 0 else 0
 
         ranges = [0, first_non_cell, last_cell+1, len(sorted_bc)]
 
@@ -117,7 +118,7 @@ class SampleData:
         # Subdivide the mixed section
         mixed_segments = segment_log_plot_by_length(sorted_counts, ranges[1], ranges[2])
         for i in xrange(len(mixed_segments)-1):
-            plot_segments.append(get_plot_segment(mixed_segments[i], mixed_segments[i+1], sorted_bc, self.cell_barcodes, legend=False))
+            plot_segments.append(get_plot_segment(mixed_segments[i], mixed_segments[i+1], cum_num_cells, legend=False))
 
         return sorted_counts, plot_segments
 
@@ -138,14 +139,18 @@ def segment_log_plot_by_length(y_data, x_start, x_end):
     log_max_x = np.log(len(y_data))
     log_max_y = np.log(max(y_data))
 
+    # Length of each step along the curve
+    x = np.arange(x_start, x_end)
+    last_x = np.maximum(x_start, x - 1)
+    dx = (np.log(x) - np.log(last_x)) / log_max_x
+    dy = (np.log(y_data[x]) - np.log(y_data[last_x])) / log_max_y
+    step_lens = np.sqrt(dx*dx + dy*dy)
+
     this_segment_len = 0.0
     segment_idx = [x_start]
 
-    for i in xrange(x_start, x_end):
-        last_i = max(x_start, i-1)
-        dx = (np.log(i) - np.log(last_i)) / log_max_x
-        dy = (np.log(y_data[i]) - np.log(y_data[last_i])) / log_max_y
-        this_segment_len += np.linalg.norm([dx, dy])
+    for i, step_len in itertools.izip(xrange(x_start, x_end), step_lens.tolist()):
+        this_segment_len += step_len
         if this_segment_len >= SEGMENT_NORMALIZED_MAX_LEN and i > (segment_idx[-1] + MIN_X_SPAN):
             segment_idx.append(i+1)
             this_segment_len = 0.0
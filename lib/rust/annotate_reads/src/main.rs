@@ -40,6 +40,9 @@ use std::fs::File;
 use std::io::{BufReader};
 use std::str;
 use std::collections::{HashSet, HashMap, BTreeMap};
+use std::sync::{Arc, Mutex, mpsc};
+use std::thread;
+use std::panic;
 use failure::Error;
 
 use docopt::Docopt;
@@ -62,7 +65,7 @@ use utils::CellrangerFastqHeader;
 
 const USAGE: &'static str = "
 Usage:
-  annotate_reads main <in-bam> <in-tags> <out-bam> <out-metrics> <reference-path> <gene-index> <bc-counts> <bc-whitelist> <gem-group> <out-metadata> <strandedness> <feature-dist> <library-type> <library-id> <library-info> [--fiveprime] [--skip-translate] [--bam-comments=F] [--feature-ref=F]
+  annotate_reads main <in-bam> <in-tags> <out-bam> <out-metrics> <reference-path> <gene-index> <bc-counts> <bc-whitelist> <gem-group> <out-metadata> <strandedness> <feature-dist> <library-type> <library-id> <library-info> [--fiveprime] [--skip-translate] [--bam-comments=F] [--feature-ref=F] [--threads=N]
   annotate_reads join <in-chunked-metrics> <out-json> <out-bc-csv>
   annotate_reads (-h | --help)
 
@@ -72,6 +75,7 @@ Options:
   --fiveprime          Assume reads originate from 5' end (instead of 3').
   --bam-comments=F     JSON file with array of strings to append as @CO items
   --feature-ref=F      Feature definition file (CSV)
+  --threads=N          Number of threads to annotate and compress records on [default: 1]
 ";
 
 #[derive(Debug, Deserialize, Clone)]
@@ -101,6 +105,7 @@ struct Args {
     flag_skip_translate:    bool,
     flag_bam_comments:      Option<String>,
     flag_feature_ref:       Option<String>,
+    flag_threads:           usize,
 
     // join args
     arg_in_chunked_metrics: Option<String>,
@@ -110,6 +115,13 @@ struct Args {
 
 const LIBRARY_INDEX_TAG: &'static str = "li";
 
+// Number of qnames sent to a worker at a time when running on multiple threads
+const QNAME_BATCH_SIZE: usize = 1024;
+
+// Batches read ahead of the next one to be written, per worker.
+// Bounds the number of records held in memory.
+const BATCHES_IN_FLIGHT_PER_THREAD: usize = 4;
+
 #[derive(Deserialize, Serialize, Debug)]
 pub struct LibraryInfo {
     library_id: String,
@@ -141,11 +153,11 @@ fn annotate_reads_main(args: Args) -> Result<(), Error> {
         junction_trim_bases:        0,
         region_min_overlap:         0.5,
     };
-    let annotator = TranscriptAnnotator::new(&reference_path, &args.arg_gene_index.clone().unwrap(), params);
+    let annotator = Arc::new(TranscriptAnnotator::new(&reference_path, &args.arg_gene_index.clone().unwrap(), params));
 
 
     println!("Loading whitelist");
-    let gem_group = &args.arg_gem_group.unwrap();
+    let gem_group = args.arg_gem_group.unwrap();
 
     // Attempt to translate barcodes only if the library type specifies that we should
     // If skip_translate is True for this chunk (gem_group, library_type combo), as determined by check_barcodes_compatibility,
@@ -160,16 +172,16 @@ fn annotate_reads_main(args: Args) -> Result<(), Error> {
         }
     };
 
-    let bc_umi_checker = barcodes::BarcodeUmiChecker::new(&args.arg_bc_counts.unwrap(),
-                                                          &args.arg_bc_whitelist.unwrap(),
-                                                          gem_group,
-                                                          translate_barcodes,
-                                                          &args.arg_library_type.as_ref().unwrap());
+    let bc_umi_checker = Arc::new(barcodes::BarcodeUmiChecker::new(&args.arg_bc_counts.unwrap(),
+                                                                   &args.arg_bc_whitelist.unwrap(),
+                                                                   &gem_group,
+                                                                   translate_barcodes,
+                                                                   &args.arg_library_type.as_ref().unwrap()));
 
 
-    let feature_checker = match (&args.flag_feature_ref,
-                                 &args.arg_feature_dist,
-                                 &args.arg_library_type) {
+    let feature_checker = Arc::new(match (&args.flag_feature_ref,
+                                          &args.arg_feature_dist,
+                                          &args.arg_library_type) {
         (&Some(ref fref_path), &Some(ref fdist_path), &Some(ref library_type)) => {
             if features::library_type_requires_feature_ref(library_type) {
                 println!("Loading feature reference");
@@ -192,7 +204,7 @@ fn annotate_reads_main(args: Args) -> Result<(), Error> {
             }
         },
         _ => None,
-    };
+    });
 
     println!("Setting up BAMs");
     let mut in_bam = bam::Reader::from_path(Path::new(&args.arg_in_bam.unwrap()))?;
@@ -232,6 +244,12 @@ fn annotate_reads_main(args: Args) -> Result<(), Error> {
 
     let mut out_bam = bam::Writer::from_path(Path::new(&args.arg_out_bam.unwrap()), &out_header)?;
 
+    let num_threads = args.flag_threads;
+    if num_threads > 1 {
+        in_bam.set_threads(num_threads)?;
+        out_bam.set_threads(num_threads)?;
+    }
+
     let chroms = in_bam.header().target_names().iter().map(|s| str::from_utf8(s).unwrap().to_string()).collect();
     let genomes = utils::get_reference_genomes(&reference_path);
 
@@ -239,8 +257,6 @@ fn annotate_reads_main(args: Args) -> Result<(), Error> {
 
     println!("Processing reads");
 
-    let mut num_alignments = 0;
-
     let qname_iter = in_bam.records()
         .map(|res| res.unwrap())
         .group_by(|rec| str::from_utf8(rec.qname()).unwrap().to_string());
@@ -252,13 +268,23 @@ fn annotate_reads_main(args: Args) -> Result<(), Error> {
     let library_index = library_info.iter().position(|lib| lib.library_id == library_id)
         .expect(&format!("Could not find library id {} in library info JSON", library_id));
 
-    for ((_qname, genome_alignments), tags_rec) in qname_iter.zip(tags_iter) {
-        num_alignments += genome_alignments.len();
-        process_qname(tags_rec.unwrap().id(),
-                      genome_alignments, &mut reporter,
-                      &annotator, &bc_umi_checker, &feature_checker,
-                      &mut out_bam, &gem_group, library_index)?;
-    }
+    let num_alignments = if num_threads > 1 {
+        let qnames = qname_iter.zip(tags_iter)
+            .map(|((_qname, genome_alignments), tags_rec)| (tags_rec.unwrap().id().to_owned(), genome_alignments));
+        process_qnames_threaded(qnames, &mut reporter,
+                                annotator.clone(), bc_umi_checker.clone(), feature_checker.clone(),
+                                &mut out_bam, gem_group, library_index, num_threads)?
+    } else {
+        let mut num_alignments = 0;
+        for ((_qname, genome_alignments), tags_rec) in qname_iter.zip(tags_iter) {
+            num_alignments += genome_alignments.len();
+            process_qname(tags_rec.unwrap().id(),
+                          genome_alignments, &mut reporter,
+                          &annotator, &bc_umi_checker, &feature_checker,
+                          &mut out_bam, &gem_group, library_index)?;
+        }
+        num_alignments
+    };
 
     println!("Writing metrics");
     reporter.get_metrics().write_binary(&args.arg_out_metrics.unwrap());
@@ -378,6 +404,118 @@ fn process_qname(tag_string: &str,
                  out_bam: &mut bam::Writer,
                  gem_group: &u8,
                  library_index: usize) -> Result<(), Error> {
+    let read_data = annotate_qname(tag_string, genome_alignments,
+                                   annotator, bc_umi_checker, feature_checker,
+                                   gem_group, library_index)?;
+    write_read_data(&read_data, out_bam)?;
+    reporter.update_metrics(&read_data);
+    Ok(())
+}
+
+/// Annotate the records of each qname on a pool of worker threads, in batches.
+/// Batches are written and added to the metrics in input order, so the output BAM
+/// and metrics are the same as those of process_qname run on each qname in turn.
+/// Returns the number of alignments processed.
+fn process_qnames_threaded<I>(qnames: I,
+                              reporter: &mut Reporter,
+                              annotator: Arc<TranscriptAnnotator>,
+                              bc_umi_checker: Arc<BarcodeUmiChecker>,
+                              feature_checker: Arc<Option<FeatureChecker>>,
+                              out_bam: &mut bam::Writer,
+                              gem_group: u8,
+                              library_index: usize,
+                              num_threads: usize) -> Result<usize, Error>
+    where I: Iterator<Item=(String, Vec<Record>)> {
+
+    let (work_tx, work_rx) = mpsc::channel::<(usize, Vec<(String, Vec<Record>)>)>();
+    let (result_tx, result_rx) = mpsc::channel::<(usize, Result<Vec<ReadData>, Error>)>();
+    let work_rx = Arc::new(Mutex::new(work_rx));
+
+    let mut workers = Vec::new();
+    for _ in 0..num_threads {
+        let work_rx = work_rx.clone();
+        let result_tx = result_tx.clone();
+        let annotator = annotator.clone();
+        let bc_umi_checker = bc_umi_checker.clone();
+        let feature_checker = feature_checker.clone();
+
+        workers.push(thread::spawn(move || {
+            loop {
+                let (batch_index, batch) = match work_rx.lock().unwrap().recv() {
+                    Ok(work) => work,
+                    Err(_) => break,
+                };
+                // Report a panic as an error rather than leave the main thread waiting for this batch
+                let result = panic::catch_unwind(panic::AssertUnwindSafe(|| {
+                    batch.into_iter()
+                        .map(|(tag_string, genome_alignments)|
+                             annotate_qname(&tag_string, genome_alignments,
+                                            &annotator, &bc_umi_checker, &feature_checker,
+                                            &gem_group, library_index))
+                        .collect::<Result<Vec<_>, Error>>()
+                })).unwrap_or_else(|_| Err(format_err!("Annotation thread panicked")));
+                if result_tx.send((batch_index, result)).is_err() {
+                    break;
+                }
+            }
+        }));
+    }
+    // Only the workers hold senders now, so the receiver fails if they all die
+    drop(result_tx);
+
+    let max_in_flight = num_threads * BATCHES_IN_FLIGHT_PER_THREAD;
+    let mut num_alignments = 0;
+    let mut num_batches = 0;
+    let mut next_batch = 0;
+    let mut finished_batches = BTreeMap::new();
+    let mut qnames = qnames.fuse();
+
+    loop {
+        let batch: Vec<_> = qnames.by_ref().take(QNAME_BATCH_SIZE).collect();
+        let done = batch.is_empty();
+        if !done {
+            num_alignments += batch.iter().map(|&(_, ref genome_alignments)| genome_alignments.len()).sum::<usize>();
+            work_tx.send((num_batches, batch))
+                .map_err(|_| format_err!("All annotation threads exited early"))?;
+            num_batches += 1;
+        }
+
+        // Wait for results once enough batches are queued, or for all of them once input is exhausted
+        while next_batch < num_batches && (done || num_batches - next_batch >= max_in_flight) {
+            let (batch_index, result) = result_rx.recv()
+                .map_err(|_| format_err!("All annotation threads exited early"))?;
+            finished_batches.insert(batch_index, result);
+
+            while let Some(result) = finished_batches.remove(&next_batch) {
+                for read_data in result? {
+                    write_read_data(&read_data, out_bam)?;
+                    reporter.update_metrics(&read_data);
+                }
+                next_batch += 1;
+            }
+        }
+
+        if done {
+            break;
+        }
+    }
+
+    drop(work_tx);
+    for worker in workers {
+        worker.join().map_err(|_| format_err!("Annotation thread panicked"))?;
+    }
+
+    Ok(num_alignments)
+}
+
+/// Annotate the records of a qname and attach their BAM tags
+fn annotate_qname(tag_string: &str,
+                  genome_alignments: Vec<Record>,
+                  annotator: &TranscriptAnnotator,
+                  bc_umi_checker: &BarcodeUmiChecker,
+                  feature_checker: &Option<FeatureChecker>,
+                  gem_group: &u8,
+                  library_index: usize) -> Result<ReadData, Error> {
     let fastq_header = CellrangerFastqHeader::new(tag_string);
 
     let bc_umi_data = bc_umi_checker.process_barcodes_and_umis(&fastq_header.tags);
@@ -444,7 +582,6 @@ fn process_qname(tag_string: &str,
                            is_conf_mapped_to_transcriptome,
                            is_conf_mapped_to_feature,
                            is_gene_discordant, gem_group, library_index)?;
-            out_bam.write(&r1.rec)?;
         }
         if read_data.is_paired_end() {
             let ref mut r2 = read_data.r2_data[i];
@@ -453,11 +590,20 @@ fn process_qname(tag_string: &str,
                            is_conf_mapped_to_transcriptome,
                            is_conf_mapped_to_feature,
                            is_gene_discordant, gem_group, library_index)?;
-            out_bam.write(&r2.rec)?;
         }
     }
 
-    reporter.update_metrics(&read_data);
+    Ok(read_data)
+}
+
+/// Write the records of a qname, interleaving pairs (R1,R2; R1,R2; ...)
+fn write_read_data(read_data: &ReadData, out_bam: &mut bam::Writer) -> Result<(), Error> {
+    for i in 0 .. read_data.r1_data.len() {
+        out_bam.write(&read_data.r1_data[i].rec)?;
+        if read_data.is_paired_end() {
+            out_bam.write(&read_data.r2_data[i].rec)?;
+        }
+    }
     Ok(())
 }
 
@@ -544,6 +690,7 @@ mod tests {
             flag_skip_translate:    true,
             flag_bam_comments:      None,
             flag_feature_ref:       None,
+            flag_threads:           1,
         };
         annotate_reads_main(args_main).unwrap();
 
@@ -572,6 +719,7 @@ mod tests {
             flag_skip_translate:    true,
             flag_bam_comments:      None,
             flag_feature_ref:       None,
+            flag_threads:           1,
         };
         annotate_reads_join(args_join);
     }
@@ -24,8 +24,13 @@ use rayon::prelude::*;
 use std::io::Read;
 use std::path::{Path, PathBuf};
 
+use std::cmp;
+use std::collections::VecDeque;
 use std::fs::File;
 use std::io::Write;
+use std::mem;
+use std::sync::{mpsc, Arc, Mutex};
+use std::thread;
 use docopt::Docopt;
 use fastq::{parse_path, Record};
 use serde_json::Value;
@@ -48,6 +53,9 @@ Options:
   --compress=TYPE      Output compressed FASTQ files.
                        Valid values: none, lz4, gzip
   --level=N            Output compression level
+  --threads=N          Number of threads. With more than one, each input
+                       is read on its own thread and the remaining threads
+                       (at least one) compress [default: 1]
 ";
 
 #[derive(Serialize, Deserialize)]
@@ -72,6 +80,7 @@ pub struct Args {
     flag_reads_per_fastq: usize,
     flag_compress: Option<CompressionMethod>,
     flag_level: u32,
+    flag_threads: usize,
     flag_martian_args: Option<String>,
     flag_r1: Option<String>,
     flag_r2: Option<String>,
@@ -82,6 +91,7 @@ pub struct Args {
 #[derive(Deserialize, Debug, Clone)]
 enum CompressionMethod { Lz4, Gzip }
 
+#[derive(Clone)]
 struct CompressionSpec{
     method: CompressionMethod,
     level: u32,
@@ -165,24 +175,48 @@ fn run_args(args: Args) -> Result<Vec<(Option<String>, Option<String>, Option<St
 
     let mut _out_chunks = Vec::new();
 
-    // Try to build ThreadPool, but swallow GlobalPoolAlreadyInitialized
-    let _err = rayon::ThreadPoolBuilder::new().num_threads(2).build_global();
-
-    chunks.into_par_iter().map(|(name, in_file, interleaved)| {
+    let reads_per_chunk = |interleaved| {
+        if interleaved {
+            args.flag_reads_per_fastq * 2
+        } else {
+            args.flag_reads_per_fastq
+        }
+    };
 
-        let read_per_chunk =
-            if interleaved {
-                args.flag_reads_per_fastq * 2
-            } else {
-                args.flag_reads_per_fastq
-            };
+    let cmp_spec = match (args.flag_compress.clone(), args.flag_level.clone()) {
+        (None, _) => None,
+        (Some(m), lvl) => Some(CompressionSpec{method: m, level: lvl}),
+    };
 
-        let cmp_spec = match (args.flag_compress.clone(), args.flag_level.clone()) {
-            (None, _) => None,
-            (Some(m), lvl) => Some(CompressionSpec{method: m, level: lvl}),
-        };
-        chunk_fastq(Path::new(&in_file), read_per_chunk, out_path, name, cmp_spec)
-    }).collect_into_vec(&mut _out_chunks);
+    if args.flag_threads > 1 {
+        // Read each input on its own thread, and compress batches of its records on a shared pool
+        // of the remaining threads
+        let num_compressors = cmp::max(1, args.flag_threads.saturating_sub(chunks.len()));
+        let pool = CompressorPool::new(num_compressors, cmp_spec.clone());
+
+        let readers: Vec<_> = chunks.into_iter().map(|(name, in_file, interleaved)| {
+            let read_per_chunk = reads_per_chunk(interleaved);
+            let out_path = out_path.to_path_buf();
+            let cmp_spec = cmp_spec.clone();
+            let job_tx = pool.sender();
+            thread::spawn(move || {
+                chunk_fastq_threaded(Path::new(&in_file), read_per_chunk, &out_path, name, cmp_spec, job_tx)
+            })
+        }).collect();
+
+        for reader in readers {
+            let oc = reader.join().unwrap_or_else(|_| Err(failure::err_msg("FASTQ reader thread panicked")));
+            _out_chunks.push(oc);
+        }
+        pool.finish()?;
+    } else {
+        // Try to build ThreadPool, but swallow GlobalPoolAlreadyInitialized
+        let _err = rayon::ThreadPoolBuilder::new().num_threads(2).build_global();
+
+        chunks.into_par_iter().map(|(name, in_file, interleaved)| {
+            chunk_fastq(Path::new(&in_file), reads_per_chunk(interleaved), out_path, name, cmp_spec.clone())
+        }).collect_into_vec(&mut _out_chunks);
+    }
 
     let mut out_chunks = vec![];
     for oc in _out_chunks {
@@ -255,6 +289,16 @@ impl<W: Write> Drop for StreamWrapper<W> {
     }
 }
 
+fn get_extension(compress: &Option<CompressionSpec>) -> Option<&'static str> {
+    use CompressionMethod::{Lz4, Gzip};
+
+    match compress {
+        &Some(CompressionSpec{ method: Lz4, ..}) => Some("lz4"),
+        &Some(CompressionSpec{ method: Gzip, ..}) => Some("gz"),
+        &None => None,
+    }
+}
+
 fn chunk_fastq(p: &Path, nrecord: usize, out_path: &Path, out_prefix: &str,
                compress: Option<CompressionSpec>) -> Result<(String, Vec<PathBuf>), Error> {
     use CompressionMethod::{Lz4, Gzip};
@@ -266,11 +310,7 @@ fn chunk_fastq(p: &Path, nrecord: usize, out_path: &Path, out_prefix: &str,
         let mut this_chunk = 0;
         let mut total_chunks = 0;
 
-        let extension = match &compress {
-            &Some(CompressionSpec{ method: Lz4, ..}) => Some("lz4"),
-            &Some(CompressionSpec{ method: Gzip, ..}) => Some("gz"),
-            &None => None,
-        };
+        let extension = get_extension(&compress);
 
         let path = make_fastq_path(out_path, &out_prefix, total_chunks, extension);
         let output = File::create(&path).unwrap();
@@ -325,6 +365,279 @@ fn chunk_fastq(p: &Path, nrecord: usize, out_path: &Path, out_prefix: &str,
     }
 }
 
+// In threaded mode, each chunk is written as a single LZ4 frame of independently compressed
+// blocks or as a series of gzip members, so that batches of records can be compressed in parallel.
+
+/// LZ4 frame header: magic number, flags for independent blocks of up to 4MB
+/// without content size or checksums, and the header checksum
+const LZ4_FRAME_HEADER: [u8; 7] = [0x04, 0x22, 0x4D, 0x18, 0x60, 0x70, 0x73];
+const LZ4_END_MARK: [u8; 4] = [0; 4];
+const LZ4_BLOCK_SIZE: usize = 4 * 1024 * 1024;
+/// Set in the size of a block that is stored uncompressed
+const LZ4_UNCOMPRESSED_BIT: u32 = 1 << 31;
+/// Lowest LZ4 level that uses the high compression mode
+const LZ4_MIN_HC_LEVEL: u32 = 3;
+
+/// Batches of records are handed to the compressors once they reach this size.
+/// This leaves room for the record that crosses it, so a batch usually fits in one LZ4 block.
+const BATCH_BYTES: usize = LZ4_BLOCK_SIZE - 64 * 1024;
+/// Maximum number of batches of each input waiting to be compressed or written
+const MAX_PENDING_BATCHES: usize = 8;
+
+fn push_u32_le(buf: &mut Vec<u8>, v: u32) {
+    buf.extend_from_slice(&[v as u8, (v >> 8) as u8, (v >> 16) as u8, (v >> 24) as u8]);
+}
+
+fn get_lz4_mode(level: u32) -> Option<lz4::block::CompressionMode> {
+    if level >= LZ4_MIN_HC_LEVEL {
+        Some(lz4::block::CompressionMode::HIGHCOMPRESSION(level as i32))
+    } else {
+        None
+    }
+}
+
+/// Compress a batch of FASTQ data so that it can be appended to the other batches of a chunk
+fn compress_batch(data: Vec<u8>, compress: &Option<CompressionSpec>) -> Vec<u8> {
+    use CompressionMethod::{Lz4, Gzip};
+
+    match compress {
+        &Some(CompressionSpec{method: Lz4, level}) => {
+            let mut out = Vec::with_capacity(data.len() / 2);
+            for block in data.chunks(LZ4_BLOCK_SIZE) {
+                let compressed = lz4::block::compress(block, get_lz4_mode(level), false)
+                    .expect("Failed to compress lz4 block");
+                if compressed.len() < block.len() {
+                    push_u32_le(&mut out, compressed.len() as u32);
+                    out.extend_from_slice(&compressed);
+                } else {
+                    push_u32_le(&mut out, block.len() as u32 | LZ4_UNCOMPRESSED_BIT);
+                    out.extend_from_slice(block);
+                }
+            }
+            out
+        },
+        &Some(CompressionSpec{method: Gzip, ..}) => gzip_member(&data),
+        &None => data,
+    }
+}
+
+fn gzip_member(data: &[u8]) -> Vec<u8> {
+    let mut encoder = GzEncoder::new(Vec::with_capacity(data.len() / 2), Compression::fast());
+    encoder.write_all(data).expect("Failed to compress gzip member");
+    encoder.finish().expect("Failed to compress gzip member")
+}
+
+/// A batch of FASTQ data to compress, and where to send the result
+struct CompressJob {
+    data: Vec<u8>,
+    result_tx: mpsc::SyncSender<Vec<u8>>,
+}
+
+/// Compresses batches of FASTQ data on a pool of threads
+struct CompressorPool {
+    job_tx: mpsc::SyncSender<CompressJob>,
+    workers: Vec<thread::JoinHandle<()>>,
+}
+
+impl CompressorPool {
+    fn new(num_threads: usize, compress: Option<CompressionSpec>) -> CompressorPool {
+        let (job_tx, job_rx) = mpsc::sync_channel::<CompressJob>(num_threads);
+        let job_rx = Arc::new(Mutex::new(job_rx));
+
+        let workers = (0..num_threads).map(|_| {
+            let job_rx = job_rx.clone();
+            let compress = compress.clone();
+            thread::spawn(move || {
+                loop {
+                    let job = match job_rx.lock().unwrap().recv() {
+                        Ok(job) => job,
+                        Err(_) => break,
+                    };
+                    // The reader may have given up on this batch after an error
+                    let _ = job.result_tx.send(compress_batch(job.data, &compress));
+                }
+            })
+        }).collect();
+
+        CompressorPool {
+            job_tx: job_tx,
+            workers: workers,
+        }
+    }
+
+    fn sender(&self) -> mpsc::SyncSender<CompressJob> {
+        self.job_tx.clone()
+    }
+
+    /// Wait for the workers to exit, once all senders are dropped
+    fn finish(self) -> Result<(), Error> {
+        drop(self.job_tx);
+        for worker in self.workers {
+            worker.join().map_err(|_| failure::err_msg("Compression thread panicked"))?;
+        }
+        Ok(())
+    }
+}
+
+enum PendingWrite {
+    Batch(mpsc::Receiver<Vec<u8>>),
+    NextChunk,
+}
+
+/// Writes the chunks of one input FASTQ, in order, from batches compressed on a CompressorPool
+struct ChunkWriter {
+    out_path: PathBuf,
+    out_prefix: String,
+    compress: Option<CompressionSpec>,
+    job_tx: mpsc::SyncSender<CompressJob>,
+    paths: Vec<PathBuf>,
+    output: File,
+    chunk_bytes: usize,
+    pending: VecDeque<PendingWrite>,
+}
+
+impl ChunkWriter {
+    fn new(out_path: &Path, out_prefix: &str, compress: Option<CompressionSpec>,
+           job_tx: mpsc::SyncSender<CompressJob>) -> Result<ChunkWriter, Error> {
+        let path = make_fastq_path(out_path, out_prefix, 0, get_extension(&compress));
+        let output = File::create(&path)?;
+
+        let mut writer = ChunkWriter {
+            out_path: out_path.to_path_buf(),
+            out_prefix: out_prefix.to_string(),
+            compress: compress,
+            job_tx: job_tx,
+            paths: vec![path],
+            output: output,
+            chunk_bytes: 0,
+            pending: VecDeque::new(),
+        };
+        writer.start_chunk()?;
+        Ok(writer)
+    }
+
+    fn is_lz4(&self) -> bool {
+        match self.compress {
+            Some(CompressionSpec{method: CompressionMethod::Lz4, ..}) => true,
+            _ => false,
+        }
+    }
+
+    fn start_chunk(&mut self) -> Result<(), Error> {
+        if self.is_lz4() {
+            self.output.write_all(&LZ4_FRAME_HEADER)?;
+        }
+        self.chunk_bytes = 0;
+        Ok(())
+    }
+
+    fn end_chunk(&mut self) -> Result<(), Error> {
+        if self.is_lz4() {
+            self.output.write_all(&LZ4_END_MARK)?;
+        } else if self.chunk_bytes == 0 && self.compress.is_some() {
+            // Keep empty chunks valid gzip files
+            self.output.write_all(&gzip_member(&[]))?;
+        }
+        Ok(())
+    }
+
+    /// Hand a batch of records to the compressors
+    fn write_batch(&mut self, data: Vec<u8>) -> Result<(), Error> {
+        let (result_tx, result_rx) = mpsc::sync_channel(1);
+        let job = CompressJob { data: data, result_tx: result_tx };
+        self.job_tx.send(job).map_err(|_| failure::err_msg("Compression threads exited early"))?;
+        self.pending.push_back(PendingWrite::Batch(result_rx));
+        self.write_pending(MAX_PENDING_BATCHES)
+    }
+
+    /// Start a new chunk after the batches written so far
+    fn next_chunk(&mut self) -> Result<(), Error> {
+        self.pending.push_back(PendingWrite::NextChunk);
+        self.write_pending(MAX_PENDING_BATCHES)
+    }
+
+    /// Write out pending batches, in order, until at most max_pending remain
+    fn write_pending(&mut self, max_pending: usize) -> Result<(), Error> {
+        while self.pending.len() > max_pending {
+            match self.pending.pop_front().unwrap() {
+                PendingWrite::Batch(result_rx) => {
+                    let data = result_rx.recv().map_err(|_| failure::err_msg("Compression thread failed"))?;
+                    self.output.write_all(&data)?;
+                    self.chunk_bytes += data.len();
+                },
+                PendingWrite::NextChunk => {
+                    self.end_chunk()?;
+                    let path = make_fastq_path(&self.out_path, &self.out_prefix, self.paths.len(), get_extension(&self.compress));
+                    self.output = File::create(&path)?;
+                    self.paths.push(path);
+                    self.start_chunk()?;
+                },
+            }
+        }
+        Ok(())
+    }
+
+    /// Write out all pending batches and return the chunk paths
+    fn finish(mut self) -> Result<Vec<PathBuf>, Error> {
+        self.write_pending(0)?;
+        self.end_chunk()?;
+        Ok(self.paths)
+    }
+}
+
+fn chunk_fastq_threaded(p: &Path, nrecord: usize, out_path: &Path, out_prefix: &str,
+                        compress: Option<CompressionSpec>, job_tx: mpsc::SyncSender<CompressJob>)
+                        -> Result<(String, Vec<PathBuf>), Error> {
+    println!("opening: {:?}", p);
+    let rr = parse_path(Some(p), |parser| {
+        let mut writer = ChunkWriter::new(out_path, out_prefix, compress, job_tx)?;
+        let mut batch = Vec::with_capacity(LZ4_BLOCK_SIZE);
+        let mut total = 0;
+        let mut this_chunk = 0;
+        let mut write_err = None;
+
+        let ret = parser.each(|rec| {
+            total += 1;
+            this_chunk += 1;
+            let _ = rec.write(&mut batch).unwrap();
+
+            let mut res = Ok(());
+            if batch.len() >= BATCH_BYTES || this_chunk == nrecord {
+                res = writer.write_batch(mem::replace(&mut batch, Vec::with_capacity(LZ4_BLOCK_SIZE)));
+            }
+            if res.is_ok() && this_chunk == nrecord {
+                res = writer.next_chunk();
+                this_chunk = 0;
+            }
+
+            match res {
+                Ok(()) => true,
+                Err(e) => {
+                    write_err = Some(e);
+                    false
+                },
+            }
+        });
+
+        println!("got recs: {}", total);
+        if let Some(e) = write_err {
+            return Err(e);
+        }
+        ret?;
+
+        if !batch.is_empty() {
+            writer.write_batch(batch)?;
+        }
+        writer.finish()
+    });
+
+    match rr {
+        Ok(Ok(paths)) => Ok((out_prefix.to_string(), paths)),
+        Ok(Err(v)) => Err(v),
+        Err(v) => Err(v.into()),
+    }
+}
+
 #[cfg(test)]
 mod tests {
     use tempdir;
@@ -372,6 +685,7 @@ mod tests {
             flag_martian_args: None,
             flag_compress: None,
             flag_level: 0,
+            flag_threads: 1,
             flag_r1: Some("test/mkfastq/pbmc8k_S1_L007_R1_001.fastq.gz".to_string()),
             flag_r2: Some("test/mkfastq/pbmc8k_S1_L007_R2_001.fastq.gz".to_string()),
             flag_i1: Some("test/mkfastq/pbmc8k_S1_L007_I1_001.fastq.gz".to_string()),
@@ -412,6 +726,7 @@ mod tests {
             flag_martian_args: Some("test/bcl_processor/chunk.json".to_string()),
             flag_compress: None,
             flag_level: 0,
+            flag_threads: 1,
             flag_r1: None,
             flag_r2: None,
             flag_i1: None,
@@ -451,6 +766,7 @@ mod tests {
             flag_martian_args: Some("test/invalid_fastq/chunk.json".to_string()),
             flag_compress: None,
             flag_level: 0,
+            flag_threads: 1,
             flag_r1: None,
             flag_r2: None,
             flag_i1: None,
@@ -478,6 +794,7 @@ mod tests {
             flag_martian_args: None,
             flag_compress: Some(CompressionMethod::Lz4),
             flag_level: 0,
+            flag_threads: 1,
             flag_r1: Some("test/mkfastq/pbmc8k_S1_L007_R1_001.fastq.gz".to_string()),
             flag_r2: Some("test/mkfastq/pbmc8k_S1_L007_R2_001.fastq.gz".to_string()),
             flag_i1: Some("test/mkfastq/pbmc8k_S1_L007_I1_001.fastq.gz".to_string()),
@@ -518,5 +835,133 @@ mod tests {
         strict_compare_read_sets(orig_reads, output_reads);
     }
 
+    fn decompress_lz4_chunks(out_path_sets: &Vec<(Option<String>, Option<String>, Option<String>, Option<String>)>) {
+        for &(ref r1, ref r2, ref i1, _) in out_path_sets {
+            for infn in vec![r1.clone().unwrap(), r2.clone().unwrap(), i1.clone().unwrap()] {
+                let mut inf = lz4::Decoder::new(File::open(&infn).unwrap()).unwrap();
+                let mut outf = File::create(infn.replace(".lz4", "")).unwrap();
+                std::io::copy(&mut inf, &mut outf).expect("decompression failed");
+            }
+        }
+    }
+
+    // Ensure reads are equivalent when compressing on multiple threads
+    #[test]
+    fn test_threads() {
+        for compress in vec![None, Some(CompressionMethod::Lz4), Some(CompressionMethod::Gzip)] {
+            let tempdir = tempdir::TempDir::new("chunk_reads_test").expect("create temp dir");
+            let tmp_path = tempdir.path();
+
+            let args = Args {
+                arg_output_path: tmp_path.to_str().unwrap().to_string(),
+                arg_prefix: "p1".to_string(),
+                flag_reads_per_fastq: 1000,
+                flag_martian_args: None,
+                flag_compress: compress.clone(),
+                flag_level: 0,
+                // 3 readers and 2 compressors
+                flag_threads: 5,
+                flag_r1: Some("test/mkfastq/pbmc8k_S1_L007_R1_001.fastq.gz".to_string()),
+                flag_r2: Some("test/mkfastq/pbmc8k_S1_L007_R2_001.fastq.gz".to_string()),
+                flag_i1: Some("test/mkfastq/pbmc8k_S1_L007_I1_001.fastq.gz".to_string()),
+                flag_i2: None,
+            };
+
+            let out_path_sets = super::run_args(args).unwrap();
+
+            let original_read_iter = open_fastq_pair_iter(
+                "test/mkfastq/pbmc8k_S1_L007_R1_001.fastq.gz",
+                "test/mkfastq/pbmc8k_S1_L007_R2_001.fastq.gz",
+                Some("test/mkfastq/pbmc8k_S1_L007_I1_001.fastq.gz"));
+
+            let mut orig_reads = ReadSet::new();
+            load_fastq_set(&mut orig_reads, original_read_iter);
+
+            if let Some(CompressionMethod::Lz4) = compress {
+                decompress_lz4_chunks(&out_path_sets);
+            }
+
+            let mut output_reads = ReadSet::new();
+            for (r1, r2, i1, _) in out_path_sets {
+                let r1_d = r1.map(|x| x.replace(".lz4", "")).unwrap();
+                let r2_d = r2.map(|x| x.replace(".lz4", "")).unwrap();
+                let i1_d = i1.map(|x| x.replace(".lz4", ""));
+                load_fastq_set(&mut output_reads, open_fastq_pair_iter(r1_d, r2_d, i1_d));
+            }
+
+            println!("comparing {} reads with {:?} compression", orig_reads.len(), compress);
+            strict_compare_read_sets(orig_reads, output_reads);
+        }
+    }
+
+    /// Write a FASTQ of random reads. Returns its size in bytes.
+    fn write_synthetic_fastq(path: &Path, num_reads: usize, read_len: usize, seed: u64) -> usize {
+        let mut out = std::io::BufWriter::new(File::create(path).unwrap());
+        let mut state = seed;
+        let mut num_bytes = 0;
+        for i in 0..num_reads {
+            let mut seq = Vec::with_capacity(read_len);
+            let mut qual = Vec::with_capacity(read_len);
+            for _ in 0..read_len {
+                // xorshift64
+                state ^= state << 13;
+                state ^= state >> 7;
+                state ^= state << 17;
+                seq.push(b"ACGT"[(state & 3) as usize]);
+                qual.push(b"#<AFJ"[((state >> 2) % 5) as usize]);
+            }
+            let head = format!("@SYNTHETIC:1:FLOWCELL:1:{}:{}:{} 1:N:0:0\n", 1101 + i / 1000000, i % 1000000, i);
+            out.write_all(head.as_bytes()).unwrap();
+            out.write_all(&seq).unwrap();
+            out.write_all(b"\n+\n").unwrap();
+            out.write_all(&qual).unwrap();
+            out.write_all(b"\n").unwrap();
+            num_bytes += head.len() + 2 * read_len + 4;
+        }
+        num_bytes
+    }
+
+    // Throughput of each compression method on synthetic reads. Run with:
+    // cargo test --release bench_compression -- --ignored --nocapture
+    #[test]
+    #[ignore]
+    fn bench_compression() {
+        let num_reads = 2000000;
+        let tempdir = tempdir::TempDir::new("chunk_reads_bench").expect("create temp dir");
+        let tmp_path = tempdir.path();
+
+        let r1_path = tmp_path.join("synthetic_R1.fastq");
+        let r2_path = tmp_path.join("synthetic_R2.fastq");
+        let num_bytes = write_synthetic_fastq(&r1_path, num_reads, 28, 1) +
+            write_synthetic_fastq(&r2_path, num_reads, 91, 2);
+
+        for &threads in [1, 4].iter() {
+            for compress in vec![None, Some(CompressionMethod::Lz4), Some(CompressionMethod::Gzip)] {
+                let out_path = tmp_path.join(format!("out_{:?}_{}", compress, threads));
+                std::fs::create_dir(&out_path).unwrap();
+
+                let args = Args {
+                    arg_output_path: out_path.to_str().unwrap().to_string(),
+                    arg_prefix: "p1".to_string(),
+                    flag_reads_per_fastq: 500000,
+                    flag_martian_args: None,
+                    flag_compress: compress.clone(),
+                    flag_level: 0,
+                    flag_threads: threads,
+                    flag_r1: Some(r1_path.to_str().unwrap().to_string()),
+                    flag_r2: Some(r2_path.to_str().unwrap().to_string()),
+                    flag_i1: None,
+                    flag_i2: None,
+                };
 
+                let start = std::time::Instant::now();
+                super::run_args(args).unwrap();
+                let elapsed = start.elapsed();
+                let secs = elapsed.as_secs() as f64 + elapsed.subsec_nanos() as f64 / 1e9;
+
+                println!("compress: {:?}, threads: {}: {:.0} reads/sec, {:.1} MB/s",
+                         compress, threads, num_reads as f64 / secs, num_bytes as f64 / 1e6 / secs);
+            }
+        }
+    }
 }
@@ -12,10 +12,14 @@ use std::fs;
 use std::io;
 use std::fs::File;
 use std::path::Path;
-use std::collections::{HashMap, HashSet};
+use std::collections::{HashMap, HashSet, BTreeMap};
 use std::io::{BufWriter, Write};
 use std::str;
-use std::cmp::{min, max};
+use std::mem;
+use std::panic;
+use std::thread;
+use std::sync::{Arc, Mutex, mpsc};
+use std::cmp::{min, max, Ordering};
 use std::default::Default;
 use bincode;
 use itertools::Itertools;
@@ -32,6 +36,22 @@ use bam::Read;
 
 pub struct MarkDuplicatesStage;
 
+/// Threads per chunk, for duplicate marking and BAM compression
+const MARK_DUPS_THREADS: usize = 4;
+
+/// Barcode groups are sent to worker threads in batches of at least this many records
+const GROUP_BATCH_RECORDS: usize = 4096;
+
+/// Batches read ahead of the next one to be written, per worker thread
+const BATCHES_IN_FLIGHT_PER_THREAD: usize = 4;
+
+/// Stop reading ahead once this many records are being processed.
+/// A larger barcode group is still processed whole.
+const MAX_RECORDS_IN_FLIGHT: usize = 1 << 19;
+
+/// Memory for the records being processed on worker threads
+const RECORDS_IN_FLIGHT_MEM_GB: f64 = 0.5;
+
 #[derive(Serialize, Deserialize, Default, Clone)]
 /// Read accounting
 struct Metrics {
@@ -43,6 +63,17 @@ struct Metrics {
     umis: u64,
 }
 
+impl Metrics {
+    fn merge(&mut self, other: &Metrics) {
+        self.total_reads += other.total_reads;
+        self.low_support_umi_reads += other.low_support_umi_reads;
+        self.umi_corrected_reads += other.umi_corrected_reads;
+        self.candidate_dup_reads += other.candidate_dup_reads;
+        self.dup_reads += other.dup_reads;
+        self.umis += other.umis;
+    }
+}
+
 #[derive(Serialize, Deserialize, Default, Clone)]
 /// Per-barcode information
 struct BarcodeSummary {
@@ -56,53 +87,198 @@ struct BarcodeSummaryEntry {
     umi_corrected_reads: u64,
 }
 
-#[derive(Deserialize, Serialize, Debug)]
+impl BarcodeSummaryEntry {
+    fn merge(&mut self, other: &BarcodeSummaryEntry) {
+        self.reads += other.reads;
+        self.umis += other.umis;
+        self.candidate_dup_reads += other.candidate_dup_reads;
+        self.umi_corrected_reads += other.umi_corrected_reads;
+    }
+}
+
+#[derive(Deserialize, Serialize, Debug, Clone)]
 pub struct LibraryInfo {
     library_id: String,
     library_type: String,
     gem_group: u64,
 }
 
-/// Within each gene, correct Hamming-distance-one UMIs
-fn correct_umis(umigene_counts: HashMap<(Vec<u8>, String), u64>)
-                -> HashMap<(Vec<u8>, String), Vec<u8>> {
-    let nucs = b"ACGT";
+/// UMIs of up to this many ACGT bases are packed into their ids, 2 bits per base
+const MAX_PACKED_UMI_LEN: usize = 31;
+
+/// Set in the ids of UMIs that can't be packed; the remaining bits index the interned sequences
+const INTERNED_UMI_ID: u64 = 1 << 63;
+
+/// Pack an ACGT sequence 2 bits per base below a leading 1 bit, which marks its length.
+/// Packed UMIs of equal length compare like their sequences.
+fn pack_umi(umi: &[u8]) -> Option<u64> {
+    if umi.len() > MAX_PACKED_UMI_LEN {
+        return None;
+    }
+    let mut packed = 1u64;
+    for base in umi {
+        let code = match *base {
+            b'A' => 0,
+            b'C' => 1,
+            b'G' => 2,
+            b'T' => 3,
+            _ => return None,
+        };
+        packed = (packed << 2) | code;
+    }
+    Some(packed)
+}
+
+fn packed_umi_len(packed: u64) -> usize {
+    ((63 - packed.leading_zeros()) / 2) as usize
+}
+
+fn unpack_umi(packed: u64) -> Vec<u8> {
+    let len = packed_umi_len(packed);
+    (0..len).map(|pos| b"ACGT"[((packed >> (2 * (len - 1 - pos))) & 3) as usize]).collect()
+}
+
+/// Integer ids of the UMI sequences of a barcode.
+/// Most UMIs are packed into their id; any others (e.g. containing an N) are interned.
+struct UmiIds {
+    interned: HashMap<Vec<u8>, u64>,
+    seqs: Vec<Vec<u8>>,
+}
+
+impl UmiIds {
+    fn new() -> UmiIds {
+        UmiIds {
+            interned: HashMap::new(),
+            seqs: Vec::new(),
+        }
+    }
+
+    /// Get the id of a UMI sequence, interning it if needed
+    fn get_or_insert(&mut self, umi: &[u8]) -> u64 {
+        if let Some(id) = self.get(umi) {
+            return id;
+        }
+        let id = INTERNED_UMI_ID | self.seqs.len() as u64;
+        self.interned.insert(umi.to_owned(), id);
+        self.seqs.push(umi.to_owned());
+        id
+    }
 
-    let mut corrections = HashMap::new();
+    /// Get the id of a UMI sequence, if it has one
+    fn get(&self, umi: &[u8]) -> Option<u64> {
+        pack_umi(umi).or_else(|| self.interned.get(umi).cloned())
+    }
 
-    for (&(ref umi, ref gene_id), orig_count) in &umigene_counts {
-        let mut test_umi = umi.clone();
+    fn get_seq(&self, id: u64) -> Vec<u8> {
+        if id & INTERNED_UMI_ID == 0 {
+            unpack_umi(id)
+        } else {
+            self.seqs[(id & !INTERNED_UMI_ID) as usize].clone()
+        }
+    }
 
-        let mut best_dest_count = *orig_count;
-        let mut best_dest_umi = umi.clone();
+    /// Compare the sequences of two UMIs of equal length
+    fn cmp_seqs(&self, a: u64, b: u64) -> Ordering {
+        if (a | b) & INTERNED_UMI_ID == 0 {
+            a.cmp(&b)
+        } else {
+            self.get_seq(a).cmp(&self.get_seq(b))
+        }
+    }
 
-        for pos in 0..umi.len() {
-            // Try each nucleotide at this position
-            for test_char in nucs {
-                if *test_char == umi[pos] {
-                    // Skip the identitical nucleotide
-                    continue;
+    /// Call f with the id of each UMI that differs from this one by substituting
+    /// an A, C, G or T at one position. Unknown unpackable UMIs are skipped.
+    fn for_each_neighbor<F: FnMut(u64)>(&self, id: u64, mut f: F) {
+        if id & INTERNED_UMI_ID == 0 {
+            let len = packed_umi_len(id);
+            for pos in 0..len {
+                let shift = 2 * (len - 1 - pos);
+                let code = (id >> shift) & 3;
+                for test_code in 0..4u64 {
+                    if test_code != code {
+                        f((id & !(3u64 << shift)) | (test_code << shift));
+                    }
+                }
+            }
+        } else {
+            let umi = self.get_seq(id);
+            let mut test_umi = umi.clone();
+            for pos in 0..umi.len() {
+                for test_char in b"ACGT" {
+                    if *test_char == umi[pos] {
+                        continue;
+                    }
+                    test_umi[pos] = *test_char;
+                    if let Some(test_id) = self.get(&test_umi) {
+                        f(test_id);
+                    }
                 }
-                test_umi[pos] = *test_char;
+                test_umi[pos] = umi[pos];
+            }
+        }
+    }
+}
+
+/// Read counts of the (gene, UMI) pairs of a barcode, sorted by gene then UMI
+struct UmiGeneCounts {
+    keys: Vec<(u32, u64)>,
+    counts: Vec<u64>,
+}
 
-                // Test for the existence of this mutated UMI
-                let test_count = *umigene_counts.get(&(test_umi.clone(), gene_id.clone())).unwrap_or(&0u64);
+impl UmiGeneCounts {
+    /// Count the occurrences of each (gene, UMI) pair
+    fn from_pairs(mut pairs: Vec<(u32, u64)>) -> UmiGeneCounts {
+        pairs.sort_unstable();
+
+        let mut keys: Vec<(u32, u64)> = Vec::new();
+        let mut counts = Vec::new();
+        for key in pairs {
+            if keys.last() == Some(&key) {
+                *counts.last_mut().unwrap() += 1;
+            } else {
+                keys.push(key);
+                counts.push(1u64);
+            }
+        }
+        UmiGeneCounts { keys: keys, counts: counts }
+    }
+
+    fn index_of(&self, gene: u32, umi: u64) -> Option<usize> {
+        self.keys.binary_search(&(gene, umi)).ok()
+    }
+
+    fn get(&self, gene: u32, umi: u64) -> u64 {
+        self.index_of(gene, umi).map_or(0, |i| self.counts[i])
+    }
+}
+
+/// Within each gene, correct Hamming-distance-one UMIs.
+/// Returns the corrected UMI of each (gene, UMI) pair, or None if it is left as is.
+fn correct_umis(umi_ids: &UmiIds, umigene_counts: &UmiGeneCounts) -> Vec<Option<u64>> {
+    umigene_counts.keys.iter().zip(umigene_counts.counts.iter())
+        .map(|(&(gene, umi), &orig_count)| {
+            let mut best_dest_count = orig_count;
+            let mut best_dest_umi = umi;
+
+            umi_ids.for_each_neighbor(umi, |test_umi| {
+                let test_count = umigene_counts.get(gene, test_umi);
 
                 // If there's a 1-HD UMI w/ greater count, move to that UMI.
                 // If there's a 1-HD UMI w/ equal count, move to the lexicographically larger UMI.
-                if test_count > best_dest_count || (test_count == best_dest_count && test_umi > best_dest_umi) {
-                    best_dest_umi = test_umi.clone();
+                if test_count > best_dest_count ||
+                    (test_count == best_dest_count && umi_ids.cmp_seqs(test_umi, best_dest_umi) == Ordering::Greater) {
+                    best_dest_umi = test_umi;
                     best_dest_count = test_count;
                 }
+            });
+
+            if best_dest_umi != umi {
+                Some(best_dest_umi)
+            } else {
+                None
             }
-            // Reset this position to the unmutated sequence
-            test_umi[pos] = umi[pos];
-        }
-        if *umi != best_dest_umi {
-            corrections.insert((umi.clone(), gene_id.clone()), best_dest_umi);
-        }
-    }
-    corrections
+        })
+        .collect()
 }
 
 #[derive(Deserialize, Debug)]
@@ -112,6 +288,12 @@ struct ChunkArgs {
     chunk_end: Option<i64>,
     filter_umis: bool,
     library_info: Vec<LibraryInfo>,
+    #[serde(rename = "__threads", default = "default_threads")]
+    threads: usize,
+}
+
+fn default_threads() -> usize {
+    1
 }
 
 #[derive(Deserialize, Debug)]
@@ -138,23 +320,24 @@ fn get_mate_type(record: &bam::Record) -> MateType {
 
 /// For all the records w/ the same qname (a read or a read-pair),
 /// find the single gene/feature confidently mapped to if any.
-fn get_qname_conf_mapped_feature<'a, I>(records: I) -> Option<String>
+fn get_qname_conf_mapped_feature<'a, I>(records: I) -> Option<&'a [u8]>
     where I: Iterator<Item = &'a bam::record::Record> {
-    let mut features = Vec::new();
+    let mut feature = None;
     for record in records.filter(|&r| !r.is_secondary()) {
-        let flags = utils::get_read_extra_flags(&record);
+        let flags = utils::get_read_extra_flags(record);
 
         if flags.intersects(utils::ExtraFlags::CONF_MAPPED) ||
             flags.intersects(utils::ExtraFlags::CONF_FEATURE) {
-                features.extend(utils::get_read_feature_ids(&record).into_iter());
+                for feature_id in utils::get_read_feature_ids(record) {
+                    match feature {
+                        None => feature = Some(feature_id),
+                        Some(f) if f == feature_id => {},
+                        Some(_) => return None,
+                    }
+                }
             }
     }
-    features.sort_unstable();
-    features.dedup();
-    match features.len() {
-        1 => features.into_iter().nth(0),
-        _ => None,
-    }
+    feature
 }
 
 /// Estimate BAM file compression ratio.
@@ -255,175 +438,398 @@ fn major_barcode_proportion_within_chunk(bam: &mut bam::Reader,
     }
 }
 
-/// Do duplicate marking on a single barcode's worth of data
-fn process_barcode(bc_group: &mut Vec<bam::Record>,
-                   metrics: &mut Vec<Metrics>,
-                   bc_summaries: &mut Vec<BarcodeSummary>,
-                   out_bam: &mut bam::Writer,
-                   lib_idx: usize,
-                   bc: &Vec<u8>,
-                   filter_umis: bool) {
-    // HACK: Rust's entry api still requires key-ownership to query,
-    //       so do it the ugly way.
-    if bc_summaries[lib_idx].barcodes.get(bc).is_none() {
-        // Only clone the key when it's not present
-        bc_summaries[lib_idx].barcodes.insert(bc.clone(), Default::default());
-    }
-    let barcode_summary = bc_summaries[lib_idx].barcodes.get_mut(bc).unwrap();
-
-    // Get raw UMI frequencies
-    let mut raw_umigene_counts: HashMap<(Vec<u8>, String), u64> = HashMap::new();
-    let mut low_support_umigenes: HashSet<(Vec<u8>, String)> = HashSet::new();
-
-    for (maybe_umi, umi_group) in &bc_group.iter().group_by(|x| utils::get_read_umi(&x)) {
-        let mut gene_counts: HashMap<String, u64> = HashMap::new();
-
-        if let Some(umi) = maybe_umi {
-            // Count (raw UMI, feature) pairs to prepare for UMI correction.
-            // Track (raw UMI, feature) pairs with submaximal count per (raw UMI)
-            //   to prepare for marking of low-support UMIs (putative chimeras).
-
-            // Assumes records are qname-contiguous in the input.
-            for (qname, qname_records) in &umi_group.into_iter()
-                .filter(|&x| utils::is_read_dup_candidate(x))
-                .group_by(|x| x.qname()) {
-                    match get_qname_conf_mapped_feature(qname_records.into_iter()) {
-                        None => { panic!(format!("Found 0 or >1 features for confidently mapped read/pair {}", str::from_utf8(qname).unwrap())) },
-                        Some(gene) => {
-                            *raw_umigene_counts.entry((umi.clone(), gene.clone())).or_insert(0) += 1;
-                            *gene_counts.entry(gene.clone()).or_insert(0) += 1;
-                        },
-                    }
-                } // for each qname
+/// How to update a record once its barcode's UMIs are corrected
+struct RecordUpdate {
+    extra_flags: utils::ExtraFlags,
+    corrected_umi: Option<Vec<u8>>,
+    is_dup: bool,
+}
 
-            // Mark (UMI, gene) pairs w/ frequency below the max for the UMI as low support.
-            if let Some((_max_gene, max_count)) = gene_counts.iter().max_by_key(|x| x.1) {
-                for (gene, count) in gene_counts.iter() {
-                    if filter_umis && count < max_count {
-                        low_support_umigenes.insert((umi.clone(), gene.clone()));
+/// Do duplicate marking on a single barcode's worth of data.
+/// Returns the updated records and their metrics.
+fn process_barcode(mut bc_group: Vec<bam::Record>,
+                   filter_umis: bool) -> (Vec<bam::Record>, Metrics, BarcodeSummaryEntry) {
+    let mut metrics: Metrics = Default::default();
+    let mut barcode_summary: BarcodeSummaryEntry = Default::default();
+
+    let updates = {
+        // Refer to UMIs and genes by integer ids
+        let mut umi_ids = UmiIds::new();
+        let mut gene_ids: HashMap<&[u8], u32> = HashMap::new();
+
+        // Get raw UMI frequencies
+        let mut umigene_pairs: Vec<(u32, u64)> = Vec::new();
+        let mut low_support_umigenes: Vec<(u32, u64)> = Vec::new();
+
+        for (maybe_umi, umi_group) in &bc_group.iter().group_by(|x| utils::get_read_umi(*x)) {
+            let mut gene_counts: HashMap<u32, u64> = HashMap::new();
+
+            if let Some(umi) = maybe_umi {
+                let umi_id = umi_ids.get_or_insert(umi);
+
+                // Count (raw UMI, feature) pairs to prepare for UMI correction.
+                // Track (raw UMI, feature) pairs with submaximal count per (raw UMI)
+                //   to prepare for marking of low-support UMIs (putative chimeras).
+
+                // Assumes records are qname-contiguous in the input.
+                for (qname, qname_records) in &umi_group.into_iter()
+                    .filter(|&x| utils::is_read_dup_candidate(x))
+                    .group_by(|x| x.qname()) {
+                        match get_qname_conf_mapped_feature(qname_records.into_iter()) {
+                            None => { panic!(format!("Found 0 or >1 features for confidently mapped read/pair {}", str::from_utf8(qname).unwrap())) },
+                            Some(gene) => {
+                                let next_gene_id = gene_ids.len() as u32;
+                                let gene_id = *gene_ids.entry(gene).or_insert(next_gene_id);
+                                umigene_pairs.push((gene_id, umi_id));
+                                *gene_counts.entry(gene_id).or_insert(0) += 1;
+                            },
+                        }
+                    } // for each qname
+
+                // Mark (UMI, gene) pairs w/ frequency below the max for the UMI as low support.
+                if let Some(max_count) = gene_counts.values().max() {
+                    for (gene_id, count) in gene_counts.iter() {
+                        if filter_umis && count < max_count {
+                            low_support_umigenes.push((*gene_id, umi_id));
+                        }
                     }
                 }
             }
         }
-    }
 
-    // Determine which UMIs need to be corrected
-    let umi_corrections = correct_umis(raw_umigene_counts);
+        let umigene_counts = UmiGeneCounts::from_pairs(umigene_pairs);
+        let mut is_low_support = vec![false; umigene_counts.keys.len()];
+        for (gene_id, umi_id) in low_support_umigenes {
+            is_low_support[umigene_counts.index_of(gene_id, umi_id).unwrap()] = true;
+        }
 
-    // Correct UMIs and mark PCR duplicates
-    let mut wrote_umigenes = HashSet::new();
+        // Determine which UMIs need to be corrected
+        let umi_corrections = correct_umis(&umi_ids, &umigene_counts);
 
-    for (_qname, _qname_records) in &bc_group.iter().group_by(|x| x.qname()) {
+        // Correct UMIs and mark PCR duplicates
+        let mut wrote_umigenes = HashSet::new();
+        let mut updates = Vec::with_capacity(bc_group.len());
 
-        let qname_records: Vec<_> = _qname_records.collect();
-        // Take UMI from first record
-        let maybe_umi = utils::get_read_umi(&qname_records.iter().nth(0).unwrap());
+        for (_qname, _qname_records) in &bc_group.iter().group_by(|x| x.qname()) {
 
-        let maybe_gene = get_qname_conf_mapped_feature(qname_records.iter()
-                                                       .map(|x| *x));
+            let qname_records: Vec<_> = _qname_records.collect();
+            // Take UMI from first record
+            let maybe_umi = utils::get_read_umi(qname_records[0]);
 
-        for record in qname_records {
-            // Clone here because holding a &mut to the record
-            // while simultaneously grouping by qname in the outer loop
-            // makes rustc very unhappy.
-            let mut new_record = record.clone();
-            let mut new_flags = utils::get_read_extra_flags(&new_record);
+            let maybe_gene = get_qname_conf_mapped_feature(qname_records.iter()
+                                                           .map(|x| *x));
 
-            let is_primary = !record.is_secondary();
-            let is_dup_candidate = utils::is_read_dup_candidate(&record);
+            let maybe_key = match (maybe_umi, maybe_gene) {
+                (Some(umi), Some(gene)) => {
+                    let next_gene_id = gene_ids.len() as u32;
+                    let gene_id = *gene_ids.entry(gene).or_insert(next_gene_id);
+                    Some((gene_id, umi_ids.get_or_insert(umi)))
+                },
+                _ => None,
+            };
+            let maybe_index = maybe_key.and_then(|(gene_id, umi_id)| umigene_counts.index_of(gene_id, umi_id));
 
-            if is_primary {
-                metrics[lib_idx].total_reads += 1;
-                barcode_summary.reads += 1
-            }
+            for record in qname_records {
+                let mut update = RecordUpdate {
+                    extra_flags: utils::get_read_extra_flags(&record),
+                    corrected_umi: None,
+                    is_dup: false,
+                };
 
-            metrics[lib_idx].candidate_dup_reads += is_dup_candidate as u64;
-
-            if let (Some(umi), Some(gene)) = (maybe_umi.as_ref(), maybe_gene.as_ref()) {
-                let key = (umi.clone(), gene.clone());
-
-                if is_primary && low_support_umigenes.contains(&key) {
-                    // Low support (UMI, gene). Mark as low support.
-                    // - Only consider primary alignments for this flag.
-                    // - Do not correct the UMI.
-                    // - Do not mark duplicates w/ for this (UMI, gene).
-                    metrics[lib_idx].low_support_umi_reads += 1;
-                    new_flags |= utils::ExtraFlags::LOW_SUPPORT_UMI;
-
-                } else {
-                    // Correct UMIs in all records
-                    let (corrected_umi, is_corrected) = match umi_corrections.get(&key) {
-                        Some(new_umi) => (new_umi.clone(), true),
-                        None => (umi.clone(), false),
-                    };
-
-                    // Correct the UMI tag
-                    if is_corrected {
-                        // Only tabulate metrics on primary alignments
-                        if is_primary {
-                            metrics[lib_idx].umi_corrected_reads += 1;
-                            barcode_summary.umi_corrected_reads += 1;
-                        }
+                let is_primary = !record.is_secondary();
+                let is_dup_candidate = utils::is_read_dup_candidate(&record);
 
-                        new_record.remove_aux(utils::PROC_UMI_SEQ_TAG);
-                        let _ = new_record.push_aux(utils::PROC_UMI_SEQ_TAG,
-                                            &bam::record::Aux::String(&corrected_umi));
-                    }
+                if is_primary {
+                    metrics.total_reads += 1;
+                    barcode_summary.reads += 1
+                }
+
+                metrics.candidate_dup_reads += is_dup_candidate as u64;
+
+                if let Some((gene_id, umi_id)) = maybe_key {
+                    if is_primary && maybe_index.map_or(false, |i| is_low_support[i]) {
+                        // Low support (UMI, gene). Mark as low support.
+                        // - Only consider primary alignments for this flag.
+                        // - Do not correct the UMI.
+                        // - Do not mark duplicates w/ for this (UMI, gene).
+                        metrics.low_support_umi_reads += 1;
+                        update.extra_flags |= utils::ExtraFlags::LOW_SUPPORT_UMI;
+
+                    } else {
+                        // Correct UMIs in all records
+                        let maybe_corrected_umi = maybe_index.and_then(|i| umi_corrections[i]);
+
+                        // Correct the UMI tag
+                        if let Some(corrected_umi) = maybe_corrected_umi {
+                            // Only tabulate metrics on primary alignments
+                            if is_primary {
+                                metrics.umi_corrected_reads += 1;
+                                barcode_summary.umi_corrected_reads += 1;
+                            }
 
-                    // Don't try to dup mark secondary alignments.
-                    if is_dup_candidate {
-                        let dup_key = (corrected_umi, key.1, get_mate_type(&record));
-
-                        barcode_summary.candidate_dup_reads += 1;
-
-                        if wrote_umigenes.contains(&dup_key) {
-                            // Duplicate
-                            metrics[lib_idx].dup_reads += 1;
-                            let flags = record.flags();
-                            new_record.set_flags(flags | 1024u16);
-                        } else {
-                            // Non-duplicate
-                            wrote_umigenes.insert(dup_key);
-
-                            // Flag read1 as countable
-                            if !record.is_last_in_template() {
-                                metrics[lib_idx].umis += 1;
-                                barcode_summary.umis += 1;
-                                new_flags |= utils::ExtraFlags::UMI_COUNT;
+                            update.corrected_umi = Some(umi_ids.get_seq(corrected_umi));
+                        }
+
+                        // Don't try to dup mark secondary alignments.
+                        if is_dup_candidate {
+                            let dup_key = (maybe_corrected_umi.unwrap_or(umi_id), gene_id, get_mate_type(&record));
+
+                            barcode_summary.candidate_dup_reads += 1;
+
+                            if wrote_umigenes.contains(&dup_key) {
+                                // Duplicate
+                                metrics.dup_reads += 1;
+                                update.is_dup = true;
+                            } else {
+                                // Non-duplicate
+                                wrote_umigenes.insert(dup_key);
+
+                                // Flag read1 as countable
+                                if !record.is_last_in_template() {
+                                    metrics.umis += 1;
+                                    barcode_summary.umis += 1;
+                                    update.extra_flags |= utils::ExtraFlags::UMI_COUNT;
+                                }
                             }
                         }
                     }
                 }
+                updates.push(update);
             }
-            if new_flags.bits() > 0 {
-                new_record.remove_aux(utils::EXTRA_FLAGS_TAG);
-                let _ = new_record.push_aux(utils::EXTRA_FLAGS_TAG,
-                                    &bam::record::Aux::Integer(new_flags.bits() as i64));
-            }
-            out_bam.write(&new_record).expect("Failed to write BAM record");
+        }
+        updates
+    };
+
+    for (record, update) in bc_group.iter_mut().zip(updates.into_iter()) {
+        if let Some(corrected_umi) = update.corrected_umi {
+            record.remove_aux(utils::PROC_UMI_SEQ_TAG);
+            let _ = record.push_aux(utils::PROC_UMI_SEQ_TAG,
+                                    &bam::record::Aux::String(&corrected_umi));
+        }
+        if update.is_dup {
+            let flags = record.flags();
+            record.set_flags(flags | 1024u16);
+        }
+        if update.extra_flags.bits() > 0 {
+            record.remove_aux(utils::EXTRA_FLAGS_TAG);
+            let _ = record.push_aux(utils::EXTRA_FLAGS_TAG,
+                                    &bam::record::Aux::Integer(update.extra_flags.bits() as i64));
         }
     }
+
+    (bc_group, metrics, barcode_summary)
 }
 
-fn cmd_mark_dups(args: &ChunkArgs, outs: JsonDict) -> Result<JsonDict, Error> {
+/// Consecutive records of a chunk that are duplicate marked together
+struct RecordGroup {
+    /// Library index and barcode of the records,
+    /// or None for records without a valid barcode, which are passed through
+    key: Option<(usize, Vec<u8>)>,
+    records: Vec<bam::Record>,
+}
 
-    // Load library info
-    let library_info = &args.library_info;
+/// A record group after duplicate marking, with its metrics
+struct ProcessedGroup {
+    key: Option<(usize, Vec<u8>)>,
+    records: Vec<bam::Record>,
+    metrics: Metrics,
+    summary: BarcodeSummaryEntry,
+}
 
-    // Partition metrics by library
-    let mut metrics: Vec<Metrics> = vec![Default::default(); library_info.len()];
-    let mut bc_summaries: Vec<BarcodeSummary> = vec![Default::default(); library_info.len()];
+fn process_group(group: RecordGroup, filter_umis: bool) -> ProcessedGroup {
+    match group.key {
+        Some(_) => {
+            let (records, metrics, summary) = process_barcode(group.records, filter_umis);
+            ProcessedGroup { key: group.key, records: records, metrics: metrics, summary: summary }
+        },
+        None => ProcessedGroup { key: None, records: group.records, metrics: Default::default(), summary: Default::default() },
+    }
+}
 
-    let mut bam = bam::Reader::from_path(&args.input)
-        .context("Failed to open input BAM file")?;
+type GroupBatch = (usize, Vec<RecordGroup>);
+type ProcessedBatch = (usize, thread::Result<Vec<ProcessedGroup>>);
 
-    let mut out_bam = bam::Writer::from_path(outs["alignments"].as_str().unwrap(),
-                                             &bam::Header::from_template(bam.header()))
-        .expect("Failed to open output BAM file");
+/// Duplicate marks the record groups of a chunk, on a pool of worker threads if
+/// there is more than one thread, and writes them out in input order.
+/// The output BAM and metrics are the same for any number of threads.
+struct GroupProcessor<'a> {
+    filter_umis: bool,
+    out_bam: &'a mut bam::Writer,
+    metrics: &'a mut Vec<Metrics>,
+    bc_summaries: &'a mut Vec<BarcodeSummary>,
+
+    workers: Vec<thread::JoinHandle<()>>,
+    work_tx: Option<mpsc::Sender<GroupBatch>>,
+    result_rx: Option<mpsc::Receiver<ProcessedBatch>>,
+    max_batches_in_flight: usize,
+
+    // Groups waiting to be sent to a worker
+    batch: Vec<RecordGroup>,
+    batch_records: usize,
+
+    num_batches: usize,
+    next_batch: usize,
+    records_in_flight: usize,
+    finished_batches: BTreeMap<usize, thread::Result<Vec<ProcessedGroup>>>,
+}
 
-    let range = (args.chunk_start, args.chunk_end);
-    let chunk_iter = BamChunkIter::new(&mut bam, range);
+impl<'a> GroupProcessor<'a> {
+    fn new(out_bam: &'a mut bam::Writer,
+           metrics: &'a mut Vec<Metrics>,
+           bc_summaries: &'a mut Vec<BarcodeSummary>,
+           filter_umis: bool,
+           num_threads: usize) -> GroupProcessor<'a> {
+        let mut workers = Vec::new();
+        let mut work_tx = None;
+        let mut result_rx = None;
+
+        if num_threads > 1 {
+            let (batch_tx, batch_rx) = mpsc::channel::<GroupBatch>();
+            let (processed_tx, processed_rx) = mpsc::channel::<ProcessedBatch>();
+            let batch_rx = Arc::new(Mutex::new(batch_rx));
+
+            for _ in 0..num_threads {
+                let batch_rx = batch_rx.clone();
+                let processed_tx = processed_tx.clone();
+
+                workers.push(thread::spawn(move || {
+                    loop {
+                        let (batch_index, batch) = match batch_rx.lock().unwrap().recv() {
+                            Ok(batch) => batch,
+                            Err(_) => break,
+                        };
+                        // Hand a panic back to the main thread rather than leave it waiting for this batch
+                        let result = panic::catch_unwind(panic::AssertUnwindSafe(|| {
+                            batch.into_iter().map(|group| process_group(group, filter_umis)).collect::<Vec<_>>()
+                        }));
+                        if processed_tx.send((batch_index, result)).is_err() {
+                            break;
+                        }
+                    }
+                }));
+            }
+
+            work_tx = Some(batch_tx);
+            result_rx = Some(processed_rx);
+        }
+
+        GroupProcessor {
+            filter_umis: filter_umis,
+            out_bam: out_bam,
+            metrics: metrics,
+            bc_summaries: bc_summaries,
+            workers: workers,
+            work_tx: work_tx,
+            result_rx: result_rx,
+            max_batches_in_flight: num_threads * BATCHES_IN_FLIGHT_PER_THREAD,
+            batch: Vec::new(),
+            batch_records: 0,
+            num_batches: 0,
+            next_batch: 0,
+            records_in_flight: 0,
+            finished_batches: BTreeMap::new(),
+        }
+    }
+
+    /// Add the next group of records of the chunk
+    fn push(&mut self, mut group: RecordGroup) {
+        if self.workers.is_empty() {
+            let processed = process_group(group, self.filter_umis);
+            self.write_group(processed);
+            return;
+        }
+
+        self.batch_records += group.records.len();
+
+        // Pass consecutive records without a barcode through as one group
+        if group.key.is_none() {
+            if let Some(last_group) = self.batch.last_mut() {
+                if last_group.key.is_none() {
+                    last_group.records.append(&mut group.records);
+                }
+            }
+        }
+        if !group.records.is_empty() {
+            self.batch.push(group);
+        }
+
+        if self.batch_records >= GROUP_BATCH_RECORDS {
+            self.send_batch();
+        }
+    }
+
+    /// Process and write any remaining groups
+    fn finish(mut self) {
+        if !self.batch.is_empty() {
+            self.send_batch();
+        }
+
+        // Workers exit once the queue is closed and empty
+        self.work_tx = None;
+        while self.next_batch < self.num_batches {
+            self.receive_batch();
+        }
+        for worker in self.workers.drain(..) {
+            worker.join().expect("Duplicate marking thread panicked");
+        }
+    }
+
+    fn send_batch(&mut self) {
+        let batch = mem::replace(&mut self.batch, Vec::new());
+        self.work_tx.as_ref().unwrap().send((self.num_batches, batch))
+            .expect("Duplicate marking threads exited early");
+        self.num_batches += 1;
+        self.records_in_flight += self.batch_records;
+        self.batch_records = 0;
+
+        // Bound the number of records held in memory
+        while self.next_batch < self.num_batches &&
+            (self.num_batches - self.next_batch >= self.max_batches_in_flight ||
+             self.records_in_flight >= MAX_RECORDS_IN_FLIGHT) {
+            self.receive_batch();
+        }
+    }
+
+    /// Wait for a batch to finish, then write out any batches that are next in order
+    fn receive_batch(&mut self) {
+        let (batch_index, result) = self.result_rx.as_ref().unwrap().recv()
+            .expect("Duplicate marking threads exited early");
+        self.finished_batches.insert(batch_index, result);
+
+        while let Some(result) = self.finished_batches.remove(&self.next_batch) {
+            let groups = result.unwrap_or_else(|e| panic::resume_unwind(e));
+            for group in groups {
+                self.records_in_flight -= group.records.len();
+                self.write_group(group);
+            }
+            self.next_batch += 1;
+        }
+    }
+
+    fn write_group(&mut self, group: ProcessedGroup) {
+        match group.key {
+            Some((lib_idx, bc)) => {
+                self.metrics[lib_idx].merge(&group.metrics);
+                self.bc_summaries[lib_idx].barcodes.entry(bc)
+                    .or_insert_with(Default::default)
+                    .merge(&group.summary);
+            },
+            None => {
+                for record in &group.records {
+                    self.metrics[utils::get_read_library_index(record)].total_reads += 1;
+                }
+            },
+        }
+        for record in &group.records {
+            self.out_bam.write(record).expect("Failed to write BAM record");
+        }
+    }
+}
 
+/// Split the records of a chunk into groups of the same (barcode, library),
+/// and groups of records without a valid barcode, in order
+fn push_record_groups<I>(records: I, processor: &mut GroupProcessor)
+    where I: Iterator<Item = bam::Record> {
     let mut maybe_prev_bc: Option<Vec<u8>> = None;
     let mut maybe_prev_lib_idx: Option<usize> = None;
 
@@ -438,15 +844,14 @@ fn cmd_mark_dups(args: &ChunkArgs, outs: JsonDict) -> Result<JsonDict, Error> {
     // into memory unnecessarily. Chaining filter() upstream did not
     // work due to the required side effects of metric-tallying and BAM writing.
     // So here we do filter(...).group_by(...) from scratch.
-    for record in chunk_iter.map(|r| r.unwrap()) {
+    for record in records {
         let maybe_bc = utils::get_read_barcode(&record);
         let lib_idx = utils::get_read_library_index(&record);
 
         // Skip records without a valid barcode.
 
         if maybe_bc.is_none() {
-            metrics[lib_idx].total_reads += 1;
-            out_bam.write(&record).expect("Failed to write BAM record");
+            processor.push(RecordGroup { key: None, records: vec![record] });
             continue;
         }
 
@@ -460,10 +865,10 @@ fn cmd_mark_dups(args: &ChunkArgs, outs: JsonDict) -> Result<JsonDict, Error> {
 
             if bc != *prev_bc || lib_idx != *prev_lib_idx {
                 // Hit a group key boundary
-                process_barcode(&mut group_records,
-                                &mut metrics, &mut bc_summaries, &mut out_bam,
-                                *prev_lib_idx, prev_bc, args.filter_umis);
-                group_records.clear()
+                processor.push(RecordGroup {
+                    key: Some((*prev_lib_idx, prev_bc.clone())),
+                    records: mem::replace(&mut group_records, vec![]),
+                });
             }
         }
 
@@ -476,10 +881,42 @@ fn cmd_mark_dups(args: &ChunkArgs, outs: JsonDict) -> Result<JsonDict, Error> {
 
     // Process the final group
     if !group_records.is_empty() {
-        process_barcode(&mut group_records,
-                        &mut metrics, &mut bc_summaries, &mut out_bam,
-                        maybe_prev_lib_idx.unwrap(), &maybe_prev_bc.unwrap(),
-                        args.filter_umis);
+        processor.push(RecordGroup {
+            key: Some((maybe_prev_lib_idx.unwrap(), maybe_prev_bc.unwrap())),
+            records: group_records,
+        });
+    }
+}
+
+fn cmd_mark_dups(args: &ChunkArgs, outs: JsonDict) -> Result<JsonDict, Error> {
+
+    // Load library info
+    let library_info = &args.library_info;
+
+    // Partition metrics by library
+    let mut metrics: Vec<Metrics> = vec![Default::default(); library_info.len()];
+    let mut bc_summaries: Vec<BarcodeSummary> = vec![Default::default(); library_info.len()];
+
+    let mut bam = bam::Reader::from_path(&args.input)
+        .context("Failed to open input BAM file")?;
+
+    let mut out_bam = bam::Writer::from_path(outs["alignments"].as_str().unwrap(),
+                                             &bam::Header::from_template(bam.header()))
+        .expect("Failed to open output BAM file");
+
+    if args.threads > 1 {
+        out_bam.set_threads(args.threads)
+            .context("Failed to set output BAM compression threads")?;
+    }
+
+    let range = (args.chunk_start, args.chunk_end);
+    let chunk_iter = BamChunkIter::new(&mut bam, range);
+
+    {
+        let mut processor = GroupProcessor::new(&mut out_bam, &mut metrics, &mut bc_summaries,
+                                                args.filter_umis, args.threads);
+        push_record_groups(chunk_iter.map(|r| r.unwrap()), &mut processor);
+        processor.finish();
     }
 
     // Write metrics
@@ -520,7 +957,7 @@ impl MartianStage for MarkDuplicatesStage {
             let major_bc_prop = major_barcode_proportion_within_chunk(&mut bam_reader, &block_offsets, left_idx, right_idx, 1000);
             let chunk_size_gb = ((block_offsets[right_idx - 1usize] - block_offsets[left_idx]) as f64) / bam_comp_ratio / (1024u64.pow(3) as f64);
             // emprically learned model for memory usage estimation
-            let mem_gb = 2f64 + chunk_size_gb + chunk_size_gb * major_bc_prop;
+            let mem_gb = 2f64 + RECORDS_IN_FLIGHT_MEM_GB + chunk_size_gb + chunk_size_gb * major_bc_prop;
             let mem_gb_round = min(64i32, max(2i32, ((mem_gb / 2.0f64).ceil() * 2.0f64) as i32)); // round to next even
 
             chunks.push(json!({
@@ -530,6 +967,7 @@ impl MartianStage for MarkDuplicatesStage {
                 "bam_compression_ratio" : bam_comp_ratio,
                 "major_barcode_proportion" : major_bc_prop,
                 "__mem_gb": mem_gb_round,
+                "__threads": MARK_DUPS_THREADS,
             }));
 
             left_idx = right_idx;
@@ -572,14 +1010,7 @@ impl MartianStage for MarkDuplicatesStage {
                 .expect("Failed to read from metrics JSON file");
             for (lib_idx, lib) in chunk.iter().enumerate() {
                 let lt = &library_info[lib_idx].library_type;
-                let mut m = metrics.get_mut(lt).unwrap();
-
-                m.total_reads += lib.total_reads;
-                m.umi_corrected_reads += lib.umi_corrected_reads;
-                m.dup_reads += lib.dup_reads;
-                m.umis += lib.umis;
-                m.candidate_dup_reads += lib.candidate_dup_reads;
-                m.low_support_umi_reads += lib.low_support_umi_reads;
+                metrics.get_mut(lt).unwrap().merge(lib);
             }
         }
 
@@ -608,12 +1039,7 @@ impl MartianStage for MarkDuplicatesStage {
                         bc_summaries_lt.barcodes.insert(bc.clone(),
                                                         Default::default());
                     }
-                    let new_entry = bc_summaries_lt.barcodes.get_mut(bc).unwrap();
-
-                    new_entry.reads += bc_entry.reads;
-                    new_entry.umis += bc_entry.umis;
-                    new_entry.candidate_dup_reads += bc_entry.candidate_dup_reads;
-                    new_entry.umi_corrected_reads += bc_entry.umi_corrected_reads;
+                    bc_summaries_lt.barcodes.get_mut(bc).unwrap().merge(bc_entry);
                 }
             }
         }
@@ -674,30 +1100,65 @@ mod test {
     use serde_json;
 
     use cmd_mark_dups;
-    use cmd_mark_dups::correct_umis;
+    use cmd_mark_dups::{correct_umis, UmiIds, UmiGeneCounts};
     use utils;
 
     const RAW_UMI_SEQ_TAG: &'static [u8]     = b"UR";
 
+    /// Correct UMIs given the read count of each (UMI, gene) pair.
+    /// Returns the corrected UMI of each corrected pair.
+    fn correct_umi_counts(umi_counts: &[(&[u8], u32, u64)]) -> HashMap<(Vec<u8>, u32), Vec<u8>> {
+        let mut umi_ids = UmiIds::new();
+        let mut pairs = Vec::new();
+        for &(umi, gene, count) in umi_counts {
+            let umi_id = umi_ids.get_or_insert(umi);
+            for _ in 0..count {
+                pairs.push((gene, umi_id));
+            }
+        }
+        let umigene_counts = UmiGeneCounts::from_pairs(pairs);
+
+        let mut corr = HashMap::new();
+        for (&(gene, umi), maybe_corrected) in umigene_counts.keys.iter().zip(correct_umis(&umi_ids, &umigene_counts)) {
+            if let Some(corrected) = maybe_corrected {
+                corr.insert((umi_ids.get_seq(umi), gene), umi_ids.get_seq(corrected));
+            }
+        }
+        corr
+    }
+
     #[test]
     fn test_correct_umis() {
-        let mut umis: HashMap<(Vec<u8>, String), u64> = HashMap::new();
-        umis.insert((b"AAAA".to_vec(), "G0".to_owned()), 3u64);
-        umis.insert((b"AAAT".to_vec(), "G0".to_owned()), 2u64);
-        umis.insert((b"AAAA".to_vec(), "G1".to_owned()), 1u64);
-        umis.insert((b"AATT".to_vec(), "G1".to_owned()), 1u64);
-
-        let corr = correct_umis(umis);
+        let corr = correct_umi_counts(&[(b"AAAA", 0, 3), (b"AAAT", 0, 2), (b"AAAA", 1, 1), (b"AATT", 1, 1)]);
         assert!(corr.len() == 1);
-        assert!(corr.get(&(b"AAAT".to_vec(), "G0".to_owned())).unwrap() == b"AAAA");
-
-        let mut umis: HashMap<(Vec<u8>, String), u64> = HashMap::new();
-        umis.insert((b"CCCC".to_vec(), "G0".to_owned()), 1u64);
-        umis.insert((b"CGCC".to_vec(), "G0".to_owned()), 1u64);
+        assert!(corr.get(&(b"AAAT".to_vec(), 0)).unwrap() == b"AAAA");
 
-        let corr = correct_umis(umis);
+        let corr = correct_umi_counts(&[(b"CCCC", 0, 1), (b"CGCC", 0, 1)]);
         assert!(corr.len() == 1);
-        assert!(corr.get(&(b"CCCC".to_vec(), "G0".to_owned())).unwrap() == b"CGCC");
+        assert!(corr.get(&(b"CCCC".to_vec(), 0)).unwrap() == b"CGCC");
+
+        // UMIs that can't be packed
+        let corr = correct_umi_counts(&[(b"ANAA", 0, 1), (b"AAAA", 0, 2), (b"ACAA", 0, 1)]);
+        assert!(corr.len() == 2);
+        assert!(corr.get(&(b"ANAA".to_vec(), 0)).unwrap() == b"AAAA");
+        assert!(corr.get(&(b"ACAA".to_vec(), 0)).unwrap() == b"AAAA");
+
+        let long_umi = vec![b'A'; 40];
+        let mut long_umi_neighbor = long_umi.clone();
+        long_umi_neighbor[39] = b'T';
+        let corr = correct_umi_counts(&[(&long_umi, 0, 1), (&long_umi_neighbor, 0, 1)]);
+        assert!(corr.len() == 1);
+        assert!(*corr.get(&(long_umi, 0)).unwrap() == long_umi_neighbor);
+    }
+
+    #[test]
+    fn test_pack_umis() {
+        for umi in &[&b""[..], b"A", b"ACGT", b"TTTTTTTTTTTTTTTTTTTTTTTTTTTTTTT"] {
+            assert_eq!(cmd_mark_dups::unpack_umi(cmd_mark_dups::pack_umi(umi).unwrap()), umi.to_vec());
+        }
+        assert!(cmd_mark_dups::pack_umi(b"ACNT").is_none());
+        assert!(cmd_mark_dups::pack_umi(&[b'A'; 32]).is_none());
+        assert!(cmd_mark_dups::pack_umi(b"ACGT") < cmd_mark_dups::pack_umi(b"ACTA"));
     }
 
     fn sam_to_records(header: &HeaderView, sam: &[u8]) -> Vec<bam::Record> {
@@ -825,35 +1286,42 @@ mod test {
                     "gem_group": 1,
                 }])).unwrap();
 
-        let chunk_args = cmd_mark_dups::ChunkArgs {
-            input: in_bam_filename.to_str().unwrap().to_owned(),
-            chunk_start: chunk_intervals[0].0,
-            chunk_end: chunk_intervals[0].1,
-            filter_umis: true,
-            library_info: lib_info,
-        };
+        // The output shouldn't depend on the number of threads
+        for &threads in &[1usize, 2] {
+            let chunk_args = cmd_mark_dups::ChunkArgs {
+                input: in_bam_filename.to_str().unwrap().to_owned(),
+                chunk_start: chunk_intervals[0].0,
+                chunk_end: chunk_intervals[0].1,
+                filter_umis: true,
+                library_info: lib_info.clone(),
+                threads: threads,
+            };
 
-        // Setup output
-        let metrics_filename = test_dir.join("metrics.json");
-        let out_bam_filename = test_dir.join("output.bam");
-        let bc_summary_filename = test_dir.join("chunk_barcode_summary.bin");
-        let chunk_outs = match json!({
-            "metrics": metrics_filename.clone(),
-            "alignments": out_bam_filename.clone(),
-            "chunk_barcode_summary": bc_summary_filename.clone(),
-        }) {
-            serde_json::Value::Object(x) => Some(x),
-            _ => None,
-        }.unwrap();
-
-        let outs = cmd_mark_dups::cmd_mark_dups(&chunk_args, chunk_outs).unwrap();
-
-        // Check outs dict
-        assert_eq!(outs["metrics"].as_str().unwrap(), metrics_filename.to_str().unwrap());
-        assert_eq!(outs["alignments"].as_str().unwrap(), out_bam_filename.to_str().unwrap());
-
-        // Check output files
-        check_outputs(&test_records, &out_bam_filename, &metrics_filename);
+            // Setup output
+            let out_dir = test_dir.join(format!("threads_{}", threads));
+            fs::create_dir_all(&out_dir)
+                .expect("Failed to create test output dir");
+            let metrics_filename = out_dir.join("metrics.json");
+            let out_bam_filename = out_dir.join("output.bam");
+            let bc_summary_filename = out_dir.join("chunk_barcode_summary.bin");
+            let chunk_outs = match json!({
+                "metrics": metrics_filename.clone(),
+                "alignments": out_bam_filename.clone(),
+                "chunk_barcode_summary": bc_summary_filename.clone(),
+            }) {
+                serde_json::Value::Object(x) => Some(x),
+                _ => None,
+            }.unwrap();
+
+            let outs = cmd_mark_dups::cmd_mark_dups(&chunk_args, chunk_outs).unwrap();
+
+            // Check outs dict
+            assert_eq!(outs["metrics"].as_str().unwrap(), metrics_filename.to_str().unwrap());
+            assert_eq!(outs["alignments"].as_str().unwrap(), out_bam_filename.to_str().unwrap());
+
+            // Check output files
+            check_outputs(&test_records, &out_bam_filename, &metrics_filename);
+        }
     }
 
 
@@ -6,7 +6,6 @@ use std::fs::File;
 use std::io;
 use std::io::BufWriter;
 use std::path::Path;
-use std::str;
 use serde;
 use serde_json;
 use rust_htslib::bam;
@@ -57,17 +56,14 @@ pub fn get_read_barcode(record: &bam::Record) -> Option<Vec<u8>> {
 }
 
 /// Get an alignment record's processed UMI sequence
-pub fn get_read_umi(record: &bam::Record) -> Option<Vec<u8>> {
-    record.aux(PROC_UMI_SEQ_TAG).map(|x| x.string()).map(|x| x.to_owned())
+pub fn get_read_umi(record: &bam::Record) -> Option<&[u8]> {
+    record.aux(PROC_UMI_SEQ_TAG).map(|x| x.string())
 }
 
-/// Get an alignment record's list of mapped feature ID strings
-pub fn get_read_feature_ids(record: &bam::Record) -> Vec<String> {
-    record.aux(FEATURE_IDS_TAG).map_or(vec![], |x| str::from_utf8(x.string()).unwrap()
-                             .split(';')
-                             .map(|y| y.to_owned())
-                             .collect()
-    )
+/// Get an alignment record's mapped feature IDs
+pub fn get_read_feature_ids<'a>(record: &'a bam::Record) -> impl Iterator<Item = &'a [u8]> + 'a {
+    record.aux(FEATURE_IDS_TAG).into_iter()
+        .flat_map(|x| x.string().split(|c| *c == b';'))
 }
 
 /// Get an alignment record's extra flags
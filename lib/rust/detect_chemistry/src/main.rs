@@ -32,8 +32,9 @@ use std::fs;
 use std::fs::File;
 use std::io::{BufWriter, BufReader, Read};
 use std::hash::Hash;
+use std::sync::Arc;
 
-use bio::io::{fasta,fastq};
+use bio::io::{fasta};
 
 use debruijn::{Kmer};
 use debruijn::kmer::{IntKmer};
@@ -51,7 +52,7 @@ const USAGE: &'static str = "
 Usage:
   detect_chemistry get-transcripts <genome-fa> <in-gtf> <out-fa> [--all-transcripts]
   detect_chemistry index-transcripts <in-fa> <out-idx> [--skip=N] [--hash=XXX] [--gamma=F]
-  detect_chemistry map-reads <in-idx> <in-fq> <out-json> [--skip=N] [--min-kmers=N] [--initial-reads=N] [--fastqs=F]
+  detect_chemistry map-reads <in-idx> <in-fq> <out-json> [--skip=N] [--min-kmers=N] [--initial-reads=N] [--fastqs=F] [--threads=N] [--by-read-type]
   detect_chemistry (-h | --help)
 
 Options:
@@ -63,6 +64,8 @@ Options:
   --min-kmers=N        Min matching kmers to consider a read mapped [default: 1]
   --initial-reads=N    Process initial N reads
   --fastqs=F           Path to JSON file w/ info for each input fastq (ignores <in-fq>)
+  --threads=N          Number of fastqs to map in parallel [default: 1]
+  --by-read-type       Write metrics for each read type instead of their sum
 ";
 
 #[derive(Debug, Deserialize, Clone)]
@@ -91,6 +94,8 @@ struct Args {
     flag_min_kmers:      usize,
     flag_initial_reads:  Option<usize>,
     flag_fastqs:         Option<String>,
+    flag_threads:        usize,
+    flag_by_read_type:   bool,
 }
 
 type MyKmer = IntKmer<u64>;
@@ -199,13 +204,13 @@ fn map_reads(args: Args) {
                                     .expect("Failed to open index file for deserialization"));
 
     println!("Loading index");
-    // Use Box here to make the match arms consistent
+    // Use Arc here to make the match arms consistent and to share the index between threads
     let idx = match idx_type {
         KmerIndexType::BBHashIndex => {
-            Box::new(load_index::<BBHashKmerIndex<MyKmer>, BufReader<File>>(&mut idx_reader)) as Box<KmerPresenceQuery<MyKmer>>
+            Arc::new(load_index::<BBHashKmerIndex<MyKmer>, BufReader<File>>(&mut idx_reader)) as Arc<KmerPresenceQuery<MyKmer> + Send + Sync>
         },
         KmerIndexType::HashSetIndex => {
-            Box::new(load_index::<HashSetKmerIndex<MyKmer>, BufReader<File>>(&mut idx_reader)) as Box<KmerPresenceQuery<MyKmer>>
+            Arc::new(load_index::<HashSetKmerIndex<MyKmer>, BufReader<File>>(&mut idx_reader)) as Arc<KmerPresenceQuery<MyKmer> + Send + Sync>
         },
     };
 
@@ -230,16 +235,34 @@ fn map_reads(args: Args) {
         fq_defs.push(FastqDef{read_type: String::from("R1"), input: vec![arg_in_fq.unwrap()], interleaved: false});
     }
 
-    let mut metrics: map::Metrics = Default::default();
+    let mut inputs = Vec::new();
     for fq_def in &fq_defs {
         for fq_filename in &fq_def.input {
-            let reader = utils::open_maybe_gzip(&fq_filename);
-            let fq_reader = fastq::Reader::new(reader);
-            let fq_metrics = map::map_reads(&*idx, fq_reader, min_kmers, skip_bases, initial_reads, fq_def.interleaved, Some(fq_def.read_type.clone()));
-            map::add_metrics(&mut metrics, &fq_metrics);
+            inputs.push(map::FastqInput {
+                read_type: fq_def.read_type.clone(),
+                path: fq_filename.clone(),
+                interleaved: fq_def.interleaved,
+            });
         }
     }
-    serde_json::to_writer_pretty(File::create(&Path::new(&arg_out_json.unwrap()))
-                                 .expect("Couldn't create output JSON file"), &metrics)
-        .expect("Failed to write JSON output");
+
+    // Every read type in the fastq definitions has an entry, even without any fastqs
+    let mut metrics_by_read_type = map::map_fastqs(idx, inputs, min_kmers, skip_bases, initial_reads, args.flag_threads);
+    for fq_def in &fq_defs {
+        metrics_by_read_type.entry(fq_def.read_type.clone()).or_insert(Default::default());
+    }
+
+    let out_file = File::create(&Path::new(&arg_out_json.unwrap()))
+        .expect("Couldn't create output JSON file");
+    if args.flag_by_read_type {
+        serde_json::to_writer_pretty(out_file, &metrics_by_read_type)
+            .expect("Failed to write JSON output");
+    } else {
+        let mut metrics: map::Metrics = Default::default();
+        for fq_metrics in metrics_by_read_type.values() {
+            map::add_metrics(&mut metrics, fq_metrics);
+        }
+        serde_json::to_writer_pretty(out_file, &metrics)
+            .expect("Failed to write JSON output");
+    }
 }
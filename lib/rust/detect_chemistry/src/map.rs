@@ -3,6 +3,10 @@
 //
 
 use std::io::{Read};
+use std::collections::BTreeMap;
+use std::panic;
+use std::sync::{Arc, Mutex};
+use std::thread;
 use itertools::Itertools;
 
 use bio::io::fastq;
@@ -11,6 +15,7 @@ use debruijn::{Kmer, Vmer};
 use debruijn::dna_string::DnaString;
 
 use index;
+use utils;
 
 #[derive(Copy, Clone, Debug, Default, Serialize)]
 pub struct Metrics {
@@ -77,6 +82,55 @@ pub fn map_reads<K: Kmer, I: index::KmerPresenceQuery<K> + ?Sized, R: Read> (ind
     metrics
 }
 
+/// A FASTQ to map, and the read type to count its reads under
+#[derive(Clone, Debug)]
+pub struct FastqInput {
+    pub read_type: String,
+    pub path: String,
+    pub interleaved: bool,
+}
+
+/// Map the initial reads of each FASTQ, on up to num_threads threads sharing the index.
+/// Returns the metrics summed over the FASTQs of each read type.
+pub fn map_fastqs<K, I>(index: Arc<I>, inputs: Vec<FastqInput>, min_kmers: usize, skip_bases: usize, initial_reads: usize, num_threads: usize) -> BTreeMap<String, Metrics>
+    where K: Kmer + 'static, I: index::KmerPresenceQuery<K> + Send + Sync + ?Sized + 'static {
+
+    let mut metrics = BTreeMap::new();
+    for input in &inputs {
+        metrics.entry(input.read_type.clone()).or_insert(Metrics::default());
+    }
+
+    let num_workers = num_threads.max(1).min(inputs.len());
+    let queue = Arc::new(Mutex::new(inputs.into_iter()));
+
+    let workers: Vec<_> = (0..num_workers).map(|_| {
+        let index = index.clone();
+        let queue = queue.clone();
+        thread::spawn(move || {
+            let mut results = Vec::new();
+            loop {
+                let input = match queue.lock().unwrap().next() {
+                    Some(input) => input,
+                    None => break,
+                };
+                let fq_reader = fastq::Reader::new(utils::open_maybe_gzip(&input.path));
+                let fq_metrics = map_reads(&*index, fq_reader, min_kmers, skip_bases, initial_reads,
+                                           input.interleaved, Some(input.read_type.clone()));
+                results.push((input.read_type, fq_metrics));
+            }
+            results
+        })
+    }).collect();
+
+    for worker in workers {
+        let results = worker.join().unwrap_or_else(|e| panic::resume_unwind(e));
+        for (read_type, fq_metrics) in results {
+            add_metrics(metrics.get_mut(&read_type).unwrap(), &fq_metrics);
+        }
+    }
+    metrics
+}
+
 
 #[cfg(test)]
 mod tests {
@@ -149,4 +203,63 @@ mod tests {
         assert_eq!(metrics.antisense_reads, 50);
         assert_eq!(metrics.ambiguous_reads, 0);
     }
+
+    #[test]
+    fn test_map_fastqs() {
+        use index;
+        use std::io::{Cursor, Write};
+        use std::fs::{self, File};
+        use std::sync::Arc;
+        use bio::io::fasta;
+        use tests::random_seq_rng;
+        use debruijn::kmer::{IntKmer};
+        use rand::{SeedableRng, StdRng};
+        use map::{map_fastqs, FastqInput};
+        use bio::alphabets::dna::revcomp;
+        use std;
+
+        type MyKmer = IntKmer<u64>;
+
+        let seed = [0; 32];
+        let mut rng: StdRng = SeedableRng::from_seed(seed);
+
+        let tx_seq = random_seq_rng(100, &mut rng);
+        let fa_str = format!(">1\n{}", String::from_utf8(tx_seq.clone()).unwrap());
+        let reader = fasta::Reader::new(Cursor::new(fa_str.as_bytes()));
+        let index: index::BBHashKmerIndex<MyKmer> = index::index_transcripts_mphf(reader, 1000, 0, 2.0);
+        let index = Arc::new(index);
+
+        let mut sense_fq_reads = Vec::new();
+        let mut anti_fq_reads = Vec::new();
+        for i in 0..50 {
+            let piece = tx_seq.clone()[i..(i+50)].to_owned();
+            sense_fq_reads.push(String::from_utf8(piece.clone()).unwrap());
+            anti_fq_reads.push(String::from_utf8(revcomp(&piece).to_vec()).unwrap());
+        }
+
+        let tmp_dir = std::env::temp_dir().join(format!("detect_chemistry_test_{}", std::process::id()));
+        fs::create_dir_all(&tmp_dir).unwrap();
+        let sense_path = tmp_dir.join("sense.fastq").to_str().unwrap().to_string();
+        let anti_path = tmp_dir.join("anti.fastq").to_str().unwrap().to_string();
+        File::create(&sense_path).unwrap().write_all(make_test_fastq(&sense_fq_reads).as_bytes()).unwrap();
+        File::create(&anti_path).unwrap().write_all(make_test_fastq(&anti_fq_reads).as_bytes()).unwrap();
+
+        let input = |read_type: &str, path: &String| FastqInput {
+            read_type: read_type.to_string(), path: path.clone(), interleaved: false,
+        };
+        let inputs = vec![input("R1", &sense_path), input("R2", &anti_path), input("R1", &sense_path), input("R2", &anti_path)];
+
+        for &threads in [1, 3].iter() {
+            let metrics = map_fastqs(index.clone(), inputs.clone(), 1, 0, std::usize::MAX, threads);
+            assert_eq!(metrics.len(), 2);
+            assert_eq!(metrics["R1"].total_reads, 100);
+            assert_eq!(metrics["R1"].sense_reads, 100);
+            assert_eq!(metrics["R1"].antisense_reads, 0);
+            assert_eq!(metrics["R2"].total_reads, 100);
+            assert_eq!(metrics["R2"].antisense_reads, 100);
+            assert_eq!(metrics["R2"].sense_reads, 0);
+        }
+
+        fs::remove_dir_all(&tmp_dir).unwrap();
+    }
 }
@@ -52,19 +52,24 @@ use asm::UmiCounter;
 
 use itertools::Itertools;
 use std::path::{Path, PathBuf};
-use std::io::{BufWriter, Write};
+use std::io::{BufRead, BufReader, BufWriter, Write};
 use docopt::Docopt;
 use constants::{MAX_NUM_READPAIRS, MATCH_SCORE, MISMATCH_SCORE, GAP_OPEN, GAP_EXTEND, CLIP, DUMMY_CONTIG_NAME, QUAL_OFFSET, KMER_LEN_BANDED_ALIGN, WINDOW_SIZE_BANDED_ALIGN};
 use std::fs;
 use std::fs::File;
+use std::collections::BTreeMap;
+use std::panic;
+use std::sync::{mpsc, Arc, Mutex};
+use std::thread;
 use failure::Error;
 
 use time::PreciseTime;
 
 const USAGE: &'static str = "
 Usage:
-vdj_asm asm <inbam> <outdir> [--barcode=<BC>][--plot][--plot-json][--kmers=<NUM>][--min-contig=<NUM>][--frac-reads=<NUM>][--reads-per-barcode=<NUM>][--score-factor=<NUM>][--qual-factor=<NUM>][--rt-error=<NUM>][--min-qual=<NUM>][--match-score=<NUM>][--miss-score=<NUM>][--gap-open=<NUM>][--gap-extend=<NUM>][--min-sw-score=<NUM>][--min-umi-reads=<NUM>][--cons][--single-end][--subsample-rate=<NUM>][--use-unmapped][--mixture-filter]
+vdj_asm asm <inbam> <outdir> [--barcode=<BC>][--plot][--plot-json][--kmers=<NUM>][--min-contig=<NUM>][--frac-reads=<NUM>][--reads-per-barcode=<NUM>][--score-factor=<NUM>][--qual-factor=<NUM>][--rt-error=<NUM>][--min-qual=<NUM>][--match-score=<NUM>][--miss-score=<NUM>][--gap-open=<NUM>][--gap-extend=<NUM>][--min-sw-score=<NUM>][--min-umi-reads=<NUM>][--cons][--single-end][--subsample-rate=<NUM>][--use-unmapped][--mixture-filter][--threads=<NUM>]
 vdj_asm base-quals <inpref> <outdir> [--single-end][--rev-strand][--rt-error=<NUM>][--match-score=<NUM>][--miss-score=<NUM>][--gap-open=<NUM>][--gap-extend=<NUM>][--seed=<NUM>]
+vdj_asm base-quals-batch <manifest> <outpref> [--rt-error=<NUM>][--match-score=<NUM>][--miss-score=<NUM>][--gap-open=<NUM>][--gap-extend=<NUM>][--min-sw-score=<NUM>]
 vdj_asm read-match [--ref=FASTA][--r1=FASTQ][--r2=FASTQ][--outbam=BAM][--rev-strand][--match-score=<NUM>][--miss-score=<NUM>][--gap-open=<NUM>][--gap-extend=<NUM>][--seed=<NUM>][--min-sw-score=<NUM>]
 vdj_asm (-h | --help)
 
@@ -96,12 +101,14 @@ Options:
    --single-end           Input data are single end
    --use-unmapped         Use unmapped reads in assembly (ignore filter)
    --mixture-filter       Enable filtering of mixed contigs (probable chimeras)
+   --threads=<NUM>        Number of barcodes to assemble in parallel.
 ";
 
 #[derive(Debug, Deserialize, Clone, Default)]
 pub struct Args {
     cmd_asm: bool,
     cmd_base_quals: bool,
+    cmd_base_quals_batch: bool,
     cmd_read_match: bool,
 
     arg_inbam: Option<String>,
@@ -110,6 +117,8 @@ pub struct Args {
     arg_fasta: Option<String>,
     arg_fqpref: Option<String>,
     arg_outbam: Option<String>,
+    arg_manifest: Option<String>,
+    arg_outpref: Option<String>,
 
     flag_cons: bool,
     flag_kmers: Option<u32>,
@@ -139,7 +148,8 @@ pub struct Args {
     flag_barcode: Option<String>,
     flag_single_end: bool,
     flag_use_unmapped: bool,
-    flag_mixture_filter: bool
+    flag_mixture_filter: bool,
+    flag_threads: Option<usize>,
 }
 
 fn main() {
@@ -154,6 +164,8 @@ fn main() {
         vdj_asm(args);
     } else if args.cmd_base_quals {
         get_base_qualities(args);
+    } else if args.cmd_base_quals_batch {
+        get_base_qualities_batch(args);
     } else {
         get_matches(args);
     }
@@ -190,11 +202,7 @@ pub fn vdj_asm(args: Args) -> Result<(), Error> {
 
 
     let mut in_bam = bam::Reader::from_path(&Path::new(&input_bam_filename)).ok().expect("Error opening input bam.");
-
-    // Will create one bam per barcode and merge incrementally
-    // Can't append to a single bam, because header (contig names) is not known in advance.
-    let bam_merge_frequency = 50; // merge every N BAMs / barcodes to reduce number of files.
-    let mut out_bams = Vec::new();
+    let mut assembled_bcs = AssembledBarcodes::new(&out_prefix);
 
     let bam_iter = in_bam.records();
 
@@ -205,7 +213,10 @@ pub fn vdj_asm(args: Args) -> Result<(), Error> {
         header.get_barcode().cloned()
     };
 
-    for (barcode, records) in &bam_iter.map(|x| x.expect("trouble when reading")).group_by(get_bc) {
+    let grouped_records = bam_iter.map(|x| x.expect("trouble when reading")).group_by(get_bc);
+
+    // Reads of each barcode are read and subsampled here, in input order
+    let barcode_reads = (&grouped_records).into_iter().filter_map(|(barcode, records)| {
 
         // Handle non barcoded & barcoded reads separately
         match barcode {
@@ -213,31 +224,30 @@ pub fn vdj_asm(args: Args) -> Result<(), Error> {
 
                 // If a single barcode was requested, only process that bc.
                 if args.flag_barcode.as_ref().map_or(false, |req_bc| &bc != req_bc) {
-                    continue
-                }
-
-                let out_bam = asm_bc(records, &bc, &out_prefix, &mut metrics, &mut assembly_outs, &args);
-                out_bams.push(out_bam);
-
-                // if we've reached the BAM limit, squash the current set
-                if out_bams.len() >= bam_merge_frequency {
-                    let squashed_bam_filename = format!("{}_{}_{}.bam", out_prefix, bc.clone(), out_bams.len());
-                    bam_utils::concatenate_bams(&out_bams, &squashed_bam_filename)?;
-                    for bam in out_bams.iter() {
-                        match fs::remove_file(bam) {
-                            Ok(()) => (),
-                            Err(e) => println!("Error removing temporary BAM file: {}. Likely a filesystem hiccup. Continuing", e),
-                        }
-                    }
-                    out_bams.clear();
-                    out_bams.push(squashed_bam_filename);
+                    return None;
                 }
 
+                Some(read_bc(records, bc, &args))
             },
             None => {
                 // FIXME - what to with unbarcoded reads?
+                None
             },
         }
+    });
+
+    let num_threads = args.flag_threads.unwrap_or(1);
+    if num_threads > 1 {
+        asm_bcs_threaded(barcode_reads, &out_prefix, &mut metrics, &mut assembly_outs, &mut assembled_bcs, &args, num_threads)?;
+    } else {
+        for bc_reads in barcode_reads {
+            let barcode = bc_reads.barcode.clone();
+            let num_read_pairs = bc_reads.num_read_pairs;
+
+            let start = PreciseTime::now();
+            let out_bam = assemble_bc(bc_reads, &out_prefix, &mut metrics, &mut assembly_outs, &args);
+            assembled_bcs.add(&barcode, out_bam, num_read_pairs, elapsed_secs(start))?;
+        }
     }
 
     // Write metrics summary
@@ -249,6 +259,7 @@ pub fn vdj_asm(args: Args) -> Result<(), Error> {
     }
 
     assembly_outs.close();
+    let out_bams = assembled_bcs.finish()?;
 
     bam_utils::concatenate_bams(&out_bams, &(out_prefix.to_string() + ".bam"))?;
     bam_utils::sort_and_index(&(out_prefix.to_string() + ".bam"), &(out_prefix.to_string() + "_sorted.bam"));
@@ -302,9 +313,188 @@ impl<T> ReservoirSampler<T> {
 }
 
 
-fn asm_bc<I: Iterator<Item=bam::Record>, T: Write>(mut bam_iter: I, barcode: &str, out_prefix: &str,
-                                         metrics: &mut AssemblyMetrics, assembly_outs: &mut asm::AssemblyOuts<T>,
-                                         args: &Args) -> String {
+/// Number of barcodes read ahead of the next one to write, per assembly thread
+const BARCODES_IN_FLIGHT_PER_THREAD: usize = 2;
+
+/// Reads of a barcode, subsampled for assembly
+struct BarcodeReads {
+    barcode: String,
+    read_pairs: Vec<(graph_read::Read, Option<graph_read::Read>)>,
+    umi_counts: UmiCounter,
+    /// Number of read pairs prior to subsampling
+    num_read_pairs: usize,
+}
+
+/// Outputs of the assembly of a barcode on a worker thread
+struct BarcodeAssembly {
+    barcode: String,
+    num_read_pairs: usize,
+    out_bam: String,
+    metrics: AssemblyMetrics,
+    outs: asm::AssemblyOuts<Vec<u8>>,
+    secs: f64,
+}
+
+/// Per-barcode BAMs of the assembled barcodes and their assembly times
+struct AssembledBarcodes {
+    out_prefix: String,
+    out_bams: Vec<String>,
+    timings_writer: BufWriter<File>,
+}
+
+impl AssembledBarcodes {
+    pub fn new(out_prefix: &str) -> AssembledBarcodes {
+        let timings_file = File::create(out_prefix.to_string() + "_barcode_timings.tsv").expect("Could not create barcode timings file");
+        let mut timings_writer = BufWriter::new(timings_file);
+        timings_writer.write_fmt(format_args!("{}\t{}\t{}\n", "barcode", "num_pairs", "assembly_secs")).unwrap();
+
+        AssembledBarcodes {
+            out_prefix: out_prefix.to_string(),
+            out_bams: Vec::new(),
+            timings_writer: timings_writer,
+        }
+    }
+
+    /// Record an assembled barcode. Barcodes must be added in input order.
+    pub fn add(&mut self, barcode: &str, out_bam: String, num_read_pairs: usize, secs: f64) -> Result<(), Error> {
+        self.timings_writer.write_fmt(format_args!("{}\t{}\t{:.3}\n", barcode, num_read_pairs, secs))?;
+
+        // Will create one bam per barcode and merge incrementally
+        // Can't append to a single bam, because header (contig names) is not known in advance.
+        let bam_merge_frequency = 50; // merge every N BAMs / barcodes to reduce number of files.
+        self.out_bams.push(out_bam);
+
+        // if we've reached the BAM limit, squash the current set
+        if self.out_bams.len() >= bam_merge_frequency {
+            let squashed_bam_filename = format!("{}_{}_{}.bam", self.out_prefix, barcode, self.out_bams.len());
+            bam_utils::concatenate_bams(&self.out_bams, &squashed_bam_filename)?;
+            for bam in self.out_bams.iter() {
+                match fs::remove_file(bam) {
+                    Ok(()) => (),
+                    Err(e) => println!("Error removing temporary BAM file: {}. Likely a filesystem hiccup. Continuing", e),
+                }
+            }
+            self.out_bams.clear();
+            self.out_bams.push(squashed_bam_filename);
+        }
+        Ok(())
+    }
+
+    /// Returns the BAMs to concatenate into the final BAM
+    pub fn finish(mut self) -> Result<Vec<String>, Error> {
+        self.timings_writer.flush()?;
+        Ok(self.out_bams)
+    }
+}
+
+fn elapsed_secs(start: PreciseTime) -> f64 {
+    start.to(PreciseTime::now()).num_microseconds().unwrap_or(0) as f64 / 1e6
+}
+
+/// Assemble barcodes on num_threads worker threads. Results are written in input order,
+/// so all outputs are the same as assembling the barcodes one at a time. At most
+/// BARCODES_IN_FLIGHT_PER_THREAD barcodes per thread are kept in memory.
+fn asm_bcs_threaded<I, T>(barcode_reads: I, out_prefix: &str,
+                          metrics: &mut AssemblyMetrics, assembly_outs: &mut asm::AssemblyOuts<T>,
+                          assembled_bcs: &mut AssembledBarcodes,
+                          args: &Args, num_threads: usize) -> Result<(), Error>
+    where I: Iterator<Item=BarcodeReads>, T: Write {
+
+    let (work_tx, work_rx) = mpsc::channel::<(usize, BarcodeReads)>();
+    let (result_tx, result_rx) = mpsc::channel();
+    let work_rx = Arc::new(Mutex::new(work_rx));
+    let shared_args = Arc::new(args.clone());
+
+    let mut workers = Vec::with_capacity(num_threads);
+    for _ in 0..num_threads {
+        let work_rx = work_rx.clone();
+        let result_tx = result_tx.clone();
+        let args = shared_args.clone();
+        let out_prefix = out_prefix.to_string();
+
+        workers.push(thread::spawn(move || {
+            loop {
+                let (index, bc_reads) = match work_rx.lock().unwrap().recv() {
+                    Ok(work) => work,
+                    Err(_) => break,
+                };
+
+                // Hand panics back to the main thread instead of leaving it waiting on this barcode
+                let result = panic::catch_unwind(panic::AssertUnwindSafe(|| {
+                    let barcode = bc_reads.barcode.clone();
+                    let num_read_pairs = bc_reads.num_read_pairs;
+                    let mut bc_metrics = AssemblyMetrics::default();
+                    let mut bc_outs = asm::AssemblyOuts::new(Vec::new(), Vec::new(), Vec::new(), Vec::new());
+
+                    let start = PreciseTime::now();
+                    let out_bam = assemble_bc(bc_reads, &out_prefix, &mut bc_metrics, &mut bc_outs, &args);
+                    BarcodeAssembly {
+                        barcode: barcode,
+                        num_read_pairs: num_read_pairs,
+                        out_bam: out_bam,
+                        metrics: bc_metrics,
+                        outs: bc_outs,
+                        secs: elapsed_secs(start),
+                    }
+                }));
+
+                if result_tx.send((index, result)).is_err() {
+                    break;
+                }
+            }
+        }));
+    }
+    drop(result_tx);
+
+    let max_in_flight = num_threads * BARCODES_IN_FLIGHT_PER_THREAD;
+    let mut barcode_reads = barcode_reads.fuse();
+    let mut num_sent = 0;
+    let mut num_written = 0;
+    let mut finished = BTreeMap::new();
+
+    loop {
+        let next_bc = barcode_reads.next();
+        let done = next_bc.is_none();
+        if let Some(bc_reads) = next_bc {
+            work_tx.send((num_sent, bc_reads)).map_err(|_| failure::err_msg("Assembly threads exited early"))?;
+            num_sent += 1;
+        }
+
+        // Write finished barcodes in order, waiting for them once too many are in flight or all were sent
+        while num_written < num_sent && (done || num_sent - num_written >= max_in_flight) {
+            let (index, result) = result_rx.recv().map_err(|_| failure::err_msg("Assembly threads exited early"))?;
+            finished.insert(index, result);
+
+            while let Some(result) = finished.remove(&num_written) {
+                let bc_asm: BarcodeAssembly = match result {
+                    Ok(bc_asm) => bc_asm,
+                    Err(e) => panic::resume_unwind(e),
+                };
+
+                assembly_outs.fasta_writer.write_all(&bc_asm.outs.fasta_writer)?;
+                assembly_outs.fastq_writer.write_all(&bc_asm.outs.fastq_writer)?;
+                assembly_outs.summary_writer.write_all(&bc_asm.outs.summary_writer)?;
+                assembly_outs.umi_summary_writer.write_all(&bc_asm.outs.umi_summary_writer)?;
+                metrics.assemblable_read_pairs_by_bc.extend(bc_asm.metrics.assemblable_read_pairs_by_bc);
+                assembled_bcs.add(&bc_asm.barcode, bc_asm.out_bam, bc_asm.num_read_pairs, bc_asm.secs)?;
+                num_written += 1;
+            }
+        }
+
+        if done {
+            break;
+        }
+    }
+
+    drop(work_tx);
+    for worker in workers {
+        worker.join().map_err(|_| failure::err_msg("Assembly thread panicked"))?;
+    }
+    Ok(())
+}
+
+/// Read the records of a barcode and subsample them to at most the maximum number of read pairs per barcode
+fn read_bc<I: Iterator<Item=bam::Record>>(mut bam_iter: I, barcode: String, args: &Args) -> BarcodeReads {
 
     let single_end = args.flag_single_end;
 
@@ -313,11 +503,6 @@ fn asm_bc<I: Iterator<Item=bam::Record>, T: Write>(mut bam_iter: I, barcode: &st
         None => MAX_NUM_READPAIRS,
     };
 
-    let min_umi_reads = match args.flag_min_umi_reads {
-        Some(c) => c,
-        None => 1,
-    };
-
     let mut sampled_reads = ReservoirSampler::<(graph_read::Read, Option<graph_read::Read>)>::new(max_readpairs_per_bc, 1);
     let mut umi_counts = UmiCounter::new();
     let mut npairs = 0;
@@ -354,6 +539,33 @@ fn asm_bc<I: Iterator<Item=bam::Record>, T: Write>(mut bam_iter: I, barcode: &st
         npairs += 1;
     }
 
+    BarcodeReads {
+        barcode: barcode,
+        read_pairs: sampled_reads.done(),
+        umi_counts: umi_counts,
+        num_read_pairs: npairs as usize,
+    }
+}
+
+/// Assemble the reads of a barcode. Returns the path of the barcode's BAM.
+fn assemble_bc<T: Write>(bc_reads: BarcodeReads, out_prefix: &str,
+                         metrics: &mut AssemblyMetrics, assembly_outs: &mut asm::AssemblyOuts<T>,
+                         args: &Args) -> String {
+
+    let BarcodeReads { barcode, read_pairs, mut umi_counts, num_read_pairs: npairs } = bc_reads;
+
+    let single_end = args.flag_single_end;
+
+    let max_readpairs_per_bc = match args.flag_reads_per_barcode {
+        Some(v) => v,
+        None => MAX_NUM_READPAIRS,
+    };
+
+    let min_umi_reads = match args.flag_min_umi_reads {
+        Some(c) => c,
+        None => 1,
+    };
+
     fn rec_unmapped(rec: &(graph_read::Read, Option<graph_read::Read>)) -> bool {
         match rec {
             &(ref r1, None) => r1.is_unmapped(),
@@ -363,7 +575,7 @@ fn asm_bc<I: Iterator<Item=bam::Record>, T: Write>(mut bam_iter: I, barcode: &st
 
     // Single array of selected reads
     let mut reads = Vec::new();
-    for rec in sampled_reads.done() {
+    for rec in read_pairs {
 
         if !args.flag_use_unmapped && rec_unmapped(&rec) {
             continue;
@@ -378,11 +590,11 @@ fn asm_bc<I: Iterator<Item=bam::Record>, T: Write>(mut bam_iter: I, barcode: &st
     }
 
     // Only keep sequences with good UMIs - these will be assembled
-    println!("Reads/UMI cutoff: {}", min_umi_reads);
+    println!("{}: Reads/UMI cutoff: {}", barcode, min_umi_reads);
     let good_umis = umi_counts.get_good_umis(min_umi_reads);
 
-    println!("Observed {} read pairs with {} distinct UMIs prior to subsampling", npairs, umi_counts.len());
-    let recalculate_umi_counts = (npairs as usize) > max_readpairs_per_bc;
+    println!("{}: Observed {} read pairs with {} distinct UMIs prior to subsampling", barcode, npairs, umi_counts.len());
+    let recalculate_umi_counts = npairs > max_readpairs_per_bc;
     if recalculate_umi_counts {
         umi_counts.reset_counts();
     }
@@ -397,10 +609,10 @@ fn asm_bc<I: Iterator<Item=bam::Record>, T: Write>(mut bam_iter: I, barcode: &st
     }
 
     println!("Barcode {}: Assembling {:?} reads, {:?} distinct UMIs", barcode, reads.len(), umi_counts.count_good_umis(1));
-    println!("Good UMIs: {:?}", good_umis);
+    println!("{}: Good UMIs: {:?}", barcode, good_umis);
 
     // Report number of reads used
-    println!("Reads to use in assembly: {}", assembled_reads.len());
+    println!("{}: Reads to use in assembly: {}", barcode, assembled_reads.len());
     let assemblable_read_pairs = match single_end {
         true => assembled_reads.len() as u64,
         false => assembled_reads.len() as u64 / 2,
@@ -488,12 +700,12 @@ fn asm_bc<I: Iterator<Item=bam::Record>, T: Write>(mut bam_iter: I, barcode: &st
         contigs = result.1;
     }
 
-    println!("Assembled {} contigs in {} sec", contigs.len(), cc_start.to(PreciseTime::now()));
-    println!("maxrss: {}", perf::getrusage().ru_maxrss as u64);
+    println!("{}: Assembled {} contigs in {} sec", barcode, contigs.len(), cc_start.to(PreciseTime::now()));
+    println!("{}: maxrss: {}", barcode, perf::getrusage().ru_maxrss as u64);
 
 
     if args.flag_plot {
-        println!("Writing gfa");
+        println!("{}: Writing gfa", barcode);
         let path = out_prefix.to_string() + "_" + &barcode + "_graph.gfa";
         graph.graph.to_gfa(path).unwrap();
     }
@@ -546,10 +758,10 @@ fn get_assembly_contig_header(seqs: &Vec<String>, pref: &str) -> (bam::header::H
     header.push_record(&header_rec);
 
     if seqs.is_empty() {
-        println!("isempty");
+        println!("{}: isempty", pref);
         // bam_utils::add_ref_to_bam_header(&mut header, &DUMMY_CONTIG_NAME.to_string(), 0);
     } else {
-        println!("notisempty");
+        println!("{}: notisempty", pref);
         for (idx, ref seq) in seqs.iter().enumerate() {
             let contig_name = format!("{}_contig_{}", pref, idx + 1);
             contig_names.push(contig_name.clone());
@@ -566,18 +778,7 @@ pub fn get_base_qualities(args: Args) {
     let file_pref = args.arg_inpref.unwrap();
     let out_dir = args.arg_outdir.unwrap();
 
-    let fasta = bio::io::fasta::Reader::from_file(Path::new(&(file_pref.clone() + ".fasta"))).ok()
-        .expect("Could not open input FASTA");
-    let mut record_iter = fasta.records();
-    let record = record_iter.next().unwrap().ok()
-        .expect("Error reading sequence from fasta file");
-    let ref_seq_name = record.id().to_owned();
-    let ref_seq = utils::replace_ns(&String::from_utf8_lossy(record.seq()).into_owned(), &ref_seq_name);
-
-    let record = record_iter.next();
-    if record.is_some() {
-        println!("FASTA file has more than one sequence. Only the first one will be used.")
-    }
+    let (ref_seq_name, ref_seq) = read_base_quals_ref(&file_pref);
 
     let rt_error = match args.flag_rt_error {
         Some(c) => c,
@@ -586,20 +787,7 @@ pub fn get_base_qualities(args: Args) {
 
     let single_end = args.flag_single_end;
 
-    let mut fq_iter = match single_end {
-        true => {
-            let name1 = utils::find_file_maybe_compressed(&(file_pref.clone() + ".fastq"))
-                .expect("Couldn't find FASTQ file");
-            fastq::CellrangerPairedFastqIter::new(&name1, None, false)
-        },
-        false => {
-            let name1 = utils::find_file_maybe_compressed(&(file_pref.clone() + "_1.fastq"))
-                .expect("Couldn't find R1 FASTQ file");
-            let name2 = utils::find_file_maybe_compressed(&(file_pref.clone() + "_2.fastq"))
-                .expect("Coldn't find R2 FASTQ file");
-            fastq::CellrangerPairedFastqIter::new(&name1, Some(&name2), false)
-        },
-    };
+    let mut fq_iter = open_base_quals_fastqs(&file_pref, single_end);
 
     let base_path = Path::new(&(file_pref));
     // components returns a Components, last returns a Component,
@@ -632,12 +820,160 @@ pub fn get_base_qualities(args: Args) {
         None => 50.0,
     };
 
+    let (quals, _) = align_and_compute_base_quals(&mut fq_iter, &align_helper, single_end,
+                                                  min_align_score, rt_error, 0, &mut out_bam);
+    assert!(quals.len() == ref_seq.len());
+
+    fastq_writer.write_fmt(format_args!("@{}\n{}\n+\n{}\n", ref_seq_name, ref_seq,
+                           fastq::get_qual_string(&quals, QUAL_OFFSET))).unwrap();
+}
+
+/// Compute base qualities for many sequences in a single process.
+///
+/// # Usage
+/// vdj_asm base-quals-batch <manifest> <outpref> <options>
+///
+/// The manifest has one tab-separated line per group: `<inpref>\t<single_end>`, where
+/// `single_end` is 0 or 1. Each group has the same inputs as `base-quals`
+/// (<inpref>.fasta and <inpref>.fastq or <inpref>_1.fastq/<inpref>_2.fastq).
+///
+/// Outputs:
+/// - <outpref>.bam: alignments of all groups, with one reference per group in manifest order.
+/// - <outpref>.fastq: one record per group with the recomputed base qualities.
+/// - <outpref>_timings.tsv: number of input reads and processing time per group.
+pub fn get_base_qualities_batch(args: Args) {
+
+    let scoring = get_scoring(&args);
+    let manifest = args.arg_manifest.clone().unwrap();
+    let out_pref = args.arg_outpref.clone().unwrap();
+
+    let rt_error = match args.flag_rt_error {
+        Some(c) => c,
+        None => 0.0001,
+    };
+    let min_align_score = match args.flag_min_sw_score {
+        Some(c) => c,
+        None => 50.0,
+    };
+
+    let mut groups = Vec::new();
+    {
+        let manifest_file = File::open(&manifest).expect("Could not open manifest");
+        for line in BufReader::new(manifest_file).lines() {
+            let line = line.expect("Error reading manifest");
+            if line.trim().is_empty() {
+                continue;
+            }
+            let fields: Vec<&str> = line.trim_end().split('\t').collect();
+            assert!(fields.len() == 2, "Invalid manifest line: {}", line);
+            let single_end = match fields[1] {
+                "0" => false,
+                "1" => true,
+                _ => panic!("Invalid single-end value in manifest line: {}", line),
+            };
+            groups.push((fields[0].to_string(), single_end));
+        }
+    }
+
+    // The BAM header needs all the references up front.
+    let refs: Vec<(String, String)> = groups.iter().map(|&(ref pref, _)| read_base_quals_ref(pref)).collect();
+
+    let mut header = bam::header::Header::new();
+    let mut header_rec = bam::header::HeaderRecord::new(b"PG");
+    header_rec.push_tag(b"ID", &"vdj_asm base-quals-batch");
+    header.push_record(&header_rec);
+    for &(ref ref_seq_name, ref ref_seq) in refs.iter() {
+        bam_utils::add_ref_to_bam_header(&mut header, ref_seq_name, ref_seq.len());
+    }
+
+    let mut out_bam = bam::Writer::from_path(&(out_pref.clone() + ".bam"), &header).unwrap();
+
+    let fastq_file = File::create(out_pref.clone() + ".fastq").expect("Could not create fastq file");
+    let mut fastq_writer = BufWriter::new(&fastq_file);
+
+    let timings_file = File::create(out_pref.clone() + "_timings.tsv").expect("Could not create timings file");
+    let mut timings_writer = BufWriter::new(&timings_file);
+    timings_writer.write_fmt(format_args!("{}\t{}\t{}\n", "name", "num_reads", "seconds")).unwrap();
+
+    for (tid, (&(ref file_pref, single_end), &(ref ref_seq_name, ref ref_seq))) in groups.iter().zip(refs.iter()).enumerate() {
+        let start = PreciseTime::now();
+
+        let mut fq_iter = open_base_quals_fastqs(file_pref, single_end);
+        let group_refs = vec![ref_seq.clone()];
+        let align_helper = sw::AlignHelper::new(&group_refs, scoring.clone(), KMER_LEN_BANDED_ALIGN, WINDOW_SIZE_BANDED_ALIGN);
+
+        let (quals, num_reads) = align_and_compute_base_quals(&mut fq_iter, &align_helper, single_end,
+                                                              min_align_score, rt_error, tid, &mut out_bam);
+        assert!(quals.len() == ref_seq.len());
+
+        fastq_writer.write_fmt(format_args!("@{}\n{}\n+\n{}\n", ref_seq_name, ref_seq,
+                               fastq::get_qual_string(&quals, QUAL_OFFSET))).unwrap();
+
+        let elapsed = start.to(PreciseTime::now());
+        timings_writer.write_fmt(format_args!("{}\t{}\t{:.3}\n", ref_seq_name, num_reads,
+                                 elapsed.num_milliseconds() as f64 / 1000.0)).unwrap();
+    }
+}
+
+/// Read the sequence whose qualities will be computed from <file_pref>.fasta.
+/// Returns the name and sequence (with Ns replaced) of the first record.
+fn read_base_quals_ref(file_pref: &str) -> (String, String) {
+    let fasta = bio::io::fasta::Reader::from_file(Path::new(&(file_pref.to_string() + ".fasta"))).ok()
+        .expect("Could not open input FASTA");
+    let mut record_iter = fasta.records();
+    let record = record_iter.next().unwrap().ok()
+        .expect("Error reading sequence from fasta file");
+    let ref_seq_name = record.id().to_owned();
+    let ref_seq = utils::replace_ns(&String::from_utf8_lossy(record.seq()).into_owned(), &ref_seq_name);
+
+    let record = record_iter.next();
+    if record.is_some() {
+        println!("FASTA file has more than one sequence. Only the first one will be used.")
+    }
+    (ref_seq_name, ref_seq)
+}
+
+fn open_base_quals_fastqs(file_pref: &str, single_end: bool) -> fastq::CellrangerPairedFastqIter {
+    match single_end {
+        true => {
+            let name1 = utils::find_file_maybe_compressed(&(file_pref.to_string() + ".fastq"))
+                .expect("Couldn't find FASTQ file");
+            fastq::CellrangerPairedFastqIter::new(&name1, None, false)
+        },
+        false => {
+            let name1 = utils::find_file_maybe_compressed(&(file_pref.to_string() + "_1.fastq"))
+                .expect("Couldn't find R1 FASTQ file");
+            let name2 = utils::find_file_maybe_compressed(&(file_pref.to_string() + "_2.fastq"))
+                .expect("Coldn't find R2 FASTQ file");
+            fastq::CellrangerPairedFastqIter::new(&name1, Some(&name2), false)
+        },
+    }
+}
+
+/// Align reads against the single reference of align_helper and compute the base qualities
+/// of that reference. Alignments are written to out_bam against reference out_tid.
+/// Returns the qualities and the number of read records processed.
+fn align_and_compute_base_quals(fq_iter: &mut fastq::CellrangerPairedFastqIter,
+                                align_helper: &sw::AlignHelper,
+                                single_end: bool,
+                                min_align_score: f64,
+                                rt_error: f64,
+                                out_tid: usize,
+                                out_bam: &mut bam::Writer) -> (Vec<u8>, usize) {
+
+    // Alignments are computed against reference 0 of align_helper, but written against out_tid.
+    let to_out_tid = |al_pack: &Option<sw::AlignmentPacket>| {
+        al_pack.clone().map(|mut al| { al.ref_idx = out_tid; al })
+    };
+
     let mut good_alignments = Vec::new();
+    let mut num_reads = 0;
 
     loop {
         match fq_iter.next() {
             Some(pair) => {
                 let r1 = pair.r1;
+                num_reads += 1;
 
                 let bitenc1 = dna_string::DnaString::from_bytes(&r1.seq);
                 let mut read1 = graph_read::Read::new(r1.id, pair.umi, pair.header.clone(), bitenc1, r1.quals.clone());
@@ -646,6 +982,7 @@ pub fn get_base_qualities(args: Args) {
                 let (read2, al_pack2) = match single_end {
                     true => (None, None),
                     false => {
+                        num_reads += 1;
                         let r2 = pair.r2.unwrap();
                         let bitenc2 = dna_string::DnaString::from_bytes(&r2.seq);
                         let mut read2 = graph_read::Read::new(r2.id, pair.umi, pair.header.clone(), bitenc2, r2.quals.clone());
@@ -656,10 +993,13 @@ pub fn get_base_qualities(args: Args) {
                     }
                 };
 
+                let out_al_pack1 = to_out_tid(&al_pack1);
+                let out_al_pack2 = to_out_tid(&al_pack2);
+
                 match al_pack1.clone() {
                     Some(al_pack) => {
                         good_alignments.push((al_pack.clone(), read1.clone()));
-                        let _ = out_bam.write(&mut read1.to_bam_record(&Some(al_pack), &al_pack2));
+                        let _ = out_bam.write(&mut read1.to_bam_record(&out_al_pack1, &out_al_pack2));
                     },
                     None => {
                         let _ = out_bam.write(&mut read1.to_unmapped_bam_record());
@@ -669,7 +1009,7 @@ pub fn get_base_qualities(args: Args) {
                 match (read2, al_pack2) {
                     (Some(read), Some(al_pack)) => {
                         good_alignments.push((al_pack.clone(), read.clone()));
-                        let _ = out_bam.write(&mut read.to_bam_record(&al_pack1, &Some(al_pack)));
+                        let _ = out_bam.write(&mut read.to_bam_record(&out_al_pack1, &out_al_pack2));
                     },
                     (Some(read), None) => {
                         let _ = out_bam.write(&mut read.to_unmapped_bam_record());
@@ -681,19 +1021,17 @@ pub fn get_base_qualities(args: Args) {
         }
     }
 
+    let ref_len = align_helper.refs[0].len();
     let quals : Vec<u8>;
     if good_alignments.is_empty() {
-        quals = vec![0; ref_seq.len()];
+        quals = vec![0; ref_len];
     } else {
         good_alignments.sort_by_key(|x| x.1.umi);
         let pileup = align_helper.pileup(0, &good_alignments);
 
         quals = align_helper.base_quals(0, &pileup, rt_error);
-        assert!(quals.len() == ref_seq.len());
     }
-
-    fastq_writer.write_fmt(format_args!("@{}\n{}\n+\n{}\n", ref_seq_name, ref_seq,
-                           fastq::get_qual_string(&quals, QUAL_OFFSET))).unwrap();
+    (quals, num_reads)
 }
 
 /// Extract aligner parameters from input arguments
@@ -1124,6 +1462,60 @@ mod tests {
         }
     }
 
+    #[test]
+    fn test_vdj_asm_threads() {
+
+        let true_seqs = get_seqs_by_barcode(&"test/inputs/test_asm.fasta");
+
+        let summary_barcodes = |outdir: &str| -> Vec<String> {
+            let summary = BufReader::new(File::open(format!("{}/test_asm_summary.tsv", outdir)).unwrap());
+            summary.lines().skip(1).map(|line| line.unwrap().split('\t').next().unwrap().to_string()).collect()
+        };
+
+        let mut barcodes_by_threads = Vec::new();
+        for &threads in [1, 3].iter() {
+            let outdir = format!("test/outputs/asm_threads_{}", threads);
+            init_test(&outdir);
+
+            let args = Args {
+                            cmd_asm: true,
+                            arg_inbam: Some("test/inputs/test_asm.bam".to_string()),
+                            arg_outdir: Some(outdir.clone()),
+                            flag_kmers: Some(0),
+                            flag_min_contig: Some(150),
+                            flag_min_sw_score: Some(50.0),
+                            flag_rt_error: Some(0.0001),
+                            flag_min_qual: Some(2),
+                            flag_qual_factor: Some(0.9),
+                            flag_score_factor: Some(0.6),
+                            flag_frac_reads: Some(0.3),
+                            flag_min_umi_reads: Some(1),
+                            flag_use_unmapped: true,
+                            flag_threads: Some(threads),
+                            .. Args::default()
+                            };
+            vdj_asm(args).unwrap();
+
+            let assembled_seqs = get_seqs_by_barcode(&format!("{}/test_asm.fasta", outdir));
+            for (bc, seqs) in true_seqs.iter() {
+                assert_eq!(*seqs, *assembled_seqs.get(bc).unwrap());
+            }
+
+            let mut bam = bam::Reader::from_path(Path::new(&format!("{}/test_asm.bam", outdir))).ok().expect("Error reading test_asm.bam");
+            let (mapped, unmapped) = count_records(&mut bam);
+            assert_eq!(unmapped, 6);
+            assert_eq!(mapped, 48);
+
+            let timings = BufReader::new(File::open(format!("{}/test_asm_barcode_timings.tsv", outdir)).unwrap());
+            assert_eq!(timings.lines().count(), 1 + true_seqs.len());
+
+            barcodes_by_threads.push(summary_barcodes(&outdir));
+        }
+
+        // Barcodes are written in input order regardless of the number of threads
+        assert_eq!(barcodes_by_threads[0], barcodes_by_threads[1]);
+    }
+
     fn read_one_fq_record(fq_file: &str) -> (String, String, Vec<u8>) {
         let mut fastq = bio::io::fastq::Reader::from_file(fq_file).ok().expect("Could not open FASTQ file");
         let mut record = bio::io::fastq::Record::new();
@@ -1204,6 +1596,52 @@ mod tests {
         }
     }
 
+    #[test]
+    fn test_base_qualities_batch() {
+
+        let outdir = "test/outputs/base_quals_batch";
+        let manifest = "test/outputs/base_quals_batch/manifest.tsv";
+        let out_pref = "test/outputs/base_quals_batch/batch";
+
+        init_test(outdir);
+        {
+            let mut f = File::create(manifest).unwrap();
+            f.write_all(b"test/inputs/base_quals/test_base_quals\t0\n").unwrap();
+            f.write_all(b"test/inputs/base_quals/test_base_quals\t1\n").unwrap();
+        }
+
+        let args = Args {
+                        cmd_base_quals_batch: true,
+                        arg_manifest: Some(manifest.to_string()),
+                        arg_outpref: Some(out_pref.to_string()),
+                        flag_min_sw_score: Some(50.0),
+                        flag_rt_error: Some(0.0001),
+                        .. Args::default()
+                        };
+        get_base_qualities_batch(args);
+
+        let mut bam = bam::Reader::from_path(Path::new(&(out_pref.to_string() + ".bam"))).ok().expect("Error reading batch bam");
+        assert_eq!(bam.header().target_count(), 2);
+        let (mapped, unmapped) = count_records(&mut bam);
+        // Same records as the paired-end and single-end runs of test_base_qualities
+        assert_eq!(unmapped, 4);
+        assert_eq!(mapped, 12);
+
+        // The paired-end group must match the single-group mode
+        let single_args = Args {
+                        cmd_base_quals: true,
+                        arg_inpref: Some("test/inputs/base_quals/test_base_quals".to_string()),
+                        arg_outdir: Some(outdir.to_string()),
+                        flag_min_sw_score: Some(50.0),
+                        flag_rt_error: Some(0.0001),
+                        .. Args::default()
+                        };
+        get_base_qualities(single_args);
+        let (_, _, single_qual) = read_one_fq_record(&(outdir.to_string() + "/test_base_quals.fastq"));
+        let (_, _, batch_qual) = read_one_fq_record(&(out_pref.to_string() + ".fastq"));
+        assert_eq!(single_qual, batch_qual);
+    }
+
     fn revcomp_fastq(infile: &str, outfile: &str) {
         let fq_reader = bio::io::fastq::Reader::from_file(infile).unwrap();
         let mut fq_writer = bio::io::fastq::Writer::to_file(outfile).unwrap();
@@ -2,8 +2,11 @@
 #
 # Copyright (c) 2017 10x Genomics, Inc. All rights reserved.
 #
+import cPickle
+import h5py as h5
 import json
 import martian
+import math
 import numpy as np
 
 import cellranger.h5_constants as h5_constants
@@ -14,72 +17,265 @@ import tenkit.safe_json as tk_safe_json
 
 __MRO__ = """
 stage CHECK_INVARIANTS(
-    in  map[] input_sample_defs,
-    in  h5    merged_raw_gene_bc_matrices_h5,
-    out json  summary,
-    src py    "stages/aggregator/check_invariants",
-) split (
+    in  map[]  input_sample_defs,
+    in  h5     merged_raw_gene_bc_matrices_h5,
+    out json   summary,
+    src py     "stages/aggregator/check_invariants",
+) split using (
+    in  map    sample_def,
+    in  int    col_start,
+    in  int    col_end,
+    out pickle counts,
 )
 """
 
+# Number of molecule info rows to read at a time
+MOL_INFO_BLOCK_SIZE = 10000000
+
+# Target number of nonzero entries of the aggregated matrix per chunk
+MATRIX_CHUNK_NNZ = 500000000
+
+# Maximum number of columns of the aggregated matrix per chunk.
+# Counting a column range takes ~280 bytes per column, empty or not.
+MATRIX_CHUNK_COLS = 2000000
+
+# Sample every Nth indptr entry of the aggregated matrix to place chunk boundaries
+INDPTR_SAMPLE_STRIDE = 1000
+
+# Memory used by the join to hold the sparse per-barcode counts, per aggregated barcode
+JOIN_BYTES_PER_BC = 24
+
 def split(args):
-    matrix_mem_gb = int(1.5 * cr_matrix.CountMatrix.get_mem_gb_from_matrix_h5(args.merged_raw_gene_bc_matrices_h5))
+    chunks = []
+
+    # One chunk per input library
+    for sample_def in args.input_sample_defs:
+        with MoleculeCounter.open(sample_def[cr_constants.AGG_H5_FIELD], 'r') as mc:
+            num_gem_groups = len(mc.get_gem_groups())
+            num_bcs = len(mc.get_ref_column_lazy('barcodes'))
+            num_features = len(mc.feature_reference.feature_defs)
+        # Per-gem-group count vectors and their bincount buffers
+        counts_mem_gb = int(math.ceil(3 * 8 * num_gem_groups * (num_bcs + num_features) / 1e9))
+        chunks.append({
+            'sample_def': sample_def,
+            '__mem_gb': h5_constants.MIN_MEM_GB + counts_mem_gb,
+        })
+
+    # Chunks of columns of the aggregated matrix with about MATRIX_CHUNK_NNZ entries each
+    with h5.File(args.merged_raw_gene_bc_matrices_h5, 'r') as f:
+        group = f['matrix']
+        num_cols = group[h5_constants.H5_MATRIX_SHAPE_ATTR][1]
+        indptr_ds = group[h5_constants.H5_MATRIX_INDPTR_ATTR]
+        sample_cols = np.arange(0, num_cols, INDPTR_SAMPLE_STRIDE)
+        sample_nnz = indptr_ds[::INDPTR_SAMPLE_STRIDE][:len(sample_cols)]
+
+    # Start a chunk wherever the nonzero count crosses a multiple of MATRIX_CHUNK_NNZ,
+    # and at least every MATRIX_CHUNK_COLS columns
+    nnz_bins = sample_nnz / MATRIX_CHUNK_NNZ
+    nnz_starts = sample_cols[np.flatnonzero(np.diff(np.concatenate(([-1], nnz_bins))))]
+    col_starts = np.union1d(nnz_starts, np.arange(0, num_cols, MATRIX_CHUNK_COLS))
+    col_ends = list(col_starts[1:]) + [num_cols]
+    for col_start, col_end in zip(col_starts, col_ends):
+        chunks.append({
+            'col_start': int(col_start),
+            'col_end': int(col_end),
+            '__mem_gb': h5_constants.MIN_MEM_GB,
+        })
+
+    join_mem_gb = int(math.ceil(JOIN_BYTES_PER_BC * num_cols / 1e9))
     join_args = {
-        '__mem_gb': max(matrix_mem_gb, h5_constants.MIN_MEM_GB),
+        '__mem_gb': max(join_mem_gb, h5_constants.MIN_MEM_GB),
     }
-    return {'chunks': [], 'join': join_args}
+    return {'chunks': chunks, 'join': join_args}
 
-def join(args, outs, chunk_defs, chunk_outs):
-    # compute invariants on input data
-    input_genomes = set()
-    input_features = set()
-    input_bc_counts = {}
-    input_feature_counts = {}
-    input_num_gem_groups = 0
+def main(args, outs):
+    if args.sample_def is not None:
+        counts = count_molecule_info(args.sample_def)
+    else:
+        counts = count_matrix_columns(args.merged_raw_gene_bc_matrices_h5, args.col_start, args.col_end)
 
-    for sample_def in args.input_sample_defs:
-        library_id = sample_def['library_id']
-        with MoleculeCounter.open(sample_def[cr_constants.AGG_H5_FIELD], 'r') as mc:
-            input_genomes.update(mol_counter_genomes(mc))
-            input_features.update(mol_counter_features_id_type(mc))
-            gem_groups = mc.get_gem_groups()
-            input_num_gem_groups += len(gem_groups)
-
-            mol_gem_group = mc.get_column('gem_group')
-
-            mol_barcode_idx = mc.get_column('barcode_idx')
-            for gg in gem_groups:
-                input_bc_counts[(library_id, gg)] = np.zeros(len(mc.get_ref_column('barcodes')))
-                bc_idx, counts = np.unique(mol_barcode_idx[mol_gem_group == gg], return_counts=True)
-                input_bc_counts[(library_id, gg)][bc_idx] = counts
-            del mol_barcode_idx
-
-            mol_feature_idx = mc.get_column('feature_idx')
-            for gg in gem_groups:
-                input_feature_counts[(library_id, gg)] = np.zeros(len(mc.feature_reference.feature_defs))
-                feature_idx, counts = np.unique(mol_feature_idx[mol_gem_group == gg], return_counts=True)
-                input_feature_counts[(library_id, gg)][feature_idx] = counts
-            del mol_feature_idx
+    with open(outs.counts, 'w') as f:
+        cPickle.dump(counts, f, cPickle.HIGHEST_PROTOCOL)
 
-    # compute invariants on output
-    output_matrix = cr_matrix.CountMatrix.load_h5_file(args.merged_raw_gene_bc_matrices_h5)
-    output_genomes = set(output_matrix.get_genomes())
-    output_features = set(count_matrix_features_id_type(output_matrix))
-    output_bc_counts = {}
-    output_feature_counts = {}
-    output_gem_index = cr_matrix.get_gem_group_index(args.merged_raw_gene_bc_matrices_h5)
-    output_num_gem_groups = len(output_gem_index)
+def to_sparse_counts(counts):
+    """ Returns (indices, values) of the nonzero entries of a count vector """
+    idx = np.flatnonzero(counts)
+    return idx, counts[idx]
+
+def to_dense_counts(num_entries, idx, values):
+    counts = np.zeros(num_entries, dtype=np.int64)
+    counts[idx] = values
+    return counts
+
+def count_molecule_info(sample_def):
+    """ Count molecules per barcode and per feature in each gem group of an input library.
+        Barcode counts are stored sparsely, as (barcode_idx, count). """
+    with MoleculeCounter.open(sample_def[cr_constants.AGG_H5_FIELD], 'r') as mc:
+        gem_groups = sorted(mc.get_gem_groups())
+        num_bcs = len(mc.get_ref_column_lazy('barcodes'))
+        num_features = len(mc.feature_reference.feature_defs)
+
+        # Position of each gem group in gem_groups
+        gg_pos = np.zeros(1 + max(gem_groups), dtype=np.int64)
+        gg_pos[gem_groups] = np.arange(len(gem_groups))
+
+        bc_counts = np.zeros(len(gem_groups) * num_bcs, dtype=np.int64)
+        feature_counts = np.zeros(len(gem_groups) * num_features, dtype=np.int64)
+
+        gem_group_ds = mc.get_column_lazy('gem_group')
+        barcode_idx_ds = mc.get_column_lazy('barcode_idx')
+        feature_idx_ds = mc.get_column_lazy('feature_idx')
+        for start in xrange(0, mc.nrows(), MOL_INFO_BLOCK_SIZE):
+            end = min(start + MOL_INFO_BLOCK_SIZE, mc.nrows())
+            pos = gg_pos[gem_group_ds[start:end]]
+            bc_counts += np.bincount(pos * num_bcs + barcode_idx_ds[start:end].astype(np.int64),
+                                     minlength=len(bc_counts))
+            feature_counts += np.bincount(pos * num_features + feature_idx_ds[start:end].astype(np.int64),
+                                          minlength=len(feature_counts))
+
+        by_gem_group = {}
+        for i, gg in enumerate(gem_groups):
+            bc_idx, bc_values = to_sparse_counts(bc_counts[(i*num_bcs):((i+1)*num_bcs)])
+            by_gem_group[gg] = {
+                'num_bcs': num_bcs,
+                'bc_idx': bc_idx,
+                'bc_counts': bc_values,
+                'feature_counts': feature_counts[(i*num_features):((i+1)*num_features)],
+            }
+
+        return {
+            'library_id': sample_def['library_id'],
+            'genomes': mol_counter_genomes(mc),
+            'features': list(mol_counter_features_id_type(mc)),
+            'gem_groups': by_gem_group,
+        }
 
-    for gg in output_gem_index:
-        library_id, old_gg = output_gem_index[gg]
-        matrix_gg = output_matrix.select_barcodes_by_gem_group(gg)
-        output_bc_counts[(library_id, old_gg)] = matrix_gg.get_counts_per_bc()
-        output_feature_counts[(library_id, old_gg)] = matrix_gg.get_counts_per_feature()
+def count_matrix_columns(matrix_h5, col_start, col_end):
+    """ Count UMIs per barcode and per feature in each gem group of a range of columns of a matrix.
+        Barcode counts are stored sparsely, as (rank of the column among the columns
+        of its gem group in this range, count). """
+    with h5.File(matrix_h5, 'r') as f:
+        group = f['matrix']
+        num_features = group[h5_constants.H5_MATRIX_SHAPE_ATTR][0]
 
+        # Gem group of each column, from the barcode suffix
+        bcs = group[h5_constants.H5_BCS_ATTR][col_start:col_end]
+        col_gem_groups = np.char.partition(bcs, '-')[:, 2].astype(np.int64)
+        gem_groups, col_gg_pos = np.unique(col_gem_groups, return_inverse=True)
+
+        indptr = group[h5_constants.H5_MATRIX_INDPTR_ATTR][col_start:(col_end+1)]
+        data_ds = group[h5_constants.H5_MATRIX_DATA_ATTR]
+        indices_ds = group[h5_constants.H5_MATRIX_INDICES_ATTR]
+
+        bc_counts = np.zeros(col_end - col_start, dtype=np.int64)
+        feature_counts = np.zeros(len(gem_groups) * num_features, dtype=np.int64)
+
+        # Single pass over the nonzero entries of the column range
+        for start in xrange(indptr[0], indptr[-1], cr_matrix.HDF5_LOAD_BLOCK_SIZE):
+            end = min(start + cr_matrix.HDF5_LOAD_BLOCK_SIZE, indptr[-1])
+            data = data_ds[start:end].astype(np.int64)
+            cols = np.searchsorted(indptr, np.arange(start, end), side='right') - 1
+            bc_counts += np.bincount(cols, weights=data, minlength=len(bc_counts)).astype(np.int64)
+            rows = col_gg_pos[cols] * num_features + indices_ds[start:end]
+            feature_counts += np.bincount(rows, weights=data, minlength=len(feature_counts)).astype(np.int64)
+
+    by_gem_group = {}
+    for i, gg in enumerate(gem_groups):
+        gg_cols = np.flatnonzero(col_gg_pos == i)
+        bc_idx, bc_values = to_sparse_counts(bc_counts[gg_cols])
+        by_gem_group[int(gg)] = {
+            'num_bcs': len(gg_cols),
+            'bc_idx': bc_idx,
+            'bc_counts': bc_values,
+            'feature_counts': feature_counts[(i*num_features):((i+1)*num_features)],
+        }
+
+    return {'gem_groups': by_gem_group}
+
+def compare_counts(library_id, gem_group, in_counts, out_counts):
+    """ Compare the counts of a gem group of an input library to the aggregated matrix.
+        Returns a description of the first failed invariant, or None """
+    if out_counts is None or in_counts['num_bcs'] != out_counts['num_bcs']:
+        return ('Barcode list for library {}, GEM group {} has different length '
+                'in aggregated output compared to input.'.format(library_id, gem_group))
+
+    input_bc_counts = to_dense_counts(in_counts['num_bcs'], in_counts['bc_idx'], in_counts['bc_counts'])
+    output_bc_counts = to_dense_counts(out_counts['num_bcs'], out_counts['bc_idx'], out_counts['bc_counts'])
+    if np.any(input_bc_counts < output_bc_counts):
+        return ('Barcode(s) in library {}, GEM group {} have higher UMI counts '
+                'in aggregated output compared to inputs'.format(library_id, gem_group))
+
+    if len(in_counts['feature_counts']) != len(out_counts['feature_counts']):
+        return ('Feature list for library {}, GEM group {} has different length '
+                'in aggregated output compared to input.'.format(library_id, gem_group))
+    if np.any(in_counts['feature_counts'] < out_counts['feature_counts']):
+        return ('Feature(s) in library {}, GEM group {} have higher UMI counts '
+                'in aggregated output compared to inputs'.format(library_id, gem_group))
+
+    return None
+
+def merge_matrix_counts(chunk_counts):
+    """ Combine the counts of consecutive column ranges of a matrix, by gem group """
+    merged = {}
+    for counts in chunk_counts:
+        for gg, gg_counts in counts['gem_groups'].iteritems():
+            if gg not in merged:
+                merged[gg] = {'num_bcs': 0, 'bc_idx': [], 'bc_counts': [],
+                              'feature_counts': np.zeros_like(gg_counts['feature_counts'])}
+            m = merged[gg]
+            m['bc_idx'].append(gg_counts['bc_idx'] + m['num_bcs'])
+            m['bc_counts'].append(gg_counts['bc_counts'])
+            m['num_bcs'] += gg_counts['num_bcs']
+            m['feature_counts'] += gg_counts['feature_counts']
+
+    for m in merged.itervalues():
+        m['bc_idx'] = np.concatenate(m['bc_idx'])
+        m['bc_counts'] = np.concatenate(m['bc_counts'])
+    return merged
+
+def join(args, outs, chunk_defs, chunk_outs):
     exit_message = ('An internal problem in the aggr pipeline has been detected '
                      'that might lead to incorrect results. Please report this '
                      'problem to support@10xgenomics.com.')
 
+    # compute invariants on output
+    output_feature_ref = cr_matrix.CountMatrix.load_feature_ref_from_h5_file(args.merged_raw_gene_bc_matrices_h5)
+    output_genomes = set(cr_matrix.CountMatrix._get_genomes_from_feature_ref(output_feature_ref))
+    output_features = set((f.id, f.feature_type) for f in output_feature_ref.feature_defs)
+    output_gem_index = cr_matrix.get_gem_group_index(args.merged_raw_gene_bc_matrices_h5)
+    output_num_gem_groups = len(output_gem_index)
+
+    matrix_chunk_outs = []
+    for chunk_def, chunk_out in zip(chunk_defs, chunk_outs):
+        if chunk_def.sample_def is None:
+            with open(chunk_out.counts) as f:
+                matrix_chunk_outs.append(cPickle.load(f))
+    output_counts = {}
+    for gg, gg_counts in merge_matrix_counts(matrix_chunk_outs).iteritems():
+        output_counts[output_gem_index[gg]] = gg_counts
+    del matrix_chunk_outs
+
+    # compute invariants on input data, comparing one library at a time
+    input_genomes = set()
+    input_features = set()
+    input_num_gem_groups = 0
+    count_failure = None
+
+    for chunk_def, chunk_out in zip(chunk_defs, chunk_outs):
+        if chunk_def.sample_def is None:
+            continue
+        with open(chunk_out.counts) as f:
+            input_counts = cPickle.load(f)
+
+        library_id = input_counts['library_id']
+        input_genomes.update(input_counts['genomes'])
+        input_features.update(input_counts['features'])
+        input_num_gem_groups += len(input_counts['gem_groups'])
+
+        for gg, in_counts in sorted(input_counts['gem_groups'].iteritems()):
+            if count_failure is None:
+                count_failure = compare_counts(library_id, gg, in_counts, output_counts.get((library_id, gg)))
+
     if input_genomes != output_genomes:
         martian.log_info('Genomes differ between input molecule files and aggregated matrix')
         martian.exit(exit_message)
@@ -89,27 +285,9 @@ def join(args, outs, chunk_defs, chunk_outs):
     if input_num_gem_groups != output_num_gem_groups:
         martian.log_info('Number of GEM groups differs between input molecule files and aggregated matrix')
         martian.exit(exit_message)
-    for lib_gg in input_bc_counts.keys():
-        if len(input_bc_counts[lib_gg]) != len(output_bc_counts[lib_gg]):
-            martian.log_info('Barcode list for library {}, GEM group {} has different length '
-                             'in aggregated output compared to input.'
-                             .format(lib_gg[0], lib_gg[1]))
-            martian.exit(exit_message)
-        if np.any(input_bc_counts[lib_gg] < output_bc_counts[lib_gg]):
-            martian.log_info('Barcode(s) in library {}, GEM group {} have higher UMI counts '
-                             'in aggregated output compared to inputs'
-                             .format(lib_gg[0], lib_gg[1]))
-            martian.exit(exit_message)
-        if len(input_feature_counts[lib_gg]) != len(output_feature_counts[lib_gg]):
-            martian.log_info('Feature list for library {}, GEM group {} has different length '
-                             'in aggregated output compared to input.'
-                             .format(lib_gg[0], lib_gg[1]))
-            martian.exit(exit_message)
-        if np.any(input_feature_counts[lib_gg] < output_feature_counts[lib_gg]):
-            martian.log_info('Feature(s) in library {}, GEM group {} have higher UMI counts '
-                             'in aggregated output compared to inputs'
-                             .format(lib_gg[0], lib_gg[1]))
-            martian.exit(exit_message)
+    if count_failure is not None:
+        martian.log_info(count_failure)
+        martian.exit(exit_message)
 
     summary = {
         'genomes_present': list(input_genomes),
@@ -125,6 +303,3 @@ def mol_counter_genomes(mol_counter):
 
 def mol_counter_features_id_type(mol_counter):
     return ((f.id, f.feature_type) for f in mol_counter.feature_reference.feature_defs)
-
-def count_matrix_features_id_type(count_matrix):
-    return ((f.id, f.feature_type) for f in count_matrix.feature_ref.feature_defs)
@@ -5,14 +5,10 @@
 # Merge similar clusters produced by graph-clustering
 
 import numpy as np
-import pandas as pd
-import resource
-import sys
-from scipy.cluster.hierarchy import linkage
 import cellranger.analysis.clustering as cr_clustering
 import cellranger.analysis.io as analysis_io
-from cellranger.analysis.diffexp import compute_sseq_params, sseq_differential_expression
 import cellranger.analysis.graphclust as cr_graphclust
+import cellranger.analysis.mergeclust as cr_mergeclust
 from cellranger.analysis.singlegenome import SingleGenomeAnalysis
 from cellranger.matrix import CountMatrix
 
@@ -29,11 +25,8 @@ stage MERGE_CLUSTERS(
 )
 """
 
-# Adjusted p-value threshold for calling genes DE
-MERGE_CLUSTERS_DE_ADJ_P_THRESHOLD = 0.05
-
-# Do not merge cluster pairs if they have enough DE genes
-MIN_DE_GENES = 1
+# Processes used to test cluster pairs for DE genes
+MERGE_CLUSTERS_THREADS = 4
 
 def split(args):
     if args.skip:
@@ -44,6 +37,7 @@ def split(args):
         'chunks': [{'__mem_gb': 1}],
         'join': {
             '__mem_gb': max(6, matrix_mem_gb),
+            '__threads': MERGE_CLUSTERS_THREADS,
         }
     }
 
@@ -75,82 +69,17 @@ def join(args, outs, chunk_defs, chunk_outs):
     # Make cluster labels 0-based
     labels = labels[use_bcs] - 1
 
-    # Convert PCA coords to dataframe
     pca = SingleGenomeAnalysis.load_pca_from_h5(args.pca_h5).transformed_pca_matrix[use_bcs,:]
-    pca_df = pd.DataFrame(pca)
-    print pca_df.shape
+    print pca.shape
 
     # 1) Run hierarchical clustering on cluster medoids in PCA-space
     # 2) For each pair of clusters that are sibling leaves,
     #   3) Run a differential expression analysis
     #   4) Merge the clusters if not enough genes are differentially expressed
     #   5) If merged, stop considering cluster-pairs and goto 1)
-
-    # Cache already-checked cluster-pairs
-    # set of (frozenset, frozenset)
-    checked_cluster_pairs = set()
-
-    while True:
-        print resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
-        sys.stdout.flush()
-        if len(np.bincount(labels)) == 1:
-            # One cluster remains
-            break
-
-        # Compute medoids, perform hierarchical clustering
-        pca_df['cluster'] = labels
-        medoids = pca_df.groupby('cluster').apply(lambda x: x.median(axis=0)).as_matrix()[:,:-1]
-        hc = linkage(medoids, 'complete')
-        max_label = np.max(labels)
-
-        print np.bincount(labels)
-        print 'max=%d' % max_label
-
-        any_merged = False
-        for step in xrange(hc.shape[0]):
-            if hc[step,0] <= max_label and hc[step,1] <= max_label:
-                leaf0, leaf1 = hc[step,0], hc[step,1]
-
-                group0 = np.flatnonzero(labels == leaf0)
-                group1 = np.flatnonzero(labels == leaf1)
-
-                # Skip this cluster pair if already checked
-                set0 = frozenset(group0)
-                set1 = frozenset(group1)
-                cluster_pair = tuple(sorted([set0, set1]))
-                if cluster_pair in checked_cluster_pairs:
-                    continue
-                checked_cluster_pairs.add(cluster_pair)
-
-                print 'Comparing clusters (%d,%d)' % (1+leaf0,1+leaf1)
-                submat = expr_mat[:,np.concatenate((group0,group1))]
-
-                print '\tComputing params on (%d,%d) matrix' % submat.shape
-                params = compute_sseq_params(submat)
-
-                print '\tRunning DE on %d vs %d cells' % (len(group0), len(group1))
-                group0_submat = np.arange(len(group0))
-                group1_submat = np.arange(len(group0), len(group0)+len(group1))
-                de_result = sseq_differential_expression(submat,
-                                                         group0_submat, group1_submat,
-                                                         params)
-
-                n_de_genes = np.sum(de_result.adjusted_p_value < MERGE_CLUSTERS_DE_ADJ_P_THRESHOLD)
-                if n_de_genes == 0:
-                    print '\tFound %d DE genes. Merging clusters (%d,%d)' % (n_de_genes, 1+leaf0,1+leaf1)
-                    # Relabel as the smaller-index cluster
-                    labels[labels == leaf1] = leaf0
-
-                    # Shift all labels above old label down
-                    labels[labels > leaf1] = labels[labels > leaf1] - 1
-
-                    any_merged = True
-                    break
-
-        sys.stdout.flush()
-
-        if not any_merged:
-            break
+    merger = cr_mergeclust.ClusterMerger(expr_mat, pca, labels)
+    merger.run(threads=args.__threads)
+    labels = merger.get_labels(len(labels))
 
     # Convert back to one-based cluster labels
     labels += 1
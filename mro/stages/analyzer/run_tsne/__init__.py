@@ -37,6 +37,14 @@ stage RUN_TSNE(
 )
 """
 
+def get_tsne_mem_gb(num_bcs, num_input_dims, perplexity):
+    """ Estimate the memory (GB) to run tSNE on a dense (num_bcs x num_input_dims) input """
+    # Dense float64 input and the copy made for bh_sne
+    input_bytes = 2 * 8 * num_bcs * num_input_dims
+    # Sparse input similarities over 3*perplexity neighbors per barcode, plus the neighbor search
+    neighbor_bytes = 2 * 12 * num_bcs * 3 * perplexity
+    return int(np.ceil(float(input_bytes + neighbor_bytes) / 1e9))
+
 def split(args):
     if args.skip:
         return {'chunks': [{'__mem_gb': h5_constants.MIN_MEM_GB}]}
@@ -44,16 +52,30 @@ def split(args):
     feature_ref = cr_matrix.CountMatrix.load_feature_ref_from_h5_file(args.matrix_h5)
     feature_types = sorted(list(set(fd.feature_type for fd in feature_ref.feature_defs)))
 
+    _, num_bcs, nonzero_entries = cr_matrix.CountMatrix.load_dims_from_h5(args.matrix_h5)
+    perplexity = args.perplexity if args.perplexity is not None else analysis_constants.TSNE_DEFAULT_PERPLEXITY
+
     chunks = []
-    matrix_mem_gb = cr_matrix.CountMatrix.get_mem_gb_from_matrix_h5(args.matrix_h5)
     min_tsne_dims = analysis_constants.TSNE_N_COMPONENTS
     max_tsne_dims = args.max_dims if args.max_dims is not None else min_tsne_dims
     for tsne_dims, feature_type in itertools.product(xrange(min_tsne_dims, max_tsne_dims+1),
                                                       feature_types):
+        if feature_type == lib_constants.GENE_EXPRESSION_LIBRARY_TYPE:
+            # Only the PCA and the barcodes are loaded
+            _, num_pcs = cr_pca.load_pca_shape_from_h5(args.pca_h5)
+            num_input_dims = min(num_pcs, args.input_pcs) if args.input_pcs is not None else num_pcs
+            mem_gb = get_tsne_mem_gb(num_bcs, num_input_dims, perplexity)
+        else:
+            # The selected features are loaded as a sparse matrix, then densified
+            num_features = sum(1 for fd in feature_ref.feature_defs if fd.feature_type == feature_type)
+            sparse_mem_gb = cr_matrix.CountMatrix.get_mem_gb_from_matrix_dim(
+                num_bcs, min(nonzero_entries, num_bcs * num_features))
+            mem_gb = sparse_mem_gb + get_tsne_mem_gb(num_bcs, num_features, perplexity)
+
         chunks.append({
             'tsne_dims': tsne_dims,
             'feature_type': feature_type,
-            '__mem_gb': max(matrix_mem_gb, h5_constants.MIN_MEM_GB),
+            '__mem_gb': max(mem_gb, h5_constants.MIN_MEM_GB),
         })
     return {'chunks': chunks, 'join': {'__mem_gb' : 1}}
 
@@ -77,18 +99,18 @@ def main(args, outs):
 
     tsne_dims = args.tsne_dims
 
-    matrix = cr_matrix.CountMatrix.load_h5_file(args.matrix_h5)
-
     if args.feature_type == lib_constants.GENE_EXPRESSION_LIBRARY_TYPE:
         # Use PCA for gene expression
         pca = cr_pca.load_pca_from_h5(args.pca_h5)
         tsne_input = pca.transformed_pca_matrix
+        barcodes = cr_matrix.CountMatrix.load_bcs_from_h5(args.matrix_h5)
     else:
         # Use feature space for other feature types
         # Assumes other feature types are much lower dimension than gene expression
-        matrix = matrix.select_features_by_type(args.feature_type)
+        matrix = cr_matrix.CountMatrix.load_features_by_type_from_h5(args.matrix_h5, args.feature_type)
         matrix.m.data = np.log2(1 + matrix.m.data)
-        tsne_input = matrix.m.transpose().todense()
+        tsne_input = matrix.m.transpose().toarray()
+        barcodes = matrix.bcs
 
     name = get_tsne_name(args.feature_type, args.tsne_dims)
     key = get_tsne_key(args.feature_type, args.tsne_dims)
@@ -101,7 +123,7 @@ def main(args, outs):
     with tables.open_file(outs.tsne_h5, 'w', filters = filters) as f:
         cr_tsne.save_tsne_h5(tsne, f)
 
-    cr_tsne.save_tsne_csv(tsne, matrix, outs.tsne_csv)
+    cr_tsne.save_tsne_csv(tsne, barcodes, outs.tsne_csv)
 
 def join(args, outs, chunk_defs, chunk_outs):
     if args.skip:
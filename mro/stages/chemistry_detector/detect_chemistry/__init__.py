@@ -11,13 +11,13 @@ import os
 import tenkit.log_subprocess as tk_subproc
 import tenkit.stats as tk_stats
 import cellranger.chemistry as cr_chem
+import cellranger.chemistry_index as cr_chem_index
 import cellranger.constants as cr_constants
 import cellranger.library_constants as cr_libraries
 import cellranger.fastq as cr_fastq
 import cellranger.preflight as cr_preflight
 import cellranger.io as cr_io
 import cellranger.vdj.preflight as vdj_preflight
-import cellranger.vdj.reference as vdj_ref
 import enum
 
 __MRO__ = """
@@ -52,6 +52,9 @@ MAX_AMBIGUOUS_MAPPED_READ_FRAC = 0.75
 # Min fraction of reads going to V(D)J ref to call as V(D)J
 MIN_VDJ_READ_FRAC = 0.25
 
+# Metrics written by detect_chemistry map-reads for each read type
+MAP_READS_METRICS = ['total_reads', 'sense_reads', 'antisense_reads', 'ambiguous_reads', 'mapped_reads']
+
 class ReadState(enum.Enum):
     SENSE_MAPPED = 0
     ANTISENSE_MAPPED = 1
@@ -84,15 +87,25 @@ def run(args):
     print ' '.join(args)
     tk_subproc.check_call(args)
 
-def map_reads(fq_spec_path, idx_path, out_path):
+def map_reads(fq_spec_path, idx_path, out_path, threads):
+    """ Map the FASTQs of all read types in one run, mapping up to 'threads' FASTQs at once.
+        Returns a dict of metrics per read type """
     run(['detect_chemistry', 'map-reads',
          idx_path, '/dev/null', out_path,
          '--initial-reads', str(INITIAL_READS),
-         '--fastqs', fq_spec_path])
+         '--fastqs', fq_spec_path,
+         '--threads', str(threads),
+         '--by-read-type'])
 
     # Get output
     with open(out_path) as f:
-        return json.load(f)
+        metrics = json.load(f)
+
+    # Read types without any FASTQs have no reads
+    for read_type in READ_TYPES:
+        if read_type not in metrics:
+            metrics[read_type] = {k: 0 for k in MAP_READS_METRICS}
+    return metrics
 
 
 def find_fastqs(sample_defs):
@@ -133,70 +146,27 @@ def run_preflight_checks(args):
         vdj_preflight.check_refdata(args.vdj_reference_path, True)
 
 def prepare_transcriptome_indexes(reference_path, vdj_reference_path):
-    """ Use ReadStates of R1/R2 to determine SC3Pv1 vs SC3Pv2 vs SC5P-R1 vs SC5P_auto/SCVDJ.
-        Returns (chemistry_name, report, metrics)
-        where report is a text report and metrics is a dict """
-
-    ## Index the reference fasta
-    fa_path = os.path.join(reference_path, cr_constants.REFERENCE_FASTA_PATH)
-    new_fa_path = martian.make_path('ref.fa')
-
-    need_index = True
-
-    if os.path.exists(fa_path + '.fai'):
-        # Look for existing .fai file (won't exist for our standard ref packages)
-        martian.update_progress('Found genome FASTA index....')
-        new_fa_path = fa_path
-        need_index = False
-
-    else:
-        # Note: this will fail if user's fs doesn't support symlinks
-        martian.update_progress('Symlinking genome FASTA...')
-        os.symlink(fa_path, new_fa_path)
+    """ Get k-mer indexes of the transcriptome and of the V(D)J reference (optional).
+        An index built into the reference (mkref --chemistry-index) or into the shared
+        cache is reused if it matches the reference; otherwise it is built here.
+        Returns (kmer_idx_path, vdj_idx_path) """
 
-    if need_index:
-        martian.update_progress('Indexing genome...')
-        run(['samtools', 'faidx', new_fa_path])
+    martian.update_progress('Preparing kmer index...')
+    gex_work_dir = martian.make_path('gex_index')
+    os.makedirs(gex_work_dir)
+    kmer_idx_path = cr_chem_index.get_transcriptome_kmer_index(reference_path, gex_work_dir)
 
-
-    ## Generate a transcriptome reference from a genome ref
-    martian.update_progress('Building transcriptome...')
-    gtf_path = os.path.join(reference_path, cr_constants.REFERENCE_GENES_GTF_PATH)
-    out_fa_path = martian.make_path('transcriptome.fa')
-    # Only index the 1st encountered transcript per gene
-    run(['detect_chemistry', 'get-transcripts', new_fa_path, gtf_path, out_fa_path])
-
-
-    ## Build kmer index
-    martian.update_progress('Building kmer index...')
-    kmer_idx_path = martian.make_path('kmers.idx')
-
-    ## Use a larger step size as the reference grows.
-    ## This ensure the index size stays sane.
-    ## Should get to a step of <10 for the whole genome, which
-    ## is still 3x overlap w/ 32-mers
-    fa_size = os.path.getsize(os.path.realpath(out_fa_path))
-    step = fa_size / 400000000
-    skip = step - 1
-
-    index_args = ['detect_chemistry', 'index-transcripts']
-    if skip > 0:
-        index_args.append('--skip=%d' % skip)
-
-    index_args.extend([out_fa_path, kmer_idx_path])
-    run(index_args)
-
-    # Build VDJ kmer index (optional)
+    # VDJ kmer index (optional)
     vdj_idx_path = None
     if vdj_reference_path is not None:
-        vdj_fa_path = vdj_ref.get_vdj_reference_fasta(vdj_reference_path)
-        vdj_idx_path = martian.make_path('vdj_kmers.idx')
-        run(['detect_chemistry', 'index-transcripts', vdj_fa_path, vdj_idx_path])
+        vdj_work_dir = martian.make_path('vdj_index')
+        os.makedirs(vdj_work_dir)
+        vdj_idx_path = cr_chem_index.get_vdj_kmer_index(vdj_reference_path, vdj_work_dir)
 
     return (kmer_idx_path, vdj_idx_path)
 
 
-def infer_sc3p_or_sc5p(chunks, kmer_idx_path, vdj_idx_path):
+def infer_sc3p_or_sc5p(chunks, kmer_idx_path, vdj_idx_path, threads):
     """ Use ReadStates of R1/R2 to determine SC3Pv1 vs SC3Pv2 vs SC5P-R1 vs SC5P_auto/SCVDJ.
         Returns (chemistry_name, report, metrics)
         where report is a text report and metrics is a dict """
@@ -205,25 +175,19 @@ def infer_sc3p_or_sc5p(chunks, kmer_idx_path, vdj_idx_path):
     martian.update_progress('Mapping reads...')
 
     # Prepare fastq paths
-    fq_specs = {}
-    for read_type in READ_TYPES:
-        fq_specs[read_type] = martian.make_path('%s_in.json' % read_type)
-        with open(fq_specs[read_type], 'w') as f:
-            json.dump([c for c in chunks if c['read_type'] == read_type], f)
+    fq_spec_path = martian.make_path('fastqs_in.json')
+    with open(fq_spec_path, 'w') as f:
+        json.dump([c for c in chunks if c['read_type'] in READ_TYPES], f)
 
     # Map reads to gene expression reference
-    metrics = {}
-    for read_type in READ_TYPES:
-        map_out_path = martian.make_path('%s_out.json' % read_type)
-        metrics[read_type] = map_reads(fq_specs[read_type], kmer_idx_path, map_out_path)
+    all_metrics = map_reads(fq_spec_path, kmer_idx_path, martian.make_path('out.json'), threads)
+    metrics = {read_type: all_metrics[read_type] for read_type in READ_TYPES}
 
     # Map reads to VDJ reference (optional)
     if vdj_idx_path is not None:
+        all_vdj_metrics = map_reads(fq_spec_path, vdj_idx_path, martian.make_path('vdj_out.json'), threads)
         for read_type in READ_TYPES:
-            map_out_path = martian.make_path('vdj_%s_out.json' % read_type)
-            vdj_metrics = map_reads(fq_specs[read_type], vdj_idx_path, map_out_path)
-
-            for k,v in vdj_metrics.iteritems():
+            for k,v in all_vdj_metrics[read_type].iteritems():
                 metrics[read_type]['vdj_' + k] = v
 
     # Verify total read counts
@@ -345,7 +309,7 @@ def main(args, outs):
             chunks = find_fastqs([sd])
 
             sd_report = "\nDetect Report -- %s (%s):\n" % (sd["read_path"], sd.get("library_type"))
-            chemistry_name, _report, metrics = infer_sc3p_or_sc5p(chunks, txome_idx, vdj_idx)
+            chemistry_name, _report, metrics = infer_sc3p_or_sc5p(chunks, txome_idx, vdj_idx, args.__threads)
             sd_report += _report
             report += sd_report
             auto_chemistries[idx] = chemistry_name
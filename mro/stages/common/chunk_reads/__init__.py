@@ -48,7 +48,7 @@ def main(args, outs):
 
     output_path = martian.make_path("")
     prefix = "fastq_chunk"
-    chunk_reads_args = ['chunk_reads',  '--reads-per-fastq', str(args.reads_per_file), output_path, prefix, "--martian-args", "chunk_args.json", '--compress', 'lz4']
+    chunk_reads_args = ['chunk_reads',  '--reads-per-fastq', str(args.reads_per_file), output_path, prefix, "--martian-args", "chunk_args.json", '--compress', 'lz4', '--threads', str(args.__threads)]
     print "running chunk reads: [%s]" % str(chunk_reads_args)
     tk_subproc.check_call(chunk_reads_args)
 
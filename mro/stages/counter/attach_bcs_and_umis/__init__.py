@@ -59,6 +59,9 @@ stage ATTACH_BCS_AND_UMIS(
 )
 '''
 
+# Threads per chunk for annotate_reads; also used for BAM compression
+ANNOTATE_READS_THREADS = 4
+
 def split(args):
     # Write BAM comments to json file
     bam_comment_fn = martian.make_path('bam_comments.json')
@@ -90,6 +93,7 @@ def split(args):
             'bam_comments_json': bam_comment_fn,
             'skip_translate': this_skip_translate,
             '__mem_gb': 4,
+            '__threads': ANNOTATE_READS_THREADS,
         })
     join = {
         '__mem_gb': 12,
@@ -124,6 +128,7 @@ def main(args, outs):
         args.library_id,
         args.library_info_json,
         '--bam-comments', args.bam_comments_json,
+        '--threads', str(args.__threads),
     ]
 
     if cr_chem.get_endedness(args.chemistry_def) == cr_constants.FIVE_PRIME:
@@ -14,6 +14,9 @@ import cellranger.rna.matrix as rna_matrix
 import cellranger.report as cr_report
 import cellranger.utils as cr_utils
 
+# Processes used to sum the chunk reporters in the join
+JOIN_REPORTER_THREADS = 4
+
 __MRO__ = """
 stage COUNT_GENES(
     in  string sample_id,
@@ -27,7 +30,7 @@ stage COUNT_GENES(
     in  map    align,
     out h5     matrices_h5,
     out path   matrices_mex,
-    out pickle chunked_reporter,
+    out h5     chunked_reporter,
     out json   reporter_summary,
     out h5     barcode_summary,
     src py     "stages/counter/count_genes",
@@ -49,6 +52,7 @@ def split(args):
     #          to estimate the matrix memory size.
     join = {
         '__mem_gb': 12,
+        '__threads': JOIN_REPORTER_THREADS,
     }
     return {'chunks': chunks, 'join': join}
 
@@ -64,7 +68,8 @@ def join_matrices(args, outs, chunk_defs, chunk_outs):
 
 def join_reporter(args, outs, chunk_defs, chunk_outs):
     outs.chunked_reporter = None
-    reporter = cr_report.merge_reporters([chunk_out.chunked_reporter for chunk_out in chunk_outs])
+    reporter = cr_report.merge_reporters([chunk_out.chunked_reporter for chunk_out in chunk_outs],
+                                         threads=args.__threads)
 
     reporter.report_summary_json(outs.reporter_summary)
     reporter.report_barcodes_h5(outs.barcode_summary)
@@ -120,4 +125,4 @@ def main(args, outs):
     reporter.store_reference_metadata(args.reference_path, cr_constants.REFERENCE_TYPE, cr_constants.REFERENCE_METRIC_PREFIX)
 
     matrix.save_h5_file(outs.matrices_h5)
-    reporter.save(outs.chunked_reporter)
+    reporter.save_columnar(outs.chunked_reporter)
@@ -38,11 +38,23 @@ def main(args, outs):
     bam_prefix, ext = os.path.splitext(outs.output)
     tk_bam.sort(str(args.chunk_input), str(bam_prefix))
 
+    # Index each chunk so the join can merge it one reference at a time
+    tk_bam.index(outs.output)
+    outs.index = outs.output + '.bai'
+
 def merge(input_bams, output_bam, threads=1):
-    ''' Merge the sorted bam chunks hierarchically to conserve open file handles '''
+    ''' Merge the sorted bam chunks. If they fit within the open file limit, merge
+        references in parallel, on as many threads as the limit allows; otherwise
+        merge hierarchically to conserve open file handles '''
     soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
     soft -= 100
 
+    # Each concurrent region merge opens every input
+    region_threads = min(max(1, threads), soft / max(1, len(input_bams)))
+    if region_threads >= 1:
+        tk_bam.merge_by_region(output_bam, input_bams, region_threads)
+        return
+
     tmp_dir = os.path.dirname(output_bam)
     while len(input_bams) > 1:
         new_bams = []
@@ -6,6 +6,7 @@
 # of the member cells and computes the base qualities of the consensus sequences.
 
 from collections import defaultdict, Counter
+import csv
 import itertools
 import json
 import martian
@@ -16,6 +17,7 @@ import pysam
 import re
 import shutil
 import sys
+import time
 import tenkit.bam as tk_bam
 import tenkit.fasta as tk_fasta
 import tenkit.log_subprocess as tk_subproc
@@ -59,6 +61,7 @@ stage ASSEMBLE_CONSENSUS(
     out csv        consensus_annotations_csv,
     out json       summary,
     out csv        clonotypes                   "info about clonotypes",
+    out tsv        consensus_timings            "per-consensus processing times",
     src py         "stages/vdj/assemble_consensus",
 ) split using (
     in  string[]   chunk_clonotypes,
@@ -82,8 +85,7 @@ MAX_READS_PER_CONTIG = 20000
 # If fewer contigs than this, we'll just pick one as the consensus.
 MIN_CONTIGS_FOR_CONSENSUS = 2
 
-# Merge consensus BAMs every N files
-MERGE_BAMS_EVERY = 10
+CONSENSUS_TIMINGS_HEADER = ['clonotype_id', 'consensus_id', 'python_seconds', 'base_quals_seconds']
 
 def rm_files(filenames):
     for filename in filenames:
@@ -193,8 +195,6 @@ def main(args, outs):
 
     in_bam = tk_bam.create_bam_infile(args.contig_bam)
 
-    n_merged_bams = 0
-
     # For all contigs relevant to this chunk,
     #   get the assembler umi data required for base qual recalculation.
     # Do not attempt to read into a pandas object because it can be huge.
@@ -220,13 +220,17 @@ def main(args, outs):
 
     assert(args.metric_prefix in reporter.vdj_clonotype_types)
 
-    # Iterate over clonotype assignments
+    # Per-consensus python time (seconds), keyed by consensus id
+    consensus_times = Counter()
+
+    # Pass 1: build the consensus sequences and prepare the inputs for base quality recalculation.
+    consensus_infos = []
     for clonotype_id, clonotype in clonotypes.iteritems():
         if not clonotype_id in chunk_clonotypes:
             continue
 
         for consensus_id, consensus in clonotype['consensuses'].iteritems():
-            cdr = consensus['cdr3_seq']
+            start_time = time.time()
 
             # Verify that the contig annotation data are consistent with the clonotype assignment data
             assert set(consensus['cell_contigs']) == \
@@ -264,48 +268,109 @@ def main(args, outs):
             metric = reporter._get_metric_attr('vdj_clonotype_gt1_j_annotations_contig_frac', args.metric_prefix)
             metric.add(1, filter=anno_count > 1)
 
-            wrong_cdr_metric = reporter._get_metric_attr('vdj_clonotype_consensus_wrong_cdr_contig_frac', args.metric_prefix)
-
             tmp_dir = martian.make_path(consensus_id + '_outs')
             cr_io.mkdir(tmp_dir, allow_existing=True)
 
             res = get_consensus_seq(consensus_id, sel_contig_ids, best_contig.contig_name, tmp_dir, args)
-            (best_seq, best_quals, consensus_seq, contig_to_cons_bam, contig_fastq, contig_fasta) = res
-
-            outs.chunked_consensus_bams.append(contig_to_cons_bam)
+            (best_seq, best_quals, consensus_seq, contig_fastq, contig_fasta) = res
 
-            # make sure the bam file has the right header (single sequence with this consensus name)
-            tmp_bam = tk_bam.create_bam_infile(contig_to_cons_bam)
-            if list(tmp_bam.references) != [consensus_id]:
-                # Print some info to help us debug
-                print tmp_bam.references, consensus_id
-                assert(list(tmp_bam.references) == [consensus_id])
-            tmp_bam.close()
+            if os.path.isdir(tmp_dir):
+                shutil.rmtree(tmp_dir)
 
+            qual_reads_pref = None
             if consensus_seq:
                 # If this is not None, we actually built a consensus, so we have to compute the quals from scratch.
                 # Use a subset of the contigs for computing quals.
                 contig_ids = map(lambda c: c.contig_name, sorted(sel_contigs, key=lambda c:c.umi_count, reverse=True))
                 contig_ids = contig_ids[0:MAX_CELLS_FOR_BASE_QUALS]
 
-                consensus_quals = get_consensus_quals(in_bam, consensus_id, contig_fasta,
-                                                      contig_ids, contig_umis, tmp_dir)
-            else:
-                consensus_seq = best_seq
-                consensus_quals = best_quals
-
-            assert(len(consensus_seq) == len(consensus_quals))
+                qual_reads_pref = write_consensus_qual_reads(in_bam, contig_fasta, contig_ids, contig_umis)
+
+            consensus_infos.append({
+                'clonotype_id': clonotype_id,
+                'clonotype': clonotype,
+                'consensus_id': consensus_id,
+                'cdr3_seq': consensus['cdr3_seq'],
+                'sel_contigs': sel_contigs,
+                'sel_contig_ids': sel_contig_ids,
+                'best_seq': best_seq,
+                'best_quals': best_quals,
+                'consensus_seq': consensus_seq,
+                'contig_fastq': contig_fastq,
+                'contigs_pref': re.sub('.fasta', '', contig_fasta),
+                'qual_reads_pref': qual_reads_pref,
+            })
 
-            total_read_count = sum([c.read_count for c in sel_contigs])
-            total_umi_count = sum([c.umi_count for c in sel_contigs])
+            consensus_times[consensus_id] += time.time() - start_time
 
-            contig_info_dict = {
-                'cells': clonotype['barcodes'],
-                'cell_contigs': sel_contig_ids,
-                'clonotype_freq': clonotype['freq'],
-                'clonotype_prop': clonotype['prop'],
-            }
+    in_bam.close()
 
+    # Align the contigs of each consensus against it.
+    cons_bam_groups = [(info['contigs_pref'], True) for info in consensus_infos]
+    new_cons_bam, _, cons_bam_times = run_base_quals_batch(cons_bam_groups, martian.make_path('consensus'))
+    # Make sure the bam file has the right header (one sequence per consensus, in order)
+    tmp_bam = tk_bam.create_bam_infile(new_cons_bam)
+    assert list(tmp_bam.references) == [info['consensus_id'] for info in consensus_infos]
+    tmp_bam.close()
+    outs.chunked_consensus_bams.append(new_cons_bam)
+
+    # Compute read-based base qualities for all consensuses that were actually built.
+    qual_groups = [(info['qual_reads_pref'], False) for info in consensus_infos if info['qual_reads_pref']]
+    if qual_groups:
+        _, all_consensus_quals, qual_times = run_base_quals_batch(qual_groups, martian.make_path('consensus_quals'))
+    else:
+        all_consensus_quals, qual_times = {}, {}
+
+    # Pass 2: annotate the consensuses and prepare the alignments against the concatenated references.
+    ref_groups = []
+    ref_name_to_consensus = {}
+    for info in consensus_infos:
+        start_time = time.time()
+
+        clonotype_id = info['clonotype_id']
+        clonotype = info['clonotype']
+        consensus_id = info['consensus_id']
+        cdr = info['cdr3_seq']
+        sel_contigs = info['sel_contigs']
+        best_seq, best_quals = info['best_seq'], info['best_quals']
+
+        wrong_cdr_metric = reporter._get_metric_attr('vdj_clonotype_consensus_wrong_cdr_contig_frac', args.metric_prefix)
+
+        if info['consensus_seq']:
+            consensus_seq = info['consensus_seq']
+            consensus_quals = all_consensus_quals[consensus_id]
+        else:
+            consensus_seq = best_seq
+            consensus_quals = best_quals
+
+        assert(len(consensus_seq) == len(consensus_quals))
+
+        total_read_count = sum([c.read_count for c in sel_contigs])
+        total_umi_count = sum([c.umi_count for c in sel_contigs])
+
+        contig_info_dict = {
+            'cells': clonotype['barcodes'],
+            'cell_contigs': info['sel_contig_ids'],
+            'clonotype_freq': clonotype['freq'],
+            'clonotype_prop': clonotype['prop'],
+        }
+
+        contig = annotate_consensus_contig(args.vdj_reference_path,
+                                           args.min_score_ratios,
+                                           args.min_word_sizes,
+                                           consensus_id, clonotype_id,
+                                           consensus_seq, consensus_quals,
+                                           read_count=total_read_count,
+                                           umi_count=total_umi_count,
+                                           info_dict=contig_info_dict,
+                                           primers=args.primers)
+
+        wrong_cdr_metric.add(1, filter=contig.cdr3_seq is None or contig.cdr3_seq != cdr)
+
+        if contig.cdr3_seq is None or contig.cdr3_seq != cdr:
+            # Something went wrong. Use "best" contig as the consensus.
+            consensus_seq = best_seq
+            consensus_quals = best_quals
             contig = annotate_consensus_contig(args.vdj_reference_path,
                                                args.min_score_ratios,
                                                args.min_word_sizes,
@@ -316,117 +381,87 @@ def main(args, outs):
                                                info_dict=contig_info_dict,
                                                primers=args.primers)
 
-            wrong_cdr_metric.add(1, filter=contig.cdr3_seq is None or contig.cdr3_seq != cdr)
+        assert(not contig.cdr3_seq is None and contig.cdr3_seq == cdr)
 
-            if contig.cdr3_seq is None or contig.cdr3_seq != cdr:
-                # Something went wrong. Use "best" contig as the consensus.
-                consensus_seq = best_seq
-                consensus_quals = best_quals
-                contig = annotate_consensus_contig(args.vdj_reference_path,
-                                                   args.min_score_ratios,
-                                                   args.min_word_sizes,
-                                                   consensus_id, clonotype_id,
-                                                   consensus_seq, consensus_quals,
-                                                   read_count=total_read_count,
-                                                   umi_count=total_umi_count,
-                                                   info_dict=contig_info_dict,
-                                                   primers=args.primers)
-
-            assert(not contig.cdr3_seq is None and contig.cdr3_seq == cdr)
-
-            consensus_contigs.append(contig)
-
-            tk_fasta.write_read_fasta(consensus_fasta, consensus_id, consensus_seq)
-            tk_fasta.write_read_fastq(consensus_fastq, consensus_id,
-                                      consensus_seq, consensus_quals)
-            assert(len(consensus_seq) == len(consensus_quals))
-
-            ref_seq_parts, ref_annos = contig.get_concat_reference_sequence()
-
-            # Align the contigs and consensus to a synthetic concatenated reference
-            if ref_seq_parts is not None:
-                # Trim the last segment down to the annotated length
-                #   to avoid including the entire (500nt) C-region
-                ref_seq_parts[-1] = ref_seq_parts[-1][0:ref_annos[-1].annotation_match_end]
-
-                # Concatenate the reference VDJC segments
-                ref_seq = reduce(lambda x, y: x + y, ref_seq_parts)
-                ref_name = re.sub('consensus', 'concat_ref', consensus_id)
-
-                # Reannotate the reference sequence.
-                # Restrict the annotation to the already-called segments to
-                #   reduce the risk of discordance between the consensus and
-                #   concat_ref annotations.
-                ref_contig = annotate_consensus_contig(args.vdj_reference_path,
-                                                       args.min_score_ratios,
-                                                       args.min_word_sizes,
-                                                       ref_name, clonotype_id,
-                                                       ref_seq, 'I'*len(ref_seq),
-                                                       use_features=set([a.feature.feature_id for a in ref_annos]),
-                )
-                ref_contigs.append(ref_contig)
-
-                # Add the consensus sequence to the input FASTQ (next to the contigs)
-                with open(contig_fastq, 'a') as contig_fq:
-                    # Create a fake UMI and barcode
-                    header = cr_fastq.AugmentedFastqHeader(consensus_id)
-                    header.set_tag(PROCESSED_UMI_TAG, consensus_id)
-                    header.set_tag(PROCESSED_BARCODE_TAG, consensus_id)
-                    tk_fasta.write_read_fastq(contig_fq, header.to_string(),
-                                              consensus_seq, consensus_quals)
-
-                # Reuse this file (this had the assembly output but we don't need it anymore)
-                ref_fasta_name = martian.make_path(consensus_id + '_contigs.fasta')
-                with open(ref_fasta_name, 'w') as f:
-                    tk_fasta.write_read_fasta(f, ref_name, ref_seq)
-
-                # Also append to the final output
-                tk_fasta.write_read_fasta(ref_fasta, ref_name, ref_seq)
-
-                cmd = [
-                    'vdj_asm', 'base-quals',
-                    martian.make_path(consensus_id + '_contigs'),
-                    tmp_dir,
-                    '--single-end'
-                ]
-                sys.stderr.write('Running ' + ' '.join(cmd) + '\n')
-
-                tk_subproc.check_call(cmd, cwd=os.getcwd())
-
-                # Move out of tmp dir
-                rec_bam = martian.make_path(consensus_id + '_reference.bam')
-                cr_io.move(os.path.join(tmp_dir, consensus_id + '_contigs.bam'), rec_bam)
-                outs.chunked_concat_ref_bams.append(rec_bam)
+        consensus_contigs.append(contig)
 
-            if os.path.isdir(tmp_dir):
-                shutil.rmtree(tmp_dir)
+        tk_fasta.write_read_fasta(consensus_fasta, consensus_id, consensus_seq)
+        tk_fasta.write_read_fastq(consensus_fastq, consensus_id,
+                                  consensus_seq, consensus_quals)
+        assert(len(consensus_seq) == len(consensus_quals))
 
-            # Clean up unneeded files ASAP
-            rm_files([consensus_id + '_contigs.fasta',
-                      consensus_id + '_contigs.fastq'])
+        ref_seq_parts, ref_annos = contig.get_concat_reference_sequence()
 
-            # Merge N most recent BAM files to avoid filesystem overload
-            if len(outs.chunked_consensus_bams) >= MERGE_BAMS_EVERY:
-                assert len(outs.chunked_consensus_bams) == len(outs.chunked_concat_ref_bams)
+        # Align the contigs and consensus to a synthetic concatenated reference
+        if ref_seq_parts is not None:
+            # Trim the last segment down to the annotated length
+            #   to avoid including the entire (500nt) C-region
+            ref_seq_parts[-1] = ref_seq_parts[-1][0:ref_annos[-1].annotation_match_end]
 
-                new_cons_bam = martian.make_path('merged-consensus-%03d.bam' % n_merged_bams)
-                concatenate_bams(new_cons_bam, outs.chunked_consensus_bams)
-                rm_files(outs.chunked_consensus_bams)
-                outs.chunked_consensus_bams = [new_cons_bam]
+            # Concatenate the reference VDJC segments
+            ref_seq = reduce(lambda x, y: x + y, ref_seq_parts)
+            ref_name = re.sub('consensus', 'concat_ref', consensus_id)
 
-                new_ref_bam = martian.make_path('merged-ref-%03d.bam' % n_merged_bams)
-                concatenate_bams(new_ref_bam, outs.chunked_concat_ref_bams)
-                rm_files(outs.chunked_concat_ref_bams)
-                outs.chunked_concat_ref_bams = [new_ref_bam]
+            # Reannotate the reference sequence.
+            # Restrict the annotation to the already-called segments to
+            #   reduce the risk of discordance between the consensus and
+            #   concat_ref annotations.
+            ref_contig = annotate_consensus_contig(args.vdj_reference_path,
+                                                   args.min_score_ratios,
+                                                   args.min_word_sizes,
+                                                   ref_name, clonotype_id,
+                                                   ref_seq, 'I'*len(ref_seq),
+                                                   use_features=set([a.feature.feature_id for a in ref_annos]),
+            )
+            ref_contigs.append(ref_contig)
 
-                n_merged_bams += 1
+            # Add the consensus sequence to the input FASTQ (next to the contigs)
+            with open(info['contig_fastq'], 'a') as contig_fq:
+                # Create a fake UMI and barcode
+                header = cr_fastq.AugmentedFastqHeader(consensus_id)
+                header.set_tag(PROCESSED_UMI_TAG, consensus_id)
+                header.set_tag(PROCESSED_BARCODE_TAG, consensus_id)
+                tk_fasta.write_read_fastq(contig_fq, header.to_string(),
+                                          consensus_seq, consensus_quals)
 
-    in_bam.close()
+            # Reuse this file (this had the consensus sequence but we don't need it anymore)
+            with open(info['contigs_pref'] + '.fasta', 'w') as f:
+                tk_fasta.write_read_fasta(f, ref_name, ref_seq)
+
+            # Also append to the final output
+            tk_fasta.write_read_fasta(ref_fasta, ref_name, ref_seq)
+
+            ref_groups.append((info['contigs_pref'], True))
+            ref_name_to_consensus[ref_name] = consensus_id
+
+        consensus_times[consensus_id] += time.time() - start_time
 
     consensus_fastq.close()
     consensus_fasta.close()
     ref_fasta.close()
 
+    # Align the contigs and consensuses against the concatenated references.
+    ref_times = {}
+    if ref_groups:
+        new_ref_bam, _, ref_times = run_base_quals_batch(ref_groups, martian.make_path('concat_ref'))
+        outs.chunked_concat_ref_bams.append(new_ref_bam)
+
+    # Clean up intermediate files
+    for info in consensus_infos:
+        rm_files([info['contigs_pref'] + suffix for suffix in
+                  ['.fasta', '.fastq', '_1.fastq', '_2.fastq']])
+
+    with open(outs.consensus_timings, 'w') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(CONSENSUS_TIMINGS_HEADER)
+        for info in consensus_infos:
+            consensus_id = info['consensus_id']
+            ref_name = re.sub('consensus', 'concat_ref', consensus_id)
+            base_quals_time = cons_bam_times.get(consensus_id, 0.0) + qual_times.get(consensus_id, 0.0) + \
+                              (ref_times.get(ref_name, 0.0) if ref_name in ref_name_to_consensus else 0.0)
+            writer.writerow([info['clonotype_id'], consensus_id,
+                             '%.3f' % consensus_times[consensus_id], '%.3f' % base_quals_time])
+
     reporter.save(outs.chunked_reporter)
 
     with open(outs.consensus_annotations_json, 'w') as out_file:
@@ -436,6 +471,49 @@ def main(args, outs):
         vdj_annot.save_annotation_list_json(out_file, ref_contigs)
 
 
+def run_base_quals_batch(groups, out_pref):
+    """Run base quality recalculation for many sequences in a single vdj_asm process.
+
+    Args:
+    - groups: list of (file prefix, single_end). Each prefix points to a FASTA with
+        the sequence and the FASTQ(s) with the reads to align against it.
+    - out_pref: prefix of the output files.
+
+    Return value:
+    A tuple (out_bam_name, quals, timings).
+    - out_bam_name: BAM with the alignments of all groups (one reference per group, in order).
+    - quals: dict from sequence name to base qualities (in FASTQ format).
+    - timings: dict from sequence name to processing time in seconds.
+    """
+    manifest_name = out_pref + '_manifest.tsv'
+    with open(manifest_name, 'w') as f:
+        for pref, single_end in groups:
+            f.write('%s\t%d\n' % (pref, int(single_end)))
+
+    cmd = [
+        'vdj_asm', 'base-quals-batch',
+        manifest_name,
+        out_pref,
+    ]
+    sys.stderr.write('Running ' + ' '.join(cmd) + '\n')
+
+    tk_subproc.check_call(cmd, cwd=os.getcwd())
+
+    quals = {}
+    with open(out_pref + '.fastq', 'r') as f:
+        for (name, _, qual) in tk_fasta.read_generator_fastq(f):
+            quals[name] = qual
+
+    timings = {}
+    with open(out_pref + '_timings.tsv', 'r') as f:
+        for row in csv.DictReader(f, delimiter='\t'):
+            timings[row['name']] = float(row['seconds'])
+
+    rm_files([manifest_name, out_pref + '.fastq'])
+
+    return out_pref + '.bam', quals, timings
+
+
 def get_consensus_seq(clonotype_name, sel_contigs, best_contig, out_dir, args):
     """Build a consensus sequence from a set of contigs.
 
@@ -448,12 +526,12 @@ def get_consensus_seq(clonotype_name, sel_contigs, best_contig, out_dir, args):
     - args: stage args.
 
     - Return value:
-    A tuple (best_contig_seq, best_contig_quals, consensus_seq, out_bam_name, out_fastq_name, out_fasta_name).
+    A tuple (best_contig_seq, best_contig_quals, consensus_seq, out_fastq_name, out_fasta_name).
     - best_contig_seq/best_contig_quals: the sequence and quals of the best contig
     - consensus_seq: the consensus sequence or None if no consensus could be built.
-    - out_bam_name: Path of BAM with alignments of contigs to consensus seq.
     - out_fastq_name: FASTQ with contig sequences.
     - out_fasta_name: FASTA with consensus sequence.
+    The contigs are aligned against the consensus sequence later, by run_base_quals_batch.
     enough reads for consensus.
     """
 
@@ -547,39 +625,25 @@ def get_consensus_seq(clonotype_name, sel_contigs, best_contig, out_dir, args):
     with open(out_fasta_name, 'w') as f:
         tk_fasta.write_read_fasta(f, clonotype_name, out_seq if out_seq else best_contig_seq)
 
-    # Now align the same reads that were used in vdj_asm against the consensus that you just got.
-    # The output will be in out_dir/<clonotype_name> + '_contigs.bam'
-    cmd = [
-        'vdj_asm', 'base-quals',
-        martian.make_path(clonotype_name + '_contigs'),
-        out_dir,
-        '--single-end'
-    ]
-    sys.stderr.write('Running ' + ' '.join(cmd) + '\n')
-
-    tk_subproc.check_call(cmd, cwd=os.getcwd())
-
-    # Move the BAM of the contigs aligned against the consensus out of the outs
-    # (Will overwrite this bam which was already used as input to assembly).
-    cr_io.move(os.path.join(out_dir, clonotype_name + '_contigs.bam'), out_bam_name)
+    # The assembly input is no longer needed.
+    cr_io.remove(out_bam_name, allow_nonexisting=True)
 
-    return (best_contig_seq, best_contig_quals, out_seq, out_bam_name, out_fastq_name, out_fasta_name)
+    return (best_contig_seq, best_contig_quals, out_seq, out_fastq_name, out_fasta_name)
 
 
-def get_consensus_quals(in_bam, clonotype_name, in_fasta, sel_contigs, contig_umis, out_dir):
-    """Compute base quality scores of a sequence.
+def write_consensus_qual_reads(in_bam, in_fasta, sel_contigs, contig_umis):
+    """Write the reads used to compute the base quality scores of a sequence.
 
     Args:
     - in_bam: bam file to get the list of reads assigned to UMIs on the selected contigs
-    - clonotype_name: Used for naming output files.
+    - in_fasta: FASTA with the sequence. Reads are written next to it.
     - sel_contigs: Contigs that led to the consensus sequence above
     - contig_umis: from contig name to list of umis assigned to that contig
 
     Return value:
-    String with base qualities (in FASTQ format).
+    File prefix to pass to run_base_quals_batch (paired-end).
     """
 
-    pref = re.sub('.fasta', '', os.path.basename(in_fasta))
     fastq1 = re.sub('.fasta', '_1.fastq', in_fasta)
     fastq2 = re.sub('.fasta', '_2.fastq', in_fasta)
 
@@ -641,19 +705,7 @@ def get_consensus_quals(in_bam, clonotype_name, in_fasta, sel_contigs, contig_um
 
     assert(len(sel_reads) > 0)
 
-    cmd = [
-        'vdj_asm', 'base-quals',
-        re.sub('.fasta', '', in_fasta),
-        out_dir
-    ]
-    sys.stderr.write('Running ' + ' '.join(cmd) + '\n')
-
-    tk_subproc.check_call(cmd, cwd=os.getcwd())
-
-    with open(os.path.join(out_dir, pref + '.fastq'), 'r') as f:
-        lines = f.readlines()
-
-    return lines[3].strip()
+    return re.sub('.fasta', '', in_fasta)
 
 
 def annotate_consensus_contig(reference_path, min_score_ratios, min_word_sizes,
@@ -768,6 +820,13 @@ def join(args, outs, chunk_defs, chunk_outs):
     with open(outs.clonotypes, 'w') as f:
         vdj_annot.save_clonotype_info_csv(f, consensus_contigs)
 
+    timing_fns = [chunk_out.consensus_timings for chunk_out in chunk_outs
+                  if chunk_out.consensus_timings and os.path.isfile(chunk_out.consensus_timings)]
+    if timing_fns:
+        cr_io.concatenate_headered_files(outs.consensus_timings, timing_fns)
+    else:
+        outs.consensus_timings = None
+
     outs.chunked_consensus_bams = []
     outs.chunked_concat_ref_bams = []
 
@@ -776,10 +835,6 @@ def concatenate_and_index_fastas(out_fasta, fastas):
     cr_io.concatenate_files(out_fasta, fastas)
     tk_subproc.check_call(['samtools', 'faidx', out_fasta], cwd=os.getcwd())
 
-def concatenate_bams(out_bam, bams):
-    # Drop the UMI tag since it's useless
-    vdj_utils.concatenate_and_fix_bams(out_bam, bams, drop_tags=[PROCESSED_UMI_TAG])
-
 def concatenate_sort_and_index_bams(out_bam, bams):
     tmp_bam = out_bam.replace('.bam', '_tmp.bam')
     # Drop the UMI tag since it's useless
@@ -52,6 +52,9 @@ stage ASSEMBLE_VDJ(
 MEM_BYTES_PER_READ = 15000
 MAX_READS_PER_BC = 200000
 
+# Barcodes assembled in parallel by each chunk
+ASSEMBLY_THREADS = 4
+
 # Merge output bams in chunks of N
 MERGE_BAMS_N = 64
 
@@ -66,7 +69,8 @@ def run_assembly(fastq_pref, fasta_pref, args):
         '--score-factor=' + str(args.score_factor),
         '--qual-factor=' + str(args.qual_factor),
         '--min-sw-score=' + str(args.min_sw_score),
-        '--rt-error=' + str(args.rt_error)]
+        '--rt-error=' + str(args.rt_error),
+        '--threads=' + str(args.__threads)]
 
     if not cr_chem.has_umis(args.chemistry_def):
         martian.log_info('Assembly without UMIs is not fully supported.')
@@ -101,21 +105,26 @@ def split(args):
                 _, reads = line.strip().split()
                 reads_per_bc.append(float(reads) * subsample_rate)
 
-        max_reads = np.max(reads_per_bc + [0.0])
-
         # vdj_asm is hard-coded to use a maximum of 200k reads / BC.
-        max_reads = min(MAX_READS_PER_BC, max_reads)
+        capped_reads = np.minimum(np.array(reads_per_bc + [0.0]), MAX_READS_PER_BC)
+
+        # Up to ASSEMBLY_THREADS barcodes are assembled at once, so bound by the largest ones.
+        max_reads = np.sum(np.sort(capped_reads)[-ASSEMBLY_THREADS:])
 
         # The assembly step takes roughly num_reads * MEM_BYTES_PER_READ bytes of memory to complete each BC.
+        # A user-specified mem_gb is sized for assembling one barcode at a time.
         if args.mem_gb is None:
             mem_gb = max(2, int(np.ceil(MEM_BYTES_PER_READ * max_reads / 1e9)))
+            threads = ASSEMBLY_THREADS
         else:
             mem_gb = args.mem_gb
+            threads = 1
 
         chunks.append({
             'chunked_bam': bam,
             'gem_group': gem_group,
             '__mem_gb': mem_gb,
+            '__threads': threads,
         })
 
     if not chunks:
@@ -45,6 +45,10 @@ stage BUCKET_FASTQ_BY_BC(
 # when reads fall below the kmer length. Namely reads will go blank.
 MIN_READ_LENGTH = 50
 
+# Memory budget for reads buffered before spilling sorted runs to disk
+BUCKET_BUFFER_GB = 1.0
+COMPRESS_SPILLS = True
+
 def split(args):
     paired_end = cr_chem.is_paired_end(args.chemistry_def)
 
@@ -81,7 +85,7 @@ def split(args):
             'read2s_chunk': fastq2 if paired_end else None,
             'bcs': bcs,
             'chunks_per_gem_group': chunks_per_gem_group,
-            '__mem_gb': 6,
+            '__mem_gb': 3,
         })
     return {'chunks': chunks, 'join': {'__mem_gb': 2}}
 
@@ -127,14 +131,15 @@ def main(args, outs):
     bc_file = cr_io.open_maybe_gzip(args.bcs)
     bcs = (line.strip() for line in bc_file)
 
-    buckets = {}
-
     bucket_filenames = {}
 
     for gem_group, bucket_name in enumerate_bucket_names(args.chunks_per_gem_group):
         filename = martian.make_path("%s.fastq" % bucket_name)
         bucket_filenames[bucket_name] = filename
-        buckets[bucket_name] = []
+
+    writer = vdj_utils.FastqBucketWriter(bucket_filenames,
+                                         max_buffer_bytes=int(BUCKET_BUFFER_GB * 1e9),
+                                         compress_spills=COMPRESS_SPILLS)
 
     for read1, read2, barcode in itertools.izip_longest(read1s, read2s, bcs):
         # Exclude unbarcoded reads
@@ -145,41 +150,25 @@ def main(args, outs):
         if len(read1[1]) < MIN_READ_LENGTH or (read2 is not None and len(read2[1]) < MIN_READ_LENGTH):
             continue
 
-        # Attach processed barcode to reads
-        r1_hdr = cr_fastq.AugmentedFastqHeader(read1[0])
-        r1_hdr.set_tag(cr_constants.PROCESSED_BARCODE_TAG, barcode)
-        r1_new_qname = r1_hdr.to_string()
-
-        if paired_end:
-            r2_hdr = cr_fastq.AugmentedFastqHeader(read2[0])
-            r2_hdr.set_tag(cr_constants.PROCESSED_BARCODE_TAG, barcode)
-            r2_new_qname = r2_hdr.to_string()
-
         barcode_seq, gem_group = cr_utils.split_barcode_seq(barcode)
         bucket_name = get_bucket_name(gem_group, barcode_seq, args.chunks_per_gem_group[gem_group])
 
-        buckets[bucket_name].append((r1_new_qname, read1[1], read1[2]))
+        # Attach processed barcode to reads
+        r1_new_qname = cr_fastq.AugmentedFastqHeader.set_header_tag(read1[0], cr_constants.PROCESSED_BARCODE_TAG, barcode)
+        writer.write(bucket_name, barcode, cr_fastq.AugmentedFastqHeader.strip_header_tags(read1[0]),
+                     r1_new_qname, read1[1], read1[2])
+
         if paired_end:
-            buckets[bucket_name].append((r2_new_qname, read2[1], read2[2]))
+            r2_new_qname = cr_fastq.AugmentedFastqHeader.set_header_tag(read2[0], cr_constants.PROCESSED_BARCODE_TAG, barcode)
+            writer.write(bucket_name, barcode, cr_fastq.AugmentedFastqHeader.strip_header_tags(read2[0]),
+                         r2_new_qname, read2[1], read2[2])
 
-    outs.buckets = {}
+    martian.log_info('Spilled buffered reads to disk %d times' % writer.num_spills)
 
     # Sort and write each bucket
-    for bucket_name, bucket in buckets.iteritems():
-        bucket.sort(key=vdj_utils.fastq_barcode_sort_key)
-
-        # Don't create empty bucket files.
-        # This is common when the reads are ordered by gem group
-        # And a chunk sees only a single gem group.
-        if len(bucket) == 0:
-            continue
-
-        filename = bucket_filenames[bucket_name]
-        with cr_io.open_maybe_gzip(filename, 'w') as f:
-            for read in bucket:
-                tk_fasta.write_read_fastq(f, *read)
-
-        outs.buckets[bucket_name] = bucket_filenames[bucket_name]
+    # Empty buckets are not written. This is common when the reads are ordered
+    # by gem group and a chunk sees only a single gem group.
+    outs.buckets = writer.close()
 
 def join(args, outs, chunk_defs, chunk_outs):
     outs.coerce_strings()
@@ -133,30 +133,19 @@ def call_cell_barcodes(umi_info_path, gem_group):
 
     # Get umi info for this gem group only
     bc_str = vdj_umi_info.get_column(umi_info_path, 'barcodes')
-    bc_gg = np.array([int(cr_utils.split_barcode_seq(bc)[1]) for bc in bc_str])
-    bc_in_gg = bc_gg == gem_group
+    bc_in_gg = vdj_umi_info.get_barcode_gem_groups(bc_str) == gem_group
 
     umi_info = vdj_umi_info.read_umi_info(umi_info_path)
-    umi_barcode_idx = []
-    umi_read_pairs = []
-    for bc_idx, data_iter in itertools.groupby(itertools.izip(umi_info['barcode_idx'],
-                                                              umi_info['umi_idx'],
-                                                              umi_info['reads']),
-                                              key=lambda x: x[0]):
-        if not bc_in_gg[bc_idx]:
-            continue
-
-        bc_umi_read_pairs = {}
-        for _, umi, reads in data_iter:
-            bc_umi_read_pairs[umi] = bc_umi_read_pairs.get(umi, 0) + reads
-
-        for r in bc_umi_read_pairs.itervalues():
-            umi_barcode_idx.append(bc_idx)
-            umi_read_pairs.append(r)
+    umi_barcode_idx, umi_read_pairs = vdj_umi_info.get_umi_read_pairs(umi_info['barcode_idx'],
+                                                                      umi_info['umi_idx'],
+                                                                      umi_info['reads'])
+    use_umis = bc_in_gg[umi_barcode_idx]
+    umi_barcode_idx = umi_barcode_idx[use_umis]
+    umi_read_pairs = umi_read_pairs[use_umis]
 
     rpu_threshold, umi_threshold, bc_support, confidence = vdj_stats.call_vdj_cells(
-        umi_barcode_idx=np.array(umi_barcode_idx, dtype=vdj_umi_info.get_dtype('barcode_idx')),
-        umi_read_pairs=np.array(umi_read_pairs, dtype=vdj_umi_info.get_dtype('reads')),
+        umi_barcode_idx=umi_barcode_idx.astype(vdj_umi_info.get_dtype('barcode_idx')),
+        umi_read_pairs=umi_read_pairs.astype(vdj_umi_info.get_dtype('reads')),
         barcodes=bc_str,
         rpu_mix_init_sd=RPU_MIX_INIT_SD,
         umi_mix_init_sd=UMI_MIX_INIT_SD,
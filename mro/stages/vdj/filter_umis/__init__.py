@@ -9,10 +9,8 @@ import tenkit.stats as tk_stats
 import cellranger.h5_constants as h5_constants
 import cellranger.library_constants as lib_constants
 import cellranger.report as cr_report
-import cellranger.utils as cr_utils
 import cellranger.vdj.report as vdj_report
 import cellranger.vdj.umi_info as vdj_umi_info
-import itertools
 
 __MRO__ = """
 stage FILTER_UMIS(
@@ -42,37 +40,31 @@ def split(args):
     barcode_indices = vdj_umi_info.get_column(args.umi_info, 'barcode_idx')
     barcodes = vdj_umi_info.get_column(args.umi_info, 'barcodes')
 
+    # Start a new chunk wherever the gem group changes
+    row_gem_groups = vdj_umi_info.get_barcode_gem_groups(barcodes)[barcode_indices]
+    chunk_starts = 1 + np.flatnonzero(row_gem_groups[1:] != row_gem_groups[:-1])
+
     chunks = []
 
     start_row = 0
-    prev_gem_group = None
-    prev_barcode_idx = None
-
-    for row, barcode_idx in enumerate(barcode_indices):
-        if barcode_idx == prev_barcode_idx:
-            continue
-
-        _, gem_group = cr_utils.split_barcode_seq(barcodes[barcode_idx])
+    prev_gem_group = int(row_gem_groups[0]) if len(row_gem_groups) > 0 else None
 
-        if prev_gem_group is not None and gem_group != prev_gem_group:
-            # Write complete chunk
-            end_row = row
-            mem_gb = max(h5_constants.MIN_MEM_GB,
-                         2*int(np.ceil(vdj_umi_info.get_mem_gb(args.umi_info,
-                                                               start_row=start_row,
-                                                               end_row=end_row))))
+    for end_row in chunk_starts.tolist():
+        # Write complete chunk
+        mem_gb = max(h5_constants.MIN_MEM_GB,
+                     2*int(np.ceil(vdj_umi_info.get_mem_gb(args.umi_info,
+                                                           start_row=start_row,
+                                                           end_row=end_row))))
 
-            chunks.append({
-                'gem_group': prev_gem_group,
-                'start_row': start_row,
-                'end_row': end_row,
-                '__mem_gb': mem_gb,
-            })
+        chunks.append({
+            'gem_group': prev_gem_group,
+            'start_row': start_row,
+            'end_row': end_row,
+            '__mem_gb': mem_gb,
+        })
 
-            start_row = end_row
-
-        prev_gem_group = gem_group
-        prev_barcode_idx = barcode_idx
+        start_row = end_row
+        prev_gem_group = int(row_gem_groups[start_row])
 
     # Write final chunk
     end_row = vdj_umi_info.get_num_rows(args.umi_info)
@@ -106,29 +98,34 @@ def main(args, outs):
     umi_info = vdj_umi_info.read_umi_info(args.umi_info, args.start_row, args.end_row)
     chains = umi_info['chains']
     barcodes = umi_info['barcodes']
-    bc_gg = [str(cr_utils.split_barcode_seq(bc)[1]) for bc in barcodes]
-    # Compute N50 read pairs per UMI for this gem group
-    umi_read_pairs = []
+    bc_gg = vdj_umi_info.get_barcode_gem_groups(barcodes)
+
+    chain_idx = umi_info['chain_idx']
+    reads = umi_info['reads'].astype(np.int64)
+
+    # Min read pairs per UMI for each row, from the gem group of its barcode
+    row_gg = bc_gg[umi_info['barcode_idx']]
+    min_read_pairs = np.zeros(len(reads), dtype=np.int64)
+    for gg in np.unique(row_gg).tolist():
+        min_read_pairs[row_gg == gg] = args.min_readpairs_per_umi[str(gg)]
+    bad_reads = reads < min_read_pairs
+
+    chain_read_pairs = np.bincount(chain_idx, weights=reads, minlength=len(chains)).astype(np.int64)
+    chain_bad_read_pairs = np.bincount(chain_idx[bad_reads], weights=reads[bad_reads], minlength=len(chains)).astype(np.int64)
+
     total_read_pairs = {}
-    chain_bad_read_pairs = {}
-    for bc_idx, data_iter in itertools.groupby(itertools.izip(umi_info['barcode_idx'],
-                                                              umi_info['umi_idx'],
-                                                              umi_info['chain_idx'],
-                                                              umi_info['reads']),
-                                              key=lambda x: x[0]):
-
-        bc_umi_read_pairs = {}
-        for _, umi, chain_idx, reads in data_iter:
-            bc_umi_read_pairs[umi] = bc_umi_read_pairs.get(umi, 0) + reads
-            chain = chains[chain_idx]
-            total_read_pairs[chain] = total_read_pairs.get(chain, 0) + reads
-            total_read_pairs[cr_constants.MULTI_REFS_PREFIX] = total_read_pairs.get(cr_constants.MULTI_REFS_PREFIX, 0) + reads
-            if reads < args.min_readpairs_per_umi[bc_gg[bc_idx]]:
-                chain_bad_read_pairs[chain] = chain_bad_read_pairs.get(chain, 0) + reads
-                chain_bad_read_pairs[cr_constants.MULTI_REFS_PREFIX] = chain_bad_read_pairs.get(cr_constants.MULTI_REFS_PREFIX, 0) + reads
-
-        for r in bc_umi_read_pairs.itervalues():
-            umi_read_pairs.append(r)
+    bad_read_pairs = {}
+    for i in np.unique(chain_idx).tolist():
+        total_read_pairs[chains[i]] = chain_read_pairs[i]
+        bad_read_pairs[chains[i]] = chain_bad_read_pairs[i]
+    if len(chain_idx) > 0:
+        total_read_pairs[lib_constants.MULTI_REFS_PREFIX] = chain_read_pairs.sum()
+        bad_read_pairs[lib_constants.MULTI_REFS_PREFIX] = chain_bad_read_pairs.sum()
+
+    # Compute N50 read pairs per UMI for this gem group
+    _, umi_read_pairs = vdj_umi_info.get_umi_read_pairs(umi_info['barcode_idx'],
+                                                        umi_info['umi_idx'],
+                                                        umi_info['reads'])
 
     rppu_n50 = tk_stats.NX(umi_read_pairs, 0.5)
     if rppu_n50 is None:
@@ -136,7 +133,7 @@ def main(args, outs):
 
     # Report bad read-pairs/umi
     for chain in reporter.vdj_genes:
-        bad_count = chain_bad_read_pairs.get(chain, 0)
+        bad_count = bad_read_pairs.get(chain, 0)
         total_count = total_read_pairs.get(chain, 0)
         reporter._get_metric_attr('vdj_recombinome_low_support_reads_frac', chain).set_value(bad_count, total_count)
 
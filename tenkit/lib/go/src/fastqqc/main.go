@@ -0,0 +1,253 @@
+package main
+
+// Copyright (c) 2018 10x Genomics, Inc. All rights reserved.
+
+import (
+	"encoding/json"
+	"github.com/10XGenomics/docopt"
+	"io"
+	"io/ioutil"
+	"log"
+	"strconv"
+	"strings"
+	"tenkit/barcode"
+	"tenkit/fastq"
+)
+
+// Same output format as barcodeqc
+type BarcodeInfo struct {
+	BarcodeQ30BaseCount        int64          `json:"q30_base_count"`
+	ExactBarcodeMatchCount     int            `json:"exact_match_count"`
+	CorrectedBarcodeMatchCount int            `json:"corrected_match_count"`
+	TotalBaseCount             int64          `json:"total_base_count"`
+	TotalReadCount             int            `json:"total_read_count"`
+	ValidatedBarcodeCounts     map[string]int `json:"validated_sequence_counts"`
+	MeanBaseQualityScore       float64        `json:"mean_base_qscore"`
+}
+
+// Same output format as q30count
+type QualityInfo struct {
+	Q30BaseCount   int64 `json:"q30_base_count"`
+	TotalBaseCount int64 `json:"total_base_count"`
+}
+
+const READ_TO_END = -1
+
+// Must match the validator parameters used by barcodeqc
+const MAX_EXPECTED_BARCODE_ERRORS = 1.0
+const BARCODE_CONFIDENCE_THRESHOLD = 0.975
+
+type BarcodeQC struct {
+	counter    *barcode.BarcodeCounter
+	startIndex int
+	length     int
+	rc         bool
+
+	correctedCounts   map[string]int
+	validBarcodeCount int
+	// Off-whitelist barcodes that may be corrected once the whitelist
+	// barcode distribution is known, keyed by barcode + "\t" + qual.
+	pending map[string]int
+}
+
+type Q30QC struct {
+	startIndex     int
+	length         int
+	q30BaseCount   int64
+	totalBaseCount int64
+}
+
+/**
+ * Count a barcode in a single pass. Whether a barcode is valid only depends on
+ * the final barcode distribution if it is off the whitelist and has few enough
+ * expected errors to be corrected, so only those barcodes are kept for
+ * correction after the pass. This gives the same counts as barcodeqc, which
+ * reads the FASTQ twice.
+ */
+func (qc *BarcodeQC) count(read *fastq.FastqRecord) {
+	seq := read.Seq
+	if qc.rc {
+		seq = fastq.ReverseComplementSeq(seq)
+	}
+	bclen := qc.length
+	if len(seq) < qc.length {
+		bclen = len(seq)
+	}
+	bc := string(seq[qc.startIndex : qc.startIndex+bclen])
+	bcQual := read.Qual[qc.startIndex : qc.startIndex+bclen]
+	qc.counter.CountBarcode(bc, bcQual)
+
+	if !qc.counter.HasWhitelist() {
+		if len(bc) > 1 {
+			qc.correctedCounts[bc] += 1
+			qc.validBarcodeCount += 1
+		}
+		return
+	}
+	if barcode.ExpectedErrors(bcQual) >= MAX_EXPECTED_BARCODE_ERRORS {
+		return
+	}
+	if qc.counter.InWhitelist(bc) {
+		qc.correctedCounts[bc] += 1
+		qc.validBarcodeCount += 1
+	} else {
+		qc.pending[bc+"\t"+string(bcQual)] += 1
+	}
+}
+
+func (qc *BarcodeQC) finish() *BarcodeInfo {
+	validator := qc.counter.GetBarcodeValidator(MAX_EXPECTED_BARCODE_ERRORS, BARCODE_CONFIDENCE_THRESHOLD)
+	for key, count := range qc.pending {
+		sep := strings.IndexByte(key, '\t')
+		correctedBarcode, valid := validator.ValidateBarcode(key[:sep], []byte(key[sep+1:]))
+		if valid {
+			qc.correctedCounts[string(correctedBarcode)] += count
+			qc.validBarcodeCount += count
+		}
+	}
+
+	return &BarcodeInfo{
+		BarcodeQ30BaseCount:        qc.counter.GetQ30BaseCount(),
+		TotalBaseCount:             qc.counter.GetTotalBaseCount(),
+		TotalReadCount:             qc.counter.GetTotalCount(),
+		ExactBarcodeMatchCount:     qc.counter.GetTotalCount() - qc.counter.GetMismatchCount(),
+		MeanBaseQualityScore:       qc.counter.GetMeanBaseQualityScore(),
+		CorrectedBarcodeMatchCount: qc.validBarcodeCount,
+		ValidatedBarcodeCounts:     qc.correctedCounts,
+	}
+}
+
+func (qc *Q30QC) count(read *fastq.FastqRecord) {
+	endIndex := qc.startIndex + qc.length
+	if qc.length == READ_TO_END {
+		endIndex = len(read.Seq)
+	}
+	for _, qual := range read.Qual[qc.startIndex:endIndex] {
+		if uint32(qual)-33 >= 30 {
+			qc.q30BaseCount += 1
+		}
+		qc.totalBaseCount += 1
+	}
+}
+
+func (qc *Q30QC) finish() *QualityInfo {
+	return &QualityInfo{Q30BaseCount: qc.q30BaseCount, TotalBaseCount: qc.totalBaseCount}
+}
+
+func writeJson(path string, value interface{}) {
+	data, err := json.Marshal(value)
+	if err != nil {
+		log.Fatal("ERROR: Failed to serialize QC information: ", err.Error())
+	}
+	if err := ioutil.WriteFile(path, data, 0755); err != nil {
+		log.Fatal("ERROR: Failed to write QC file: ", err.Error())
+	}
+}
+
+func parseIntOpt(opts map[string]interface{}, name string, defaultValue int) int {
+	value := opts[name]
+	if value == nil {
+		return defaultValue
+	}
+	intValue, err := strconv.Atoi(value.(string))
+	if err != nil {
+		log.Fatal("ERROR: " + name + " argument must be an integer.")
+	}
+	return intValue
+}
+
+func main() {
+	doc := `Tenkit FASTQ QC.
+
+Computes barcode QC (as barcodeqc) and Q30 counts (as q30count) with a single
+decompression pass over the FASTQ.
+
+Usage:
+    fastqqc <fastq_path> [options]
+    fastqqc -h | --help | --version
+Options:
+    --barcode-json=PATH     Write barcode QC to this file.
+    --bc-start-index=NUM    The starting index of the barcode in the read.
+    --bc-length=NUM         The length of the barcode in the read.
+    --rc                    Process the reverse complement of the barcode.
+    --whitelist=PATH        The path to the barcode whitelist.
+    --q30-json=PATH         Write Q30 counts to this file.
+    --read-start-index=NUM  The starting index of the read to consider for Q30 counts.
+    -h --help               Show this message.
+    --version               Show version.
+`
+	opts, _ := docopt.Parse(doc, nil, true, "0.1", false)
+
+	inputFastq := opts["<fastq_path>"].(string)
+
+	var barcodeQC *BarcodeQC
+	var barcodeJson string
+	if value := opts["--barcode-json"]; value != nil {
+		barcodeJson = value.(string)
+		whitelistValue := opts["--whitelist"]
+		if whitelistValue == nil {
+			log.Fatal("ERROR: Must supply --whitelist argument")
+		}
+		whitelist := whitelistValue.(string)
+		if opts["--bc-length"] == nil {
+			log.Fatal("ERROR: Must supply --bc-length argument")
+		}
+		if whitelist != barcode.BLANK_WHITELIST_FILE {
+			if _, err := ioutil.ReadFile(whitelist); err != nil {
+				log.Fatal("ERROR: Unable to read barcode whitelist: ", err.Error())
+			}
+		}
+		barcodeQC = &BarcodeQC{
+			counter:         barcode.NewBarcodeCounter(whitelist),
+			startIndex:      parseIntOpt(opts, "--bc-start-index", 0),
+			length:          parseIntOpt(opts, "--bc-length", 16),
+			rc:              opts["--rc"].(bool),
+			correctedCounts: make(map[string]int),
+			pending:         make(map[string]int),
+		}
+	}
+
+	var q30QC *Q30QC
+	var q30Json string
+	if value := opts["--q30-json"]; value != nil {
+		q30Json = value.(string)
+		q30QC = &Q30QC{
+			startIndex: parseIntOpt(opts, "--read-start-index", 0),
+			length:     READ_TO_END,
+		}
+	}
+
+	if barcodeQC == nil && q30QC == nil {
+		log.Fatal("ERROR: Must supply --barcode-json and/or --q30-json")
+	}
+
+	// The barcode is reverse complemented by BarcodeQC if needed, so that
+	// Q30 counts see the read as it is in the file.
+	fastqReader, err := fastq.NewFastqReader(inputFastq, false)
+	if err != nil {
+		log.Fatal("ERROR: Unable to open FASTQ file: ", err.Error())
+	}
+	var read fastq.FastqRecord
+	for {
+		err := fastqReader.ReadRecord(&read)
+		if err == io.EOF {
+			break
+		} else if err != nil {
+			log.Fatal("ERROR: Could not process FASTQ file ", err.Error())
+		}
+		if barcodeQC != nil {
+			barcodeQC.count(&read)
+		}
+		if q30QC != nil {
+			q30QC.count(&read)
+		}
+	}
+	fastqReader.Close()
+
+	if barcodeQC != nil {
+		writeJson(barcodeJson, *barcodeQC.finish())
+	}
+	if q30QC != nil {
+		writeJson(q30Json, *q30QC.finish())
+	}
+}
@@ -118,6 +118,18 @@ func (c *BarcodeCounter) GetWhitelistBarcodeCount() []int {
 	return whitelistBarcodeCounts
 }
 
+func (c *BarcodeCounter) HasWhitelist() bool {
+	return c.whitelistExists
+}
+
+func (c *BarcodeCounter) InWhitelist(barcode string) bool {
+	if !c.whitelistExists {
+		return false
+	}
+	_, ok := c.barcodeCounts[barcode]
+	return ok
+}
+
 func (c *BarcodeCounter) GetMismatchCount() int {
 	return c.mismatchCount
 }
@@ -302,10 +314,7 @@ func (v *BarcodeValidator) ValidateBarcode(barcode string, qual []byte) ([]byte,
 	if !v.whitelist_exists && len(barcode) > 1 {
 		return []byte(barcode), true
 	}
-	expected_errors := 0.0
-	for i := 0; i < len(qual); i++ {
-		expected_errors += probability(qual[i])
-	}
+	expected_errors := ExpectedErrors(qual)
 	_, in_whitelist := v.whitelist[barcode]
 	if !in_whitelist {
 		newBarcode, corrected := v.correctBarcode(barcode, qual)
@@ -319,6 +328,17 @@ func (v *BarcodeValidator) ValidateBarcode(barcode string, qual []byte) ([]byte,
 	return []byte(barcode), false
 }
 
+/**
+ * Expected number of sequencing errors given the base qualities.
+ */
+func ExpectedErrors(qual []byte) float64 {
+	expected_errors := 0.0
+	for i := 0; i < len(qual); i++ {
+		expected_errors += probability(qual[i])
+	}
+	return expected_errors
+}
+
 func probability(qual byte) float64 {
 	return math.Pow(10, -(float64(uint32(qual)-33.0))/10.0) //33 is the illumina qual offset
 }
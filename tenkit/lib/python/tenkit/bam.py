@@ -19,6 +19,7 @@ import csv
 import striped_smith_waterman.ssw_wrap as ssw_wrap
 import bisect
 import os.path
+from multiprocessing.pool import ThreadPool
 
 DEFAULT_RG_STRING = 'None:None:None:None:None'
 
@@ -245,7 +246,7 @@ def sort_and_index(file_name, sorted_prefix=None):
     log_subprocess.check_call(['samtools','sort', '-o', sorted_name, file_name])
     pysam.index(sorted_name)
 
-def _merge_by_tag(output_bam, input_bams, tag, name=False, threads=1):
+def _merge_by_tag(output_bam, input_bams, tag, name=False, threads=1, region=None):
     # Note the original samtools merge call can
     # fail if the total length of the command line
     # gets too long. Use the -b option and pass
@@ -264,6 +265,9 @@ def _merge_by_tag(output_bam, input_bams, tag, name=False, threads=1):
         args.append("-n")
     if tag is not None:
         args.extend(["-t", str(tag)])
+    if region is not None:
+        # requires indexed inputs
+        args.extend(["-R", str(region)])
     args.extend(["-b", fofn, output_bam])
 
     log_subprocess.check_call(args)
@@ -311,6 +315,71 @@ def merge_by_tag(output_bam, input_bams, tag, name=False, threads=1):
 def merge(out_file_name, input_file_names, threads=1):
     merge_by_tag(out_file_name, input_file_names, None, False, threads)
 
+def get_merge_regions(input_bams):
+    """ Plan a region-parallel merge of position-sorted, indexed bam files.
+        Returns (regions, nocoor_reads), where regions is a list of (reference name, num_reads)
+        in output order and nocoor_reads is the number of reads without a coordinate in each
+        input. References with no reads in any input are skipped. """
+    ref_reads = None
+    nocoor_reads = []
+
+    for input_bam in input_bams:
+        bam = pysam.Samfile(input_bam, check_sq=False)
+        stats = bam.get_index_statistics()
+        if ref_reads is None:
+            ref_reads = [[stat.contig, 0] for stat in stats]
+        for i, stat in enumerate(stats):
+            ref_reads[i][1] += stat.total
+        nocoor_reads.append(bam.nocoordinate)
+        bam.close()
+
+    regions = [(contig, num_reads) for contig, num_reads in (ref_reads or []) if num_reads > 0]
+    return regions, nocoor_reads
+
+def merge_by_region(out_file_name, input_file_names, threads=1):
+    """ Merge position-sorted, indexed bam files by running one merge per
+        reference in parallel and concatenating the results in reference order.
+        Reads without a coordinate are extracted from each input and appended in input order.
+        Each of the 'threads' concurrent merges opens every input, so
+        threads * len(input_file_names) must be within the open-file limit. """
+    regions, nocoor_reads = get_merge_regions(input_file_names)
+    nocoor_inputs = [(input_bam, num_reads) for input_bam, num_reads in zip(input_file_names, nocoor_reads)
+                     if num_reads > 0]
+
+    # Nothing to split; produces a valid (possibly empty) bam with a merged header
+    if len(regions) == 0 or (len(regions) == 1 and len(nocoor_inputs) == 0):
+        merge(out_file_name, input_file_names, threads)
+        return
+
+    tmp_dir = os.path.dirname(out_file_name)
+    region_bams = [os.path.join(tmp_dir, "region-%d.bam" % i) for i in xrange(len(regions))]
+    nocoor_bams = [os.path.join(tmp_dir, "nocoor-%d.bam" % i) for i in xrange(len(nocoor_inputs))]
+
+    def merge_region(i):
+        _merge_by_tag(region_bams[i], input_file_names, None, False, 1, region=regions[i][0])
+
+    # samtools merge -R does not accept '*', so view each input's unplaced reads instead
+    def extract_nocoor(i):
+        log_subprocess.check_call(['samtools', 'view', '-b', '-o', nocoor_bams[i], nocoor_inputs[i][0], '*'])
+
+    tasks = [(num_reads, merge_region, i) for i, (_, num_reads) in enumerate(regions)]
+    tasks.extend((num_reads, extract_nocoor, i) for i, (_, num_reads) in enumerate(nocoor_inputs))
+
+    # Start the largest tasks first so that they don't finish last
+    tasks.sort(key=lambda task: task[0], reverse=True)
+
+    pool = ThreadPool(max(1, threads))
+    try:
+        pool.map(lambda task: task[1](task[2]), tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    concatenate(out_file_name, region_bams + nocoor_bams)
+
+    for tmp_bam in region_bams + nocoor_bams:
+        os.remove(tmp_bam)
+
 def bam_is_empty(fn):
     if os.path.getsize(fn) > 1000000:
         return False
@@ -988,6 +1057,10 @@ def read_contains_allele(ref, allele, pos, read, reference_pyfasta, cigar, cigar
             return True
     return False
 
+BAM_KEY_INDEX_MAGIC = 'BAMKIDX1'
+# magic, number of keys, key width in bytes
+BAM_KEY_INDEX_HEADER = struct.Struct('<8sQQ')
+
 class BamIndex:
     def __init__(self, file_name, file_suffix, key_func, cmp_func):
         self.file_name = file_name
@@ -997,10 +1070,12 @@ class BamIndex:
         self.index_file_name = file_name + '.' + file_suffix
         self.in_bam = create_bam_infile(file_name)
 
-    def save_key_index(self):
-        f = open(self.index_file_name, 'w')
-        out_index = csv.writer(f, delimiter='\t')
+        # Keys sorted lexicographically and their virtual offsets
+        self.key_array = None
+        self.offset_array = None
 
+    def iter_key_offsets(self):
+        ''' Yield (key, virtual_offset) for the first read of every distinct key. '''
         self.in_bam.reset()
 
         last_key = None
@@ -1008,7 +1083,7 @@ class BamIndex:
         for i, read in enumerate(self.in_bam):
             if i == 0:
                 last_key = self.key_func(read)
-                out_index.writerow((last_key, last_pos))
+                yield last_key, last_pos
             else:
                 key = self.key_func(read)
                 cmp_value = self.cmp_func(key, last_key)
@@ -1017,46 +1092,132 @@ class BamIndex:
                     print "idx: %i, key: %s, last_key: %s" % (i, str(key), str(last_key))
                     raise Exception("BAM file %s is not sorted by key" % self.file_name)
                 elif cmp_value != 0:
-                    out_index.writerow((key, last_pos))
+                    yield key, last_pos
                     last_key = key
 
             last_pos = self.in_bam.tell()
 
+    def save_key_index(self, binary=False):
+        ''' Write the key index. If binary is set, write the compact binary format
+            (fixed-width keys + uint64 virtual offsets) instead of tab-separated text. '''
+        if binary:
+            self.save_binary_key_index()
+            return
+
+        f = open(self.index_file_name, 'w')
+        out_index = csv.writer(f, delimiter='\t')
+        for key, pos in self.iter_key_offsets():
+            out_index.writerow((key, pos))
         f.close()
 
-    def load_key_index(self):
+    def save_binary_key_index(self):
+        keys = []
+        offsets = []
+        for key, pos in self.iter_key_offsets():
+            keys.append(key if key is not None else '')
+            offsets.append(pos)
+
+        key_array = np.array(keys, dtype='S%d' % max(1, max(len(k) for k in keys) if keys else 1))
+        offset_array = np.array(offsets, dtype='<u8')
+        del keys, offsets
+
+        # Store keys in byte order so lookups can use np.searchsorted regardless of cmp_func
+        order = np.argsort(key_array, kind='mergesort')
+        key_array = key_array[order]
+        offset_array = offset_array[order]
+
+        with open(self.index_file_name, 'wb') as f:
+            f.write(BAM_KEY_INDEX_HEADER.pack(BAM_KEY_INDEX_MAGIC, len(key_array), key_array.dtype.itemsize))
+            key_array.tofile(f)
+            offset_array.tofile(f)
+
+    def load_key_index(self, mmap=False):
+        ''' Load either a text or binary key index. If mmap is set, a binary index is
+            memory-mapped rather than read into memory. '''
+        with open(self.index_file_name, 'rb') as f:
+            magic = f.read(len(BAM_KEY_INDEX_MAGIC))
+
+        if magic == BAM_KEY_INDEX_MAGIC:
+            self.load_binary_key_index(mmap=mmap)
+        else:
+            self.load_text_key_index()
+
+    def load_text_key_index(self):
         f = open(self.index_file_name, 'r')
         in_index = csv.reader(f, delimiter='\t')
 
-        self.keys = []
+        keys = []
+        offsets = []
         for row in in_index:
             if len(row) != 2:
                 raise Exception("BAM index file %s has incorrect format" % self.index_file_name)
             key, pos = row
             if not pos.isdigit():
                 raise Exception("BAM index file %s has incorrect format" % self.index_file_name)
-            self.keys.append((key, long(pos)))
+            keys.append(key)
+            offsets.append(long(pos))
 
         f.close()
 
-    def get_reads_iter_with_key(self, key):
-        # Binary search through keys
-        low, high = 0, len(self.keys)
-        while low < high:
-            mid = (low + high) / 2
-            mid_key, _ = self.keys[mid]
-
-            cmp_value = self.cmp_func(mid_key, key)
-            if cmp_value < 0:
-                low = mid + 1
-            elif cmp_value > 0:
-                high = mid
+        key_array = np.array(keys, dtype='S%d' % max(1, max(len(k) for k in keys) if keys else 1))
+        offset_array = np.array(offsets, dtype='<u8')
+        order = np.argsort(key_array, kind='mergesort')
+        self.key_array = key_array[order]
+        self.offset_array = offset_array[order]
+
+    def load_binary_key_index(self, mmap=False):
+        with open(self.index_file_name, 'rb') as f:
+            header = f.read(BAM_KEY_INDEX_HEADER.size)
+            if len(header) != BAM_KEY_INDEX_HEADER.size:
+                raise Exception("BAM index file %s has incorrect format" % self.index_file_name)
+            magic, num_keys, key_width = BAM_KEY_INDEX_HEADER.unpack(header)
+            if magic != BAM_KEY_INDEX_MAGIC:
+                raise Exception("BAM index file %s has incorrect format" % self.index_file_name)
+
+            expected_size = BAM_KEY_INDEX_HEADER.size + num_keys * (key_width + 8)
+            if os.fstat(f.fileno()).st_size != expected_size:
+                raise Exception("BAM index file %s has incorrect format" % self.index_file_name)
+
+            key_dtype = np.dtype('S%d' % key_width)
+            if num_keys == 0:
+                self.key_array = np.zeros(0, dtype=key_dtype)
+                self.offset_array = np.zeros(0, dtype='<u8')
+            elif mmap:
+                self.key_array = np.memmap(f, dtype=key_dtype, mode='r',
+                                           offset=BAM_KEY_INDEX_HEADER.size, shape=(num_keys,))
+                self.offset_array = np.memmap(f, dtype='<u8', mode='r',
+                                              offset=BAM_KEY_INDEX_HEADER.size + num_keys * key_width,
+                                              shape=(num_keys,))
             else:
-                low, high = mid, mid
-                break
+                self.key_array = np.fromfile(f, dtype=key_dtype, count=num_keys)
+                self.offset_array = np.fromfile(f, dtype='<u8', count=num_keys)
+
+    def get_offsets(self, keys):
+        ''' Return the virtual offset of the first read for each key as an int64 array,
+            with -1 for keys that are not in the index. '''
+        query = np.asarray([k if k is not None else '' for k in keys], dtype=self.key_array.dtype)
+        offsets = np.full(len(query), -1, dtype=np.int64)
+        if len(self.key_array) == 0 or len(query) == 0:
+            return offsets
+
+        idx = np.searchsorted(self.key_array, query)
+        in_range = idx < len(self.key_array)
+        found = np.zeros(len(query), dtype=bool)
+        found[in_range] = self.key_array[idx[in_range]] == query[in_range]
+
+        # Queries longer than the key width are truncated by the dtype and can't be in the index
+        key_width = self.key_array.dtype.itemsize
+        found &= np.array([k is None or len(k) <= key_width for k in keys], dtype=bool)
+
+        offsets[found] = self.offset_array[idx[found]].astype(np.int64)
+        return offsets
+
+    def get_reads_iter_with_key(self, key):
+        pos = self.get_offsets([key])[0]
+        if pos < 0:
+            return
 
-        _, pos = self.keys[low]
-        self.in_bam.seek(pos)
+        self.in_bam.seek(long(pos))
 
         # Iterate through reads to find reads with associated key
         for read in self.in_bam:
@@ -1122,11 +1283,11 @@ class BamQnameIndex(BamIndex):
     def __init__(self, file_name):
         return BamIndex.__init__(self, file_name, 'qname', qname_key_func, qname_cmp_func)
 
-    def save_qname_index(self):
-        BamIndex.save_key_index(self)
+    def save_qname_index(self, binary=False):
+        BamIndex.save_key_index(self, binary=binary)
 
-    def load_qname_index(self):
-        BamIndex.load_key_index(self)
+    def load_qname_index(self, mmap=False):
+        BamIndex.load_key_index(self, mmap=mmap)
 
     def get_reads_iter_with_qname(self, qname):
         return BamIndex.get_reads_iter_with_key(self, qname)
@@ -1148,11 +1309,11 @@ class BamBCIndex(BamIndex):
     def __init__(self, file_name):
         return BamIndex.__init__(self, file_name, 'bxi', bc_key_func, bc_cmp_func)
 
-    def save_index(self):
-        BamIndex.save_key_index(self)
+    def save_index(self, binary=False):
+        BamIndex.save_key_index(self, binary=binary)
 
-    def load_index(self):
-        BamIndex.load_key_index(self)
+    def load_index(self, mmap=False):
+        BamIndex.load_key_index(self, mmap=mmap)
 
     def get_reads_bc_iter(self, bc):
         return BamIndex.get_reads_iter_with_key(self, bc)
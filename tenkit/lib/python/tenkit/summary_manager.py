@@ -118,7 +118,7 @@ class QuantileEstimator(SummaryStatistic):
         if x > self.max or self.max is None:
             self.max = x
 
-        if self.count > 0 and self.count % (2 * self.k) == 0:
+        if self.count % (2 * self.k) == 0 and len(self.buffer[0]) > 0:
             self.buffer[0].sort()
             self.buffer[1].sort()
             self.leaves_sorted = True
@@ -129,6 +129,50 @@ class QuantileEstimator(SummaryStatistic):
         self.buffer[index].append(x)
         self.count += 1
 
+    def add_many(self, values):
+        ''' Add an array of values. Leaves the estimator in exactly the state
+        that calling add() on each value in turn would, so the error bound is
+        unchanged. Full leaf blocks are sorted and collapsed with numpy. '''
+        values = np.asarray(values).ravel()
+        if len(values) == 0:
+            return
+
+        self.leaves_sorted = False
+
+        vmin = values.min().item()
+        vmax = values.max().item()
+        if vmin < self.min or self.min is None:
+            self.min = vmin
+        if vmax > self.max or self.max is None:
+            self.max = vmax
+
+        block = 2 * self.k
+        pos = 0
+        while pos < len(values):
+            # leaves are full (and were not already merged by the fast path)
+            if self.count % block == 0 and len(self.buffer[0]) > 0:
+                self.buffer[0].sort()
+                self.buffer[1].sort()
+                self.leaves_sorted = True
+                self.collapse_recursive(self.buffer[0], 1)
+
+            take = min(block - self.count % block, len(values) - pos)
+            chunk = values[pos:pos + take]
+            pos += take
+
+            if take == block and pos < len(values):
+                # This block fills both (empty) leaves and would be collapsed
+                # by the very next add, so merge it straight into level 2
+                self.count += take
+                self._push_level(np.sort(chunk)[1::2].tolist(), 2)
+                continue
+
+            chunk = chunk.tolist()
+            n0 = max(0, min(self.k - len(self.buffer[0]), take))
+            self.buffer[0].extend(chunk[:n0])
+            self.buffer[1].extend(chunk[n0:])
+            self.count += take
+
     # Slow implementation if a and b are already sorted... will speed up later
     # if an issue - HP
     def collapse(self, a, b):
@@ -162,6 +206,17 @@ class QuantileEstimator(SummaryStatistic):
 
         self.collapse_recursive(merged, level + 1)
 
+    # place a collapsed buffer at 'level', merging upwards if it is occupied
+    def _push_level(self, merged, level):
+        if level >= len(self.buffer):
+            self.buffer.append([])
+            self.b += 1
+
+        if len(self.buffer[level]) == 0:
+            self.buffer[level] = merged
+        else:
+            self.collapse_recursive(merged, level)
+
     @staticmethod
     def weight(level):
         if level == 0 or level == 1:
@@ -172,6 +227,29 @@ class QuantileEstimator(SummaryStatistic):
         res = MergedQuantileEstimator([self, other])
         return res
 
+    def to_dict(self):
+        ''' Serialize to a dict of scalars and one numpy array per level '''
+        return {
+            'epsilon': self.epsilon,
+            'n': self.n,
+            'b': self.b,
+            'k': self.k,
+            'count': self.count,
+            'min': self.min,
+            'max': self.max,
+            'buffer': [np.array(level) for level in self.buffer],
+        }
+
+    @staticmethod
+    def from_dict(d):
+        ''' Read from a dict '''
+        result = QuantileEstimator(d['epsilon'], d['n'], d['b'], d['k'])
+        result.count = d['count']
+        result.min = d['min']
+        result.max = d['max']
+        result.buffer = [np.asarray(level).tolist() for level in d['buffer']]
+        return result
+
     # should only be called when all buffers are full (except 0 and 1)
     def quantile(self, q):
         if self.count == 0:
@@ -280,6 +358,15 @@ class MergedQuantileEstimator(SummaryStatistic):
 
         return res
 
+    def to_dict(self):
+        ''' Serialize to a dict '''
+        return {'qes': [qe.to_dict() for qe in self.qes]}
+
+    @staticmethod
+    def from_dict(d):
+        ''' Read from a dict '''
+        return MergedQuantileEstimator([QuantileEstimator.from_dict(qe) for qe in d['qes']])
+
 
 class DiscreteDistribution(SummaryStatistic):
     def __init__(self, lower, upper):
@@ -324,6 +411,32 @@ class DiscreteDistribution(SummaryStatistic):
 
         return
 
+    def add_many(self, values):
+        ''' Add an array of integer values with a single bincount '''
+        values = np.asarray(values).ravel()
+        if len(values) == 0:
+            return
+        if values.dtype.kind not in 'iub':
+            raise Exception('DiscreteDistribution values must be integers')
+
+        lower_obs = values.min().item()
+        upper_obs = values.max().item()
+        self.check_range(lower_obs)
+        self.check_range(upper_obs)
+
+        self._prob = None
+        self._ecdf = None
+
+        self.hist += np.bincount(values - self.lower, minlength=len(self.hist))
+        self.count += len(values)
+
+        if lower_obs < self.lower_obs or self.lower_obs is None:
+            self.lower_obs = lower_obs
+        if upper_obs > self.upper_obs or self.upper_obs is None:
+            self.upper_obs = upper_obs
+
+        return
+
     def min(self):
         return self.lower_obs
 
@@ -398,6 +511,27 @@ class DiscreteDistribution(SummaryStatistic):
 
         return ret
 
+    def to_dict(self):
+        ''' Serialize to a dict '''
+        return {
+            'lower': self.lower,
+            'upper': self.upper,
+            'count': self.count,
+            'lower_obs': self.lower_obs,
+            'upper_obs': self.upper_obs,
+            'hist': self.hist,
+        }
+
+    @staticmethod
+    def from_dict(d):
+        ''' Read from a dict '''
+        result = DiscreteDistribution(d['lower'], d['upper'])
+        result.count = d['count']
+        result.lower_obs = d['lower_obs']
+        result.upper_obs = d['upper_obs']
+        result.hist[:] = d['hist']
+        return result
+
 class DictionaryDistribution(SummaryStatistic):
     def __init__(self):
         self.dict = {}
@@ -412,12 +546,53 @@ class DictionaryDistribution(SummaryStatistic):
 
         return self.dict[x]
 
+    # keys: array of keys
+    # vals: optional array of values, one per key (default 1 each)
+    def add_many(self, keys, vals = None):
+        if len(keys) == 0:
+            return
+
+        key_arr = np.asarray(keys)
+        if key_arr.ndim != 1 or key_arr.dtype.kind == 'O':
+            # not representable as a flat numpy array (e.g. tuple keys)
+            if vals is None:
+                vals = [1] * len(keys)
+            for x, val in zip(keys, vals):
+                self.add(x, val)
+            return
+        keys = key_arr
+
+        uniq, inverse = np.unique(keys, return_inverse=True)
+        if vals is None:
+            sums = np.bincount(inverse)
+        else:
+            vals = np.asarray(vals)
+            sums = np.bincount(inverse, weights=vals)
+            if vals.dtype.kind in 'iub':
+                sums = sums.astype(np.int64)
+
+        for x, val in zip(uniq.tolist(), sums.tolist()):
+            self.dict[x] = self.dict.get(x, 0) + val
+
+        return
+
     def combine(self, dd):
         res = DictionaryDistribution()
         res.dict = tk_dict.add_dicts(self.dict, dd.dict, 1)
 
         return res
 
+    def to_dict(self):
+        ''' Serialize to a dict '''
+        return {'dict': dict(self.dict)}
+
+    @staticmethod
+    def from_dict(d):
+        ''' Read from a dict '''
+        result = DictionaryDistribution()
+        result.dict = dict(d['dict'])
+        return result
+
     def get(self, k):
         return self.dict.get(k, 0)
 
@@ -541,6 +716,21 @@ class BasicSummary(SummaryStatistic):
 
         return res
 
+    def to_dict(self):
+        ''' Serialize to a dict '''
+        return dict(self.__dict__)
+
+    @staticmethod
+    def from_dict(d):
+        ''' Read from a dict '''
+        result = BasicSummary()
+        result.__dict__.update(d)
+        return result
+
+SUMMARY_TYPES = {cls.__name__: cls for cls in
+                 [QuantileEstimator, MergedQuantileEstimator, DiscreteDistribution,
+                  DictionaryDistribution, BasicSummary]}
+
 class SummaryManager:
     def __init__(self):
         self.summaries = {}
@@ -563,7 +753,7 @@ class SummaryManager:
     def save(self, fname):
         with open(fname, 'wb') as fhandle:
             #pickle.dump( self.summaries, fhandle )
-            pickle.dump( self, fhandle )
+            pickle.dump( self, fhandle, pickle.HIGHEST_PROTOCOL )
         return
 
     @staticmethod
@@ -587,6 +777,24 @@ class SummaryManager:
 
         return res
 
+    def to_dict(self):
+        ''' Serialize to a dict. Buffers and histograms are kept as numpy
+        arrays, so the result pickles compactly and can be rebuilt with
+        from_dict() and combined with summaries from other chunks. '''
+        summaries = {}
+        for name, summary in self.summaries.iteritems():
+            summaries[name] = (type(summary).__name__, summary.to_dict())
+        return {'summaries': summaries, 'attributes': dict(self.attributes)}
+
+    @staticmethod
+    def from_dict(d):
+        ''' Read from a dict '''
+        result = SummaryManager()
+        for name, (summary_type, summary_dict) in d['summaries'].iteritems():
+            result.summaries[name] = SUMMARY_TYPES[summary_type].from_dict(summary_dict)
+        result.attributes.update(d['attributes'])
+        return result
+
     def set_attrib(self, k, v):
         self.attributes[k] = v
 
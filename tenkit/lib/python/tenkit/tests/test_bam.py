@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2018 10X Genomics, Inc. All rights reserved.
+#
+# Unit tests for tenkit.bam
+#
+
+import os
+import shutil
+import tempfile
+import numpy as np
+import tenkit.test as tk_test
+import tenkit.bam as tk_bam
+
+def bisect_offset(key_offsets, cmp_func, key):
+    ''' Offset of key in a list of (key, offset) sorted by cmp_func, as found by the
+        binary search BamIndex used before get_offsets. None if the key is absent. '''
+    low, high = 0, len(key_offsets)
+    while low < high:
+        mid = (low + high) / 2
+        cmp_value = cmp_func(key_offsets[mid][0], key)
+        if cmp_value < 0:
+            low = mid + 1
+        elif cmp_value > 0:
+            high = mid
+        else:
+            return key_offsets[mid][1]
+    return None
+
+class TestBamIndex(tk_test.UnitTestBase):
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        self.bam_name = os.path.join(self.out_dir, 'reads.bam')
+
+        # Name-sorted as by samtools: read2 comes before read10, unlike byte order
+        rng = np.random.RandomState(0)
+        self.reads_per_key = [('read%d' % i, rng.randint(1, 5)) for i in xrange(1, 40)]
+        bam, tids = tk_bam.create_bam_outfile(self.bam_name, ['chr1'], [1000])
+        for key, num_reads in self.reads_per_key:
+            for j in xrange(num_reads):
+                tk_bam.write_read(bam, key, 'ACGT', 'IIII', tids['chr1'], j)
+        bam.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def make_index(self, suffix):
+        return tk_bam.BamIndex(self.bam_name, suffix, tk_bam.qname_key_func, tk_bam.qname_cmp_func)
+
+    def test_text_and_binary_indices(self):
+        text_index = self.make_index('txt_idx')
+        text_index.save_key_index()
+        binary_index = self.make_index('bin_idx')
+        binary_index.save_key_index(binary=True)
+
+        # An index written in the original text format, in BAM order
+        key_offsets = list(text_index.iter_key_offsets())
+        legacy_index = self.make_index('legacy_idx')
+        with open(legacy_index.index_file_name, 'w') as f:
+            for key, pos in key_offsets:
+                f.write('%s\t%d\n' % (key, pos))
+
+        text_index.load_key_index()
+        legacy_index.load_key_index()
+        binary_index.load_key_index()
+        mmap_index = self.make_index('bin_idx')
+        mmap_index.load_key_index(mmap=True)
+
+        for index in [legacy_index, binary_index, mmap_index]:
+            self.assertEqual(text_index.key_array.tolist(), index.key_array.tolist())
+            self.assertEqual(text_index.offset_array.tolist(), index.offset_array.tolist())
+        self.assertEqual(sorted(key for key, _ in self.reads_per_key), text_index.key_array.tolist())
+
+        keys = [key for key, _ in self.reads_per_key]
+        queries = [keys[0], keys[-1], keys[len(keys) / 2], 'read0', 'read100', 'read', 'reads', '', None, 'x' * 100]
+        expected = [bisect_offset(key_offsets, tk_bam.qname_cmp_func, key) for key in queries]
+        expected = [-1 if pos is None else pos for pos in expected]
+        for index in [text_index, legacy_index, binary_index, mmap_index]:
+            self.assertEqual(expected, index.get_offsets(queries).tolist())
+            self.assertEqual(expected[:3], index.get_offsets(queries[:3]).tolist())
+            self.assertEqual([], index.get_offsets([]).tolist())
+
+    def test_get_reads_iter_with_key(self):
+        index = self.make_index('bin_idx')
+        index.save_key_index(binary=True)
+        index.load_key_index(mmap=True)
+
+        for key, num_reads in [self.reads_per_key[0], self.reads_per_key[-1], self.reads_per_key[9]]:
+            reads = list(index.get_reads_iter_with_key(key))
+            self.assertEqual(num_reads, len(reads))
+            self.assertTrue(all(read.qname == key for read in reads))
+        self.assertEqual([], list(index.get_reads_iter_with_key('read0')))
+
+class TestMergeByRegion(tk_test.UnitTestBase):
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def write_sorted_bam(self, name, reads):
+        """ Write (qname, chrom, pos) reads, with chrom None for unmapped reads, sorted by position """
+        chroms = ['chr1', 'chr2', 'chr3']
+        bam_name = os.path.join(self.out_dir, name)
+        bam, tids = tk_bam.create_bam_outfile(bam_name, chroms, [1000] * len(chroms))
+        for qname, chrom, pos in sorted(reads, key=lambda r: (chrom_order(chroms, r[1]), r[2])):
+            tk_bam.write_read(bam, qname, 'ACGT', 'IIII', tids.get(chrom, -1), pos)
+        bam.close()
+        tk_bam.index(bam_name)
+        return bam_name
+
+    def read_bam(self, bam_name):
+        bam = tk_bam.create_bam_infile(bam_name)
+        reads = [(read.qname, read.tid, read.pos, read.is_unmapped) for read in bam]
+        bam.close()
+        return reads
+
+    def test_merge_by_region(self):
+        rng = np.random.RandomState(0)
+        input_bams = []
+        for i in xrange(3):
+            # No reads on chr3; unmapped reads in all but the last input
+            reads = [('r%d_%d' % (i, j), rng.choice(['chr1', 'chr2']), rng.randint(0, 996)) for j in xrange(50)]
+            if i < 2:
+                reads.extend(('u%d_%d' % (i, j), None, -1) for j in xrange(5))
+            input_bams.append(self.write_sorted_bam('in%d.bam' % i, reads))
+
+        expected_bam = os.path.join(self.out_dir, 'expected.bam')
+        tk_bam.merge(expected_bam, input_bams)
+        expected = self.read_bam(expected_bam)
+        self.assertEqual(160, len(expected))
+
+        for threads in [1, 3]:
+            merged_dir = os.path.join(self.out_dir, 'merged%d' % threads)
+            os.mkdir(merged_dir)
+            merged_bam = os.path.join(merged_dir, 'merged.bam')
+            tk_bam.merge_by_region(merged_bam, input_bams, threads)
+            self.assertEqual(expected, self.read_bam(merged_bam))
+            self.assertEqual(['merged.bam'], os.listdir(merged_dir))
+
+def chrom_order(chroms, chrom):
+    return chroms.index(chrom) if chrom in chroms else len(chroms)
+
+if __name__ == '__main__':
+    tk_test.run_tests()
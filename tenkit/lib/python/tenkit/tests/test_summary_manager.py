@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2018 10X Genomics, Inc. All rights reserved.
+#
+# Unit tests for tenkit.summary_manager
+#
+
+import cPickle as pickle
+import time
+import numpy as np
+import tenkit.test as tk_test
+import tenkit.summary_manager as tk_summary
+
+class TestSummaryManager(tk_test.UnitTestBase):
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+
+    def test_quantile_add_many_matches_add(self):
+        values = self.rng.randint(0, 1000, 10000)
+
+        for batch_size in [1, 7, 64, 10000]:
+            qe_add = tk_summary.QuantileEstimator(0.001, len(values))
+            qe_many = tk_summary.QuantileEstimator(0.001, len(values))
+            for x in values.tolist():
+                qe_add.add(x)
+            for i in xrange(0, len(values), batch_size):
+                qe_many.add_many(values[i:i+batch_size])
+
+            self.assertEqual(qe_add.count, qe_many.count)
+            self.assertEqual(qe_add.buffer, qe_many.buffer)
+            for q in [0.0, 0.1, 0.5, 0.9, 1.0]:
+                self.assertEqual(qe_add.quantile(q), qe_many.quantile(q))
+
+    def test_quantile_error_bound(self):
+        epsilon = 0.001
+        values = self.rng.normal(size=100000)
+        qe = tk_summary.QuantileEstimator(epsilon, len(values))
+        qe.add_many(values)
+
+        sorted_values = np.sort(values)
+        for q in [0.01, 0.25, 0.5, 0.75, 0.99]:
+            rank = np.searchsorted(sorted_values, qe.quantile(q), side='right')
+            self.assertTrue(abs(rank - q * len(values)) <= 2 * epsilon * len(values))
+
+    def test_discrete_add_many(self):
+        values = self.rng.randint(-5, 50, 10000)
+        dd_add = tk_summary.DiscreteDistribution(-5, 49)
+        dd_many = tk_summary.DiscreteDistribution(-5, 49)
+        for x in values.tolist():
+            dd_add.add(x)
+        dd_many.add_many(values[:5000])
+        dd_many.add_many(values[5000:])
+
+        self.assertTrue(np.array_equal(dd_add.hist, dd_many.hist))
+        self.assertEqual(dd_add.count, dd_many.count)
+        self.assertEqual(dd_add.min(), dd_many.min())
+        self.assertEqual(dd_add.max(), dd_many.max())
+        self.assertEqual(dd_add.quantile(0.5), dd_many.quantile(0.5))
+
+        with self.assertRaises(Exception):
+            dd_many.add_many([0, 50])
+
+    def test_dictionary_add_many(self):
+        keys = self.rng.choice(['AAAC', 'CGTA', 'TTTT', 'GACA'], 1000)
+        vals = self.rng.randint(0, 10, 1000)
+
+        dd_add = tk_summary.DictionaryDistribution()
+        dd_many = tk_summary.DictionaryDistribution()
+        for k, v in zip(keys.tolist(), vals.tolist()):
+            dd_add.add(k)
+            dd_add.add(k, v)
+        dd_many.add_many(keys)
+        dd_many.add_many(keys, vals)
+        self.assertEqual(dd_add.dict, dd_many.dict)
+
+        tuple_keys = [(k, v) for k, v in zip(keys.tolist(), vals.tolist())]
+        dd_add = tk_summary.DictionaryDistribution()
+        dd_many = tk_summary.DictionaryDistribution()
+        for k in tuple_keys:
+            dd_add.add(k)
+        dd_many.add_many(tuple_keys)
+        self.assertEqual(dd_add.dict, dd_many.dict)
+
+    def test_serialized_combine(self):
+        chunks = [self.rng.randint(0, 100, 5000) for i in xrange(4)]
+
+        merged = None
+        for chunk in chunks:
+            sm = tk_summary.SummaryManager()
+            sm.add_summarizer(tk_summary.QuantileEstimator(0.001, 20000), 'qe')
+            sm.add_summarizer(tk_summary.DiscreteDistribution(0, 99), 'dd')
+            sm.add_summarizer(tk_summary.DictionaryDistribution(), 'dict')
+            sm.add_summarizer(tk_summary.BasicSummary(), 'basic')
+            for name in ['qe', 'dd', 'dict']:
+                sm.get_summarizer(name).add_many(chunk)
+            for x in chunk.tolist():
+                sm.get_summarizer('basic').add(x)
+
+            sm = tk_summary.SummaryManager.from_dict(pickle.loads(pickle.dumps(sm.to_dict(), pickle.HIGHEST_PROTOCOL)))
+            merged = sm if merged is None else merged.combine(sm)
+
+        # round-trip the merged estimator too
+        merged = tk_summary.SummaryManager.from_dict(merged.to_dict())
+
+        all_values = np.concatenate(chunks)
+        self.assertEqual(merged.get_summarizer('dd').count, len(all_values))
+        self.assertTrue(np.array_equal(merged.get_summarizer('dd').hist, np.bincount(all_values, minlength=100)))
+        self.assertEqual(merged.get_summarizer('dict').dict, dict(enumerate(np.bincount(all_values).tolist())))
+        self.assertAlmostEqual(merged.get_summarizer('basic').mean(), all_values.mean())
+
+        sorted_values = np.sort(all_values)
+        median = merged.get_summarizer('qe').quantile(0.5)
+        rank = np.searchsorted(sorted_values, median, side='right')
+        self.assertTrue(abs(rank - 0.5 * len(all_values)) <= 2 * 0.001 * len(all_values) + np.sum(sorted_values == median))
+
+    def test_add_many_throughput(self):
+        ''' Compare add() against add_many() and report values/sec for both. '''
+        values = self.rng.normal(size=200000)
+        int_values = self.rng.randint(0, 1000, len(values))
+
+        def rate(f):
+            start = time.time()
+            f()
+            return len(values) / max(time.time() - start, 1e-6)
+
+        qe = tk_summary.QuantileEstimator(0.0001, len(values))
+        qe_add_rate = rate(lambda: [qe.add(x) for x in values.tolist()])
+        qe = tk_summary.QuantileEstimator(0.0001, len(values))
+        qe_many_rate = rate(lambda: qe.add_many(values))
+
+        dd = tk_summary.DiscreteDistribution(0, 999)
+        dd_add_rate = rate(lambda: [dd.add(x) for x in int_values.tolist()])
+        dd = tk_summary.DiscreteDistribution(0, 999)
+        dd_many_rate = rate(lambda: dd.add_many(int_values))
+
+        print "QuantileEstimator: add %.0f values/sec, add_many %.0f values/sec" % (qe_add_rate, qe_many_rate)
+        print "DiscreteDistribution: add %.0f values/sec, add_many %.0f values/sec" % (dd_add_rate, dd_many_rate)
+
+        self.assertTrue(qe_many_rate > qe_add_rate)
+        self.assertTrue(dd_many_rate > dd_add_rate)
+
+if __name__ == '__main__':
+    tk_test.run_tests()
@@ -152,11 +152,13 @@ class FindCommonBarcodes:
         index_counts = {}
 
         for fq in fastqs:
-            n = 0
-            for read in fq.read_fastq():
-                index_counts[read.seq] = index_counts.get(read.seq, 0) + 1
-                n += 1
-                if n > sample_size:
+            # Count the first sample_size + 1 reads of each file
+            reads_left = int(sample_size) + 1
+            for _, seqs, _ in read_fastq_blocks(fq.file, rc=fq.rc):
+                seqs = seqs[:reads_left]
+                count_sequences(seqs, index_counts)
+                reads_left -= len(seqs)
+                if reads_left <= 0:
                     break
 
         return index_counts
@@ -274,6 +276,234 @@ def process_fastq_chunk_no_demult(seq_iters, filenames, file_cache,
 
 
 
+# Reads per block in the block demultiplexer
+DEMULT_BLOCK_SIZE = 2**16
+
+# Longest index read that fits in a uint64 with 2 bits per base
+MAX_ENCODED_INDEX_LEN = 32
+
+NUC_TO_2BIT = numpy.full(256, 255, dtype=numpy.uint8)
+for _i, _nuc in enumerate('ACGT'):
+    NUC_TO_2BIT[ord(_nuc)] = _i
+
+def encode_2bit(seqs):
+    ''' Encode equal-length sequences as 2-bit packed uint64s.
+        Returns (codes, valid) where valid is False for sequences with non-ACGT bases. '''
+    n = len(seqs)
+    seq_len = len(seqs[0]) if n > 0 else 0
+    assert seq_len <= MAX_ENCODED_INDEX_LEN
+
+    bases = NUC_TO_2BIT[numpy.frombuffer(''.join(seqs), dtype=numpy.uint8).reshape(n, seq_len)]
+    valid = (bases != 255).all(axis=1)
+
+    codes = numpy.zeros(n, dtype=numpy.uint64)
+    for j in xrange(seq_len):
+        codes = (codes << numpy.uint64(2)) | bases[:, j].astype(numpy.uint64)
+    return codes, valid
+
+def decode_2bit(code, seq_len):
+    return ''.join('ACGT'[(code >> (2 * (seq_len - 1 - j))) & 3] for j in xrange(seq_len))
+
+def count_sequences(seqs, counts):
+    ''' Add the number of occurrences of each sequence to the counts dict. '''
+    for seq_len, idx in group_by_length(seqs):
+        group_seqs = seqs if len(idx) == len(seqs) else [seqs[i] for i in idx]
+        if seq_len > MAX_ENCODED_INDEX_LEN:
+            for seq in group_seqs:
+                counts[seq] = counts.get(seq, 0) + 1
+            continue
+
+        codes, valid = encode_2bit(group_seqs)
+        unique_codes, unique_counts = numpy.unique(codes[valid], return_counts=True)
+        for code, count in itertools.izip(unique_codes, unique_counts):
+            seq = decode_2bit(int(code), seq_len)
+            counts[seq] = counts.get(seq, 0) + int(count)
+
+        for i in numpy.flatnonzero(~valid):
+            counts[group_seqs[i]] = counts.get(group_seqs[i], 0) + 1
+
+def group_by_length(seqs):
+    ''' Return a list of (length, indices) for the sequences, with indices as numpy arrays. '''
+    lengths = numpy.fromiter(itertools.imap(len, seqs), dtype=numpy.int64, count=len(seqs))
+    if len(lengths) > 0 and (lengths == lengths[0]).all():
+        return [(int(lengths[0]), numpy.arange(len(seqs)))]
+    return [(int(l), numpy.flatnonzero(lengths == l)) for l in numpy.unique(lengths)]
+
+class SampleIndexLookup:
+    ''' Assign index reads to sample indices with a sorted table of 2-bit
+        encoded sequences. Index reads within max_mismatches of exactly one
+        sample index are assigned to it; exact matches always win.
+        Sequences that can't be encoded (non-ACGT, too long) only match exactly. '''
+
+    def __init__(self, sample_indices, max_mismatches=0):
+        assert max_mismatches in (0, 1)
+        self.sample_indices = list(sample_indices)
+        self.exact = {si: slot for slot, si in enumerate(self.sample_indices)}
+
+        # length -> (sorted codes, slots)
+        self.tables = {}
+        by_len = collections.defaultdict(list)
+        for slot, si in enumerate(self.sample_indices):
+            if len(si) <= MAX_ENCODED_INDEX_LEN and all(c in 'ACGT' for c in si):
+                by_len[len(si)].append((si, slot))
+
+        for seq_len, entries in by_len.iteritems():
+            exact_codes, _ = encode_2bit([si for si, _ in entries])
+            table = {}
+            for code, (_, slot) in itertools.izip(exact_codes, entries):
+                table[int(code)] = slot
+
+            if max_mismatches > 0:
+                neighbors = collections.defaultdict(set)
+                for code, (_, slot) in itertools.izip(exact_codes, entries):
+                    code = int(code)
+                    for pos in xrange(seq_len):
+                        shift = 2 * (seq_len - 1 - pos)
+                        base = (code >> shift) & 3
+                        for other in xrange(4):
+                            if other != base:
+                                neighbors[code ^ ((base ^ other) << shift)].add(slot)
+                for code, slots in neighbors.iteritems():
+                    # Drop ambiguous neighbours
+                    if code not in table and len(slots) == 1:
+                        table[code] = iter(slots).next()
+
+            codes = numpy.array(sorted(table.keys()), dtype=numpy.uint64)
+            slots = numpy.array([table[int(c)] for c in codes], dtype=numpy.int64)
+            self.tables[seq_len] = (codes, slots)
+
+    def lookup(self, seqs):
+        ''' Return the sample index slot of each sequence, or -1 for no match. '''
+        result = numpy.full(len(seqs), -1, dtype=numpy.int64)
+        if len(self.sample_indices) == 0:
+            return result
+
+        for seq_len, idx in group_by_length(seqs):
+            table = self.tables.get(seq_len)
+            if table is None or seq_len > MAX_ENCODED_INDEX_LEN:
+                # Can only match exactly
+                for i in idx:
+                    result[i] = self.exact.get(seqs[i], -1)
+                continue
+
+            group_seqs = seqs if len(idx) == len(seqs) else [seqs[i] for i in idx]
+            codes, valid = encode_2bit(group_seqs)
+
+            table_codes, table_slots = table
+            pos = numpy.searchsorted(table_codes, codes)
+            pos[pos == len(table_codes)] = 0
+            found = valid & (table_codes[pos] == codes)
+            group_result = numpy.where(found, table_slots[pos], -1)
+
+            # Non-ACGT reads can still be an exact match to a non-ACGT sample index
+            for i in numpy.flatnonzero(~valid):
+                group_result[i] = self.exact.get(group_seqs[i], -1)
+
+            result[idx] = group_result
+
+        return result
+
+def read_fastq_blocks(filename, rc=False, block_size=DEMULT_BLOCK_SIZE):
+    ''' Yield (headers, seqs, quals) lists of up to block_size records,
+        stripped and optionally reverse complemented as in FastqParser. '''
+    if filename[-2:] == "gz":
+        proc = martian.Popen(["gunzip", "--stdout", filename], stdout=subprocess.PIPE)
+        reader = proc.stdout
+    else:
+        reader = open(filename, "r")
+
+    while True:
+        lines = list(itertools.islice(reader, 4 * block_size))
+        # Drop a truncated last record, as FastqParser does
+        complete = len(lines) - len(lines) % 4
+        if complete == 0:
+            break
+        lines = lines[:complete]
+        headers = [x.strip() for x in lines[0::4]]
+        seqs = [x.strip() for x in lines[1::4]]
+        quals = [x.strip() for x in lines[3::4]]
+        if rc:
+            seqs = [tk_seq.get_rev_comp(x) for x in seqs]
+            quals = [x[::-1] for x in quals]
+        yield headers, seqs, quals
+        if complete < 4 * block_size:
+            break
+
+    reader.close()
+
+def format_fastq_records(headers, seqs, quals):
+    return ['%s\n%s\n+\n%s\n' % rec for rec in itertools.izip(headers, seqs, quals)]
+
+# Demultiplex a series of FASTQ files in blocks of reads.
+# The index file must be the first file.
+# Index reads are assigned to sample indices with a vectorized lookup on 2-bit
+# encoded sequences, then the records of each destination are written with one
+# write per output file and block.
+# Output is identical to process_fastq_chunk when max_mismatches is 0.
+# The stage only reaches this through main_demultiplex with demultiplex=False, i.e.
+# without sample indices; demultiplexing runs godemux (see main). The sample-index
+# assignment, including max_mismatches=1, is only exercised by the tests.
+def process_fastq_chunk_blocks(input_files, rc_flags, filenames, no_match_filenames, file_cache,
+    _interleave_map, summary_counts, max_mismatches=0, block_size=DEMULT_BLOCK_SIZE, max_reads=-1):
+
+    if _interleave_map is None:
+        interleave_map = range(len(input_files))
+    else:
+        interleave_map = _interleave_map
+
+    # Output slot -> list of input indices written to it, in input order
+    slot_inputs = collections.defaultdict(list)
+    for i, target_index in enumerate(interleave_map):
+        slot_inputs[target_index].append(i)
+    out_slots = sorted(slot_inputs.keys())
+
+    sample_indices = sorted(filenames.keys())
+    lookup = SampleIndexLookup(sample_indices, max_mismatches=max_mismatches)
+    dest_filenames = [filenames[si] for si in sample_indices] + [no_match_filenames]
+    no_match_dest = len(sample_indices)
+    dest_counts = numpy.zeros(len(dest_filenames), dtype=numpy.int64)
+
+    block_iters = [read_fastq_blocks(fn, rc=rc, block_size=block_size) for fn, rc in itertools.izip(input_files, rc_flags)]
+    n = 0
+
+    for blocks in itertools.izip(*block_iters):
+        num_reads = min(len(b[0]) for b in blocks)
+        if max_reads > 0:
+            num_reads = min(num_reads, max_reads - n)
+
+        dest = lookup.lookup(blocks[0][1][:num_reads])
+        dest[dest < 0] = no_match_dest
+        dest_counts += numpy.bincount(dest, minlength=len(dest_filenames))
+
+        records = [format_fastq_records(h[:num_reads], s[:num_reads], q[:num_reads]) for (h, s, q) in blocks]
+
+        # Group reads by destination, keeping input order within each destination
+        order = numpy.argsort(dest, kind='mergesort')
+        dests, starts = numpy.unique(dest[order], return_index=True)
+        ends = numpy.append(starts[1:], len(order))
+
+        for d, start, end in itertools.izip(dests, starts, ends):
+            read_idx = order[start:end].tolist()
+            target_filenames = dest_filenames[d]
+            for slot in out_slots:
+                inputs = slot_inputs[slot]
+                if len(inputs) == 1:
+                    recs = records[inputs[0]]
+                    buf = ''.join([recs[k] for k in read_idx])
+                else:
+                    buf = ''.join([records[i][k] for k in read_idx for i in inputs])
+                file_cache.get(target_filenames[slot]).write(buf)
+
+        n += num_reads
+        martian.log_info("Reads processed %i" % n)
+
+        if max_reads > 0 and n >= max_reads:
+            break
+
+    for si, count in itertools.izip(sample_indices, dest_counts[:no_match_dest]):
+        summary_counts[si] += int(count)
+    summary_counts[DEMULTIPLEX_INVALID_SAMPLE_INDEX] += int(dest_counts[no_match_dest])
+
 
 def groupby(f, items):
     groups = collections.defaultdict(list)
@@ -421,7 +651,8 @@ def main_demultiplex_go(args, outs):
     martian.check_call(subproc_args)
 
 # DEPRECATED
-# This code is only here for the case where demultiplex = False
+# This code is only here for the case where demultiplex = False;
+# the demultiplex branch below is not reached from main
 def main_demultiplex(args, outs):
 
     do_interleave = True
@@ -475,22 +706,21 @@ def main_demultiplex(args, outs):
                 f = "read-%s_si-%s_lane-%03d-chunk-%03d.fastq.gz" % (read, barcode, in_file.lane, args.chunk_number)
                 return os.path.join(path, f)
 
-            if args.rc_i2_read:
-                # For NextSeq we need to RC the I2 read
-                input_iters = [ FastqParser(f.filename, rc=(f.read == "I2")).read_fastq() for f in input_files ]
-            else:
-                input_iters = [ FastqParser(f.filename).read_fastq() for f in input_files ]
+            # For NextSeq we need to RC the I2 read
+            rc_flags = [ args.rc_i2_read and f.read == "I2" for f in input_files ]
+            input_filenames = [ f.filename for f in input_files ]
 
             martian.log_info("Demultiplexing from: %s" % input_files[0].filename)
 
             if demultiplex:
                 bc_files = { bc: [output_file(output_path, f, bc) for f in output_files] for bc in good_bcs }
                 err_files = [ output_file(output_path, f, "X") for f in output_files ]
-                process_fastq_chunk(input_iters, bc_files, err_files, file_cache, interleave_map, summary_counts)
+                process_fastq_chunk_blocks(input_filenames, rc_flags, bc_files, err_files, file_cache, interleave_map, summary_counts)
 
             else:
+                # With no sample indices every read goes to the 'X' files
                 out_files = [ output_file(output_path, f, 'X') for f in output_files ]
-                process_fastq_chunk_no_demult(input_iters, out_files, file_cache, interleave_map, summary_counts)
+                process_fastq_chunk_blocks(input_filenames, rc_flags, {}, out_files, file_cache, interleave_map, summary_counts)
 
         output_files = file_cache.have_opened
 
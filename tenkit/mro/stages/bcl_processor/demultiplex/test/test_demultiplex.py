@@ -3,10 +3,15 @@
 #
 # Test the demultiplexer
 
+import collections
 import subprocess
 import os
 import os.path
 import glob
+import random
+import shutil
+import time
+import tenkit.cache as tk_cache
 import tenkit.test as tk_test
 from tenkit.constants import TEST_FILE_IN_DIR, TEST_FILE_OUT_DIR
 from .. import *
@@ -153,3 +158,84 @@ class TestFunctions(tk_test.UnitTestBase):
         self.assertTrue(summary['invalid_count'] > 0)
         self.assertTrue(all([ x > 0 for x in summary['sample_index_counts'].values()]))
         self.assertEqual(summary['num_reads'], len(start_headers_r1))
+
+
+class TestBlockDemultiplex(tk_test.UnitTestBase):
+    ''' Compare the block demultiplexer against process_fastq_chunk on synthetic input
+        and report reads/sec for both. '''
+
+    num_reads = 200000
+
+    def setUp(self):
+        martian.test_initialize(outfile(""))
+        random.seed(0)
+
+        self.base_dir = outfile("block_demultiplex")
+        if os.path.exists(self.base_dir):
+            shutil.rmtree(self.base_dir)
+        os.makedirs(self.base_dir)
+
+        def random_seq(length):
+            return ''.join(random.choice('ACGT') for _ in xrange(length))
+
+        self.sample_indices = [random_seq(8) for _ in xrange(24)]
+        self.input_files = [os.path.join(self.base_dir, "input_%s.fastq" % rt) for rt in ("I1", "R1", "R2")]
+        with open(self.input_files[0], 'w') as i1, open(self.input_files[1], 'w') as r1, open(self.input_files[2], 'w') as r2:
+            for n in xrange(self.num_reads):
+                if random.random() < 0.8:
+                    si = random.choice(self.sample_indices)
+                elif random.random() < 0.5:
+                    si = 'N' + random_seq(7)
+                else:
+                    si = random_seq(8)
+                for f, seq in ((i1, si), (r1, random_seq(26)), (r2, random_seq(98))):
+                    f.write("@read%d\n%s\n+\n%s\n" % (n, seq, 'F' * len(seq)))
+
+    def run_demultiplexer(self, use_blocks):
+        out_path = os.path.join(self.base_dir, "blocks" if use_blocks else "reads")
+        os.makedirs(out_path)
+
+        # Interleave R1 and R2
+        interleave_map = [0, 1, 1]
+        bc_files = {bc: [os.path.join(out_path, "read-%s_si-%s.fastq" % (rt, bc)) for rt in ("I1", "RA")]
+                    for bc in self.sample_indices}
+        err_files = [os.path.join(out_path, "read-%s_si-X.fastq" % rt) for rt in ("I1", "RA")]
+        summary_counts = collections.defaultdict(int)
+
+        start = time.time()
+        with tk_cache.FileHandleCache(open_func=open) as file_cache:
+            if use_blocks:
+                process_fastq_chunk_blocks(self.input_files, [False] * 3, bc_files, err_files,
+                                           file_cache, interleave_map, summary_counts)
+            else:
+                input_iters = [FastqParser(fn).read_fastq() for fn in self.input_files]
+                process_fastq_chunk(input_iters, bc_files, err_files, file_cache, interleave_map, summary_counts)
+        elapsed = time.time() - start
+        print "%s: %.0f reads/sec" % ("process_fastq_chunk_blocks" if use_blocks else "process_fastq_chunk",
+                                      self.num_reads / elapsed)
+
+        return out_path, dict(summary_counts)
+
+    def test_block_demultiplex(self):
+        reads_path, reads_counts = self.run_demultiplexer(False)
+        blocks_path, blocks_counts = self.run_demultiplexer(True)
+
+        self.assertEqual(reads_counts, blocks_counts)
+        self.assertEqual(sorted(os.listdir(reads_path)), sorted(os.listdir(blocks_path)))
+        for fn in os.listdir(reads_path):
+            with open(os.path.join(reads_path, fn)) as f1, open(os.path.join(blocks_path, fn)) as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+    def test_index_counts(self):
+        index_seqs = [read.seq for read in FastqParser(self.input_files[0]).read_fastq()]
+        counts = {}
+        count_sequences(index_seqs, counts)
+        self.assertEqual(counts, dict(collections.Counter(index_seqs)))
+
+    def test_mismatch_lookup(self):
+        lookup = SampleIndexLookup(self.sample_indices, max_mismatches=1)
+        si = self.sample_indices[0]
+        mismatch = ('C' if si[0] != 'C' else 'G') + si[1:]
+        slots = lookup.lookup([si, mismatch, 'N' * 8, si[:4]])
+        self.assertEqual(list(slots[:2]), [0, 0])
+        self.assertEqual(list(slots[2:]), [-1, -1])
@@ -2,7 +2,8 @@
 #
 # Copyright (c) 2016 10X Genomics, Inc. All rights reserved.
 #
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from multiprocessing.pool import ThreadPool
 import martian
 import json
 import os
@@ -30,6 +31,7 @@ stage MAKE_QC_SUMMARY(
     in  string   software_version,
     in  string   bcl2fastq_version,
     in  string   bcl2fastq_args,
+    in  int      qc_threads,
     out json     qc_summary,
     out bool     completed,
     src py       "stages/make_fastqs/make_qc_summary",
@@ -57,6 +59,10 @@ ANALYZE_RUN_PD_SUMMARY_CS_KEY_MAP = {
 
 GEM_COUNT_THRESHOLD_ESTIMATE = 10
 
+# Number of FASTQs to QC concurrently in a chunk if qc_threads is not set.
+# Each job also runs a gunzip process.
+DEFAULT_QC_THREADS = 4
+
 class ReadQCStats(object):
     def __init__(self):
         """
@@ -225,10 +231,38 @@ def split(args):
     if len(chunk_dict) == 0:
         martian.exit("No FASTQs matched your sample sheet's lane, sample, and indexes. Please recheck your sample sheet.")
 
-    chunk_defs = [{'input_files': file_list, 'project': tup[0], 'lane': tup[1], 'sample': tup[2], 'subfolder': tup[3]} for tup, file_list in sorted(chunk_dict.items())]
+    chunk_defs = [{'input_files': file_list, 'project': tup[0], 'lane': tup[1], 'sample': tup[2], 'subfolder': tup[3],
+                   '__threads': get_qc_threads(args, len(file_list))} for tup, file_list in sorted(chunk_dict.items())]
     return { 'chunks': chunk_defs }
 
 
+def get_qc_threads(args, num_files):
+    qc_threads = args.qc_threads if args.qc_threads else DEFAULT_QC_THREADS
+    return max(1, min(qc_threads, num_files))
+
+
+def run_fastq_qc(job):
+    """
+    Run fastqqc on a single FASTQ, computing barcode QC and/or Q30 counts in one pass.
+    """
+    subproc_args = ['fastqqc', job['filename']]
+    if job['barcode_json']:
+        subproc_args.extend(['--barcode-json', job['barcode_json'],
+                             '--whitelist', job['whitelist'],
+                             '--bc-start-index', str(job['bc_start_index']),
+                             '--bc-length', str(job['bc_length'])])
+        if job['rc']:
+            subproc_args.append('--rc')
+    if job['q30_json']:
+        subproc_args.extend(['--q30-json', job['q30_json'],
+                             '--read-start-index', str(job['read_start_index'])])
+    try:
+        tk_proc.check_call(subproc_args)
+    except subprocess.CalledProcessError, e:
+        return "Could not QC FASTQ %s: return code %s" % (job['filename'], e.returncode)
+    return None
+
+
 def main(args, outs):
     if not args.run_qc:
         return
@@ -239,6 +273,8 @@ def main(args, outs):
 
     bc_file_type = args.file_read_types_map[args.bc_read_type]
     barcode_files = [f for f in file_infos if f.read == bc_file_type]
+    r1_files = [f for f in file_infos if args.file_read_types_map['R1'] == f.read]
+    r2_files = [f for f in file_infos if args.file_read_types_map['R2'] == f.read]
 
     # Note: this is Martian 3 incompatible; revert back to summary_chunk if merging
     # back into master (also applies to additional references to `qc_summary` in the main function)
@@ -249,52 +285,61 @@ def main(args, outs):
         'read1': [],
         'read2': []
     }
+
+    # One QC job per FASTQ, so that a file holding both the barcode and R1 or R2
+    # is only decompressed once.
+    jobs = OrderedDict()
+    def get_job(fastq_file):
+        if fastq_file.filename not in jobs:
+            jobs[fastq_file.filename] = {
+                'filename': fastq_file.filename,
+                'barcode_json': None,
+                'q30_json': None,
+            }
+        return jobs[fastq_file.filename]
+
     for idx, bf in enumerate(barcode_files):
         output_json_path = os.path.join(out_base, "output_%d_BC.json" % idx)
-        subproc_args = [ 'barcodeqc', bf.filename, output_json_path, "--whitelist", whitelist_path,
-                         "--bc-start-index", str(args.bc_start_index), "--bc-length",
-                         str(args.bc_length)]
-        if args.bc_read_type == "I2" and args.rc_i2_read:
-            subproc_args.append("--rc")
-        try:
-            tk_proc.check_call(subproc_args)
-        except subprocess.CalledProcessError, e:
-            martian.throw("Could not QC barcodes: return code %s" % e.returncode)
+        get_job(bf).update({
+            'barcode_json': output_json_path,
+            'whitelist': whitelist_path,
+            'bc_start_index': args.bc_start_index,
+            'bc_length': args.bc_length,
+            'rc': args.bc_read_type == "I2" and args.rc_i2_read,
+        })
 
         # needs to be summary_chunk in Martian 3
         outs.qc_summary['barcode'].append(output_json_path)
 
-    r1_files = [f for f in file_infos if args.file_read_types_map['R1'] == f.read]
-    for idx, r1f in enumerate(r1_files):
-        output_json_path = os.path.join(out_base, "output_%d_R1.json" % idx)
-        if bc_file_type == 'R1':
-            start_index = args.bc_start_index
-        else:
-            start_index = 0
-        subproc_args = [ 'q30count', r1f.filename, output_json_path, '--read-start-index', str(start_index) ]
-        try:
-            tk_proc.check_call(subproc_args)
-        except subprocess.CalledProcessError, e:
-            martian.throw("Could not count Q30 reads on R1: return code %s" % e.returncode)
+    for read_type, read_files in (('R1', r1_files), ('R2', r2_files)):
+        summary_key = 'read1' if read_type == 'R1' else 'read2'
+        for idx, rf in enumerate(read_files):
+            output_json_path = os.path.join(out_base, "output_%d_%s.json" % (idx, read_type))
+            if bc_file_type == read_type:
+                start_index = args.bc_start_index
+            else:
+                start_index = 0
+            get_job(rf).update({
+                'q30_json': output_json_path,
+                'read_start_index': start_index,
+            })
 
-        # needs to be summary_chunk in Martian 3
-        outs.qc_summary['read1'].append(output_json_path)
+            # needs to be summary_chunk in Martian 3
+            outs.qc_summary[summary_key].append(output_json_path)
 
-    r2_files = [f for f in file_infos if args.file_read_types_map['R2'] == f.read]
-    for idx, r2f in enumerate(r2_files):
-        output_json_path = os.path.join(out_base, "output_%d_R2.json" % idx)
-        if bc_file_type == 'R2':
-            start_index = args.bc_start_index
-        else:
-            start_index = 0
-        subproc_args = ['q30count', r2f.filename, output_json_path, '--read-start-index', str(start_index)]
-        try:
-            tk_proc.check_call(subproc_args)
-        except subprocess.CalledProcessError, e:
-            martian.throw("Could not count Q30 reads on R2: return code %s" % e.returncode)
+    if not jobs:
+        return
 
-        # needs to be summary_chunk in Martian 3
-        outs.qc_summary['read2'].append(output_json_path)
+    pool = ThreadPool(get_qc_threads(args, len(jobs)))
+    try:
+        errors = pool.map(run_fastq_qc, jobs.values())
+    finally:
+        pool.close()
+        pool.join()
+
+    for error in errors:
+        if error is not None:
+            martian.throw(error)
 
 
 def join(args, outs, chunk_args, chunk_outs):